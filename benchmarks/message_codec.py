@@ -0,0 +1,63 @@
+"""
+Benchmark message encoding, decoding and copying.
+"""
+
+import sys
+import time
+
+from vumi.message import TransportUserMessage, TransportEvent
+
+
+def make_user_message():
+    return TransportUserMessage(
+        to_addr="+27831234567",
+        from_addr="*120*1234#",
+        transport_name="dummy_transport",
+        transport_type="ussd",
+        content="Hello, this is a benchmark message.",
+        session_event=TransportUserMessage.SESSION_RESUME,
+        helper_metadata={
+            "tag": {"tag": ["pool", "tag1"]},
+            "go": {"conversation_key": "abc123", "user_account": "def456"},
+        },
+        transport_metadata={"session_id": "12345", "provider": "MNO"},
+    )
+
+
+def make_event():
+    return TransportEvent(
+        event_type="delivery_report",
+        user_message_id=TransportUserMessage.generate_id(),
+        sent_message_id="remote-id",
+        delivery_status="delivered",
+        transport_name="dummy_transport",
+        helper_metadata={"tag": {"tag": ["pool", "tag1"]}},
+    )
+
+
+def bench(name, func, loops):
+    start = time.time()
+    for _ in xrange(loops):
+        func()
+    elapsed = time.time() - start
+    print "  %-8s %10.0f msgs/sec" % (name, loops / elapsed)
+
+
+def run_bench(loops):
+    for msg in [make_user_message(), make_event()]:
+        msg_class = type(msg)
+        msg_json = msg.to_json()
+        print "%s (%d bytes, %d loops):" % (
+            msg_class.__name__, len(msg_json), loops)
+        bench("encode", msg.to_json, loops)
+        bench("decode", lambda: msg_class.from_json(msg_json), loops)
+        bench("copy", msg.copy, loops)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args:
+        loops = int(args[0])
+    else:
+        loops = 20000
+    run_bench(loops)
@@ -0,0 +1,153 @@
+"""
+Benchmark message store cache reconciliation.
+
+Riak is replaced by an in-memory stand-in that serves index pages after a
+configurable delay, and Redis by an asynchronous FakeRedis, so this measures
+how well recon overlaps its round trips rather than raw backend speed.
+"""
+
+import sys
+import time
+from datetime import datetime, timedelta
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, succeed
+from twisted.internet.task import deferLater
+
+from vumi.components.message_store import MessageStore
+from vumi.components.message_store_cache import MessageStoreCache
+from vumi.message import format_vumi_date
+from vumi.persist.txredis_manager import TxRedisManager
+from vumi.persist.txriak_manager import TxRiakManager
+from vumi.utils import LRUCache
+
+
+class FakeIndexPage(object):
+    """
+    An index page over a list of already formatted index rows.
+    """
+
+    def __init__(self, rows, page_size, latency, offset=0):
+        self._rows = rows
+        self._page_size = page_size
+        self._latency = latency
+        self._offset = offset
+
+    def __iter__(self):
+        return iter(self._rows[self._offset:self._offset + self._page_size])
+
+    def has_next_page(self):
+        return self._offset + self._page_size < len(self._rows)
+
+    def next_page(self):
+        if not self.has_next_page():
+            return succeed(None)
+        return deferLater(
+            reactor, self._latency, FakeIndexPage, self._rows,
+            self._page_size, self._latency, self._offset + self._page_size)
+
+
+class FakeRiakManager(TxRiakManager):
+    """
+    Just enough of a Riak manager to make the message store run recon
+    asynchronously.
+    """
+
+    def __init__(self):
+        pass
+
+
+class BenchMessageStore(MessageStore):
+
+    def __init__(self, redis, outbound, inbound, events, page_size, latency):
+        self.manager = FakeRiakManager()
+        self.cache = MessageStoreCache(redis)
+        self.tag_cache = LRUCache(0)
+        self.batch_cache = LRUCache(0)
+        self._outbound = outbound
+        self._inbound = inbound
+        self._events = events
+        self._page_size = page_size
+        self._latency = latency
+
+    def _page(self, rows, start):
+        if start is not None:
+            rows = [row for row in rows if row[1] >= start]
+        return deferLater(
+            reactor, self._latency, FakeIndexPage, rows, self._page_size,
+            self._latency)
+
+    def batch_outbound_keys_with_addresses(self, batch_id, max_results=None,
+                                           start=None, end=None):
+        return self._page(self._outbound, start)
+
+    def batch_inbound_keys_with_addresses(self, batch_id, max_results=None,
+                                          start=None, end=None):
+        return self._page(self._inbound, start)
+
+    def message_event_keys_with_statuses(self, msg_id, max_results=None):
+        return self._page(self._events.get(msg_id, []), None)
+
+
+def make_rows(prefix, count, now):
+    return [
+        (u"%s-%d" % (prefix, i),
+         format_vumi_date(now - timedelta(seconds=count - i)),
+         u"addr-%d" % (i % 100,))
+        for i in xrange(count)]
+
+
+def make_events(outbound):
+    events = {}
+    for key, timestamp, _addr in outbound:
+        events[key] = [
+            (key + u"-ack", timestamp, u"ack"),
+            (key + u"-dr", timestamp, u"delivery_report.delivered"),
+        ]
+    return events
+
+
+@inlineCallbacks
+def run_bench(messages, page_size, latency, concurrency):
+    now = datetime.utcnow()
+    outbound = make_rows(u"out", messages, now)
+    inbound = make_rows(u"in", messages, now)
+    events = make_events(outbound)
+
+    redis = yield TxRedisManager.from_config({
+        'FAKE_REDIS': 'yes',
+        'key_prefix': 'recon_bench',
+    })
+    store = BenchMessageStore(
+        redis, outbound, inbound, events, page_size, latency)
+    store.RECON_CONCURRENCY = concurrency
+    # Keep the cached key sets small so most keys take the bulk path.
+    store.cache.TRUNCATE_MESSAGE_KEY_COUNT_AT = page_size
+
+    start = time.time()
+    yield store.reconcile_cache(u"batch", format_vumi_date(now))
+    elapsed = time.time() - start
+
+    status = yield store.cache.get_event_status(u"batch")
+    outbound_count = yield store.cache.count_outbound_message_keys(u"batch")
+    inbound_count = yield store.cache.count_inbound_message_keys(u"batch")
+    print "concurrency %3d: %.2fs (outbound=%d inbound=%d ack=%d)" % (
+        concurrency, elapsed, outbound_count, inbound_count, status['ack'])
+    yield redis.close_manager()
+
+
+@inlineCallbacks
+def main(messages, page_size, latency):
+    try:
+        for concurrency in (1, 10, 50):
+            yield run_bench(messages, page_size, latency, concurrency)
+    finally:
+        reactor.stop()
+
+
+if __name__ == "__main__":
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    page_size = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    latency = float(sys.argv[3]) if len(sys.argv) > 3 else 0.005
+    reactor.callWhenRunning(main, messages, page_size, latency)
+    reactor.run()
@@ -0,0 +1,44 @@
+"""
+Benchmark setting and publishing metric values with and without
+pre-aggregation in the metric manager.
+
+Reports the time taken to set and poll the values and the size of the JSON
+encoded metric message that would be published for them.
+"""
+
+import json
+import random
+import sys
+import time
+
+from vumi.blinkenlights.message20110818 import MetricMessage
+from vumi.blinkenlights.metrics import (
+    MetricManager, Metric, AVG, MAX, P95, P99)
+
+
+def run_bench(values, pre_aggregate):
+    manager = MetricManager("bench.", pre_aggregate=pre_aggregate)
+    metric = manager.register(
+        Metric("latency", [AVG, MAX, P95, P99]))
+
+    start = time.time()
+    for value in values:
+        metric.set(value)
+    msg = MetricMessage()
+    manager._collect_polled_metrics(msg)
+    elapsed = time.time() - start
+
+    size = len(json.dumps(msg.to_dict()))
+    print "pre_aggregate=%-5s: %.3fs, %d bytes published" % (
+        pre_aggregate, elapsed, size)
+
+
+def main(count):
+    values = [random.lognormvariate(0, 1) for _ in xrange(count)]
+    run_bench(values, False)
+    run_bench(values, True)
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    main(count)
@@ -0,0 +1,155 @@
+"""
+Benchmark the metrics aggregation pipeline.
+
+A RandomMetricsGenerator that sets a configurable number of values every
+tick feeds MetricTimeBucket workers, which feed MetricAggregator workers,
+which feed a collector stand-in that records how long after the end of
+each time bucket its aggregates arrive. Everything runs in one process
+over a fake AMQP broker, so the throughput reported is the rate one
+reactor thread can push datapoints through the whole pipeline while still
+keeping up.
+"""
+
+import random
+import sys
+import time
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.task import LoopingCall, deferLater
+
+from vumi.blinkenlights.metrics import Metric, AVG, MAX
+from vumi.blinkenlights.metrics_workers import (
+    RandomMetricsGenerator, MetricTimeBucket, MetricAggregator,
+    MetricsCollectorWorker)
+from vumi.tests.fake_amqp import FakeAMQPBroker
+from vumi.tests.helpers import WorkerHelper
+
+BUCKET_SIZE = 1
+LAG = 1.0
+
+
+class LoadGenerator(RandomMetricsGenerator):
+    """
+    Sets `values_per_tick` values on each of `metrics` metrics every
+    generator period.
+    """
+
+    load_metrics = ()
+    datapoints = 0
+
+    @inlineCallbacks
+    def startWorker(self):
+        yield super(LoadGenerator, self).startWorker()
+        self.load_metrics = [
+            self.mm.register(Metric("load.%d" % i, [AVG, MAX]))
+            for i in xrange(self.config["metrics"])]
+
+    def run(self):
+        for metric in self.load_metrics:
+            for _ in xrange(self.config["values_per_tick"]):
+                metric.set(random.random())
+        self.datapoints += (
+            len(self.load_metrics) * self.config["values_per_tick"])
+
+
+class CountingAggregator(MetricAggregator):
+
+    datapoints = 0
+
+    def consume_metric(self, metric_name, aggregates, values):
+        self.datapoints += len(values)
+        return super(CountingAggregator, self).consume_metric(
+            metric_name, aggregates, values)
+
+
+class LagCollector(MetricsCollectorWorker):
+
+    def setup_worker(self):
+        self.lags = []
+
+    def consume_metrics(self, metric_name, values):
+        now = time.time()
+        for timestamp, _value in values:
+            self.lags.append(now - (timestamp + BUCKET_SIZE))
+
+
+@inlineCallbacks
+def start_worker(broker, worker_class, config):
+    worker = WorkerHelper.get_worker_raw(worker_class, config, broker)
+    yield worker.startWorker()
+    returnValue(worker)
+
+
+def deferred_sleep(seconds):
+    return deferLater(reactor, seconds, lambda: None)
+
+
+def clear_dispatched(broker):
+    # The fake broker keeps a copy of everything published.
+    for exchange in broker.dispatched.keys():
+        broker.clear_messages(exchange)
+
+
+@inlineCallbacks
+def run_bench(metrics, values_per_tick, buckets, duration):
+    broker = FakeAMQPBroker()
+    collector = yield start_worker(broker, LagCollector, {})
+    aggregators = []
+    for bucket in xrange(buckets):
+        aggregator = yield start_worker(broker, CountingAggregator, {
+            "bucket": bucket, "bucket_size": BUCKET_SIZE, "lag": LAG})
+        aggregators.append(aggregator)
+    time_buckets = []
+    for _ in xrange(2):
+        time_bucket = yield start_worker(broker, MetricTimeBucket, {
+            "buckets": buckets, "bucket_size": BUCKET_SIZE})
+        time_buckets.append(time_bucket)
+    generator = yield start_worker(broker, LoadGenerator, {
+        "manager_period": 0.5,
+        "generator_period": 0.1,
+        "metrics": metrics,
+        "values_per_tick": values_per_tick,
+    })
+    cleaner = LoopingCall(clear_dispatched, broker)
+    cleaner.start(1.0)
+
+    start = time.time()
+    yield deferred_sleep(duration)
+    generator.stopWorker()
+    generated = generator.datapoints
+    # Give the last buckets time to be aggregated.
+    yield deferred_sleep(BUCKET_SIZE + LAG + 1)
+    elapsed = time.time() - start
+    cleaner.stop()
+
+    aggregated = sum(a.datapoints for a in aggregators)
+    lags = sorted(collector.lags)
+    print "%d metrics x %d values/tick:" % (metrics, values_per_tick)
+    print "  generated  %d datapoints (%.0f/min)" % (
+        generated, generated * 60.0 / duration)
+    print "  aggregated %d datapoints in %.1fs" % (aggregated, elapsed)
+    if lags:
+        print "  aggregate lag: p50 %.2fs, max %.2fs (%d aggregates)" % (
+            lags[len(lags) / 2], lags[-1], len(lags))
+
+    for aggregator in aggregators:
+        aggregator.stopWorker()
+    yield broker.wait_delivery()
+
+
+@inlineCallbacks
+def main(metrics, values_per_tick, buckets, duration):
+    try:
+        yield run_bench(metrics, values_per_tick, buckets, duration)
+    finally:
+        reactor.stop()
+
+
+if __name__ == "__main__":
+    metrics = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    values_per_tick = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    buckets = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+    duration = float(sys.argv[4]) if len(sys.argv) > 4 else 10.0
+    reactor.callWhenRunning(main, metrics, values_per_tick, buckets, duration)
+    reactor.run()
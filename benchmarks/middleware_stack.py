@@ -0,0 +1,74 @@
+"""
+Benchmark the per-message overhead of middleware stacks.
+
+Messages are passed through stacks of 1 to 10 synchronous middlewares, both
+with the current MiddlewareStack and with the previous implementation that
+ran every handler through inlineCallbacks.
+"""
+
+import sys
+import time
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+from vumi.middleware.base import MiddlewareStack, MiddlewareError
+from vumi.middleware.provider_setter import StaticProviderSettingMiddleware
+from vumi.tests.helpers import MessageHelper
+
+
+class SequentialMiddlewareStack(MiddlewareStack):
+    """
+    The middleware stack as it was before handler chains were compiled.
+    """
+
+    @inlineCallbacks
+    def _handle_sequential(self, middlewares, handler_name, message,
+                           connector_name):
+        method_name = 'handle_%s' % (handler_name,)
+        for middleware in middlewares:
+            handler = getattr(middleware, method_name)
+            message = yield handler(message, connector_name)
+            if message is None:
+                raise MiddlewareError(
+                    'Returned value of %s.%s should never be None' % (
+                        middleware, method_name,))
+        returnValue(message)
+
+    def apply_consume(self, handler_name, message, connector_name):
+        return self._handle_sequential(
+            self.consume_middlewares, 'consume_%s' % (handler_name,),
+            message, connector_name)
+
+
+def make_stack(stack_class, size):
+    middlewares = []
+    for i in range(size):
+        mw = StaticProviderSettingMiddleware(
+            "mw%d" % (i,), {"provider": "provider%d" % (i,)}, None)
+        mw.setup_middleware()
+        middlewares.append(mw)
+    return stack_class(middlewares)
+
+
+def run_bench(stack_class, size, msgs):
+    stack = make_stack(stack_class, size)
+    start = time.time()
+    for msg in msgs:
+        stack.apply_consume("inbound", msg, "sms")
+    elapsed = time.time() - start
+    return elapsed / len(msgs) * 1e6
+
+
+def main(count):
+    msg_helper = MessageHelper()
+    msgs = [msg_helper.make_inbound("hello") for _ in xrange(count)]
+    print "middlewares  sequential (us/msg)  compiled (us/msg)"
+    for size in range(1, 11):
+        sequential = run_bench(SequentialMiddlewareStack, size, msgs)
+        compiled = run_bench(MiddlewareStack, size, msgs)
+        print "%11d  %19.2f  %17.2f" % (size, sequential, compiled)
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    main(count)
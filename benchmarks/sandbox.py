@@ -1,5 +1,6 @@
 """
-Benchmark sandbox message processing round trip.
+Benchmark sandbox message processing round trip, both with a new sandbox
+process for each message and with a pool of long-lived sandbox processes.
 """
 
 import sys
@@ -77,13 +78,10 @@ class Timer(object):
 
 
 @inlineCallbacks
-def run_bench(loops):
-    opts = VumiOptions()
-    opts.postOptions()
-    worker_creator = WorkerCreator(opts.vumi_options)
-
+def run_mode(worker_creator, transport, loops, pooled):
     app = worker_creator.create_worker_by_class(BenchApp, {
         "transport_name": "dummy",
+        "pooled": pooled,
         "javascript": """
             api.on_inbound_message = function(command) {
                 this.request('outbound.reply_to', {
@@ -105,19 +103,12 @@ def run_bench(loops):
         },
     })
 
-    transport = worker_creator.create_worker_by_class(BenchTransport, {
-        "transport_name": "dummy",
-    })
-
-    yield transport.startService()
-    log.msg("Waiting for transport ...")
-    yield BenchTransport.WORKER_QUEUE.get()
-
     yield app.startService()
     log.msg("Waiting for worker ...")
     yield BenchApp.WORKER_QUEUE.get()
 
-    print "Starting %d loops ..." % (loops,)
+    print "Starting %d %s loops ..." % (
+        loops, "pooled" if pooled else "unpooled")
     timer = Timer()
     for i in range(loops):
         with timer:
@@ -135,8 +126,27 @@ def run_bench(loops):
     print "  max: %g, min: %g" % (timer.max(), timer.min())
     print "  loops: %d" % timer.loops()
 
-    yield transport.stopService()
     yield app.stopService()
+
+
+@inlineCallbacks
+def run_bench(loops):
+    opts = VumiOptions()
+    opts.postOptions()
+    worker_creator = WorkerCreator(opts.vumi_options)
+
+    transport = worker_creator.create_worker_by_class(BenchTransport, {
+        "transport_name": "dummy",
+    })
+
+    yield transport.startService()
+    log.msg("Waiting for transport ...")
+    yield BenchTransport.WORKER_QUEUE.get()
+
+    for pooled in (False, True):
+        yield run_mode(worker_creator, transport, loops, pooled)
+
+    yield transport.stopService()
     reactor.stop()
 
 
@@ -0,0 +1,105 @@
+"""
+Benchmark framing of PDUs received by EsmeProtocol.
+
+Large bursts of deliver_sm PDU bytes are fed to EsmeProtocol.dataReceived in
+reads of a fixed size, and compared with the previous approach of appending
+to a string buffer and chopping one PDU off the front at a time.
+
+Decoding PDUs usually costs far more than framing them, so results are
+reported both with PDU decoding and with decoding stubbed out.
+"""
+
+import sys
+import time
+
+from smpp.pdu import unpack_pdu
+from smpp.pdu_builder import DeliverSM
+
+from vumi.transports.smpp import protocol
+from vumi.transports.smpp.pdu_utils import chop_pdu_stream
+from vumi.transports.smpp.protocol import EsmeProtocol
+
+
+class BenchConfig(object):
+    smpp_enquire_link_interval = 55
+
+
+class BenchService(object):
+    log = None
+    clock = None
+    deliver_sm_processor = None
+    dr_processor = None
+    sequence_generator = None
+
+    def get_config(self):
+        return BenchConfig()
+
+
+class BenchProtocol(EsmeProtocol):
+
+    def __init__(self):
+        EsmeProtocol.__init__(self, BenchService(), 'TRX')
+        self.pdus = 0
+
+    def on_pdu(self, pdu):
+        self.pdus += 1
+
+
+class ChoppingBenchProtocol(BenchProtocol):
+    """
+    The string buffer framing EsmeProtocol used to do.
+    """
+
+    def __init__(self):
+        BenchProtocol.__init__(self)
+        self.buffer = b''
+
+    def dataReceived(self, data):
+        self.buffer += data
+        pdu_found = chop_pdu_stream(self.buffer)
+        while pdu_found is not None:
+            data, self.buffer = pdu_found
+            self.on_pdu(protocol.unpack_pdu(data))
+            pdu_found = chop_pdu_stream(self.buffer)
+
+
+def make_burst(pdus):
+    return ''.join(
+        DeliverSM(i + 1, short_message='message %d' % (i,)).get_bin()
+        for i in xrange(pdus))
+
+
+def run_bench(protocol_class, burst, read_size, pdus):
+    esme = protocol_class()
+    start = time.time()
+    for offset in xrange(0, len(burst), read_size):
+        esme.dataReceived(burst[offset:offset + read_size])
+    elapsed = time.time() - start
+    assert esme.pdus == pdus
+    return pdus / elapsed
+
+
+def run_benches(burst, read_sizes, pdus):
+    for read_size in read_sizes:
+        chopping = run_bench(ChoppingBenchProtocol, burst, read_size, pdus)
+        framing = run_bench(BenchProtocol, burst, read_size, pdus)
+        print "  read size %7d: chopping %8.0f, framing %8.0f PDUs/sec" % (
+            read_size, chopping, framing)
+
+
+def main(pdus, read_sizes):
+    burst = make_burst(pdus)
+    print "%d PDUs, %d bytes" % (pdus, len(burst))
+    print "With decoding:"
+    run_benches(burst, read_sizes, pdus)
+    print "Without decoding:"
+    protocol.unpack_pdu = lambda data: data
+    try:
+        run_benches(burst, read_sizes, pdus)
+    finally:
+        protocol.unpack_pdu = unpack_pdu
+
+
+if __name__ == "__main__":
+    pdus = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    main(pdus, [4096, 65536, 1024 * 1024])
@@ -0,0 +1,89 @@
+"""
+Benchmark SMPP sequence number allocation.
+
+Redis is replaced by an asynchronous FakeRedis with an artificial round trip
+delay, so this measures how many Redis round trips each sequence generator
+puts in front of every PDU rather than raw Redis speed.
+"""
+
+import sys
+import time
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, gatherResults
+from twisted.internet.task import deferLater
+
+from vumi.persist.txredis_manager import TxRedisManager
+from vumi.transports.smpp.sequence import RedisSequence, BlockRedisSequence
+
+
+class SlowRedis(object):
+    """
+    Wraps a Redis manager and delays the result of every call.
+    """
+
+    def __init__(self, redis, latency):
+        self._redis = redis
+        self._latency = latency
+
+    def __getattr__(self, name):
+        func = getattr(self._redis, name)
+
+        def slow_call(*args, **kw):
+            d = func(*args, **kw)
+            return d.addCallback(
+                lambda r: deferLater(reactor, self._latency, lambda: r))
+        return slow_call
+
+
+@inlineCallbacks
+def allocate(sequence_generator, pdus, concurrency):
+    """
+    Allocate ``pdus`` sequence numbers from ``concurrency`` concurrent
+    senders.
+    """
+    @inlineCallbacks
+    def run_sender(count):
+        for _ in xrange(count):
+            yield sequence_generator.next()
+
+    yield gatherResults([
+        run_sender(pdus // concurrency) for _ in xrange(concurrency)])
+
+
+@inlineCallbacks
+def run_bench(name, make_generator, pdus, concurrency, latency):
+    redis = yield TxRedisManager.from_config({
+        'FAKE_REDIS': 'yes',
+        'key_prefix': 'smpp_sequence_bench',
+    })
+    sequence_generator = make_generator(SlowRedis(redis, latency))
+
+    start = time.time()
+    yield allocate(sequence_generator, pdus, concurrency)
+    elapsed = time.time() - start
+    print "%-20s %10.0f PDUs/sec" % (name, pdus / elapsed)
+    yield redis._purge_all()
+    yield redis.close_manager()
+
+
+@inlineCallbacks
+def main(pdus, concurrency, latency):
+    try:
+        yield run_bench("RedisSequence", RedisSequence, pdus, concurrency,
+                        latency)
+        for block_size in (10, 100, 1000):
+            yield run_bench(
+                "block_size=%d" % (block_size,),
+                lambda redis: BlockRedisSequence(redis, block_size),
+                pdus, concurrency, latency)
+    finally:
+        reactor.stop()
+
+
+if __name__ == "__main__":
+    pdus = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    latency = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0005
+    reactor.callWhenRunning(main, pdus, concurrency, latency)
+    reactor.run()
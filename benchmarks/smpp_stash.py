@@ -0,0 +1,105 @@
+"""
+Benchmark stashing SMPP submit_sm state in Redis.
+
+Redis is replaced by an asynchronous FakeRedis with an artificial round trip
+delay, so this measures how many Redis round trips each approach puts in
+front of every PDU rather than raw Redis speed.
+"""
+
+import sys
+import time
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, gatherResults
+from twisted.internet.task import deferLater
+
+from smpp.pdu_builder import SubmitSM
+from vumi.persist.txredis_manager import TxRedisManager
+from vumi.transports.smpp.config import SmppTransportConfig
+from vumi.transports.smpp.smpp_transport import SmppMessageDataStash
+
+
+class SlowRedis(object):
+    """
+    Wraps a Redis manager (or pipeline) and delays the result of every call
+    that goes to the server.
+    """
+
+    def __init__(self, redis, latency):
+        self._redis = redis
+        self._latency = latency
+
+    def pipeline(self):
+        return SlowRedis(self._redis.pipeline(), self._latency)
+
+    def __getattr__(self, name):
+        func = getattr(self._redis, name)
+
+        def slow_call(*args, **kw):
+            d = func(*args, **kw)
+            if d is None:
+                # This call was queued on a pipeline.
+                return d
+            return d.addCallback(
+                lambda r: deferLater(reactor, self._latency, lambda: r))
+        return slow_call
+
+
+@inlineCallbacks
+def send_sequential(stash, vumi_message_id, pdu):
+    yield stash.cache_pdu(vumi_message_id, pdu)
+    yield stash.set_sequence_number_message_id(
+        pdu.obj['header']['sequence_number'], vumi_message_id)
+
+
+@inlineCallbacks
+def send_pipelined(stash, vumi_message_id, pdu):
+    yield stash.stash_submit_sm(vumi_message_id, pdu)
+
+
+@inlineCallbacks
+def run_bench(name, send, pdus, concurrency, latency):
+    redis = yield TxRedisManager.from_config({
+        'FAKE_REDIS': 'yes',
+        'key_prefix': 'smpp_stash_bench',
+    })
+    config = SmppTransportConfig({
+        'transport_name': 'bench',
+        'twisted_endpoint': 'tcp:host=localhost:port=0',
+        'system_id': 'bench',
+        'password': 'bench',
+    }, static=True)
+    stash = SmppMessageDataStash(SlowRedis(redis, latency), config)
+
+    @inlineCallbacks
+    def run_sender(offset, count):
+        for i in xrange(offset, offset + count):
+            yield send(stash, 'msg-%d' % (i,), SubmitSM(i, short_message='a'))
+
+    per_sender = pdus // concurrency
+    start = time.time()
+    yield gatherResults([
+        run_sender(i * per_sender, per_sender) for i in xrange(concurrency)])
+    elapsed = time.time() - start
+    print "%-12s %10.0f PDUs/sec" % (name, pdus / elapsed)
+    yield redis._purge_all()
+    yield redis.close_manager()
+
+
+@inlineCallbacks
+def main(pdus, concurrency, latency):
+    try:
+        yield run_bench("sequential", send_sequential, pdus, concurrency,
+                        latency)
+        yield run_bench("pipelined", send_pipelined, pdus, concurrency,
+                        latency)
+    finally:
+        reactor.stop()
+
+
+if __name__ == "__main__":
+    pdus = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    latency = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0005
+    reactor.callWhenRunning(main, pdus, concurrency, latency)
+    reactor.run()
@@ -0,0 +1,106 @@
+"""
+Benchmark declaring and acquiring tags in a large tag pool.
+
+Redis is replaced by a FakeRedis with an artificial round trip delay, so
+this measures how many Redis round trips each approach takes rather than
+raw Redis speed. Declaring tags one at a time and acquiring them in a loop
+over acquire_tag() are compared with the chunked, pipelined declare_tags()
+and acquire_tags().
+"""
+
+import sys
+import time
+
+from twisted.internet.defer import returnValue
+
+from vumi.components.tagpool import TagpoolManager
+from vumi.persist.redis_base import Manager
+from vumi.persist.redis_manager import RedisManager
+
+
+class SlowRedis(object):
+    """
+    Wraps a synchronous Redis manager (or pipeline) and sleeps for every call
+    that goes to the server.
+    """
+
+    def __init__(self, redis, latency, is_pipeline=False):
+        self._redis = redis
+        self._latency = latency
+        self._is_pipeline = is_pipeline
+        self.call_decorator = redis.call_decorator
+
+    def pipeline(self):
+        return SlowRedis(self._redis.pipeline(), self._latency, True)
+
+    def __getattr__(self, name):
+        func = getattr(self._redis, name)
+
+        def slow_call(*args, **kw):
+            if not self._is_pipeline or name == 'execute':
+                time.sleep(self._latency)
+            return func(*args, **kw)
+        return slow_call
+
+
+class SequentialTagpoolManager(TagpoolManager):
+    """
+    A tag pool manager that declares and acquires tags one at a time, the way
+    it was done before declare_tags() was pipelined.
+    """
+
+    @Manager.calls_manager
+    def _declare_tags(self, pool, local_tags):
+        free_list_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
+        new_tags = set(self._encode(tag) for tag in local_tags)
+        old_tags = yield self.redis.sunion(free_set_key, inuse_set_key)
+        for tag in sorted(new_tags - set(old_tags)):
+            yield self.redis.sadd(free_set_key, tag)
+            yield self.redis.rpush(free_list_key, tag)
+
+    @Manager.calls_manager
+    def acquire_tags(self, pool, count, owner=None, reason=None):
+        tags = []
+        for _ in xrange(count):
+            tag = yield self.acquire_tag(pool, owner, reason)
+            if tag is None:
+                break
+            tags.append(tag)
+        returnValue(tags)
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+
+def run_bench(name, manager_class, pool_size, acquire_count, latency):
+    redis = RedisManager.from_config({
+        'FAKE_REDIS': 'yes',
+        'key_prefix': 'tagpool_bench',
+    })
+    tpm = manager_class(SlowRedis(redis, latency))
+    tags = [("pool", "%d" % (i,)) for i in xrange(pool_size)]
+    declare_time, _ = timed(tpm.declare_tags, tags)
+    acquire_time, acquired = timed(
+        tpm.acquire_tags, "pool", acquire_count, "bench")
+    assert len(acquired) == acquire_count
+    print "%s:" % (name,)
+    print "  declare %d tags: %.2fs" % (pool_size, declare_time)
+    print "  acquire %d tags: %.2fs" % (acquire_count, acquire_time)
+    redis._close()
+
+
+def main(pool_size, acquire_count, latency):
+    print "Round trip latency: %.2fms" % (latency * 1000,)
+    run_bench("one at a time", SequentialTagpoolManager,
+              pool_size, acquire_count, latency)
+    run_bench("bulk", TagpoolManager, pool_size, acquire_count, latency)
+
+
+if __name__ == "__main__":
+    pool_size = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    acquire_count = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    latency = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0002
+    main(pool_size, acquire_count, latency)
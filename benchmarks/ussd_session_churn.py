@@ -0,0 +1,148 @@
+"""
+Benchmark USSD session churn through the SessionManager.
+
+Each simulated USSD session is created, saved and loaded on every hop and
+then cleared, the way USSD transports use sessions. This is compared with
+the previous SessionManager implementation, which made a round trip for
+every field saved. Listing all the active sessions is timed too.
+
+Redis is replaced by an asynchronous FakeRedis with an artificial round trip
+delay, so this measures how many Redis round trips each approach takes
+rather than raw Redis speed. Set VUMI_FAKE_REDIS_WAIT=0 to remove the
+extra delay FakeRedis adds to every call.
+"""
+
+import sys
+import time
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue, gatherResults
+from twisted.internet.task import deferLater
+
+from vumi.components.session import SessionManager
+from vumi.persist.txredis_manager import TxRedisManager
+
+
+class SlowRedis(object):
+    """
+    Wraps a Redis manager (or pipeline) and delays the result of every call
+    that goes to the server.
+    """
+
+    def __init__(self, redis, latency):
+        self._redis = redis
+        self._latency = latency
+
+    def pipeline(self):
+        return SlowRedis(self._redis.pipeline(), self._latency)
+
+    def __getattr__(self, name):
+        func = getattr(self._redis, name)
+
+        def slow_call(*args, **kw):
+            d = func(*args, **kw)
+            if d is None:
+                # This call was queued on a pipeline.
+                return d
+            return d.addCallback(
+                lambda r: deferLater(reactor, self._latency, lambda: r))
+        return slow_call
+
+
+class SequentialSessionManager(SessionManager):
+    """
+    The session manager as it was before its calls were pipelined.
+    """
+
+    @inlineCallbacks
+    def active_sessions(self):
+        keys = yield self.redis.keys('session:*')
+        sessions = []
+        for user_id in [key.split(':', 1)[1] for key in keys]:
+            sessions.append((user_id, (yield self.load_session(user_id))))
+        returnValue(sessions)
+
+    @inlineCallbacks
+    def create_session(self, user_id, **kwargs):
+        yield self.clear_session(user_id)
+        defaults = {
+            'created_at': time.time()
+        }
+        defaults.update(kwargs)
+        yield self.save_session(user_id, defaults)
+        if self.max_session_length:
+            yield self.schedule_session_expiry(user_id,
+                                               int(self.max_session_length))
+        returnValue((yield self.load_session(user_id)))
+
+    @inlineCallbacks
+    def save_session(self, user_id, session):
+        ukey = "%s:%s" % ('session', user_id)
+        for s_key, s_value in session.items():
+            yield self.redis.hset(ukey, s_key, s_value)
+        returnValue(session)
+
+
+@inlineCallbacks
+def ussd_session(sm, user_id, hops):
+    session = yield sm.create_session(
+        user_id, from_addr=user_id, to_addr="*120#", state="start")
+    for hop in xrange(hops):
+        session = yield sm.load_session(user_id)
+        session["state"] = "hop%d" % (hop,)
+        session["last_input"] = "%d" % (hop,)
+        yield sm.save_session(user_id, session)
+    yield sm.clear_session(user_id)
+
+
+@inlineCallbacks
+def run_bench(name, sm_class, sessions, hops, concurrency, latency):
+    redis = yield TxRedisManager.from_config({
+        'FAKE_REDIS': 'yes',
+        'key_prefix': 'session_bench',
+    })
+    sm = sm_class(SlowRedis(redis, latency), max_session_length=180)
+
+    @inlineCallbacks
+    def run_user(offset):
+        for i in xrange(offset, sessions, concurrency):
+            yield ussd_session(sm, "user%d" % (i,), hops)
+
+    start = time.time()
+    yield gatherResults([run_user(i) for i in xrange(concurrency)])
+    churn_time = time.time() - start
+
+    for i in xrange(sessions):
+        yield redis.hmset("session:user%d" % (i,), {"state": "start"})
+    start = time.time()
+    active = yield sm.active_sessions()
+    active_time = time.time() - start
+    assert len(active) == sessions
+
+    print "%s:" % (name,)
+    print "  %d sessions of %d hops: %.2fs (%.0f hops/s)" % (
+        sessions, hops, churn_time, sessions * hops / churn_time)
+    print "  list %d active sessions: %.2fs" % (sessions, active_time)
+    yield redis._close()
+
+
+@inlineCallbacks
+def main(sessions, hops, concurrency, latency):
+    try:
+        print "%d concurrent users, %.1fms round trip latency" % (
+            concurrency, latency * 1000)
+        yield run_bench("one call per field", SequentialSessionManager,
+                        sessions, hops, concurrency, latency)
+        yield run_bench("pipelined", SessionManager,
+                        sessions, hops, concurrency, latency)
+    finally:
+        reactor.stop()
+
+
+if __name__ == "__main__":
+    sessions = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    hops = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    concurrency = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    latency = float(sys.argv[4]) if len(sys.argv) > 4 else 0.001
+    reactor.callWhenRunning(main, sessions, hops, concurrency, latency)
+    reactor.run()
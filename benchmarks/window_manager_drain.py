@@ -0,0 +1,140 @@
+"""
+Benchmark draining WindowManager windows.
+
+Messages are added to a number of windows and then drained by running the
+window monitor, with every key sent to the callback acknowledged (removed)
+after each monitor run. This is compared with the previous implementation,
+which moved and removed one key at a time and drained one window at a time.
+
+Redis is replaced by an asynchronous FakeRedis with an artificial round trip
+delay, so this measures how many Redis round trips each approach takes
+rather than raw Redis speed. Set VUMI_FAKE_REDIS_WAIT=0 to remove the
+extra delay FakeRedis adds to every call.
+"""
+
+import sys
+import time
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.task import deferLater
+
+from vumi.components.window_manager import WindowManager
+from vumi.persist.txredis_manager import TxRedisManager
+
+
+class SlowRedis(object):
+    """
+    Wraps a Redis manager and delays the result of every call.
+    """
+
+    def __init__(self, redis, latency):
+        self._redis = redis
+        self._latency = latency
+
+    def __getattr__(self, name):
+        func = getattr(self._redis, name)
+
+        def slow_call(*args, **kw):
+            d = func(*args, **kw)
+            return d.addCallback(
+                lambda r: deferLater(reactor, self._latency, lambda: r))
+        return slow_call
+
+
+class SequentialWindowManager(WindowManager):
+    """
+    The window manager as it was before windows were drained in bulk.
+    """
+
+    @inlineCallbacks
+    def get_next_key(self, window_id):
+        window_key = self.window_key(window_id)
+        inflight_key = self.flight_key(window_id)
+        waiting_list = yield self.count_waiting(window_id)
+        if waiting_list == 0:
+            return
+        flight_size = yield self.count_in_flight(window_id)
+        if self.window_size - flight_size > 0:
+            next_key = yield self.redis.rpoplpush(window_key, inflight_key)
+            if next_key:
+                yield self.redis.zadd(self.stats_key(window_id), **{
+                    next_key: self.get_clocktime(),
+                })
+                returnValue(next_key)
+
+    @inlineCallbacks
+    def remove_keys(self, window_id, keys):
+        for key in keys:
+            yield self.redis.lrem(self.flight_key(window_id), key, 1)
+            yield self.redis.delete(self.window_key(window_id, key))
+            yield self.redis.delete(self.stats_key(window_id, key))
+            yield self.clear_external_id(window_id, key)
+            yield self.redis.zrem(self.stats_key(window_id), key)
+
+    @inlineCallbacks
+    def _monitor_windows(self, key_callback, cleanup=True,
+                         cleanup_callback=None):
+        windows = yield self.get_windows()
+        for window_id in windows:
+            key = yield self.get_next_key(window_id)
+            while key:
+                yield key_callback(window_id, key)
+                key = yield self.get_next_key(window_id)
+
+
+@inlineCallbacks
+def run_bench(name, wm_class, windows, messages, window_size, latency):
+    redis = yield TxRedisManager.from_config({
+        'FAKE_REDIS': 'yes',
+        'key_prefix': 'window_manager_bench',
+    })
+    wm = wm_class(redis, window_size=window_size)
+    window_ids = ["window%d" % (i,) for i in xrange(windows)]
+    for window_id in window_ids:
+        yield wm.create_window(window_id)
+        for i in xrange(messages):
+            yield wm.add(window_id, i)
+    wm.redis = SlowRedis(redis, latency)
+
+    sent = {}
+
+    def key_callback(window_id, key):
+        sent.setdefault(window_id, []).append(key)
+
+    start = time.time()
+    total = 0
+    while total < windows * messages:
+        yield wm._monitor_windows(key_callback, False)
+        for window_id, keys in sent.items():
+            yield wm.remove_keys(window_id, keys)
+            total += len(keys)
+        sent.clear()
+    elapsed = time.time() - start
+
+    print "%s: %d messages in %.2fs (%.0f messages/s)" % (
+        name, total, elapsed, total / elapsed)
+    wm.stop()
+    yield redis._close()
+
+
+@inlineCallbacks
+def main(windows, messages, window_size, latency):
+    try:
+        print "%d windows of size %d, %.1fms round trip latency" % (
+            windows, window_size, latency * 1000)
+        yield run_bench("one key at a time", SequentialWindowManager,
+                        windows, messages, window_size, latency)
+        yield run_bench("bulk", WindowManager,
+                        windows, messages, window_size, latency)
+    finally:
+        reactor.stop()
+
+
+if __name__ == "__main__":
+    windows = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    messages = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    window_size = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+    latency = float(sys.argv[4]) if len(sys.argv) > 4 else 0.001
+    reactor.callWhenRunning(main, windows, messages, window_size, latency)
+    reactor.run()
@@ -0,0 +1,79 @@
+"""
+Benchmark the per-message cost of fetching worker config.
+
+An application worker's get_config() and a Sandbox's get_config() are called
+for every message, both with cached config objects and with the previous
+implementation, which built and validated a new config object each time.
+"""
+
+import sys
+import time
+
+from twisted.internet.defer import succeed
+
+from vumi.application.base import ApplicationWorker
+from vumi.application.sandbox import Sandbox
+from vumi.tests.helpers import MessageHelper, WorkerHelper
+
+
+class DummyApplication(ApplicationWorker):
+    pass
+
+
+class UncachedApplication(DummyApplication):
+    """
+    The application worker as it was before config objects were cached.
+    """
+
+    def get_config(self, msg, ctxt=None):
+        return succeed(self.CONFIG_CLASS(self.config))
+
+
+class UncachedSandbox(Sandbox):
+    """
+    The sandbox as it was before config objects were cached.
+    """
+
+    def get_config(self, msg):
+        config = self.config.copy()
+        config['sandbox_id'] = self.sandbox_id_for_message(msg)
+        return succeed(self.CONFIG_CLASS(config))
+
+
+def run_bench(worker_class, config, msgs):
+    worker = WorkerHelper.get_worker_raw(worker_class, config)
+    start = time.time()
+    for msg in msgs:
+        worker.get_config(msg)
+    elapsed = time.time() - start
+    return elapsed / len(msgs) * 1e6
+
+
+def main(count, sandboxes):
+    msg_helper = MessageHelper()
+    msgs = [
+        msg_helper.make_inbound(
+            "hello", sandbox_id="sandbox%d" % (i % sandboxes,))
+        for i in xrange(count)]
+    app_config = {'transport_name': 'sms'}
+    sandbox_config = {
+        'transport_name': 'sms',
+        'executable': '/bin/true',
+        'timeout': '10',
+    }
+    print "%d messages, %d sandbox ids" % (count, sandboxes)
+    print "worker        uncached (us/msg)  cached (us/msg)"
+    print "%-12s  %17.2f  %15.2f" % (
+        "application",
+        run_bench(UncachedApplication, app_config, msgs),
+        run_bench(DummyApplication, app_config, msgs))
+    print "%-12s  %17.2f  %15.2f" % (
+        "sandbox",
+        run_bench(UncachedSandbox, sandbox_config, msgs),
+        run_bench(Sandbox, sandbox_config, msgs))
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    sandboxes = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    main(count, sandboxes)
@@ -9,6 +9,7 @@ import json
 import pkg_resources
 import logging
 import operator
+from collections import defaultdict
 from uuid import uuid4
 from StringIO import StringIO
 import warnings
@@ -28,7 +29,8 @@ from OpenSSL.SSL import (
     VERIFY_PEER, VERIFY_FAIL_IF_NO_PEER_CERT, VERIFY_CLIENT_ONCE, VERIFY_NONE,
     SSLv3_METHOD, SSLv23_METHOD, TLSv1_METHOD)
 
-from vumi.config import ConfigText, ConfigInt, ConfigList, ConfigDict
+from vumi.config import (
+    ConfigText, ConfigInt, ConfigList, ConfigDict, ConfigBool)
 from vumi.application.base import ApplicationWorker
 from vumi.message import Message
 from vumi.errors import ConfigError
@@ -163,18 +165,20 @@ class SandboxProtocol(ProcessProtocol):
         except Exception, e:
             return SandboxCommand(cmd="unknown", line=line, exception=e)
 
+    def _dispatch_command(self, command):
+        d = self.api.dispatch_request(command)
+        self._pending_requests.append(d)
+
     def outReceived(self, data):
         lines = self._process_data(self.chunk, data)
         for i in range(len(lines) - 1):
-            d = self.api.dispatch_request(self._parse_command(lines[i]))
-            self._pending_requests.append(d)
+            self._dispatch_command(self._parse_command(lines[i]))
         self.chunk = lines[-1]
 
     def outConnectionLost(self):
         if self.chunk:
             line, self.chunk = self.chunk, ""
-            d = self.api.dispatch_request(self._parse_command(line))
-            self._pending_requests.append(d)
+            self._dispatch_command(self._parse_command(line))
 
     def errReceived(self, data):
         lines = self._process_data(self.error_chunk, data)
@@ -207,12 +211,245 @@ class SandboxProtocol(ProcessProtocol):
         if not self._started.fired():
             self._started.callback(Failure(
                 SandboxError("Process failed to start.")))
+        self._log_error_lines()
+        requests_done = DeferredList(self._pending_requests)
+        requests_done.addCallback(self._process_request_results)
+        requests_done.addCallback(lambda _r: self._done.callback(result))
+
+    def _log_error_lines(self):
         if self.error_lines:
             self.api.log("\n".join(self.error_lines), logging.ERROR)
             self.error_lines = []
+
+
+class PooledSandboxProtocol(SandboxProtocol):
+    """A protocol for a long-lived sandboxed process that handles many
+    messages, one at a time.
+
+    Each message or event is sent to the process with
+    :meth:`process_message`. Once the process has finished handling it, it
+    must write a ``done`` command (e.g. ``{"cmd": "done", "cmd_id": "1",
+    "reply": false}``) to `stdout` and wait for the next command.
+
+    The timeout and receive limit apply to each message rather than to the
+    lifetime of the process. A process that exceeds them is killed.
+    """
+
+    def __init__(self, sandbox_id, api, executable, spawn_kwargs,
+                 rlimits, timeout, recv_limit):
+        SandboxProtocol.__init__(
+            self, sandbox_id, api, executable, spawn_kwargs, rlimits, timeout,
+            recv_limit)
+        self.timeout_task.cancel()
+        self.timeout = timeout
+        self.messages_processed = 0
+        self.ended = False
+        self._message_done = None
+        self.done().addBoth(self._process_ended)
+
+    def process_message(self, api_callback):
+        """Calls ``api_callback`` to send a message or event to the process.
+
+        Returns a deferred that fires with ``None`` once the process reports
+        that it is done with the message, or with the process' exit status
+        if it ends first.
+        """
+        if self._message_done is not None:
+            raise SandboxError(
+                "Sandbox %r is already processing a message."
+                % (self.sandbox_id,))
+        self.recv_bytes = 0
+        self.api.clear_inbound_messages()
+        self._message_done = Deferred()
+        self.timeout_task = reactor.callLater(self.timeout, self.kill)
+        api_callback()
+        return self._message_done
+
+    def retire(self):
+        """Closes the process' `stdin` so that it exits once it is idle,
+        killing it if it doesn't exit within the timeout.
+        """
+        if self.ended:
+            return
+        self.transport.closeStdin()
+        if not self.timeout_task.active():
+            self.timeout_task = reactor.callLater(self.timeout, self.kill)
+
+    def memory_usage(self):
+        """Returns the resident memory size of the process in bytes, or
+        ``None`` if it can't be determined.
+        """
+        try:
+            with open("/proc/%d/statm" % (self.transport.pid,)) as statm:
+                pages = int(statm.read().split()[1])
+        except (IOError, OSError, TypeError, ValueError, IndexError):
+            return None
+        return pages * resource.getpagesize()
+
+    def _dispatch_command(self, command):
+        if command.get('cmd') == 'done' and not command.get('reply'):
+            self._message_requests_done()
+        else:
+            SandboxProtocol._dispatch_command(self, command)
+
+    def _message_requests_done(self):
         requests_done = DeferredList(self._pending_requests)
+        self._pending_requests = []
         requests_done.addCallback(self._process_request_results)
-        requests_done.addCallback(lambda _r: self._done.callback(result))
+        requests_done.addCallback(lambda _r: self._finish_message(None))
+
+    def _finish_message(self, result):
+        if self.timeout_task.active():
+            self.timeout_task.cancel()
+        self._log_error_lines()
+        message_done, self._message_done = self._message_done, None
+        if message_done is not None:
+            self.messages_processed += 1
+            message_done.callback(result)
+
+    def _process_ended(self, result):
+        self.ended = True
+        self._finish_message(result)
+
+
+class SandboxPool(object):
+    """A pool of warm :class:`PooledSandboxProtocol` instances, kept per
+    sandbox id.
+
+    :param int max_processes:
+        Maximum number of processes per sandbox id. Messages for a sandbox
+        id that has no idle process wait for one once this is reached.
+    :param int max_messages:
+        Number of messages a process handles before it is retired.
+    :param int idle_timeout:
+        Number of seconds an idle process is kept before it is retired.
+    :param int max_memory:
+        If set, processes using more than this many bytes of resident
+        memory after handling a message are retired.
+    """
+
+    def __init__(self, max_processes, max_messages, idle_timeout,
+                 max_memory=None, clock=None):
+        self.max_processes = max_processes
+        self.max_messages = max_messages
+        self.idle_timeout = idle_timeout
+        self.max_memory = max_memory
+        self.clock = clock if clock is not None else reactor
+        self._processes = defaultdict(set)
+        self._starting = defaultdict(int)
+        self._idle = defaultdict(list)
+        self._idle_tasks = {}
+        self._waiters = defaultdict(list)
+
+    def process_count(self, sandbox_id):
+        return len(self._processes[sandbox_id]) + self._starting[sandbox_id]
+
+    def idle_count(self, sandbox_id):
+        return len(self._idle[sandbox_id])
+
+    def acquire(self, sandbox_id, start_process):
+        """Returns a deferred that fires with a process for ``sandbox_id``.
+
+        An idle process is reused if there is one. Otherwise
+        ``start_process`` is called to start a new one if there is room in
+        the pool, and it is expected to return a deferred that fires with
+        a started :class:`PooledSandboxProtocol`.
+        """
+        idle = self._idle[sandbox_id]
+        if idle:
+            protocol = idle.pop()
+            self._idle_tasks.pop(protocol).cancel()
+            return succeed(protocol)
+        if self.process_count(sandbox_id) < self.max_processes:
+            return self._start(sandbox_id, start_process)
+        d = Deferred()
+        self._waiters[sandbox_id].append((d, start_process))
+        return d
+
+    def _start(self, sandbox_id, start_process):
+        self._starting[sandbox_id] += 1
+
+        def started(protocol):
+            self._processes[sandbox_id].add(protocol)
+            protocol.done().addBoth(lambda _r: self._remove(protocol))
+            return protocol
+
+        d = maybeDeferred(start_process)
+        d.addBoth(self._decrement_starting, sandbox_id)
+        d.addCallback(started)
+        return d
+
+    def _decrement_starting(self, result, sandbox_id):
+        self._starting[sandbox_id] -= 1
+        if isinstance(result, Failure):
+            self._wake_waiter(sandbox_id)
+        return result
+
+    def release(self, protocol):
+        """Returns a process to the pool once it has finished a message.
+
+        Processes that have handled too many messages or use too much
+        memory are retired instead.
+        """
+        if protocol.ended:
+            return
+        if self._should_retire(protocol):
+            protocol.retire()
+            return
+        sandbox_id = protocol.sandbox_id
+        waiters = self._waiters[sandbox_id]
+        if waiters:
+            d, _start_process = waiters.pop(0)
+            d.callback(protocol)
+            return
+        self._idle[sandbox_id].append(protocol)
+        self._idle_tasks[protocol] = self.clock.callLater(
+            self.idle_timeout, self._expire, protocol)
+
+    def _should_retire(self, protocol):
+        if protocol.messages_processed >= self.max_messages:
+            return True
+        if self.max_memory is not None:
+            memory = protocol.memory_usage()
+            if memory is not None and memory > self.max_memory:
+                return True
+        return False
+
+    def _expire(self, protocol):
+        del self._idle_tasks[protocol]
+        self._idle[protocol.sandbox_id].remove(protocol)
+        protocol.retire()
+
+    def _remove(self, protocol):
+        sandbox_id = protocol.sandbox_id
+        self._processes[sandbox_id].discard(protocol)
+        idle_task = self._idle_tasks.pop(protocol, None)
+        if idle_task is not None:
+            idle_task.cancel()
+            self._idle[sandbox_id].remove(protocol)
+        self._wake_waiter(sandbox_id)
+
+    def _wake_waiter(self, sandbox_id):
+        waiters = self._waiters[sandbox_id]
+        if waiters and self.process_count(sandbox_id) < self.max_processes:
+            d, start_process = waiters.pop(0)
+            self._start(sandbox_id, start_process).chainDeferred(d)
+
+    def shutdown(self):
+        """Retires all idle processes, and busy processes once they finish
+        their current message. Returns a deferred that fires once all
+        processes have ended.
+        """
+        self.max_messages = 0
+        done = []
+        for processes in self._processes.values():
+            done.extend(protocol.done() for protocol in processes)
+        for sandbox_id, idle in self._idle.items():
+            for protocol in list(idle):
+                self._idle_tasks.pop(protocol).cancel()
+                idle.remove(protocol)
+                protocol.retire()
+        return DeferredList(done, consumeErrors=True)
 
 
 class SandboxResources(object):
@@ -633,7 +870,8 @@ class JsSandboxResource(SandboxResource):
         app_context = self.app_worker.app_context_for_api(api)
         api.sandbox_send(SandboxCommand(cmd="initialize",
                                         javascript=javascript,
-                                        app_context=app_context))
+                                        app_context=app_context,
+                                        pooled=api.config.pooled))
 
 
 class LoggingResource(SandboxResource):
@@ -1071,6 +1309,9 @@ class SandboxApi(object):
         self.sandbox_send(SandboxCommand(cmd="inbound-event",
                                          msg=event.payload))
 
+    def clear_inbound_messages(self):
+        self._inbound_messages.clear()
+
     def sandbox_send(self, msg):
         self._sandbox.send(msg)
 
@@ -1179,6 +1420,26 @@ class SandboxConfig(ApplicationWorker.CONFIG_CLASS):
         " these directly using Twisted logging instead.",
         default=None)
     sandbox_id = ConfigText("This is set based on individual messages.")
+    pooled = ConfigBool(
+        "If true, sandboxed processes are kept running and reused for many"
+        " messages instead of being started for each message. The timeout"
+        " and receive limit then apply to each message. The process must"
+        " write a `done` command after handling each message. A process is"
+        " configured for the first message it handles.",
+        default=False, static=True)
+    pool_max_processes = ConfigInt(
+        "Maximum number of pooled processes per sandbox id.",
+        default=1, static=True)
+    pool_max_messages = ConfigInt(
+        "Number of messages a pooled process handles before it is"
+        " replaced.", default=1000, static=True)
+    pool_idle_timeout = ConfigInt(
+        "Number of seconds an idle pooled process is kept running.",
+        default=300, static=True)
+    pool_max_memory = ConfigInt(
+        "If set, pooled processes using more than this many bytes of"
+        " resident memory after handling a message are replaced.",
+        default=None, static=True)
 
 
 class Sandbox(ApplicationWorker):
@@ -1186,6 +1447,9 @@ class Sandbox(ApplicationWorker):
 
     CONFIG_CLASS = SandboxConfig
 
+    # Set up in setup_application if the `pooled` config option is set.
+    pool = None
+
     KB, MB = 1024, 1024 * 1024
     DEFAULT_RLIMITS = {
         resource.RLIMIT_CORE: (1 * MB, 1 * MB),
@@ -1205,9 +1469,14 @@ class Sandbox(ApplicationWorker):
         self.resources.validate_config()
 
     def get_config(self, msg):
-        config = self.config.copy()
-        config['sandbox_id'] = self.sandbox_id_for_message(msg)
-        return succeed(self.CONFIG_CLASS(config))
+        sandbox_id = self.sandbox_id_for_message(msg)
+
+        def get_config_data():
+            config = self.config.copy()
+            config['sandbox_id'] = sandbox_id
+            return config
+
+        return succeed(self.get_cached_config(sandbox_id, get_config_data))
 
     def _convert_rlimits(self, rlimits_config):
         rlimits = dict((getattr(resource, key, key), value) for key, value in
@@ -1218,10 +1487,19 @@ class Sandbox(ApplicationWorker):
         return rlimits
 
     def setup_application(self):
+        config = self.get_static_config()
+        self.pool = None
+        if config.pooled:
+            self.pool = SandboxPool(
+                config.pool_max_processes, config.pool_max_messages,
+                config.pool_idle_timeout, config.pool_max_memory)
         return self.resources.setup_resources()
 
+    @inlineCallbacks
     def teardown_application(self):
-        return self.resources.teardown_resources()
+        if self.pool is not None:
+            yield self.pool.shutdown()
+        yield self.resources.teardown_resources()
 
     def setup_connectors(self):
         # Set the default event handler so we can handle events from any
@@ -1250,7 +1528,10 @@ class Sandbox(ApplicationWorker):
         rlimits = self.get_rlimits(api.config)
         spawn_kwargs = dict(
             args=args, env=api.config.env, path=api.config.path)
-        return SandboxProtocol(
+        protocol_class = SandboxProtocol
+        if self.pool is not None:
+            protocol_class = PooledSandboxProtocol
+        return protocol_class(
             api.config.sandbox_id, api, executable, spawn_kwargs, rlimits,
             api.config.timeout, api.config.recv_limit)
 
@@ -1287,9 +1568,39 @@ class Sandbox(ApplicationWorker):
         d.addCallbacks(on_start, log.error)
         return d
 
+    @inlineCallbacks
+    def _start_pooled_sandbox(self, msg_or_event, config):
+        sandbox_protocol = yield self.sandbox_protocol_for_message(
+            msg_or_event, config)
+        sandbox_protocol.spawn()
+        yield sandbox_protocol.started()
+        sandbox_protocol.api.sandbox_init()
+        returnValue(sandbox_protocol)
+
+    @inlineCallbacks
+    def _process_in_pool(self, msg_or_event, config, api_callback):
+        try:
+            sandbox_protocol = yield self.pool.acquire(
+                config.sandbox_id,
+                lambda: self._start_pooled_sandbox(msg_or_event, config))
+        except Exception:
+            log.error()
+            return
+
+        d = sandbox_protocol.process_message(
+            lambda: api_callback(sandbox_protocol.api))
+        d.addErrback(log.error)
+        status = yield d
+        self.pool.release(sandbox_protocol)
+        returnValue(status)
+
     @inlineCallbacks
     def process_message_in_sandbox(self, msg):
         config = yield self.get_config(msg)
+        if self.pool is not None:
+            status = yield self._process_in_pool(
+                msg, config, lambda api: api.sandbox_inbound_message(msg))
+            returnValue(status)
         sandbox_protocol = yield self.sandbox_protocol_for_message(msg, config)
 
         def sandbox_init():
@@ -1301,6 +1612,10 @@ class Sandbox(ApplicationWorker):
     @inlineCallbacks
     def process_event_in_sandbox(self, event):
         config = yield self.get_config(event)
+        if self.pool is not None:
+            status = yield self._process_in_pool(
+                event, config, lambda api: api.sandbox_inbound_event(event))
+            returnValue(status)
         sandbox_protocol = yield self.sandbox_protocol_for_message(
             event, config)
 
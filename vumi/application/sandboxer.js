@@ -57,6 +57,7 @@ var SandboxRunner = function (api) {
     self.chunk = "";
     self.pending_requests = {};
     self.loaded = false;
+    self.pooled = false;
 
     self.emitter.on('command', function (command) {
         var handler_name = "on_" + command.cmd.replace('.', '_').replace('-', '_');
@@ -71,6 +72,7 @@ var SandboxRunner = function (api) {
 
     self.emitter.on('reply', function (reply) {
         var handler = self.pending_requests[reply.cmd_id];
+        delete self.pending_requests[reply.cmd_id];
         if (handler && handler.callback) {
             handler.callback.call(self.api, reply);
         }
@@ -89,7 +91,13 @@ var SandboxRunner = function (api) {
     });
 
     self.api.emitter.on('done', function() {
-        self.exit();
+        if (self.pooled) {
+            // Tell the worker we're ready for the next message.
+            self.send_command(self.api.populate_command("done", {}));
+        }
+        else {
+            self.exit();
+        }
     });
 
     self.exit = function() {
@@ -109,6 +117,7 @@ var SandboxRunner = function (api) {
         ctxt.api = self.api;
         loaded_module.runInNewContext(ctxt);
         self.loaded = true;
+        self.pooled = !!command.pooled;
     };
 
     self.send_command = function (cmd) {
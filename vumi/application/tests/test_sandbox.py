@@ -16,12 +16,13 @@ from OpenSSL.SSL import (
     SSLv3_METHOD, SSLv23_METHOD, TLSv1_METHOD)
 
 from twisted.internet.defer import (
-    inlineCallbacks, fail, succeed, DeferredQueue)
+    inlineCallbacks, fail, succeed, DeferredQueue, gatherResults)
 from twisted.internet.error import ProcessTerminated
+from twisted.internet.task import Clock
 from twisted.web.http_headers import Headers
 
 from vumi.application.sandbox import (
-    Sandbox, SandboxApi, SandboxCommand, SandboxResources,
+    Sandbox, SandboxApi, SandboxCommand, SandboxResources, SandboxConfig,
     SandboxResource, RedisResource, OutboundResource, JsSandboxResource,
     LoggingResource, HttpClientResource, JsSandbox, JsFileSandbox,
     HttpClientContextFactory, HttpClientPolicyForHTTPS, make_context_factory)
@@ -85,6 +86,33 @@ class TestSandbox(SandboxTestCaseBase):
             sys.executable, ['-c', python_code],
             extra_config=extra_config)
 
+    @inlineCallbacks
+    def test_get_config(self):
+        app = yield self.setup_app("")
+        msg = self.app_helper.make_inbound("foo", sandbox_id='sb1')
+        config = yield app.get_config(msg)
+        self.assertEqual(config.sandbox_id, 'sb1')
+        self.assertEqual(config.timeout, 10)
+        other_msg = self.app_helper.make_inbound("bar", sandbox_id='sb2')
+        other_config = yield app.get_config(other_msg)
+        self.assertEqual(other_config.sandbox_id, 'sb2')
+        # Config objects are reused for messages with the same sandbox id.
+        config2 = yield app.get_config(
+            self.app_helper.make_ack(sandbox_id='sb1'))
+        self.assertTrue(config2 is config)
+
+    @inlineCallbacks
+    def test_get_config_after_invalidate(self):
+        app = yield self.setup_app("")
+        msg = self.app_helper.make_inbound("foo", sandbox_id='sb1')
+        config = yield app.get_config(msg)
+        app.config = dict(app.config, timeout='20')
+        app.invalidate_config_cache()
+        new_config = yield app.get_config(msg)
+        self.assertEqual(config.timeout, 10)
+        self.assertEqual(new_config.timeout, 20)
+        self.assertEqual(new_config.sandbox_id, 'sb1')
+
     @inlineCallbacks
     def test_bad_command_from_sandbox(self):
         app = yield self.setup_app(
@@ -389,6 +417,129 @@ class TestSandbox(SandboxTestCaseBase):
         ack.set_routing_endpoint('foo')
         return self.event_dispatch_check(ack)
 
+    POOLED_CODE = (
+        "import sys, json\n"
+        "count = 0\n"
+        "while True:\n"
+        "    line = sys.stdin.readline()\n"
+        "    if not line:\n"
+        "        break\n"
+        "    cmd = json.loads(line)\n"
+        "    if cmd['reply']:\n"
+        "        continue\n"
+        "    count += 1\n"
+        "%s"
+        "    log = {'cmd': 'log.info', 'cmd_id': str(count),\n"
+        "           'reply': False, 'msg': cmd['cmd'] + ' ' + str(count)}\n"
+        "    sys.stdout.write(json.dumps(log) + '\\n')\n"
+        "    sys.stdout.write(json.dumps({'cmd': 'done', 'cmd_id': 'd',\n"
+        "                                 'reply': False}) + '\\n')\n"
+        "    sys.stdout.flush()\n")
+
+    def setup_pooled_app(self, extra_code="", **config):
+        config.update({
+            'pooled': True,
+            'sandbox': {
+                'log': {'cls': 'vumi.application.sandbox.LoggingResource'},
+            },
+        })
+        return self.setup_app(self.POOLED_CODE % (extra_code,), config)
+
+    @inlineCallbacks
+    def test_pooled_process_reused(self):
+        app = yield self.setup_pooled_app()
+        with LogCatcher() as lc:
+            for _ in range(2):
+                status = yield app.process_message_in_sandbox(
+                    self.app_helper.make_inbound("foo", sandbox_id='sb1'))
+                self.assertEqual(status, None)
+            yield app.process_event_in_sandbox(
+                self.app_helper.make_ack(sandbox_id='sb1'))
+            msgs = lc.messages()
+        self.assertEqual(msgs, [
+            'inbound-message 1', 'inbound-message 2', 'inbound-event 3'])
+        self.assertEqual(app.pool.process_count('sb1'), 1)
+        self.assertEqual(app.pool.idle_count('sb1'), 1)
+
+    @inlineCallbacks
+    def test_pooled_processes_per_sandbox_id(self):
+        app = yield self.setup_pooled_app()
+        with LogCatcher() as lc:
+            for sandbox_id in ['sb1', 'sb2', 'sb1']:
+                yield app.process_message_in_sandbox(
+                    self.app_helper.make_inbound("foo", sandbox_id=sandbox_id))
+            msgs = lc.messages()
+        self.assertEqual(msgs, [
+            'inbound-message 1', 'inbound-message 1', 'inbound-message 2'])
+        self.assertEqual(app.pool.process_count('sb1'), 1)
+        self.assertEqual(app.pool.process_count('sb2'), 1)
+
+    @inlineCallbacks
+    def test_pooled_messages_wait_for_process(self):
+        app = yield self.setup_pooled_app()
+        with LogCatcher() as lc:
+            yield gatherResults([
+                app.process_message_in_sandbox(
+                    self.app_helper.make_inbound("foo", sandbox_id='sb1'))
+                for _ in range(3)])
+            msgs = lc.messages()
+        self.assertEqual(msgs, [
+            'inbound-message 1', 'inbound-message 2', 'inbound-message 3'])
+        self.assertEqual(app.pool.process_count('sb1'), 1)
+
+    @inlineCallbacks
+    def test_pooled_max_messages(self):
+        app = yield self.setup_pooled_app(pool_max_messages=2)
+        with LogCatcher() as lc:
+            for _ in range(3):
+                yield app.process_message_in_sandbox(
+                    self.app_helper.make_inbound("foo", sandbox_id='sb1'))
+            msgs = lc.messages()
+        self.assertEqual(msgs, [
+            'inbound-message 1', 'inbound-message 2', 'inbound-message 1'])
+
+    @inlineCallbacks
+    def test_pooled_max_memory(self):
+        app = yield self.setup_pooled_app(pool_max_memory=1)
+        with LogCatcher() as lc:
+            for _ in range(2):
+                yield app.process_message_in_sandbox(
+                    self.app_helper.make_inbound("foo", sandbox_id='sb1'))
+            msgs = lc.messages()
+        self.assertEqual(msgs, ['inbound-message 1', 'inbound-message 1'])
+
+    @inlineCallbacks
+    def test_pooled_idle_timeout(self):
+        app = yield self.setup_pooled_app(pool_idle_timeout=30)
+        clock = app.pool.clock = Clock()
+        with LogCatcher():
+            yield app.process_message_in_sandbox(
+                self.app_helper.make_inbound("foo", sandbox_id='sb1'))
+        [protocol] = app.pool._idle['sb1']
+        clock.advance(29)
+        self.assertEqual(app.pool.idle_count('sb1'), 1)
+        clock.advance(1)
+        self.assertEqual(app.pool.idle_count('sb1'), 0)
+        status = yield protocol.done()
+        self.assertEqual(status, 0)
+        self.assertEqual(app.pool.process_count('sb1'), 0)
+
+    @inlineCallbacks
+    def test_pooled_message_timeout(self):
+        app = yield self.setup_pooled_app(
+            "    if cmd['msg']['content'] == 'hang':\n"
+            "        continue\n", timeout=1)
+        with LogCatcher() as lc:
+            status = yield app.process_message_in_sandbox(
+                self.app_helper.make_inbound("hang", sandbox_id='sb1'))
+            self.assertEqual(status, None)
+            yield app.process_message_in_sandbox(
+                self.app_helper.make_inbound("foo", sandbox_id='sb1'))
+            msgs = lc.messages()
+        self.assertEqual(msgs, ['inbound-message 1'])
+        [kill_err] = self.flushLoggedErrors(ProcessTerminated)
+        self.assertTrue('process ended by signal' in str(kill_err.value))
+
     def test_sandbox_command_does_not_parse_timestamps(self):
         # We should serialise datetime objects correctly.
         timestamp = datetime(2014, 07, 18, 15, 0, 0)
@@ -477,6 +628,33 @@ class JsSandboxTestMixin(object):
             'Done.',
         ])
 
+    @inlineCallbacks
+    def test_js_sandboxer_pooled(self):
+        app_js = pkg_resources.resource_filename('vumi.application.tests',
+                                                 'app.js')
+        javascript = file(app_js).read()
+        app = yield self.setup_app(javascript, extra_config={"pooled": True})
+
+        with LogCatcher() as lc:
+            for _ in range(2):
+                status = yield app.process_message_in_sandbox(
+                    self.app_helper.make_inbound("foo", sandbox_id='sandbox1'))
+                self.assertEqual(status, None)
+            failures = [log['failure'].value for log in lc.errors]
+            msgs = lc.messages()
+        self.assertEqual(failures, [])
+        self.assertEqual(msgs, [
+            'Starting sandbox ...',
+            'Loading sandboxed code ...',
+            'From init!',
+            'From command: inbound-message',
+            'Log successful: true',
+            'Done.',
+            'From command: inbound-message',
+            'Log successful: true',
+            'Done.',
+        ])
+
 
 class TestJsSandbox(SandboxTestCaseBase, JsSandboxTestMixin):
 
@@ -875,6 +1053,14 @@ class TestOutboundResource(ResourceTestCaseBase):
 
 
 class JsDummyAppWorker(DummyAppWorker):
+
+    class DummyApi(DummyAppWorker.DummyApi):
+        def __init__(self):
+            super(JsDummyAppWorker.DummyApi, self).__init__()
+            self.config = SandboxConfig({'transport_name': 'dummy'})
+
+    sandbox_api_cls = DummyApi
+
     def javascript_for_api(self, api):
         return 'testscript'
 
@@ -900,7 +1086,16 @@ class TestJsSandboxResource(ResourceTestCaseBase):
         self.assertEqual(msgs, [SandboxCommand(cmd='initialize',
                                                cmd_id=msgs[0]['cmd_id'],
                                                javascript='testscript',
-                                               app_context='appcontext')])
+                                               app_context='appcontext',
+                                               pooled=False)])
+
+    def test_sandbox_init_pooled(self):
+        msgs = []
+        self.api.sandbox_send = lambda msg: msgs.append(msg)
+        self.api.config = SandboxConfig(
+            {'transport_name': 'dummy', 'pooled': True})
+        self.resource.sandbox_init(self.api)
+        self.assertEqual(msgs[0]['pooled'], True)
 
 
 class TestLoggingResource(ResourceTestCaseBase):
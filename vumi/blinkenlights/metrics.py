@@ -5,6 +5,7 @@
 Includes a publisher, a consumer and a set of simple metrics.
 """
 
+import math
 import time
 import warnings
 
@@ -48,11 +49,19 @@ class MetricManager(object):
     :type on_publish: f(metric_manager)
     :param on_publish:
         Function to call immediately after metrics after published.
+    :type pre_aggregate: bool
+    :param pre_aggregate:
+        If ``True``, registered metrics aggregate the values set on them in
+        place and publish a single :class:`MetricSummary` per interval
+        instead of every value. This keeps memory use and message sizes
+        constant however often values are set, but requires aggregation
+        workers that understand summaries.
     """
 
     def __init__(self, prefix, publish_interval=5, on_publish=None,
-                 publisher=None):
+                 publisher=None, pre_aggregate=False):
         self.prefix = prefix
+        self.pre_aggregate = pre_aggregate
         self._metrics = []  # list of metrics to poll
         self._oneshot_msgs = []  # list of oneshot messages since last publish
         self._metrics_lookup = {}  # metric name -> metric
@@ -170,6 +179,202 @@ class AggregatorAlreadyDefinedError(Exception):
     pass
 
 
+class QuantileSketch(object):
+    """A mergeable sketch for estimating quantiles in bounded memory.
+
+    Values are counted in buckets whose bounds grow geometrically, so any
+    quantile can be estimated to within ``relative_accuracy`` of the true
+    value. Sketches with the same accuracy can be merged without losing
+    precision. If there are ever more than ``max_buckets`` buckets, the
+    buckets holding the smallest magnitudes are collapsed together, which
+    only affects the accuracy of the lowest quantiles.
+
+    :type relative_accuracy: float
+    :param relative_accuracy:
+        The maximum relative error of estimated quantiles.
+    :type max_buckets: int
+    :param max_buckets:
+        The maximum number of buckets kept for each sign of value.
+    """
+
+    def __init__(self, relative_accuracy=0.01, max_buckets=2048):
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.count = 0
+        self.zero_count = 0
+        self.positive = {}  # bucket index -> count
+        self.negative = {}  # bucket index -> count (of negated values)
+
+    def _index(self, value):
+        return int(math.ceil(math.log(value) / self._log_gamma))
+
+    def _value(self, index):
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def _add_to(self, buckets, index, count):
+        buckets[index] = buckets.get(index, 0) + count
+        if len(buckets) > self.max_buckets:
+            indexes = sorted(buckets)
+            excess = len(indexes) - self.max_buckets
+            target = indexes[excess]
+            for idx in indexes[:excess]:
+                buckets[target] += buckets.pop(idx)
+
+    def add(self, value):
+        """Add a value to the sketch."""
+        self.count += 1
+        if value > 0:
+            self._add_to(self.positive, self._index(value), 1)
+        elif value < 0:
+            self._add_to(self.negative, self._index(-value), 1)
+        else:
+            self.zero_count += 1
+
+    def merge(self, other):
+        """Add all the values counted by another sketch to this one."""
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError(
+                "Can't merge sketches with different accuracies: %r, %r" % (
+                    self.relative_accuracy, other.relative_accuracy))
+        self.count += other.count
+        self.zero_count += other.zero_count
+        for index, count in other.positive.iteritems():
+            self._add_to(self.positive, index, count)
+        for index, count in other.negative.iteritems():
+            self._add_to(self.negative, index, count)
+
+    def quantile(self, q):
+        """Estimate the value at quantile ``q`` (between 0 and 1).
+
+        Returns 0.0 if the sketch is empty.
+        """
+        if not self.count:
+            return 0.0
+        rank = int(q * (self.count - 1))
+        seen = 0
+        for index in sorted(self.negative, reverse=True):
+            seen += self.negative[index]
+            if seen > rank:
+                return -self._value(index)
+        seen += self.zero_count
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.positive):
+            seen += self.positive[index]
+            if seen > rank:
+                return self._value(index)
+
+    def to_dict(self):
+        return {
+            'accuracy': self.relative_accuracy,
+            'zero': self.zero_count,
+            'positive': sorted(self.positive.iteritems()),
+            'negative': sorted(self.negative.iteritems()),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data['accuracy'])
+        sketch.zero_count = data['zero']
+        sketch.positive = dict((int(i), c) for i, c in data['positive'])
+        sketch.negative = dict((int(i), c) for i, c in data['negative'])
+        sketch.count = (sketch.zero_count + sum(sketch.positive.values()) +
+                        sum(sketch.negative.values()))
+        return sketch
+
+
+class MetricSummary(object):
+    """Running aggregates of a set of metric values.
+
+    A summary takes the same amount of space however many values it has
+    seen, and summaries can be merged. Summaries are published in place of
+    the individual values by metrics managed by a pre-aggregating
+    :class:`MetricManager`.
+
+    :type sketch: :class:`QuantileSketch`
+    :param sketch:
+        A sketch to track quantiles with, if they are needed.
+    """
+
+    def __init__(self, sketch=None):
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self.last = None
+        self.last_timestamp = None
+        self.sketch = sketch
+
+    @staticmethod
+    def is_summary(value):
+        """Check whether a published value is a serialised summary."""
+        return isinstance(value, dict)
+
+    def add(self, timestamp, value):
+        """Add a value set at ``timestamp``."""
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        self._update_last(timestamp, value)
+        if self.sketch is not None:
+            self.sketch.add(value)
+
+    def _update_last(self, timestamp, value):
+        # Ties are broken by value, to match sorting (timestamp, value)
+        # pairs.
+        if (self.last_timestamp is None or
+                (timestamp, value) >= (self.last_timestamp, self.last)):
+            self.last_timestamp = timestamp
+            self.last = value
+
+    def merge(self, other):
+        """Add all the values summarised by another summary to this one."""
+        if not other.count:
+            return
+        if self.sketch is None and not self.count and other.sketch is not None:
+            self.sketch = QuantileSketch(other.sketch.relative_accuracy)
+        self.count += other.count
+        self.sum += other.sum
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+        self._update_last(other.last_timestamp, other.last)
+        if self.sketch is not None and other.sketch is not None:
+            self.sketch.merge(other.sketch)
+
+    def to_dict(self):
+        data = {
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min,
+            'max': self.max,
+            'last': self.last,
+            'last_timestamp': self.last_timestamp,
+        }
+        if self.sketch is not None:
+            data['sketch'] = self.sketch.to_dict()
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        summary = cls()
+        summary.count = data['count']
+        summary.sum = data['sum']
+        summary.min = data['min']
+        summary.max = data['max']
+        summary.last = data['last']
+        summary.last_timestamp = data['last_timestamp']
+        if 'sketch' in data:
+            summary.sketch = QuantileSketch.from_dict(data['sketch'])
+        return summary
+
+
 class Aggregator(object):
     """Registry of aggregate functions for metrics.
 
@@ -180,15 +385,24 @@ class Aggregator(object):
     :param func:
        The aggregation function. Should return a default value
        if the list of values is empty (usually this default is 0.0).
+    :type summary_func: f(:class:`MetricSummary`) -> float
+    :param summary_func:
+       An optional function that calculates the same aggregate from a
+       :class:`MetricSummary`. Only aggregators that have one can be used
+       with pre-aggregated metrics.
     """
 
     REGISTRY = {}
 
-    def __init__(self, name, func):
+    #: Whether :attr:`summary_func` needs a :class:`QuantileSketch`.
+    needs_sketch = False
+
+    def __init__(self, name, func, summary_func=None):
         if name in self.REGISTRY:
             raise AggregatorAlreadyDefinedError(name)
         self.name = name
         self.func = func
+        self.summary_func = summary_func
         self.REGISTRY[name] = self
 
     @classmethod
@@ -198,13 +412,59 @@ class Aggregator(object):
     def __call__(self, values):
         return self.func(values)
 
+    def aggregate_summary(self, summary):
+        return self.summary_func(summary)
+
+
+class QuantileAggregator(Aggregator):
+    """An aggregator that estimates a quantile of the values.
 
-SUM = Aggregator("sum", sum)
+    Pre-aggregated metrics estimate quantiles with a
+    :class:`QuantileSketch`.
+
+    :type name: str
+    :param name:
+       Short name for the aggregator.
+    :type q: float
+    :param q:
+       The quantile to estimate, between 0 and 1.
+    """
+
+    needs_sketch = True
+
+    def __init__(self, name, q):
+        self.q = q
+        super(QuantileAggregator, self).__init__(
+            name, self._quantile, self._summary_quantile)
+
+    def _quantile(self, values):
+        if not values:
+            return 0.0
+        return sorted(values)[int(self.q * (len(values) - 1))]
+
+    def _summary_quantile(self, summary):
+        if summary.sketch is None:
+            return 0.0
+        return summary.sketch.quantile(self.q)
+
+
+def _if_count(func):
+    return lambda summary: func(summary) if summary.count else 0.0
+
+
+SUM = Aggregator("sum", sum, lambda summary: summary.sum)
 AVG = Aggregator("avg",
-                 lambda values: sum(values) / len(values) if values else 0.0)
-MAX = Aggregator("max", lambda values: max(values) if values else 0.0)
-MIN = Aggregator("min", lambda values: min(values) if values else 0.0)
-LAST = Aggregator("last", lambda values: values[-1] if values else 0.0)
+                 lambda values: sum(values) / len(values) if values else 0.0,
+                 _if_count(lambda summary: summary.sum / summary.count))
+MAX = Aggregator("max", lambda values: max(values) if values else 0.0,
+                 _if_count(lambda summary: summary.max))
+MIN = Aggregator("min", lambda values: min(values) if values else 0.0,
+                 _if_count(lambda summary: summary.min))
+LAST = Aggregator("last", lambda values: values[-1] if values else 0.0,
+                  _if_count(lambda summary: summary.last))
+P50 = QuantileAggregator("p50", 0.5)
+P95 = QuantileAggregator("p95", 0.95)
+P99 = QuantileAggregator("p99", 0.99)
 
 
 class MetricRegistrationError(Exception):
@@ -245,8 +505,12 @@ class Metric(object):
             aggregators = self.DEFAULT_AGGREGATORS
         self.name = name
         self.aggs = tuple(sorted(agg.name for agg in aggregators))
+        self._needs_sketch = any(agg.needs_sketch for agg in aggregators)
         self._manager = None
         self._values = []  # list of unpolled values
+        self._pre_aggregate = False
+        self._summary = None  # summary of unpolled values if pre-aggregating
+        self._summary_timestamp = None  # when the summary was started
 
     @property
     def managed(self):
@@ -259,13 +523,36 @@ class Metric(object):
                 "Metric %s already registered with MetricManager with"
                 " prefix %s." % (self.name, self._manager.prefix))
         self._manager = manager
+        self._pre_aggregate = manager.pre_aggregate
+
+    def new_summary(self):
+        """Create an empty :class:`MetricSummary` for this metric."""
+        sketch = QuantileSketch() if self._needs_sketch else None
+        return MetricSummary(sketch)
 
     def set(self, value):
         """Append a value for later polling."""
-        self._values.append((int(time.time()), value))
+        timestamp = int(time.time())
+        if self._pre_aggregate:
+            if self._summary is None:
+                self._summary = self.new_summary()
+                self._summary_timestamp = timestamp
+            self._summary.add(timestamp, value)
+        else:
+            self._values.append((timestamp, value))
 
     def poll(self):
-        """Called periodically by the :class:`MetricManager`."""
+        """Called periodically by the :class:`MetricManager`.
+
+        If the metric is pre-aggregating, this returns at most one value,
+        a serialised :class:`MetricSummary` timestamped with the time the
+        first of its values was set.
+        """
+        if self._pre_aggregate:
+            summary, self._summary = self._summary, None
+            if summary is None:
+                return []
+            return [(self._summary_timestamp, summary.to_dict())]
         values, self._values = self._values, []
         return values
 
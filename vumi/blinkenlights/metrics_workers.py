@@ -13,7 +13,8 @@ from twisted.internet.protocol import DatagramProtocol
 
 from vumi.service import Consumer, Publisher, Worker
 from vumi.blinkenlights.metrics import (MetricsConsumer, MetricManager, Count,
-                                        Metric, Timer, Aggregator)
+                                        Metric, Timer, Aggregator,
+                                        MetricSummary, QuantileSketch)
 from vumi.blinkenlights.message20110818 import MetricMessage
 
 
@@ -52,9 +53,14 @@ class AggregatedMetricPublisher(Publisher):
     routing_key = "vumi.metrics.aggregates"
 
     def publish_aggregate(self, metric_name, timestamp, value):
-        # TODO: perhaps change interface to publish multiple metrics?
+        self.publish_aggregates([(metric_name, timestamp, value)])
+
+    def publish_aggregates(self, aggregates):
+        """Publish a list of (metric_name, timestamp, value) tuples in a
+        single message."""
         msg = MetricMessage()
-        msg.append((metric_name, (), [(timestamp, value)]))
+        msg.extend((metric_name, (), [(timestamp, value)])
+                   for metric_name, timestamp, value in aggregates)
         self.publish_message(msg)
 
 
@@ -113,22 +119,51 @@ class TimeBucketPublisher(Publisher):
         return int(md5.hexdigest(), 16) % self.buckets
 
     def publish_metric(self, metric_name, aggregates, values):
-        timestamp_buckets = {}
-        for timestamp, value in values:
-            ts_key = int(timestamp) / self.bucket_size
-            ts_bucket = timestamp_buckets.get(ts_key)
-            if ts_bucket is None:
-                ts_bucket = timestamp_buckets[ts_key] = []
-            ts_bucket.append((timestamp, value))
-
-        for ts_key, ts_bucket in timestamp_buckets.iteritems():
-            bucket = self.find_bucket(metric_name, ts_key)
+        self.publish_metrics([(metric_name, aggregates, values)])
+
+    def publish_metrics(self, datapoints):
+        """Redistribute a list of datapoints to the aggregators.
+
+        Datapoints headed for the same aggregator are published together,
+        so each call publishes at most one message per bucket.
+        """
+        bucket_msgs = {}
+        for metric_name, aggregates, values in datapoints:
+            timestamp_buckets = {}
+            for timestamp, value in values:
+                ts_key = int(timestamp) / self.bucket_size
+                ts_bucket = timestamp_buckets.get(ts_key)
+                if ts_bucket is None:
+                    ts_bucket = timestamp_buckets[ts_key] = []
+                ts_bucket.append((timestamp, value))
+
+            for ts_key, ts_bucket in timestamp_buckets.iteritems():
+                bucket = self.find_bucket(metric_name, ts_key)
+                msg = bucket_msgs.get(bucket)
+                if msg is None:
+                    msg = bucket_msgs[bucket] = MetricMessage()
+                msg.append((metric_name, aggregates, ts_bucket))
+
+        for bucket, msg in bucket_msgs.iteritems():
             routing_key = self.ROUTING_KEY_TEMPLATE % bucket
-            msg = MetricMessage()
-            msg.append((metric_name, aggregates, ts_bucket))
             self.publish_message(msg, routing_key=routing_key)
 
 
+class MetricMessageConsumer(MetricsConsumer):
+    """Consumer for metrics published by :class:`MetricManager`s that
+    handles each message's datapoints together.
+
+    :type callback: f(datapoints)
+    :param callback:
+        Called for each message as it arrives with the list of
+        (metric_name, aggregators, values) datapoints it contains.
+    """
+
+    def consume_message(self, vumi_message):
+        msg = MetricMessage.from_dict(vumi_message.payload)
+        self.callback(msg.datapoints())
+
+
 class MetricTimeBucket(Worker):
     """Gathers metrics messages and redistributes them to aggregators.
 
@@ -157,8 +192,8 @@ class MetricTimeBucket(Worker):
         log.msg("Bucket size is %d seconds" % bucket_size)
         self.publisher = yield self.start_publisher(TimeBucketPublisher,
                                                     buckets, bucket_size)
-        self.consumer = yield self.start_consumer(MetricsConsumer,
-                self.publisher.publish_metric)
+        self.consumer = yield self.start_consumer(MetricMessageConsumer,
+                self.publisher.publish_metrics)
 
 
 class DiscardedMetricError(Exception):
@@ -180,6 +215,17 @@ class MetricAggregator(Worker):
     lag : int, seconds, optional
         The number of seconds after a bucket's time ends to wait
         before processing the bucket. Default is 5s.
+
+    Buckets are checked every `bucket_size` seconds, starting from the
+    moment the next bucket is due, so each bucket is processed as soon as
+    its `lag` has passed. All the aggregates calculated for a bucket are
+    published in a single message.
+
+    Values are folded into a running :class:`MetricSummary` as they arrive
+    (along with summaries published by pre-aggregating metric managers), so
+    memory use per metric per bucket is constant. Only metrics that request
+    an aggregator which can't be calculated from a summary keep their raw
+    values.
     """
 
     _time = time.time  # hook for faking time in tests
@@ -196,8 +242,9 @@ class MetricAggregator(Worker):
         log.msg("Bucket size is %d seconds" % self.bucket_size)
         self.lag = float(self.config.get("lag", 5.0))
 
-        # ts_key -> { metric_name -> (aggregate_set, values) }
-        # values is a list of (timestamp, value) pairs
+        # ts_key -> { metric_name -> (aggregate_set, values, summary) }
+        # values is a list of (timestamp, value) pairs that haven't been
+        # summarised and summary is a MetricSummary of all the others
         self.buckets = {}
         # initialize last processed bucket
         self._last_ts_key = self._ts_key(self._time() - self.lag) - 2
@@ -207,7 +254,19 @@ class MetricAggregator(Worker):
                                                   bucket, self.consume_metric)
 
         self._task = LoopingCall(self.check_buckets)
-        done = self._task.start(self.bucket_size, False)
+        self._task_start = reactor.callLater(
+            self._next_check_delay(), self._start_checking)
+
+    def _next_check_delay(self):
+        """Return the number of seconds until the next bucket is due."""
+        now = self._time()
+        next_due = (self._ts_key(now - self.lag) + 1) * self.bucket_size
+        # Aim just past the boundary so that rounding can't make the check
+        # miss the bucket it was scheduled for.
+        return next_due + self.lag - now + 0.001
+
+    def _start_checking(self):
+        done = self._task.start(self.bucket_size, True)
         done.addErrback(lambda failure: log.err(failure,
                         "MetricAggregator bucket checking task died"))
 
@@ -224,17 +283,30 @@ class MetricAggregator(Worker):
                 aggregates = []
                 ts = ts_key * self.bucket_size
                 items = self.buckets[ts_key].iteritems()
-                for metric_name, (agg_set, values) in items:
-                    values = [v for t, v in sorted(values)]
+                for metric_name, (agg_set, values, summary) in items:
+                    if values:
+                        # Only metrics with aggregators that can't use a
+                        # summary keep raw values, and those may care about
+                        # their order.
+                        values.sort()
+                        for timestamp, value in values:
+                            summary.add(timestamp, value)
+                        values = [v for t, v in values]
                     for agg_name in agg_set:
                         agg_metric = "%s.%s" % (metric_name, agg_name)
                         agg_func = Aggregator.from_name(agg_name)
-                        agg_value = agg_func(values)
-                        aggregates.append((agg_metric, agg_value))
-
-                for agg_metric, agg_value in aggregates:
-                    self.publisher.publish_aggregate(agg_metric, ts,
-                                                     agg_value)
+                        if agg_func.summary_func is not None:
+                            agg_value = agg_func.aggregate_summary(summary)
+                        elif summary.count > len(values):
+                            log.msg("Can't calculate %s from summarised"
+                                    " values, skipping." % (agg_metric,))
+                            continue
+                        else:
+                            agg_value = agg_func(values)
+                        aggregates.append((agg_metric, ts, agg_value))
+
+                if aggregates:
+                    self.publisher.publish_aggregates(aggregates)
                 del self.buckets[ts_key]
         self._last_ts_key = current_ts_key
 
@@ -247,13 +319,30 @@ class MetricAggregator(Worker):
             metrics = self.buckets[ts_key] = {}
         metric = metrics.get(metric_name)
         if metric is None:
-            metric = metrics[metric_name] = (set(), [])
-        existing_aggregates, existing_values = metric
+            aggs = [Aggregator.from_name(name) for name in aggregates]
+            sketch = None
+            if any(agg.needs_sketch for agg in aggs):
+                sketch = QuantileSketch()
+            metric = metrics[metric_name] = (
+                set(), [], MetricSummary(sketch))
+        existing_aggregates, existing_values, summary = metric
         existing_aggregates.update(aggregates)
-        existing_values.extend(values)
+        summarise = all(
+            Aggregator.from_name(name).summary_func is not None
+            for name in existing_aggregates)
+        for timestamp, value in values:
+            if MetricSummary.is_summary(value):
+                summary.merge(MetricSummary.from_dict(value))
+            elif summarise:
+                summary.add(timestamp, value)
+            else:
+                existing_values.append((timestamp, value))
 
     def stopWorker(self):
-        self._task.stop()
+        if self._task_start.active():
+            self._task_start.cancel()
+        if self._task.running:
+            self._task.stop()
         self.check_buckets()
 
 
@@ -182,6 +182,24 @@ class TestMetricManager(VumiTestCase):
         mm.publish_metrics()
         self._check_msg(mm, cnt, [1])
 
+    @inlineCallbacks
+    def test_publish_metrics_poll_pre_aggregate(self):
+        mm = metrics.MetricManager(
+            "vumi.test.", 0.1, self.on_publish, pre_aggregate=True)
+        cnt = mm.register(metrics.Count("my.count"))
+        yield self.start_manager_as_publisher(mm)
+
+        cnt.inc()
+        cnt.inc()
+        mm.publish_metrics()
+        msgs = yield self.worker_helper.wait_for_dispatched_metrics()
+        [datapoint] = msgs[-1]
+        self.assertEqual(datapoint[0], "vumi.test.my.count")
+        [(_timestamp, value)] = datapoint[2]
+        summary = metrics.MetricSummary.from_dict(value)
+        self.assertEqual(summary.count, 2)
+        self.assertEqual(metrics.SUM.aggregate_summary(summary), 2.0)
+
     @inlineCallbacks
     def test_publish_metrics_oneshot(self):
         mm = metrics.MetricManager("vumi.test.", 0.1, self.on_publish)
@@ -271,7 +289,15 @@ class TestMetricManager(VumiTestCase):
         self.assertTrue(error.type is BadMetricError)
 
 
-class TestAggregators(VumiTestCase):
+class AssertCloseMixin(object):
+
+    def assert_close(self, actual, expected, tolerance):
+        self.assertTrue(
+            abs(actual - expected) <= tolerance,
+            "%r not within %r of %r" % (actual, tolerance, expected))
+
+
+class TestAggregators(VumiTestCase, AssertCloseMixin):
     def test_sum(self):
         self.assertEqual(metrics.SUM([]), 0.0)
         self.assertEqual(metrics.SUM([1.0, 2.0]), 3.0)
@@ -307,11 +333,143 @@ class TestAggregators(VumiTestCase):
         self.assertEqual(metrics.LAST.name, "last")
         self.assertEqual(metrics.Aggregator.from_name("last"), metrics.LAST)
 
+    def test_quantiles(self):
+        values = [float(v) for v in range(1, 101)]
+        self.assertEqual(metrics.P50([]), 0.0)
+        self.assertEqual(metrics.P50(values), 50.0)
+        self.assertEqual(metrics.P95(values), 95.0)
+        self.assertEqual(metrics.P99(list(reversed(values))), 99.0)
+        self.assertEqual(metrics.P95.name, "p95")
+        self.assertEqual(metrics.Aggregator.from_name("p95"), metrics.P95)
+
+    def test_summary_funcs(self):
+        summary = metrics.MetricSummary(metrics.QuantileSketch())
+        empty = metrics.MetricSummary()
+        for timestamp, value in [(1, 2.0), (2, 1.0), (2, 0.5)]:
+            summary.add(timestamp, value)
+        expected = [
+            (metrics.SUM, 3.5), (metrics.AVG, 3.5 / 3), (metrics.MIN, 0.5),
+            (metrics.MAX, 2.0), (metrics.LAST, 1.0)]
+        for agg, value in expected:
+            self.assertEqual(agg.aggregate_summary(summary), value)
+            self.assertEqual(agg.aggregate_summary(empty), 0.0)
+        self.assert_close(
+            metrics.P50.aggregate_summary(summary), 1.0, 0.01)
+        self.assertEqual(metrics.P50.aggregate_summary(empty), 0.0)
+
     def test_already_registered(self):
         self.assertRaises(metrics.AggregatorAlreadyDefinedError,
                           metrics.Aggregator, "sum", sum)
 
 
+class TestQuantileSketch(VumiTestCase, AssertCloseMixin):
+    def assert_quantiles(self, sketch, values):
+        values = sorted(values)
+        for q in [0.0, 0.1, 0.5, 0.9, 0.95, 0.99, 1.0]:
+            expected = values[int(q * (len(values) - 1))]
+            self.assert_close(
+                sketch.quantile(q), expected,
+                abs(expected) * sketch.relative_accuracy)
+
+    def test_empty(self):
+        sketch = metrics.QuantileSketch()
+        self.assertEqual(sketch.count, 0)
+        self.assertEqual(sketch.quantile(0.5), 0.0)
+
+    def test_quantiles(self):
+        sketch = metrics.QuantileSketch()
+        values = [v * 0.37 for v in range(-200, 1000)]
+        for value in values:
+            sketch.add(value)
+        self.assertEqual(sketch.count, len(values))
+        self.assert_quantiles(sketch, values)
+
+    def test_merge(self):
+        sketch1 = metrics.QuantileSketch()
+        sketch2 = metrics.QuantileSketch()
+        values = [1.5 ** (v % 40) for v in range(500)]
+        for i, value in enumerate(values):
+            [sketch1, sketch2][i % 2].add(value)
+        sketch1.merge(sketch2)
+        self.assertEqual(sketch1.count, len(values))
+        self.assert_quantiles(sketch1, values)
+
+    def test_merge_different_accuracies(self):
+        self.assertRaises(
+            ValueError, metrics.QuantileSketch(0.01).merge,
+            metrics.QuantileSketch(0.02))
+
+    def test_max_buckets(self):
+        sketch = metrics.QuantileSketch(max_buckets=10)
+        values = [1.1 ** v for v in range(100)]
+        for value in values:
+            sketch.add(value)
+        self.assertEqual(len(sketch.positive), 10)
+        self.assertEqual(sketch.count, len(values))
+        self.assert_close(
+            sketch.quantile(0.99), values[98], values[98] * 0.01)
+
+    def test_dict_round_trip(self):
+        sketch = metrics.QuantileSketch()
+        for value in [-3.0, 0.0, 0.0, 1.0, 2.0, 400.0]:
+            sketch.add(value)
+        data = sketch.to_dict()
+        copy = metrics.QuantileSketch.from_dict(data)
+        self.assertEqual(copy.to_dict(), data)
+        self.assertEqual(copy.count, 6)
+        self.assertEqual(copy.quantile(0.5), sketch.quantile(0.5))
+
+
+class TestMetricSummary(VumiTestCase):
+    def test_add(self):
+        summary = metrics.MetricSummary()
+        summary.add(10, 3.0)
+        summary.add(12, 1.0)
+        summary.add(11, 5.0)
+        self.assertEqual(
+            (summary.count, summary.sum, summary.min, summary.max),
+            (3, 9.0, 1.0, 5.0))
+        self.assertEqual((summary.last_timestamp, summary.last), (12, 1.0))
+
+    def test_last_ties_broken_by_value(self):
+        summary = metrics.MetricSummary()
+        summary.add(10, 3.0)
+        summary.add(10, 1.0)
+        self.assertEqual(summary.last, 3.0)
+
+    def test_merge(self):
+        summary1 = metrics.MetricSummary()
+        summary1.add(10, 3.0)
+        summary2 = metrics.MetricSummary(metrics.QuantileSketch())
+        summary2.add(11, 1.0)
+        summary2.add(9, 5.0)
+        summary1.merge(summary2)
+        self.assertEqual(
+            (summary1.count, summary1.sum, summary1.min, summary1.max),
+            (3, 9.0, 1.0, 5.0))
+        self.assertEqual(summary1.last, 1.0)
+        # summary1 had values before it saw a sketch, so it can't have one
+        self.assertEqual(summary1.sketch, None)
+
+    def test_merge_adopts_sketch(self):
+        summary1 = metrics.MetricSummary()
+        summary2 = metrics.MetricSummary(metrics.QuantileSketch())
+        summary2.add(11, 1.0)
+        summary1.merge(summary2)
+        self.assertEqual(summary1.sketch.count, 1)
+
+    def test_dict_round_trip(self):
+        summary = metrics.MetricSummary(metrics.QuantileSketch())
+        summary.add(10, 3.0)
+        summary.add(11, 1.0)
+        data = summary.to_dict()
+        self.assertTrue(metrics.MetricSummary.is_summary(data))
+        self.assertFalse(metrics.MetricSummary.is_summary(1.0))
+        copy = metrics.MetricSummary.from_dict(data)
+        self.assertEqual(copy.to_dict(), data)
+        self.assertEqual(copy.sketch.count, 2)
+
+
 class CheckValuesMixin(object):
 
     def _check_poll_base(self, metric, n):
@@ -338,7 +496,7 @@ class CheckValuesMixin(object):
         self.assertEqual(actual_values, expected_values)
 
 
-class TestMetric(VumiTestCase, CheckValuesMixin):
+class TestMetric(VumiTestCase, CheckValuesMixin, AssertCloseMixin):
     def test_manage(self):
         mm = metrics.MetricManager("vumi.test.")
         metric = metrics.Metric("foo")
@@ -362,6 +520,28 @@ class TestMetric(VumiTestCase, CheckValuesMixin):
         metric.set(2.0)
         self.check_poll(metric, [1.0, 2.0])
 
+    def test_poll_pre_aggregate(self):
+        mm = metrics.MetricManager("vumi.test.", pre_aggregate=True)
+        metric = mm.register(metrics.Metric("foo"))
+        self.check_poll(metric, [])
+        metric.set(1.0)
+        metric.set(2.0)
+        [data] = self._check_poll_base(metric, 1)
+        summary = metrics.MetricSummary.from_dict(data)
+        self.assertEqual((summary.count, summary.sum), (2, 3.0))
+        self.assertEqual(summary.sketch, None)
+        self.check_poll(metric, [])
+
+    def test_poll_pre_aggregate_quantiles(self):
+        mm = metrics.MetricManager("vumi.test.", pre_aggregate=True)
+        metric = mm.register(metrics.Metric("foo", [metrics.P99]))
+        for value in range(1000):
+            metric.set(float(value))
+        [data] = self._check_poll_base(metric, 1)
+        summary = metrics.MetricSummary.from_dict(data)
+        self.assert_close(
+            metrics.P99.aggregate_summary(summary), 989.0, 9.9)
+
 
 class TestCount(VumiTestCase, CheckValuesMixin):
     def test_inc_and_poll(self):
@@ -3,6 +3,7 @@ from twisted.internet.protocol import DatagramProtocol
 from twisted.internet import reactor
 
 from vumi.blinkenlights import metrics_workers
+from vumi.blinkenlights.metrics import MetricSummary, QuantileSketch
 from vumi.blinkenlights.message20110818 import MetricMessage
 from vumi.tests.helpers import VumiTestCase, WorkerHelper
 
@@ -52,8 +53,8 @@ class TestMetricTimeBucket(VumiTestCase):
         expected_buckets = [
             [],
             [[[u'vumi.test.bar', ['sum'], [[1240, 1.0]]]]],
-            [[[u'vumi.test.foo', ['agg'], [[1230, 1.5]]]],
-             [[u'vumi.test.foo', ['agg'], [[1235, 2.0]]]]],
+            [[[u'vumi.test.foo', ['agg'], [[1230, 1.5]]],
+              [u'vumi.test.foo', ['agg'], [[1235, 2.0]]]]],
             [],
             ]
 
@@ -152,6 +153,82 @@ class TestMetricAggregator(VumiTestCase):
         worker.check_buckets()
         self.assertEqual(recv(), expected)
 
+    @inlineCallbacks
+    def test_aggregating_summaries(self):
+        config = {'bucket': 3, 'bucket_size': 5}
+        worker = yield self.worker_helper.get_worker(
+            metrics_workers.MetricAggregator, config, start=False)
+        worker._time = self.fake_time
+        yield worker.startWorker()
+
+        summary = MetricSummary()
+        summary.add(1235, 1.5)
+        summary.add(1236, 2.0)
+        aggs = ("avg", "last", "max", "min", "sum")
+        self.broker.send_datapoints("vumi.metrics.buckets", "bucket.3", [
+            ("vumi.test.foo", aggs, [(1235, summary.to_dict())]),
+            ("vumi.test.foo", aggs, [(1237, 0.5)]),
+        ])
+        yield self.broker.kick_delivery()
+
+        self.now = 1246
+        worker.check_buckets()
+        [datapoints] = self.broker.recv_datapoints(
+            "vumi.metrics.aggregates", "vumi.metrics.aggregates")
+        self.assertEqual(sorted(datapoints), [
+            ["vumi.test.foo.avg", [], [[1235, 4.0 / 3]]],
+            ["vumi.test.foo.last", [], [[1235, 0.5]]],
+            ["vumi.test.foo.max", [], [[1235, 2.0]]],
+            ["vumi.test.foo.min", [], [[1235, 0.5]]],
+            ["vumi.test.foo.sum", [], [[1235, 4.0]]],
+        ])
+        self.assertEqual(worker.buckets, {})
+
+    @inlineCallbacks
+    def test_aggregating_quantiles(self):
+        config = {'bucket': 3, 'bucket_size': 5}
+        worker = yield self.worker_helper.get_worker(
+            metrics_workers.MetricAggregator, config, start=False)
+        worker._time = self.fake_time
+        yield worker.startWorker()
+
+        summary = MetricSummary(QuantileSketch())
+        for value in range(1, 51):
+            summary.add(1235, float(value))
+        self.broker.send_datapoints("vumi.metrics.buckets", "bucket.3", [
+            ("vumi.test.foo", ("p50", "p99"), [(1235, summary.to_dict())]),
+            ("vumi.test.foo", ("p50", "p99"),
+             [(1236, float(value)) for value in range(51, 101)]),
+        ])
+        yield self.broker.kick_delivery()
+
+        self.now = 1246
+        worker.check_buckets()
+        [datapoints] = self.broker.recv_datapoints(
+            "vumi.metrics.aggregates", "vumi.metrics.aggregates")
+        [(p50_name, _, [(_, p50)]), (p99_name, _, [(_, p99)])] = sorted(
+            datapoints)
+        self.assertEqual(p50_name, "vumi.test.foo.p50")
+        self.assertTrue(abs(p50 - 50.0) <= 0.5)
+        self.assertEqual(p99_name, "vumi.test.foo.p99")
+        self.assertTrue(abs(p99 - 99.0) <= 0.99)
+
+    @inlineCallbacks
+    def test_next_check_delay(self):
+        config = {'bucket': 3, 'bucket_size': 5, 'lag': 1}
+        worker = yield self.worker_helper.get_worker(
+            metrics_workers.MetricAggregator, config, start=False)
+        worker._time = self.fake_time
+        self.now = 1241.5
+        yield worker.startWorker()
+
+        # The bucket for 1240 to 1245 is due at 1246.
+        self.assertTrue(abs(worker._next_check_delay() - 4.5) < 0.01)
+        self.now = 1245.9
+        self.assertTrue(abs(worker._next_check_delay() - 0.1) < 0.01)
+        self.now = 1246.0
+        self.assertTrue(abs(worker._next_check_delay() - 5.0) < 0.01)
+
     @inlineCallbacks
     def test_aggregating_lag(self):
         config = {'bucket': 3, 'bucket_size': 5, 'lag': 1}
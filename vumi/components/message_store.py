@@ -10,7 +10,8 @@ from uuid import uuid4
 import itertools
 import warnings
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, gatherResults, FirstError)
 
 from vumi.message import (
     TransportEvent, TransportUserMessage, parse_vumi_date, format_vumi_date)
@@ -19,6 +20,7 @@ from vumi.persist.fields import (
     VumiMessage, ForeignKey, ManyToMany, ListOf, Tag, Dynamic, Unicode)
 from vumi.persist.txriak_manager import TxRiakManager
 from vumi import log
+from vumi.utils import LRUCache
 from vumi.components.message_store_cache import MessageStoreCache
 from vumi.components.message_store_migrators import (
     EventMigrator, InboundMessageMigrator, OutboundMessageMigrator)
@@ -212,6 +214,89 @@ class ReconKeyManager(object):
         return itertools.chain(self.cache_keys, self.new_keys)
 
 
+def _unwrap_first_error(failure):
+    failure.trap(FirstError)
+    return failure.value.subFailure
+
+
+class ReconCheckpoint(object):
+    """
+    The progress of a cache recon for one direction of a batch.
+
+    This holds everything needed to carry on from the last fully processed
+    index page, so it can be stored in the cache and used to resume a recon
+    that was interrupted.
+
+    Once all the index pages have been processed, the counts are added to
+    the cache counters in the same atomic step that stores a checkpoint with
+    :attr:`counts_applied` set, so a resumed recon never adds them twice.
+    """
+
+    def __init__(self, direction, start_timestamp, key_count=0,
+                 status_counts=None, cache_keys=(), new_keys=(),
+                 last_timestamp=None, last_keys=(), counts_applied=False):
+        self.direction = direction
+        self.start_timestamp = start_timestamp
+        self.key_count = key_count
+        self.status_counts = defaultdict(int, status_counts or {})
+        self.cache_keys = [tuple(k) for k in cache_keys]
+        self.new_keys = [tuple(k) for k in new_keys]
+        self.last_timestamp = last_timestamp
+        self.last_keys = set(last_keys)
+        self.counts_applied = counts_applied
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+    def to_dict(self):
+        return {
+            'direction': self.direction,
+            'start_timestamp': self.start_timestamp,
+            'key_count': self.key_count,
+            'status_counts': dict(self.status_counts),
+            'cache_keys': self.cache_keys,
+            'new_keys': self.new_keys,
+            'last_timestamp': self.last_timestamp,
+            'last_keys': sorted(self.last_keys),
+            'counts_applied': self.counts_applied,
+        }
+
+    def key_manager(self, key_count):
+        """
+        Return a :class:`ReconKeyManager` holding the recent keys stored in
+        this checkpoint.
+        """
+        key_manager = ReconKeyManager(self.start_timestamp, key_count)
+        key_manager.cache_keys.extend(self.cache_keys)
+        key_manager.new_keys.extend(self.new_keys)
+        return key_manager
+
+    def unseen(self, rows):
+        """
+        Return the index ``rows`` that were not processed before this
+        checkpoint was made.
+
+        Index queries are resumed from :attr:`last_timestamp`, so only rows
+        with that timestamp can have been seen before.
+        """
+        return [row for row in rows
+                if not (row[1] == self.last_timestamp and
+                        row[0] in self.last_keys)]
+
+    def update(self, key_manager, rows):
+        """
+        Record the state of ``key_manager`` after processing ``rows``.
+        """
+        self.cache_keys = list(key_manager.cache_keys)
+        self.new_keys = list(key_manager.new_keys)
+        for row in rows:
+            if row[1] != self.last_timestamp:
+                self.last_timestamp = row[1]
+                self.last_keys = set()
+            self.last_keys.add(row[0])
+
+
 class MessageStore(object):
     """Vumi message store.
 
@@ -222,13 +307,30 @@ class MessageStore(object):
     A small amount of information about the state of a batch (i.e. number
     of messages in the batch, messages sent, acknowledgements and delivery
     reports received) is stored in Redis.
+
+    If ``lookup_cache_size`` is non-zero, the current batch for each tag
+    and loaded :class:`Batch` records are kept in an in-process LRU cache
+    for up to ``lookup_cache_ttl`` seconds. The cache is kept up to date by
+    :meth:`batch_start` and :meth:`batch_done` on this store, but changes
+    made by other processes may take up to ``lookup_cache_ttl`` seconds to
+    be seen.
     """
 
     # The Python Riak client defaults to max_results=1000 in places.
     DEFAULT_MAX_RESULTS = 1000
 
-    def __init__(self, manager, redis):
+    # The maximum number of index queries or cache updates for individual
+    # messages that are in flight at once during cache recon.
+    RECON_CONCURRENCY = 10
+
+    # The maximum number of records stored at once by the bulk add methods.
+    BULK_STORE_CONCURRENCY = 10
+
+    def __init__(self, manager, redis, lookup_cache_size=0,
+                 lookup_cache_ttl=60):
         self.manager = manager
+        self.tag_cache = LRUCache(lookup_cache_size, lookup_cache_ttl)
+        self.batch_cache = LRUCache(lookup_cache_size, lookup_cache_ttl)
         self.batches = manager.proxy(Batch)
         self.outbound_messages = manager.proxy(OutboundMessage)
         self.events = manager.proxy(Event)
@@ -263,77 +365,165 @@ class MessageStore(object):
         returnValue(False)
 
     @Manager.calls_manager
-    def reconcile_cache(self, batch_id, start_timestamp=None):
+    def reconcile_cache(self, batch_id, start_timestamp=None, resume=False):
         """
         Rebuild the cache for the given batch.
 
+        Progress is checkpointed in the cache after each index page. If
+        ``resume`` is ``True`` and an earlier recon of this batch was
+        interrupted, the recon carries on from its last checkpoint instead of
+        starting from scratch.
+
         The ``start_timestamp`` parameter is used for testing only.
         """
-        if start_timestamp is None:
-            start_timestamp = format_vumi_date(datetime.utcnow())
-        yield self.cache.clear_batch(batch_id)
-        yield self.cache.batch_start(batch_id)
-        yield self.reconcile_outbound_cache(batch_id, start_timestamp)
-        yield self.reconcile_inbound_cache(batch_id, start_timestamp)
+        checkpoint = None
+        if resume:
+            checkpoint_data = yield self.cache.get_recon_checkpoint(batch_id)
+            if checkpoint_data is not None:
+                checkpoint = ReconCheckpoint.from_dict(checkpoint_data)
+
+        if checkpoint is None:
+            if start_timestamp is None:
+                start_timestamp = format_vumi_date(datetime.utcnow())
+            yield self.cache.clear_batch(batch_id)
+            yield self.cache.batch_start(batch_id)
+            checkpoint = ReconCheckpoint('outbound', start_timestamp)
+
+        if checkpoint.direction == 'outbound':
+            yield self.reconcile_outbound_cache(
+                batch_id, checkpoint.start_timestamp, checkpoint)
+            checkpoint = ReconCheckpoint(
+                'inbound', checkpoint.start_timestamp)
+            yield self.cache.set_recon_checkpoint(
+                batch_id, checkpoint.to_dict())
+        yield self.reconcile_inbound_cache(
+            batch_id, checkpoint.start_timestamp, checkpoint)
+        yield self.cache.clear_recon_checkpoint(batch_id)
 
     @Manager.calls_manager
-    def reconcile_inbound_cache(self, batch_id, start_timestamp):
+    def _concurrent_map(self, func, args_list, concurrency=None):
         """
-        Rebuild the inbound message cache.
+        Call ``func`` with each tuple of arguments in ``args_list``, with at
+        most ``concurrency`` (defaulting to :attr:`RECON_CONCURRENCY`) calls
+        in flight at once, and return a list of the results.
         """
-        key_manager = ReconKeyManager(
-            start_timestamp, self.cache.TRUNCATE_MESSAGE_KEY_COUNT_AT)
-        key_count = 0
+        if concurrency is None:
+            concurrency = self.RECON_CONCURRENCY
+        results = []
+        for i in xrange(0, len(args_list), concurrency):
+            chunk = args_list[i:i + concurrency]
+            chunk_results = [func(*args) for args in chunk]
+            if isinstance(self.manager, TxRiakManager):
+                d = gatherResults(chunk_results, consumeErrors=True)
+                d.addErrback(_unwrap_first_error)
+                chunk_results = yield d
+            results.extend(chunk_results)
+        returnValue(results)
 
-        index_page = yield self.batch_inbound_keys_with_addresses(batch_id)
+    @Manager.calls_manager
+    def _reconcile_index_pages(self, batch_id, index_page, checkpoint,
+                               key_manager, process_rows):
+        """
+        Walk the pages of a recon index query, feeding the rows of each page
+        through ``key_manager`` and ``process_rows`` and storing
+        ``checkpoint`` afterwards.
+
+        The next page is fetched while the current one is being processed.
+        """
         while index_page is not None:
-            for key, timestamp, addr in index_page:
-                yield self.cache.add_from_addr(batch_id, addr)
+            next_page_d = index_page.next_page()
+            rows = checkpoint.unseen(list(index_page))
+            old_keys = []
+            for key, timestamp, addr in rows:
                 old_key = key_manager.add_key(key, timestamp)
                 if old_key is not None:
-                    key_count += 1
-            index_page = yield index_page.next_page()
+                    old_keys.append(old_key)
+            checkpoint.key_count += len(old_keys)
+            yield process_rows(rows, old_keys)
+            checkpoint.update(key_manager, rows)
+            yield self.cache.set_recon_checkpoint(
+                batch_id, checkpoint.to_dict())
+            index_page = yield next_page_d
 
-        yield self.cache.add_inbound_message_count(batch_id, key_count)
-        for key, timestamp in key_manager:
-            try:
-                yield self.cache.add_inbound_message_key(
-                    batch_id, key, self.cache.get_timestamp(timestamp))
-            except:
-                log.err()
+    @Manager.calls_manager
+    def reconcile_inbound_cache(self, batch_id, start_timestamp,
+                                checkpoint=None):
+        """
+        Rebuild the inbound message cache.
+        """
+        if checkpoint is None:
+            checkpoint = ReconCheckpoint('inbound', start_timestamp)
+        key_manager = checkpoint.key_manager(
+            self.cache.TRUNCATE_MESSAGE_KEY_COUNT_AT)
+
+        def process_rows(rows, old_keys):
+            addrs = set(addr for key, timestamp, addr in rows)
+            if addrs:
+                return self.cache.add_from_addrs(batch_id, addrs)
+
+        if not checkpoint.counts_applied:
+            index_page = yield self.batch_inbound_keys_with_addresses(
+                batch_id, start=checkpoint.last_timestamp)
+            yield self._reconcile_index_pages(
+                batch_id, index_page, checkpoint, key_manager, process_rows)
+            checkpoint.counts_applied = True
+            yield self.cache.add_inbound_recon_counts(
+                batch_id, checkpoint.key_count, checkpoint.to_dict())
+        yield self._concurrent_map(
+            self._reconcile_inbound_key,
+            [(batch_id, key, timestamp) for key, timestamp in key_manager])
 
     @Manager.calls_manager
-    def reconcile_outbound_cache(self, batch_id, start_timestamp):
+    def _reconcile_inbound_key(self, batch_id, key, timestamp):
+        try:
+            yield self.cache.add_inbound_message_key(
+                batch_id, key, self.cache.get_timestamp(timestamp))
+        except:
+            log.err()
+
+    @Manager.calls_manager
+    def reconcile_outbound_cache(self, batch_id, start_timestamp,
+                                 checkpoint=None):
         """
         Rebuild the outbound message cache.
         """
-        key_manager = ReconKeyManager(
-            start_timestamp, self.cache.TRUNCATE_MESSAGE_KEY_COUNT_AT)
-        key_count = 0
-        status_counts = defaultdict(int)
-
-        index_page = yield self.batch_outbound_keys_with_addresses(batch_id)
-        while index_page is not None:
-            for key, timestamp, addr in index_page:
-                yield self.cache.add_to_addr(batch_id, addr)
-                old_key = key_manager.add_key(key, timestamp)
-                if old_key is not None:
-                    key_count += 1
-                    sc = yield self.get_event_counts(old_key[0])
-                    for status, count in sc.iteritems():
-                        status_counts[status] += count
-            index_page = yield index_page.next_page()
+        if checkpoint is None:
+            checkpoint = ReconCheckpoint('outbound', start_timestamp)
+        key_manager = checkpoint.key_manager(
+            self.cache.TRUNCATE_MESSAGE_KEY_COUNT_AT)
+
+        def process_rows(rows, old_keys):
+            addrs = set(addr for key, timestamp, addr in rows)
+            if addrs:
+                yield self.cache.add_to_addrs(batch_id, addrs)
+            event_counts = yield self._concurrent_map(
+                self.get_event_counts, [(key,) for key, _ in old_keys])
+            for sc in event_counts:
+                for status, count in sc.iteritems():
+                    checkpoint.status_counts[status] += count
+        process_rows = self.manager.call_decorator(process_rows)
+
+        if not checkpoint.counts_applied:
+            index_page = yield self.batch_outbound_keys_with_addresses(
+                batch_id, start=checkpoint.last_timestamp)
+            yield self._reconcile_index_pages(
+                batch_id, index_page, checkpoint, key_manager, process_rows)
+            checkpoint.counts_applied = True
+            yield self.cache.add_outbound_recon_counts(
+                batch_id, checkpoint.key_count, checkpoint.status_counts,
+                checkpoint.to_dict())
+        yield self._concurrent_map(
+            self._reconcile_outbound_key,
+            [(batch_id, key, timestamp) for key, timestamp in key_manager])
 
-        yield self.cache.add_outbound_message_count(batch_id, key_count)
-        for status, count in status_counts.iteritems():
-            yield self.cache.add_event_count(batch_id, status, count)
-        for key, timestamp in key_manager:
-            try:
-                yield self.cache.add_outbound_message_key(
-                    batch_id, key, self.cache.get_timestamp(timestamp))
-                yield self.reconcile_event_cache(batch_id, key)
-            except:
-                log.err()
+    @Manager.calls_manager
+    def _reconcile_outbound_key(self, batch_id, key, timestamp):
+        try:
+            yield self.cache.add_outbound_message_key(
+                batch_id, key, self.cache.get_timestamp(timestamp))
+            yield self.reconcile_event_cache(batch_id, key)
+        except:
+            log.err()
 
     @Manager.calls_manager
     def get_event_counts(self, message_id):
@@ -358,11 +548,17 @@ class MessageStore(object):
     def reconcile_event_cache(self, batch_id, message_id):
         """
         Update the event cache for a particular message.
+
+        Event keys, timestamps and statuses come from the message's event
+        index, so the events themselves are not loaded.
         """
-        event_keys = yield self.message_event_keys(message_id)
-        for event_key in event_keys:
-            event = yield self.get_event(event_key)
-            yield self.cache.add_event(batch_id, event)
+        index_page = yield self.message_event_keys_with_statuses(message_id)
+        while index_page is not None:
+            for key, timestamp, status in index_page:
+                yield self.cache.add_event_key_with_status(
+                    batch_id, key, self.cache.get_timestamp(timestamp),
+                    status)
+            index_page = yield index_page.next_page()
 
     @Manager.calls_manager
     def batch_start(self, tags=(), **metadata):
@@ -379,7 +575,9 @@ class MessageStore(object):
                 tag_record = self.current_tags(tag)
             tag_record.current_batch.set(batch)
             yield tag_record.save()
+            self.tag_cache.set(tuple(tag), batch_id)
 
+        self.batch_cache.set(batch_id, batch)
         yield self.cache.batch_start(batch_id)
         returnValue(batch_id)
 
@@ -391,6 +589,87 @@ class MessageStore(object):
             for tag in (yield tags_bunch):
                 tag.current_batch.set(None)
                 yield tag.save()
+                self.tag_cache.set(CurrentTag._split_key(tag.key), None)
+        self.batch_cache.invalidate(batch_id)
+
+    def lookup_cache_stats(self):
+        """
+        Return a dict of hit and miss counts for the tag and batch lookup
+        caches.
+        """
+        return {
+            'tag_hits': self.tag_cache.hits,
+            'tag_misses': self.tag_cache.misses,
+            'batch_hits': self.batch_cache.hits,
+            'batch_misses': self.batch_cache.misses,
+        }
+
+    @Manager.calls_manager
+    def _current_batch_id(self, tag):
+        """
+        Return the current batch_id for ``tag``, or ``None`` if it has no
+        current batch.
+        """
+        found, batch_id = self.tag_cache.lookup(tuple(tag))
+        if not found:
+            tag_record = yield self.current_tags.load(tag)
+            if tag_record is not None:
+                batch_id = tag_record.current_batch.key
+            self.tag_cache.set(tuple(tag), batch_id)
+        returnValue(batch_id)
+
+    @Manager.calls_manager
+    def _resolve_batch_ids(self, tag, batch_id, batch_ids):
+        """
+        Return the list of batch_ids a message should be added to.
+        """
+        if batch_id is None and tag is not None:
+            batch_id = yield self._current_batch_id(tag)
+
+        batch_ids = list(batch_ids)
+        if batch_id is not None:
+            batch_ids.append(batch_id)
+        returnValue(batch_ids)
+
+    @Manager.calls_manager
+    def _load_records(self, model_proxy, keys):
+        """
+        Load the records for ``keys`` in bunches and return a dict mapping
+        keys to records. Keys without records are left out.
+        """
+        records = {}
+        for bunch in model_proxy.load_all_bunches(list(set(keys))):
+            for record in (yield bunch):
+                records[record.key] = record
+        returnValue(records)
+
+    def _save_records(self, records):
+        """
+        Save ``records``, with at most :attr:`BULK_STORE_CONCURRENCY` saves
+        in flight at once.
+        """
+        return self._concurrent_map(
+            lambda record: record.save(), [(record,) for record in records],
+            self.BULK_STORE_CONCURRENCY)
+
+    @Manager.calls_manager
+    def _add_messages(self, model_proxy, cache_func, msgs, batch_ids):
+        records = yield self._load_records(
+            model_proxy, [msg['message_id'] for msg in msgs])
+        for msg in msgs:
+            msg_id = msg['message_id']
+            msg_record = records.get(msg_id)
+            if msg_record is None:
+                msg_record = records[msg_id] = model_proxy(msg_id, msg=msg)
+            else:
+                msg_record.msg = msg
+            for batch_id in batch_ids:
+                msg_record.batches.add_key(batch_id)
+
+        for batch_id in batch_ids:
+            yield cache_func(batch_id, msgs)
+
+        yield self._save_records(records.values())
 
     @Manager.calls_manager
     def add_outbound_message(self, msg, tag=None, batch_id=None, batch_ids=()):
@@ -401,14 +680,7 @@ class MessageStore(object):
         else:
             msg_record.msg = msg
 
-        if batch_id is None and tag is not None:
-            tag_record = yield self.current_tags.load(tag)
-            if tag_record is not None:
-                batch_id = tag_record.current_batch.key
-
-        batch_ids = list(batch_ids)
-        if batch_id is not None:
-            batch_ids.append(batch_id)
+        batch_ids = yield self._resolve_batch_ids(tag, batch_id, batch_ids)
 
         for batch_id in batch_ids:
             msg_record.batches.add_key(batch_id)
@@ -416,6 +688,21 @@ class MessageStore(object):
 
         yield msg_record.save()
 
+    @Manager.calls_manager
+    def add_outbound_messages(self, msgs, tag=None, batch_id=None,
+                              batch_ids=()):
+        """
+        Add several outbound messages to the same batches.
+
+        This has the same effect as calling :meth:`add_outbound_message` for
+        each message, but existing records are loaded in bunches, the cache
+        is updated once per batch and records are stored concurrently.
+        """
+        batch_ids = yield self._resolve_batch_ids(tag, batch_id, batch_ids)
+        yield self._add_messages(
+            self.outbound_messages, self.cache.add_outbound_messages, msgs,
+            batch_ids)
+
     @Manager.calls_manager
     def get_outbound_message(self, msg_id):
         msg = yield self.outbound_messages.load(msg_id)
@@ -451,6 +738,52 @@ class MessageStore(object):
 
         yield event_record.save()
 
+    @Manager.calls_manager
+    def add_events(self, events, batch_ids=None):
+        """
+        Add several events.
+
+        This has the same effect as calling :meth:`add_event` for each event,
+        but existing records (and the outbound messages that new events refer
+        to) are loaded in bunches, the cache is updated once per batch and
+        records are stored concurrently.
+        """
+        event_records = yield self._load_records(
+            self.events, [event['event_id'] for event in events])
+        msg_records = {}
+        if batch_ids is None:
+            msg_records = yield self._load_records(
+                self.outbound_messages,
+                [event['user_message_id'] for event in events
+                 if event['event_id'] not in event_records])
+
+        batch_events = {}
+        for event in events:
+            event_id = event['event_id']
+            msg_id = event['user_message_id']
+            event_batch_ids = batch_ids
+            event_record = event_records.get(event_id)
+            if event_record is None:
+                event_record = event_records[event_id] = self.events(
+                    event_id, event=event, message=msg_id)
+                if event_batch_ids is None:
+                    msg_record = msg_records.get(msg_id)
+                    event_batch_ids = (
+                        msg_record.batches.keys()
+                        if msg_record is not None else [])
+            else:
+                event_record.event = event
+
+            if event_batch_ids is not None:
+                for batch_id in event_batch_ids:
+                    event_record.batches.add_key(batch_id)
+                    batch_events.setdefault(batch_id, []).append(event)
+
+        for batch_id, batch_event_list in batch_events.iteritems():
+            yield self.cache.add_events(batch_id, batch_event_list)
+
+        yield self._save_records(event_records.values())
+
     @Manager.calls_manager
     def get_event(self, event_id):
         event = yield self.events.load(event_id)
@@ -474,14 +807,7 @@ class MessageStore(object):
         else:
             msg_record.msg = msg
 
-        if batch_id is None and tag is not None:
-            tag_record = yield self.current_tags.load(tag)
-            if tag_record is not None:
-                batch_id = tag_record.current_batch.key
-
-        batch_ids = list(batch_ids)
-        if batch_id is not None:
-            batch_ids.append(batch_id)
+        batch_ids = yield self._resolve_batch_ids(tag, batch_id, batch_ids)
 
         for batch_id in batch_ids:
             msg_record.batches.add_key(batch_id)
@@ -489,13 +815,41 @@ class MessageStore(object):
 
         yield msg_record.save()
 
+    @Manager.calls_manager
+    def add_inbound_messages(self, msgs, tag=None, batch_id=None,
+                             batch_ids=()):
+        """
+        Add several inbound messages to the same batches.
+
+        This has the same effect as calling :meth:`add_inbound_message` for
+        each message, but existing records are loaded in bunches, the cache
+        is updated once per batch and records are stored concurrently.
+        """
+        batch_ids = yield self._resolve_batch_ids(tag, batch_id, batch_ids)
+        yield self._add_messages(
+            self.inbound_messages, self.cache.add_inbound_messages, msgs,
+            batch_ids)
+
     @Manager.calls_manager
     def get_inbound_message(self, msg_id):
         msg = yield self.inbound_messages.load(msg_id)
         returnValue(msg.msg if msg is not None else None)
 
+    @Manager.calls_manager
     def get_batch(self, batch_id):
-        return self.batches.load(batch_id)
+        """
+        Return the :class:`Batch` for ``batch_id``, or ``None`` if there
+        isn't one.
+
+        If the lookup cache is enabled, the returned record may be shared
+        with other callers and should not be modified.
+        """
+        found, batch = self.batch_cache.lookup(batch_id)
+        if not found:
+            batch = yield self.batches.load(batch_id)
+            if batch is not None:
+                self.batch_cache.set(batch_id, batch)
+        returnValue(batch)
 
     @Manager.calls_manager
     def get_tag_info(self, tag):
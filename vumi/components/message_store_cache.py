@@ -1,6 +1,7 @@
 # -*- test-case-name: vumi.components.tests.test_message_store_cache -*-
 # -*- coding: utf-8 -*-
 
+from collections import defaultdict
 from datetime import datetime
 import hashlib
 import json
@@ -17,6 +18,34 @@ class MessageStoreCacheException(VumiError):
     pass
 
 
+def _add_recon_counts_emulation(call, keys, args):
+    recon_key, status_key = keys[:2]
+    counter_keys = keys[2:]
+    for key, amount in zip(counter_keys, args[1:]):
+        call('incr', key, int(amount))
+    status_args = args[1 + len(counter_keys):]
+    for status, amount in zip(status_args[::2], status_args[1::2]):
+        call('hincrby', status_key, status, int(amount))
+    call('set', recon_key, args[0])
+    return len(counter_keys)
+
+
+# KEYS are the recon checkpoint key, the status hash key and the counter
+# keys. ARGV is the checkpoint, an amount for each counter key and then
+# pairs of status and amount.
+ADD_RECON_COUNTS_SCRIPT = Manager.register_script("""
+local counters = #KEYS - 2
+for i = 1, counters do
+    redis.call('INCRBY', KEYS[i + 2], ARGV[i + 1])
+end
+for i = counters + 2, #ARGV, 2 do
+    redis.call('HINCRBY', KEYS[2], ARGV[i], ARGV[i + 1])
+end
+redis.call('SET', KEYS[1], ARGV[1])
+return counters
+""", _add_recon_counts_emulation)
+
+
 class MessageStoreCache(object):
     """
     A helper class to provide a view on information in the message store
@@ -34,6 +63,7 @@ class MessageStoreCache(object):
     STATUS_KEY = 'status'
     SEARCH_TOKEN_KEY = 'search_token'
     SEARCH_RESULT_KEY = 'search_result'
+    RECON_KEY = 'recon'
     TRUNCATE_MESSAGE_KEY_COUNT_AT = 2000
 
     # Cache search results for 24 hrs
@@ -83,6 +113,9 @@ class MessageStoreCache(object):
     def search_result_key(self, batch_id, token):
         return self.batch_key(self.SEARCH_RESULT_KEY, batch_id, token)
 
+    def recon_key(self, batch_id):
+        return self.batch_key(self.RECON_KEY, batch_id)
+
     def uses_counters(self, batch_id):
         """
         Returns ``True`` if ``batch_id`` has moved to the new system
@@ -146,6 +179,16 @@ class MessageStoreCache(object):
             redis_key, 0, truncate_at * -1)
         returnValue(keys_removed)
 
+    def _truncate_keys_in_pipeline(self, pipe, redis_key, current_size,
+                                   truncate_at=None):
+        """
+        Queue a truncation of ``redis_key`` on ``pipe`` if ``current_size``
+        (which the caller has already fetched) exceeds the truncation limit.
+        """
+        truncate_at = (truncate_at or self.TRUNCATE_MESSAGE_KEY_COUNT_AT) + 1
+        if current_size > truncate_at:
+            pipe.zremrangebyrank(redis_key, 0, truncate_at * -1)
+
     def truncate_inbound_message_keys(self, batch_id, truncate_at=None):
         return self._truncate_keys(self.inbound_key(batch_id), truncate_at)
 
@@ -223,6 +266,7 @@ class MessageStoreCache(object):
         yield self.redis.delete(self.status_key(batch_id))
         yield self.redis.delete(self.to_addr_key(batch_id))
         yield self.redis.delete(self.from_addr_key(batch_id))
+        yield self.redis.delete(self.recon_key(batch_id))
         yield self.redis.srem(self.batch_key(), batch_id)
 
     def get_timestamp(self, timestamp):
@@ -233,31 +277,80 @@ class MessageStoreCache(object):
             timestamp = parse_vumi_date(timestamp)
         return time.mktime(timestamp.timetuple())
 
-    @Manager.calls_manager
     def add_outbound_message(self, batch_id, msg):
         """
         Add an outbound message to the cache for the given batch_id
         """
-        timestamp = self.get_timestamp(msg['timestamp'])
-        yield self.add_outbound_message_key(
-            batch_id, msg['message_id'], timestamp)
-        yield self.add_to_addr(batch_id, msg['to_addr'])
+        return self.add_outbound_messages(batch_id, [msg])
+
+    def add_outbound_messages(self, batch_id, msgs):
+        """
+        Add several outbound messages to the cache for the given batch_id.
+
+        This takes the same number of Redis round trips as adding a single
+        message.
+        """
+        return self._add_message_keys(
+            batch_id, self._keys_with_timestamps(msgs), 'outbound',
+            to_addrs=[msg['to_addr'] for msg in msgs])
 
-    @Manager.calls_manager
     def add_outbound_message_key(self, batch_id, message_key, timestamp):
         """
         Add a message key, weighted with the timestamp to the batch_id.
         """
-        new_entry = yield self.redis.zadd(self.outbound_key(batch_id), **{
-            message_key.encode('utf-8'): timestamp,
-        })
-        if new_entry:
-            yield self.increment_event_status(batch_id, 'sent')
+        return self._add_message_keys(
+            batch_id, [(message_key, timestamp)], 'outbound')
 
-            uses_counters = yield self.uses_counters(batch_id)
-            if uses_counters:
-                yield self.redis.incr(self.outbound_count_key(batch_id))
-                yield self.truncate_outbound_message_keys(batch_id)
+    def _keys_with_timestamps(self, msgs):
+        return [(msg['message_id'], self.get_timestamp(msg['timestamp']))
+                for msg in msgs]
+
+    @Manager.calls_manager
+    def _add_message_keys(self, batch_id, keys_with_timestamps, direction,
+                          to_addrs=(), from_addrs=()):
+        """
+        Add message keys to the inbound or outbound set for ``batch_id``
+        and update the relevant counters.
+
+        This takes two pipelined round trips to Redis however many keys
+        there are: the first adds the keys (and the addresses, if given) and
+        fetches the state needed to decide what to do next, the second
+        updates counters and truncates the key set if any keys were new.
+        """
+        if not keys_with_timestamps:
+            return
+
+        if direction == 'outbound':
+            key_set_key = self.outbound_key(batch_id)
+            count_key = self.outbound_count_key(batch_id)
+        else:
+            key_set_key = self.inbound_key(batch_id)
+            count_key = self.inbound_count_key(batch_id)
+
+        pipe = self.redis.pipeline()
+        pipe.zadd(key_set_key, **dict(
+            (key.encode('utf-8'), timestamp)
+            for key, timestamp in keys_with_timestamps))
+        pipe.exists(self.inbound_count_key(batch_id))
+        pipe.zcard(key_set_key)
+        if to_addrs:
+            pipe.pfadd(self.to_addr_key(batch_id),
+                       *[addr.encode('utf-8') for addr in to_addrs])
+        if from_addrs:
+            pipe.pfadd(self.from_addr_key(batch_id),
+                       *[addr.encode('utf-8') for addr in from_addrs])
+        results = yield pipe.execute()
+        new_entries, uses_counters, current_size = results[:3]
+        if not new_entries:
+            return
+
+        pipe = self.redis.pipeline()
+        if direction == 'outbound':
+            pipe.hincrby(self.status_key(batch_id), 'sent', new_entries)
+        if uses_counters:
+            pipe.incr(count_key, new_entries)
+            self._truncate_keys_in_pipeline(pipe, key_set_key, current_size)
+        yield pipe.execute()
 
     @Manager.calls_manager
     def add_outbound_message_count(self, batch_id, count):
@@ -282,28 +375,88 @@ class MessageStoreCache(object):
         """
         event_id = event['event_id']
         timestamp = self.get_timestamp(event['timestamp'])
-        new_entry = yield self.add_event_key(batch_id, event_id, timestamp)
-        if new_entry:
-            event_type = event['event_type']
-            yield self.increment_event_status(batch_id, event_type)
-            if event_type == 'delivery_report':
-                yield self.increment_event_status(
-                    batch_id, '%s.%s' % (event_type, event['delivery_status']))
+        yield self._add_event_key(
+            batch_id, event_id, timestamp, self._event_statuses(event))
+
+    def _event_statuses(self, event):
+        event_type = event['event_type']
+        statuses = [event_type]
+        if event_type == 'delivery_report':
+            statuses.append(
+                '%s.%s' % (event_type, event['delivery_status']))
+        return statuses
 
     @Manager.calls_manager
+    def add_events(self, batch_id, events):
+        """
+        Add several events to the cache for the given batch_id.
+
+        This takes the same number of Redis round trips as adding a single
+        event.
+        """
+        if not events:
+            return
+        uses_event_counters = yield self.uses_event_counters(batch_id)
+        if not uses_event_counters:
+            # See the HACK comment in _add_event_key().
+            return
+
+        pipe = self.redis.pipeline()
+        for event in events:
+            pipe.zadd(self.event_key(batch_id), **{
+                event['event_id'].encode('utf-8'):
+                    self.get_timestamp(event['timestamp']),
+            })
+        pipe.zcard(self.event_key(batch_id))
+        results = yield pipe.execute()
+        new_entries, current_size = results[:-1], results[-1]
+
+        status_counts = defaultdict(int)
+        for event, new_entry in zip(events, new_entries):
+            if new_entry:
+                for status in self._event_statuses(event):
+                    status_counts[status] += 1
+        new_count = sum(new_entries)
+        if not new_count:
+            return
+
+        pipe = self.redis.pipeline()
+        pipe.incr(self.event_count_key(batch_id), new_count)
+        for status, count in status_counts.iteritems():
+            pipe.hincrby(self.status_key(batch_id), status, count)
+        self._truncate_keys_in_pipeline(
+            pipe, self.event_key(batch_id), current_size)
+        yield pipe.execute()
+
     def add_event_key(self, batch_id, event_key, timestamp):
         """
         Add the event key to the set of known event keys.
         Returns 0 if the key already exists in the set, 1 if it doesn't.
         """
+        return self._add_event_key(batch_id, event_key, timestamp)
+
+    @Manager.calls_manager
+    def _add_event_key(self, batch_id, event_key, timestamp, statuses=()):
+        """
+        Add the event key to the set of known event keys and, if it is new,
+        increment the event counter and each of the given ``statuses``.
+        """
         uses_event_counters = yield self.uses_event_counters(batch_id)
         if uses_event_counters:
-            new_entry = yield self.redis.zadd(self.event_key(batch_id), **{
+            pipe = self.redis.pipeline()
+            pipe.zadd(self.event_key(batch_id), **{
                 event_key.encode('utf-8'): timestamp,
             })
+            pipe.zcard(self.event_key(batch_id))
+            new_entry, current_size = yield pipe.execute()
             if new_entry:
-                yield self.redis.incr(self.event_count_key(batch_id))
-                yield self.truncate_event_keys(batch_id)
+                pipe = self.redis.pipeline()
+                pipe.incr(self.event_count_key(batch_id))
+                for status in statuses:
+                    pipe.hincrby(self.status_key(batch_id), status, 1)
+                self._truncate_keys_in_pipeline(
+                    pipe, self.event_key(batch_id), current_size)
+                yield pipe.execute()
             returnValue(new_entry)
         else:
             # HACK: Disabling this because of unbounded growth.
@@ -316,6 +469,23 @@ class MessageStoreCache(object):
                 self.event_key(batch_id), event_key)
             returnValue(new_entry)
 
+    def add_event_key_with_status(self, batch_id, event_key, timestamp,
+                                  status):
+        """
+        Add the event key to the set of known event keys and, if it is new,
+        update the event counters for the given event status.
+
+        :param str status:
+            The event status, as returned by
+            :meth:`vumi.message.TransportEvent.status`.
+
+        Returns 0 if the key already exists in the set, 1 if it doesn't.
+        """
+        statuses = [status]
+        if status.startswith('delivery_report.'):
+            statuses.insert(0, 'delivery_report')
+        return self._add_event_key(batch_id, event_key, timestamp, statuses)
+
     def increment_event_status(self, batch_id, event_type, count=1):
         """
         Increment the status for the given event_type for the given batch_id.
@@ -331,30 +501,29 @@ class MessageStoreCache(object):
         stats = yield self.redis.hgetall(self.status_key(batch_id))
         returnValue(dict([(k, int(v)) for k, v in stats.iteritems()]))
 
-    @Manager.calls_manager
     def add_inbound_message(self, batch_id, msg):
         """
         Add an inbound message to the cache for the given batch_id
         """
-        timestamp = self.get_timestamp(msg['timestamp'])
-        yield self.add_inbound_message_key(
-            batch_id, msg['message_id'], timestamp)
-        yield self.add_from_addr(batch_id, msg['from_addr'])
+        return self.add_inbound_messages(batch_id, [msg])
+
+    def add_inbound_messages(self, batch_id, msgs):
+        """
+        Add several inbound messages to the cache for the given batch_id.
+
+        This takes the same number of Redis round trips as adding a single
+        message.
+        """
+        return self._add_message_keys(
+            batch_id, self._keys_with_timestamps(msgs), 'inbound',
+            from_addrs=[msg['from_addr'] for msg in msgs])
 
-    @Manager.calls_manager
     def add_inbound_message_key(self, batch_id, message_key, timestamp):
         """
         Add a message key, weighted with the timestamp to the batch_id
         """
-        new_entry = yield self.redis.zadd(self.inbound_key(batch_id), **{
-            message_key.encode('utf-8'): timestamp,
-        })
-
-        if new_entry:
-            uses_counters = yield self.uses_counters(batch_id)
-            if uses_counters:
-                yield self.redis.incr(self.inbound_count_key(batch_id))
-                yield self.truncate_inbound_message_keys(batch_id)
+        return self._add_message_keys(
+            batch_id, [(message_key, timestamp)], 'inbound')
 
     @Manager.calls_manager
     def add_inbound_message_count(self, batch_id, count):
@@ -372,6 +541,14 @@ class MessageStoreCache(object):
         return self.redis.pfadd(
             self.from_addr_key(batch_id), from_addr.encode('utf-8'))
 
+    def add_from_addrs(self, batch_id, from_addrs):
+        """
+        Add several from_addrs to this batch_id with a single command.
+        """
+        return self.redis.pfadd(
+            self.from_addr_key(batch_id),
+            *[from_addr.encode('utf-8') for from_addr in from_addrs])
+
     def get_from_addrs(self, batch_id, asc=False):
         """
         Return a set of all known from_addrs sorted by timestamp.
@@ -401,6 +578,14 @@ class MessageStoreCache(object):
         return self.redis.pfadd(
             self.to_addr_key(batch_id), to_addr.encode('utf-8'))
 
+    def add_to_addrs(self, batch_id, to_addrs):
+        """
+        Add several to_addrs to this batch_id with a single command.
+        """
+        return self.redis.pfadd(
+            self.to_addr_key(batch_id),
+            *[to_addr.encode('utf-8') for to_addr in to_addrs])
+
     def get_to_addrs(self, batch_id, asc=False):
         """
         Return a set of unique to_addrs addressed in this batch ordered
@@ -599,16 +784,21 @@ class MessageStoreCache(object):
 
         # populate the results set weighted according to the timestamps
         # that are already known in the cache.
+        pipe = self.redis.pipeline()
         for key in keys:
-            timestamp = yield self.redis.zscore(score_set_key, key)
-            yield self.redis.zadd(result_key, **{
-                key.encode('utf-8'): timestamp,
-            })
-
+            pipe.zscore(score_set_key, key)
+        timestamps = yield pipe.execute()
+
+        pipe = self.redis.pipeline()
+        if keys:
+            pipe.zadd(result_key, **dict(
+                (key.encode('utf-8'), timestamp)
+                for key, timestamp in zip(keys, timestamps)))
         # Auto expire after TTL
-        yield self.redis.expire(result_key, ttl)
+        pipe.expire(result_key, ttl)
         # Remove from the list of in progress search operations.
-        yield self.redis.srem(self.search_token_key(batch_id), token)
+        pipe.srem(self.search_token_key(batch_id), token)
+        yield pipe.execute()
 
     def is_query_in_progress(self, batch_id, token):
         """
@@ -631,3 +821,67 @@ class MessageStoreCache(object):
         """
         result_key = self.search_result_key(batch_id, token)
         return self.redis.zcard(result_key)
+
+    @Manager.calls_manager
+    def get_recon_checkpoint(self, batch_id):
+        """
+        Return the checkpoint stored by an unfinished cache recon for the
+        given batch_id, or ``None`` if there isn't one.
+        """
+        checkpoint = yield self.redis.get(self.recon_key(batch_id))
+        if checkpoint is not None:
+            checkpoint = json.loads(checkpoint)
+        returnValue(checkpoint)
+
+    def set_recon_checkpoint(self, batch_id, checkpoint):
+        """
+        Store a cache recon checkpoint for the given batch_id.
+
+        :param dict checkpoint:
+            JSON-serializable recon state.
+        """
+        return self.redis.set(self.recon_key(batch_id), json.dumps(checkpoint))
+
+    def _add_recon_counts(self, batch_id, counts, status_counts, checkpoint):
+        keys = [self.recon_key(batch_id), self.status_key(batch_id)]
+        args = [json.dumps(checkpoint)]
+        for key, count in counts:
+            keys.append(key)
+            args.append(count)
+        for status, count in sorted(status_counts.iteritems()):
+            args.extend([status, count])
+        return self.redis.run_script(ADD_RECON_COUNTS_SCRIPT, keys, args)
+
+    def add_outbound_recon_counts(self, batch_id, count, status_counts,
+                                  checkpoint):
+        """
+        Add outbound message and event counts to all relevant counters and
+        store a cache recon checkpoint for the given batch_id.
+
+        This is a single atomic operation, so a checkpoint that records the
+        counts being added can be used to avoid adding them twice.
+        """
+        statuses = dict(status_counts)
+        statuses['sent'] = statuses.get('sent', 0) + count
+        return self._add_recon_counts(batch_id, [
+            (self.outbound_count_key(batch_id), count),
+            (self.event_count_key(batch_id), sum(status_counts.values())),
+        ], statuses, checkpoint)
+
+    def add_inbound_recon_counts(self, batch_id, count, checkpoint):
+        """
+        Add an inbound message count to all inbound message counters and
+        store a cache recon checkpoint for the given batch_id.
+
+        This is a single atomic operation, so a checkpoint that records the
+        count being added can be used to avoid adding it twice.
+        """
+        return self._add_recon_counts(batch_id, [
+            (self.inbound_count_key(batch_id), count),
+        ], {}, checkpoint)
+
+    def clear_recon_checkpoint(self, batch_id):
+        """
+        Remove the cache recon checkpoint for the given batch_id.
+        """
+        return self.redis.delete(self.recon_key(batch_id))
@@ -4,11 +4,53 @@
 
 import time
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import inlineCallbacks, returnValue, succeed
 
 from vumi import log
 
 
+class ActiveSessionsPage(object):
+    """
+    A page of active sessions returned by
+    :meth:`SessionManager.active_sessions_page`.
+
+    Iterating over the page yields ``(user_id, session)`` pairs. Redis may
+    return the same session on more than one page.
+    """
+
+    def __init__(self, session_manager, cursor, count, sessions):
+        self._session_manager = session_manager
+        self._cursor = cursor
+        self._count = count
+        self._sessions = sessions
+
+    def next_page(self):
+        """
+        Fetch the next page of sessions.
+
+        :returns:
+            A deferred that fires with the next :class:`ActiveSessionsPage`,
+            or ``None`` if this is the last page.
+        """
+        if self._cursor is None:
+            return succeed(None)
+        return self._session_manager.active_sessions_page(
+            self._cursor, self._count)
+
+    def has_next_page(self):
+        """
+        Indicate whether there are more sessions to follow.
+
+        :returns:
+            ``True`` if there may be more sessions, ``False`` if this is the
+            last page.
+        """
+        return self._cursor is not None
+
+    def __iter__(self):
+        return iter(self._sessions)
+
+
 class SessionManager(object):
     """A manager for sessions.
 
@@ -46,16 +88,44 @@ class SessionManager(object):
     def active_sessions(self):
         """Return a list of active user_ids and associated sessions.
 
-        Queries redis for keys starting with the session key prefix. This is
-        O(n) over the total number of keys in redis, but this is still pretty
-        quick even for millions of keys. Try not to hit this too often, though.
+        This walks through all the pages from :meth:`active_sessions_page`,
+        so it is O(n) over the total number of keys in redis and holds every
+        session in memory. Try not to hit this too often, though.
         """
-        keys = yield self.redis.keys('session:*')
-        sessions = []
-        for user_id in [key.split(':', 1)[1] for key in keys]:
-            sessions.append((user_id, (yield self.load_session(user_id))))
+        sessions = {}
+        page = yield self.active_sessions_page()
+        while page is not None:
+            sessions.update(page)
+            page = yield page.next_page()
+        returnValue(sessions.items())
+
+    @inlineCallbacks
+    def active_sessions_page(self, cursor=None, count=100):
+        """Fetch a page of active user_ids and associated sessions.
+
+        Session keys are found with ``SCAN`` rather than ``KEYS``, so redis
+        isn't blocked while they're found, and the sessions on each page are
+        loaded in a single pipeline.
 
-        returnValue(sessions)
+        :param cursor:
+            The cursor of the page to fetch, or ``None`` for the first page.
+        :param int count:
+            Roughly how many keys redis should look at for each page.
+
+        :returns:
+            A deferred that fires with an :class:`ActiveSessionsPage`.
+        """
+        cursor, keys = yield self.redis.scan(
+            cursor, match='session:*', count=count)
+        pipe = self.redis.pipeline()
+        for key in keys:
+            pipe.hgetall(key)
+        loaded = yield pipe.execute()
+        # Sessions that expired after the scan load as empty hashes.
+        sessions = [
+            (key.split(':', 1)[1], session)
+            for key, session in zip(keys, loaded) if session]
+        returnValue(ActiveSessionsPage(self, cursor, count, sessions))
 
     def load_session(self, user_id):
         """
@@ -78,27 +148,31 @@ class SessionManager(object):
         ukey = "%s:%s" % ('session', user_id)
         return self.redis.expire(ukey, timeout)
 
-    @inlineCallbacks
     def create_session(self, user_id, **kwargs):
         """
         Create a new session using the given user_id
+
+        The old session is cleared, the new one is saved and its expiry is
+        scheduled in a single pipeline.
         """
-        yield self.clear_session(user_id)
+        ukey = "%s:%s" % ('session', user_id)
         defaults = {
             'created_at': time.time()
         }
         defaults.update(kwargs)
-        yield self.save_session(user_id, defaults)
+        pipe = self.redis.pipeline()
+        pipe.delete(ukey)
+        pipe.hmset(ukey, defaults)
         if self.max_session_length:
-            yield self.schedule_session_expiry(user_id,
-                                               int(self.max_session_length))
-        returnValue((yield self.load_session(user_id)))
+            pipe.expire(ukey, int(self.max_session_length))
+        pipe.hgetall(ukey)
+        d = pipe.execute()
+        return d.addCallback(lambda results: results[-1])
 
     def clear_session(self, user_id):
         ukey = "%s:%s" % ('session', user_id)
         return self.redis.delete(ukey)
 
-    @inlineCallbacks
     def save_session(self, user_id, session):
         """
         Save a session
@@ -112,7 +186,8 @@ class SessionManager(object):
             values that are dictionaries are converted to strings by Redis.
 
         """
+        if not session:
+            return succeed(session)
         ukey = "%s:%s" % ('session', user_id)
-        for s_key, s_value in session.items():
-            yield self.redis.hset(ukey, s_key, s_value)
-        returnValue(session)
+        d = self.redis.hmset(ukey, session)
+        return d.addCallback(lambda _: session)
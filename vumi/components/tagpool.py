@@ -12,6 +12,145 @@ from vumi.errors import VumiError
 from vumi.persist.redis_base import Manager
 
 
+# Owner tag sets hold JSON encoded ``[pool, tag]`` pairs. When a script only
+# learns which tag it has acquired on the server it needs to encode the tag
+# exactly the way json.dumps() does, so that the pair can be removed again on
+# release.
+LUA_JSON_STRING = r"""
+local ESCAPES = {
+    ['"'] = '\\"', ['\\'] = '\\\\', ['\b'] = '\\b', ['\f'] = '\\f',
+    ['\n'] = '\\n', ['\r'] = '\\r', ['\t'] = '\\t',
+}
+local function json_string(s)
+    local out = {'"'}
+    local i = 1
+    while i <= #s do
+        local cp = s:byte(i)
+        local len = 1
+        if cp >= 0xf0 then
+            cp, len = cp % 0x08, 4
+        elseif cp >= 0xe0 then
+            cp, len = cp % 0x10, 3
+        elseif cp >= 0xc0 then
+            cp, len = cp % 0x20, 2
+        end
+        for j = i + 1, i + len - 1 do
+            cp = cp * 0x40 + s:byte(j) % 0x40
+        end
+        local char = s:sub(i, i + len - 1)
+        if ESCAPES[char] then
+            table.insert(out, ESCAPES[char])
+        elseif cp >= 0x20 and cp < 0x7f then
+            table.insert(out, char)
+        elseif cp < 0x10000 then
+            table.insert(out, string.format('\\u%04x', cp))
+        else
+            cp = cp - 0x10000
+            table.insert(out, string.format(
+                '\\u%04x\\u%04x',
+                0xd800 + math.floor(cp / 0x400), 0xdc00 + cp % 0x400))
+        end
+        i = i + len
+    end
+    table.insert(out, '"')
+    return table.concat(out)
+end
+"""
+
+
+def _acquire_tags_emulation(call, keys, args):
+    free_list_key, free_set_key, inuse_set_key, reason_key, owner_key = keys
+    reason, pool_json, count = args
+    tags = []
+    for _ in xrange(int(count)):
+        tag = call('lpop', free_list_key)
+        if tag is None:
+            break
+        call('smove', free_set_key, inuse_set_key, tag)
+        call('hset', reason_key, tag, reason)
+        call('sadd', owner_key, '[%s, %s]' % (
+            pool_json, json.dumps(tag.decode('utf-8'))))
+        tags.append(tag)
+    return tags
+
+
+ACQUIRE_TAGS_SCRIPT = Manager.register_script(LUA_JSON_STRING + r"""
+local tags = {}
+for i = 1, tonumber(ARGV[3]) do
+    local tag = redis.call('LPOP', KEYS[1])
+    if not tag then
+        break
+    end
+    redis.call('SMOVE', KEYS[2], KEYS[3], tag)
+    redis.call('HSET', KEYS[4], tag, ARGV[1])
+    local owner_tag = '[' .. ARGV[2] .. ', ' .. json_string(tag) .. ']'
+    redis.call('SADD', KEYS[5], owner_tag)
+    table.insert(tags, tag)
+end
+return tags
+""", _acquire_tags_emulation)
+
+
+def _acquire_specific_tag_emulation(call, keys, args):
+    free_list_key, free_set_key, inuse_set_key, reason_key, owner_key = keys
+    tag, reason, owner_tag = args
+    moved = call('lrem', free_list_key, tag, 1)
+    if moved:
+        call('smove', free_set_key, inuse_set_key, tag)
+        call('hset', reason_key, tag, reason)
+        call('sadd', owner_key, owner_tag)
+    return moved
+
+
+ACQUIRE_SPECIFIC_TAG_SCRIPT = Manager.register_script(r"""
+local moved = redis.call('LREM', KEYS[1], 1, ARGV[1])
+if moved > 0 then
+    redis.call('SMOVE', KEYS[2], KEYS[3], ARGV[1])
+    redis.call('HSET', KEYS[4], ARGV[1], ARGV[2])
+    redis.call('SADD', KEYS[5], ARGV[3])
+end
+return moved
+""", _acquire_specific_tag_emulation)
+
+
+def _release_tag_emulation(call, keys, args):
+    (free_list_key, free_set_key, inuse_set_key, reason_key, unowned_key,
+     owners_key_prefix) = keys
+    tag, owner_tag = args
+    moved = call('smove', inuse_set_key, free_set_key, tag)
+    if moved == 1:
+        call('rpush', free_list_key, tag)
+        reason = call('hget', reason_key, tag)
+        if reason is not None:
+            owner = json.loads(reason).get('owner')
+            owner_key = unowned_key
+            if isinstance(owner, basestring):
+                owner_key = "%s%s:tags" % (
+                    owners_key_prefix, owner.encode('utf-8'))
+            call('srem', owner_key, owner_tag)
+    return moved
+
+
+# The owner of a tag is only known from its stored reason, so the key of the
+# owner's tag set is built on the server.
+RELEASE_TAG_SCRIPT = Manager.register_script(r"""
+local moved = redis.call('SMOVE', KEYS[3], KEYS[2], ARGV[1])
+if moved == 1 then
+    redis.call('RPUSH', KEYS[1], ARGV[1])
+    local reason = redis.call('HGET', KEYS[4], ARGV[1])
+    if reason then
+        local owner = cjson.decode(reason)['owner']
+        local owner_key = KEYS[5]
+        if type(owner) == 'string' then
+            owner_key = KEYS[6] .. owner .. ':tags'
+        end
+        redis.call('SREM', owner_key, ARGV[2])
+    end
+end
+return moved
+""", _release_tag_emulation)
+
+
 class TagpoolError(VumiError):
     """An error occurred during an operation on a tag pool."""
 
@@ -25,6 +164,9 @@ class TagpoolManager(object):
 
     encoding = "UTF-8"
 
+    # Number of new tags sent to redis in each pipeline by declare_tags().
+    declare_chunk_size = 1000
+
     def __init__(self, redis):
         self.redis = redis
         self.manager = redis  # TODO: This is a bit of a hack to make the
@@ -38,8 +180,18 @@ class TagpoolManager(object):
 
     @Manager.calls_manager
     def acquire_tag(self, pool, owner=None, reason=None):
-        local_tag = yield self._acquire_tag(pool, owner, reason)
-        returnValue((pool, local_tag) if local_tag is not None else None)
+        local_tags = yield self._acquire_tags(pool, 1, owner, reason)
+        returnValue((pool, local_tags[0]) if local_tags else None)
+
+    @Manager.calls_manager
+    def acquire_tags(self, pool, count, owner=None, reason=None):
+        """Acquire up to `count` free tags from a pool in one operation.
+
+        Returns a list of the tags acquired, which is shorter than `count`
+        if there aren't enough free tags in the pool.
+        """
+        local_tags = yield self._acquire_tags(pool, count, owner, reason)
+        returnValue([(pool, local_tag) for local_tag in local_tags])
 
     @Manager.calls_manager
     def acquire_specific_tag(self, tag, owner=None, reason=None):
@@ -161,43 +313,47 @@ class TagpoolManager(object):
         pool = self._encode(pool)
         return ":".join(["tagpools", pool, "metadata"])
 
-    @Manager.calls_manager
-    def _acquire_tag(self, pool, owner, reason):
-        free_list_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
-        tag = yield self.redis.lpop(free_list_key)
-        if tag is not None:
-            yield self.redis.smove(free_set_key, inuse_set_key, tag)
-            yield self._store_reason(pool, tag, owner, reason)
-        returnValue(self._decode(tag) if tag is not None else None)
+    def _tag_script_keys(self, pool, owner):
+        return self._tag_pool_keys(pool) + (
+            self._tag_pool_reason_key(pool), self._owner_tag_list_key(owner))
 
     @Manager.calls_manager
+    def _acquire_tags(self, pool, count, owner, reason):
+        tags = yield self.redis.run_script(
+            ACQUIRE_TAGS_SCRIPT, self._tag_script_keys(pool, owner),
+            [self._reason_json(owner, reason), json.dumps(pool), count])
+        returnValue([self._decode(tag) for tag in tags])
+
     def _acquire_specific_tag(self, pool, local_tag, owner, reason):
         local_tag = self._encode(local_tag)
-        free_list_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
-        moved = yield self.redis.lrem(free_list_key, local_tag, num=1)
-        if moved:
-            yield self.redis.smove(free_set_key, inuse_set_key, local_tag)
-            yield self._store_reason(pool, local_tag, owner, reason)
-        returnValue(moved)
+        return self.redis.run_script(
+            ACQUIRE_SPECIFIC_TAG_SCRIPT, self._tag_script_keys(pool, owner),
+            [local_tag, self._reason_json(owner, reason),
+             self._owner_tag(pool, local_tag)])
 
-    @Manager.calls_manager
     def _release_tag(self, pool, local_tag):
         local_tag = self._encode(local_tag)
-        free_list_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
-        count = yield self.redis.smove(inuse_set_key, free_set_key, local_tag)
-        if count == 1:
-            yield self.redis.rpush(free_list_key, local_tag)
-            yield self._remove_reason(pool, local_tag)
+        keys = self._tag_pool_keys(pool) + (
+            self._tag_pool_reason_key(pool), self._owner_tag_list_key(None),
+            ":".join(["tagpools", "owners", ""]))
+        return self.redis.run_script(
+            RELEASE_TAG_SCRIPT, keys,
+            [local_tag, self._owner_tag(pool, local_tag)])
 
     @Manager.calls_manager
     def _declare_tags(self, pool, local_tags):
         free_list_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
         new_tags = set(self._encode(tag) for tag in local_tags)
         old_tags = yield self.redis.sunion(free_set_key, inuse_set_key)
-        old_tags = set(old_tags)
-        for tag in sorted(new_tags - old_tags):
-            yield self.redis.sadd(free_set_key, tag)
-            yield self.redis.rpush(free_list_key, tag)
+        new_tags = sorted(new_tags - set(old_tags))
+        chunk_size = self.declare_chunk_size
+        for i in xrange(0, len(new_tags), chunk_size):
+            chunk = new_tags[i:i + chunk_size]
+            pipe = self.redis.pipeline()
+            pipe.sadd(free_set_key, *chunk)
+            for tag in chunk:
+                pipe.rpush(free_list_key, tag)
+            yield pipe.execute()
 
     def _tag_pool_reason_key(self, pool):
         pool = self._encode(pool)
@@ -209,25 +365,12 @@ class TagpoolManager(object):
         owner = self._encode(owner)
         return ":".join(["tagpools", "owners", owner, "tags"])
 
-    @Manager.calls_manager
-    def _store_reason(self, pool, local_tag, owner, reason):
+    def _reason_json(self, owner, reason):
         if reason is None:
             reason = {}
         reason['timestamp'] = time.time()
         reason['owner'] = owner
-        reason_hash_key = self._tag_pool_reason_key(pool)
-        yield self.redis.hset(reason_hash_key, local_tag, json.dumps(reason))
-        owner_tag_list_key = self._owner_tag_list_key(owner)
-        yield self.redis.sadd(owner_tag_list_key,
-                              json.dumps([pool, self._decode(local_tag)]))
+        return json.dumps(reason)
 
-    @Manager.calls_manager
-    def _remove_reason(self, pool, local_tag):
-        reason_hash_key = self._tag_pool_reason_key(pool)
-        reason = yield self.redis.hget(reason_hash_key, local_tag)
-        if reason is not None:
-            reason = json.loads(reason)
-            owner = reason.get('owner')
-            owner_tag_list_key = self._owner_tag_list_key(owner)
-            self.redis.srem(owner_tag_list_key,
-                            json.dumps([pool, self._decode(local_tag)]))
+    def _owner_tag(self, pool, local_tag):
+        return json.dumps([pool, self._decode(local_tag)])
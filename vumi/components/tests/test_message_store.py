@@ -12,8 +12,8 @@ from vumi.tests.helpers import (
 
 try:
     from vumi.components.message_store import (
-        MessageStore, to_reverse_timestamp, from_reverse_timestamp,
-        add_batches_to_event)
+        MessageStore, ReconCheckpoint, to_reverse_timestamp,
+        from_reverse_timestamp, add_batches_to_event)
 except ImportError, e:
     import_skip(e, 'riak')
 
@@ -53,6 +53,55 @@ class TestReverseTimestampUtils(VumiTestCase):
             "4015-04-01 12:13:14.000000", from_reverse_timestamp("F0F9025FA5"))
 
 
+class TestReconCheckpoint(VumiTestCase):
+
+    def test_to_dict_from_dict(self):
+        checkpoint = ReconCheckpoint(
+            'outbound', '2014-01-01 00:00:00.000000', key_count=2,
+            status_counts={'ack': 2}, cache_keys=[('key-3', 'ts-3')],
+            new_keys=[('key-4', 'ts-4')], last_timestamp='ts-4',
+            last_keys=['key-4'])
+        data = checkpoint.to_dict()
+        self.assertEqual(data, {
+            'direction': 'outbound',
+            'start_timestamp': '2014-01-01 00:00:00.000000',
+            'key_count': 2,
+            'status_counts': {'ack': 2},
+            'cache_keys': [('key-3', 'ts-3')],
+            'new_keys': [('key-4', 'ts-4')],
+            'last_timestamp': 'ts-4',
+            'last_keys': ['key-4'],
+            'counts_applied': False,
+        })
+        self.assertEqual(ReconCheckpoint.from_dict(data).to_dict(), data)
+
+    def test_key_manager(self):
+        checkpoint = ReconCheckpoint(
+            'inbound', 'ts-3', cache_keys=[('key-1', 'ts-1')],
+            new_keys=[('key-4', 'ts-4')])
+        key_manager = checkpoint.key_manager(1)
+        self.assertEqual(key_manager.add_key('key-2', 'ts-2'),
+                         ('key-1', 'ts-1'))
+        self.assertEqual(list(key_manager),
+                         [('key-2', 'ts-2'), ('key-4', 'ts-4')])
+
+    def test_update_and_unseen(self):
+        checkpoint = ReconCheckpoint('inbound', 'ts-9')
+        key_manager = checkpoint.key_manager(10)
+        rows = [('key-1', 'ts-1', 'addr'), ('key-2', 'ts-2', 'addr'),
+                ('key-3', 'ts-2', 'addr')]
+        for key, timestamp, addr in rows:
+            key_manager.add_key(key, timestamp)
+        checkpoint.update(key_manager, rows)
+        self.assertEqual(checkpoint.last_timestamp, 'ts-2')
+        self.assertEqual(checkpoint.last_keys, set(['key-2', 'key-3']))
+        self.assertEqual(len(checkpoint.cache_keys), 3)
+        self.assertEqual(checkpoint.unseen([
+            ('key-2', 'ts-2', 'addr'), ('key-3', 'ts-2', 'addr'),
+            ('key-4', 'ts-2', 'addr'), ('key-5', 'ts-3', 'addr'),
+        ]), [('key-4', 'ts-2', 'addr'), ('key-5', 'ts-3', 'addr')])
+
+
 class TestMessageStoreBase(VumiTestCase):
 
     @inlineCallbacks
@@ -194,6 +243,63 @@ class TestMessageStore(TestMessageStoreBase):
         self.assertEqual(list(batch.tags), [tag1])
         self.assertEqual(tag_info.current_batch.key, None)
 
+    @inlineCallbacks
+    def test_lookup_cache_disabled_by_default(self):
+        batch_id = yield self.store.batch_start([("pool", "tag")])
+        yield self.store.get_batch(batch_id)
+        yield self._create_outbound()
+        self.assertEqual(self.store.lookup_cache_stats(), {
+            'tag_hits': 0, 'tag_misses': 0,
+            'batch_hits': 0, 'batch_misses': 0,
+        })
+
+    @inlineCallbacks
+    def test_lookup_cache_tag(self):
+        store = MessageStore(self.manager, self.redis, lookup_cache_size=10)
+        batch_id = yield store.batch_start([("pool", "tag")])
+        msgs = [self.msg_helper.make_outbound("foo") for _ in range(3)]
+        for msg in msgs:
+            yield store.add_outbound_message(msg, tag=("pool", "tag"))
+        outbound_keys = yield store.batch_outbound_keys(batch_id)
+        self.assertEqual(
+            sorted(outbound_keys), sorted(msg['message_id'] for msg in msgs))
+        stats = store.lookup_cache_stats()
+        self.assertEqual((stats['tag_hits'], stats['tag_misses']), (3, 0))
+
+    @inlineCallbacks
+    def test_lookup_cache_tag_miss(self):
+        store = MessageStore(self.manager, self.redis, lookup_cache_size=10)
+        batch_id = yield self.store.batch_start([("pool", "tag")])
+        msg = self.msg_helper.make_outbound("foo")
+        yield store.add_outbound_message(msg, tag=("pool", "tag"))
+        yield store.add_outbound_message(msg, tag=("pool", "tag"))
+        outbound_keys = yield store.batch_outbound_keys(batch_id)
+        self.assertEqual(outbound_keys, [msg['message_id']])
+        stats = store.lookup_cache_stats()
+        self.assertEqual((stats['tag_hits'], stats['tag_misses']), (1, 1))
+
+    @inlineCallbacks
+    def test_lookup_cache_batch_done(self):
+        store = MessageStore(self.manager, self.redis, lookup_cache_size=10)
+        batch_id = yield store.batch_start([("pool", "tag")])
+        self.assertEqual(
+            (yield store._current_batch_id(("pool", "tag"))), batch_id)
+        yield store.batch_done(batch_id)
+        self.assertEqual(
+            (yield store._current_batch_id(("pool", "tag"))), None)
+        self.assertEqual(store.lookup_cache_stats()['tag_misses'], 0)
+
+    @inlineCallbacks
+    def test_lookup_cache_get_batch(self):
+        store = MessageStore(self.manager, self.redis, lookup_cache_size=10)
+        batch_id = yield self.store.batch_start([("pool", "tag")])
+        batch = yield store.get_batch(batch_id)
+        self.assertEqual(list(batch.tags), [("pool", "tag")])
+        self.assertEqual((yield store.get_batch(batch_id)), batch)
+        self.assertEqual((yield store.get_batch(u"missing")), None)
+        stats = store.lookup_cache_stats()
+        self.assertEqual((stats['batch_hits'], stats['batch_misses']), (1, 2))
+
     @inlineCallbacks
     def test_add_outbound_message(self):
         msg_id, msg, _batch_id = yield self._create_outbound(tag=None)
@@ -230,6 +336,45 @@ class TestMessageStore(TestMessageStoreBase):
         self.assertEqual(event_keys, [])
         self.assertEqual(batch_status, self._batch_status(sent=1))
 
+    @inlineCallbacks
+    def test_add_outbound_messages(self):
+        batch_id = yield self.store.batch_start([("pool", "tag")])
+        msgs = [self.msg_helper.make_outbound("foo") for _ in range(3)]
+        yield self.store.add_outbound_messages(msgs, batch_id=batch_id)
+
+        for msg in msgs:
+            stored_msg = yield self.store.get_outbound_message(
+                msg['message_id'])
+            self.assertEqual(stored_msg, msg)
+        outbound_keys = yield self.store.batch_outbound_keys(batch_id)
+        self.assertEqual(
+            sorted(outbound_keys), sorted(msg['message_id'] for msg in msgs))
+        batch_status = yield self.store.batch_status(batch_id)
+        self.assertEqual(batch_status, self._batch_status(sent=3))
+
+    @inlineCallbacks
+    def test_add_outbound_messages_again(self):
+        msg_id, msg, batch_id = yield self._create_outbound(by_batch=True)
+        msg['helper_metadata']['foo'] = {'bar': 'baz'}
+        new_msg = self.msg_helper.make_outbound("foo")
+        yield self.store.add_outbound_messages(
+            [msg, new_msg], batch_id=batch_id)
+
+        stored_msg = yield self.store.get_outbound_message(msg_id)
+        self.assertEqual(stored_msg, msg)
+        batch_status = yield self.store.batch_status(batch_id)
+        self.assertEqual(batch_status, self._batch_status(sent=2))
+
+    @inlineCallbacks
+    def test_add_outbound_messages_with_tag(self):
+        batch_id = yield self.store.batch_start([("pool", "tag")])
+        msgs = [self.msg_helper.make_outbound("foo") for _ in range(2)]
+        yield self.store.add_outbound_messages(msgs, tag=("pool", "tag"))
+
+        outbound_keys = yield self.store.batch_outbound_keys(batch_id)
+        self.assertEqual(
+            sorted(outbound_keys), sorted(msg['message_id'] for msg in msgs))
+
     @inlineCallbacks
     def test_add_outbound_message_with_tag(self):
         msg_id, msg, batch_id = yield self._create_outbound()
@@ -321,6 +466,48 @@ class TestMessageStore(TestMessageStoreBase):
             "%s$%s$ack" % (batch_id, to_reverse_timestamp(timestamp)),
         ]))
 
+    @inlineCallbacks
+    def test_add_events(self):
+        msg_id, msg, batch_id = yield self._create_outbound()
+        ack = self.msg_helper.make_ack(msg)
+        dr = self.msg_helper.make_delivery_report(
+            msg, delivery_status="failed")
+        yield self.store.add_events([ack, dr])
+
+        for event in [ack, dr]:
+            stored_event = yield self.store.get_event(event['event_id'])
+            self.assertEqual(stored_event, event)
+            event_record = yield self.store.events.load(event['event_id'])
+            self.assertEqual(event_record.batches.keys(), [batch_id])
+        event_keys = yield self.store.message_event_keys(msg_id)
+        self.assertEqual(
+            sorted(event_keys), sorted([ack['event_id'], dr['event_id']]))
+        batch_status = yield self.store.batch_status(batch_id)
+        self.assertEqual(
+            batch_status, self._batch_status(sent=1, ack=1, failed=1))
+
+    @inlineCallbacks
+    def test_add_events_again(self):
+        msg_id, msg, batch_id = yield self._create_outbound()
+        ack = self.msg_helper.make_ack(msg)
+        yield self.store.add_event(ack)
+        yield self.store.add_events([ack, ack])
+
+        batch_status = yield self.store.batch_status(batch_id)
+        self.assertEqual(batch_status, self._batch_status(sent=1, ack=1))
+
+    @inlineCallbacks
+    def test_add_events_with_batch_ids(self):
+        msg_id, msg, batch_id = yield self._create_outbound()
+        other_batch_id = yield self.store.batch_start([("pool", "other")])
+        ack = self.msg_helper.make_ack(msg)
+        yield self.store.add_events([ack], batch_ids=[other_batch_id])
+
+        event_record = yield self.store.events.load(ack['event_id'])
+        self.assertEqual(event_record.batches.keys(), [other_batch_id])
+        batch_status = yield self.store.batch_status(other_batch_id)
+        self.assertEqual(batch_status, self._batch_status(ack=1))
+
     @inlineCallbacks
     def test_add_ack_event_uses_existing_batches(self):
         """
@@ -540,6 +727,23 @@ class TestMessageStore(TestMessageStoreBase):
         stored_msg = yield self.store.get_inbound_message(msg_id)
         self.assertEqual(stored_msg, msg)
 
+    @inlineCallbacks
+    def test_add_inbound_messages(self):
+        batch_id = yield self.store.batch_start([("pool", "tag")])
+        msgs = [self.msg_helper.make_inbound("foo") for _ in range(3)]
+        yield self.store.add_inbound_messages(msgs, batch_id=batch_id)
+
+        for msg in msgs:
+            stored_msg = yield self.store.get_inbound_message(
+                msg['message_id'])
+            self.assertEqual(stored_msg, msg)
+        inbound_keys = yield self.store.batch_inbound_keys(batch_id)
+        self.assertEqual(
+            sorted(inbound_keys), sorted(msg['message_id'] for msg in msgs))
+        inbound_count = yield self.store.cache.count_inbound_message_keys(
+            batch_id)
+        self.assertEqual(inbound_count, 3)
+
     @inlineCallbacks
     def test_add_inbound_message_again(self):
         msg_id, msg, _batch_id = yield self._create_inbound(tag=None)
@@ -1725,6 +1929,136 @@ class TestMessageStoreCache(TestMessageStoreBase):
         self.assertEqual(batch_status["delivery_report"], 10)
         self.assertEqual(batch_status["delivery_report.delivered"], 10)
 
+    @inlineCallbacks
+    def test_reconcile_cache_resume(self):
+        """
+        If a recon is interrupted, resuming it picks up from the last
+        checkpoint and still ends up with the correct numbers.
+        """
+        cache = self.store.cache
+        cache.TRUNCATE_MESSAGE_KEY_COUNT_AT = 2
+        self.store.DEFAULT_MAX_RESULTS = 2
+        batch_id = yield self.store.batch_start([("pool", "tag")])
+
+        yield self.create_inbound_messages(batch_id, 2, from_addr='from1')
+        yield self.create_inbound_messages(batch_id, 4, from_addr='from2')
+        outbound_messages = yield self.create_outbound_messages(
+            batch_id, 5, to_addr='to1')
+        for msg in outbound_messages:
+            ack = self.msg_helper.make_ack(msg)
+            yield self.store.add_event(ack)
+
+        # Interrupt the recon after the second page of inbound messages.
+        add_from_addrs = cache.add_from_addrs
+        calls = []
+
+        def failing_add_from_addrs(batch_id, addrs):
+            calls.append(addrs)
+            if len(calls) == 2:
+                raise ValueError("Interrupted")
+            return add_from_addrs(batch_id, addrs)
+
+        self.patch(cache, 'add_from_addrs', failing_add_from_addrs)
+        yield self.assertFailure(
+            self.store.reconcile_cache(batch_id), ValueError)
+        checkpoint = yield cache.get_recon_checkpoint(batch_id)
+        self.assertEqual(checkpoint['direction'], 'inbound')
+        self.assertEqual(len(checkpoint['cache_keys']), 2)
+        self.assertEqual(len(checkpoint['last_keys']), 1)
+
+        self.patch(cache, 'add_from_addrs', add_from_addrs)
+        yield self.store.reconcile_cache(batch_id, resume=True)
+        self.assertEqual(
+            (yield cache.get_recon_checkpoint(batch_id)), None)
+
+        inbound_count = yield cache.count_inbound_message_keys(batch_id)
+        self.assertEqual(inbound_count, 6)
+        outbound_count = yield cache.count_outbound_message_keys(batch_id)
+        self.assertEqual(outbound_count, 5)
+        inbound_uniques = yield cache.count_from_addrs(batch_id)
+        self.assertEqual(inbound_uniques, 2)
+        batch_status = yield self.store.batch_status(batch_id)
+        self.assertEqual(batch_status['ack'], 5)
+        self.assertEqual(batch_status['sent'], 5)
+
+    @inlineCallbacks
+    def test_reconcile_cache_resume_after_counts_applied(self):
+        """
+        If a recon is interrupted after its counts have been added to the
+        cache, resuming it doesn't add them again.
+        """
+        cache = self.store.cache
+        cache.TRUNCATE_MESSAGE_KEY_COUNT_AT = 2
+        self.store.DEFAULT_MAX_RESULTS = 2
+        batch_id = yield self.store.batch_start([("pool", "tag")])
+
+        yield self.create_inbound_messages(batch_id, 3, from_addr='from1')
+        outbound_messages = yield self.create_outbound_messages(
+            batch_id, 5, to_addr='to1')
+        for msg in outbound_messages:
+            ack = self.msg_helper.make_ack(msg)
+            yield self.store.add_event(ack)
+
+        # Interrupt the recon after the last page of outbound messages,
+        # while the retained recent keys are being added to the cache.
+        concurrent_map = self.store._concurrent_map
+
+        def failing_concurrent_map(func, args_list, concurrency=None):
+            if func == self.store._reconcile_outbound_key:
+                raise ValueError("Interrupted")
+            return concurrent_map(func, args_list, concurrency)
+
+        self.patch(self.store, '_concurrent_map', failing_concurrent_map)
+        yield self.assertFailure(
+            self.store.reconcile_cache(batch_id), ValueError)
+        checkpoint = yield cache.get_recon_checkpoint(batch_id)
+        self.assertEqual(checkpoint['direction'], 'outbound')
+        self.assertEqual(checkpoint['counts_applied'], True)
+
+        self.patch(self.store, '_concurrent_map', concurrent_map)
+        yield self.store.reconcile_cache(batch_id, resume=True)
+        self.assertEqual(
+            (yield cache.get_recon_checkpoint(batch_id)), None)
+
+        inbound_count = yield cache.count_inbound_message_keys(batch_id)
+        self.assertEqual(inbound_count, 3)
+        outbound_count = yield cache.count_outbound_message_keys(batch_id)
+        self.assertEqual(outbound_count, 5)
+        batch_status = yield self.store.batch_status(batch_id)
+        self.assertEqual(batch_status['ack'], 5)
+        self.assertEqual(batch_status['sent'], 5)
+
+    @inlineCallbacks
+    def test_reconcile_cache_resume_before_counts_applied(self):
+        """
+        If a recon is interrupted after its last index page but before its
+        counts have been added to the cache, resuming it adds them once.
+        """
+        cache = self.store.cache
+        cache.TRUNCATE_MESSAGE_KEY_COUNT_AT = 2
+        self.store.DEFAULT_MAX_RESULTS = 2
+        batch_id = yield self.store.batch_start([("pool", "tag")])
+
+        yield self.create_inbound_messages(batch_id, 5, from_addr='from1')
+
+        add_inbound_recon_counts = cache.add_inbound_recon_counts
+
+        def failing_add_inbound_recon_counts(*args):
+            raise ValueError("Interrupted")
+
+        self.patch(cache, 'add_inbound_recon_counts',
+                   failing_add_inbound_recon_counts)
+        yield self.assertFailure(
+            self.store.reconcile_cache(batch_id), ValueError)
+        checkpoint = yield cache.get_recon_checkpoint(batch_id)
+        self.assertEqual(checkpoint['direction'], 'inbound')
+        self.assertEqual(checkpoint['counts_applied'], False)
+
+        self.patch(cache, 'add_inbound_recon_counts', add_inbound_recon_counts)
+        yield self.store.reconcile_cache(batch_id, resume=True)
+        inbound_count = yield cache.count_inbound_message_keys(batch_id)
+        self.assertEqual(inbound_count, 5)
+
     @inlineCallbacks
     def test_reconcile_cache_and_switch_to_counters(self):
         batch_id = yield self.store.batch_start([("pool", "tag")])
@@ -3,6 +3,7 @@
 """Tests for vumi.components.message_store_cache."""
 
 from datetime import datetime, timedelta
+import time
 
 from twisted.internet.defer import inlineCallbacks, returnValue
 
@@ -159,6 +160,13 @@ class TestMessageStoreCache(MessageStoreCacheTestCase):
         count = yield self.cache.count_from_addrs(self.batch_id)
         self.assertEqual(count, 10)
 
+    @inlineCallbacks
+    def test_add_from_addrs(self):
+        yield self.cache.add_from_addrs(
+            self.batch_id, [u'from-1', u'from-2', u'from-1'])
+        count = yield self.cache.count_from_addrs(self.batch_id)
+        self.assertEqual(count, 2)
+
     @inlineCallbacks
     def test_get_to_addrs(self):
         yield self.add_messages(
@@ -175,6 +183,13 @@ class TestMessageStoreCache(MessageStoreCacheTestCase):
         count = yield self.cache.count_to_addrs(self.batch_id)
         self.assertEqual(count, 10)
 
+    @inlineCallbacks
+    def test_add_to_addrs(self):
+        yield self.cache.add_to_addrs(
+            self.batch_id, [u'to-1', u'to-2', u'to-1'])
+        count = yield self.cache.count_to_addrs(self.batch_id)
+        self.assertEqual(count, 2)
+
     @inlineCallbacks
     def test_add_event(self):
         msg = self.msg_helper.make_outbound("outbound")
@@ -196,6 +211,79 @@ class TestMessageStoreCache(MessageStoreCacheTestCase):
             'sent': 1,
         })
 
+    @inlineCallbacks
+    def test_add_outbound_messages(self):
+        msgs = [self.msg_helper.make_outbound(
+            "outbound", to_addr='to-%s' % (i % 2,)) for i in range(4)]
+        yield self.cache.add_outbound_messages(self.batch_id, msgs)
+        yield self.cache.add_outbound_messages(self.batch_id, msgs[:2])
+        count = yield self.cache.count_outbound_message_keys(self.batch_id)
+        self.assertEqual(count, 4)
+        keys = yield self.cache.get_outbound_message_keys(self.batch_id)
+        self.assertEqual(
+            sorted(keys), sorted(msg['message_id'] for msg in msgs))
+        uniques = yield self.cache.count_to_addrs(self.batch_id)
+        self.assertEqual(uniques, 2)
+        status = yield self.cache.get_event_status(self.batch_id)
+        self.assertEqual(status['sent'], 4)
+
+    @inlineCallbacks
+    def test_add_inbound_messages(self):
+        msgs = [self.msg_helper.make_inbound(
+            "inbound", from_addr='from-%s' % (i % 2,)) for i in range(4)]
+        yield self.cache.add_inbound_messages(self.batch_id, msgs)
+        yield self.cache.add_inbound_messages(self.batch_id, msgs[:2])
+        count = yield self.cache.count_inbound_message_keys(self.batch_id)
+        self.assertEqual(count, 4)
+        uniques = yield self.cache.count_from_addrs(self.batch_id)
+        self.assertEqual(uniques, 2)
+
+    @inlineCallbacks
+    def test_add_events(self):
+        msg = self.msg_helper.make_outbound("outbound")
+        yield self.cache.add_outbound_message(self.batch_id, msg)
+        ack = self.msg_helper.make_ack(msg)
+        delivery = self.msg_helper.make_delivery_report(msg)
+        yield self.cache.add_events(self.batch_id, [ack, delivery, ack])
+        yield self.cache.add_events(self.batch_id, [delivery])
+        event_count = yield self.cache.count_event_keys(self.batch_id)
+        self.assertEqual(event_count, 2)
+        status = yield self.cache.get_event_status(self.batch_id)
+        self.assertEqual(status, {
+            'delivery_report': 1,
+            'delivery_report.delivered': 1,
+            'delivery_report.failed': 0,
+            'delivery_report.pending': 0,
+            'ack': 1,
+            'nack': 0,
+            'sent': 1,
+        })
+
+    @inlineCallbacks
+    def test_add_event_key_with_status(self):
+        now = time.time()
+        new_entry = yield self.cache.add_event_key_with_status(
+            self.batch_id, 'event-1', now, 'ack')
+        self.assertEqual(new_entry, 1)
+        new_entry = yield self.cache.add_event_key_with_status(
+            self.batch_id, 'event-2', now, 'delivery_report.failed')
+        self.assertEqual(new_entry, 1)
+        new_entry = yield self.cache.add_event_key_with_status(
+            self.batch_id, 'event-2', now, 'delivery_report.failed')
+        self.assertEqual(new_entry, 0)
+        event_count = yield self.cache.count_event_keys(self.batch_id)
+        self.assertEqual(event_count, 2)
+        status = yield self.cache.get_event_status(self.batch_id)
+        self.assertEqual(status, {
+            'delivery_report': 1,
+            'delivery_report.delivered': 0,
+            'delivery_report.failed': 1,
+            'delivery_report.pending': 0,
+            'ack': 1,
+            'nack': 0,
+            'sent': 0,
+        })
+
     @inlineCallbacks
     def test_add_event_idempotence(self):
         msg = self.msg_helper.make_outbound("outbound")
@@ -514,3 +602,52 @@ class TestMessageStoreCacheWithCounters(MessageStoreCacheTestCase):
         self.assertEqual(
             set(cached_message_keys),
             set([m['message_id'] for m in received_messages[-truncate_at:]]))
+
+    @inlineCallbacks
+    def test_recon_checkpoint(self):
+        checkpoint = yield self.cache.get_recon_checkpoint(self.batch_id)
+        self.assertEqual(checkpoint, None)
+        yield self.cache.set_recon_checkpoint(
+            self.batch_id, {'direction': 'outbound', 'key_count': 3})
+        checkpoint = yield self.cache.get_recon_checkpoint(self.batch_id)
+        self.assertEqual(checkpoint, {'direction': 'outbound', 'key_count': 3})
+        yield self.cache.clear_recon_checkpoint(self.batch_id)
+        checkpoint = yield self.cache.get_recon_checkpoint(self.batch_id)
+        self.assertEqual(checkpoint, None)
+
+    @inlineCallbacks
+    def test_add_outbound_recon_counts(self):
+        yield self.cache.batch_start(self.batch_id, use_counters=True)
+        yield self.cache.add_outbound_recon_counts(
+            self.batch_id, 3, {'ack': 2, 'nack': 1},
+            {'direction': 'outbound', 'counts_applied': True})
+        self.assertEqual(
+            (yield self.cache.count_outbound_message_keys(self.batch_id)), 3)
+        self.assertEqual(
+            (yield self.cache.count_event_keys(self.batch_id)), 3)
+        status = yield self.cache.get_event_status(self.batch_id)
+        self.assertEqual(status['sent'], 3)
+        self.assertEqual(status['ack'], 2)
+        self.assertEqual(status['nack'], 1)
+        checkpoint = yield self.cache.get_recon_checkpoint(self.batch_id)
+        self.assertEqual(
+            checkpoint, {'direction': 'outbound', 'counts_applied': True})
+
+    @inlineCallbacks
+    def test_add_inbound_recon_counts(self):
+        yield self.cache.batch_start(self.batch_id, use_counters=True)
+        yield self.cache.add_inbound_recon_counts(
+            self.batch_id, 4, {'direction': 'inbound', 'counts_applied': True})
+        self.assertEqual(
+            (yield self.cache.count_inbound_message_keys(self.batch_id)), 4)
+        checkpoint = yield self.cache.get_recon_checkpoint(self.batch_id)
+        self.assertEqual(
+            checkpoint, {'direction': 'inbound', 'counts_applied': True})
+
+    @inlineCallbacks
+    def test_clear_batch_clears_recon_checkpoint(self):
+        yield self.cache.set_recon_checkpoint(
+            self.batch_id, {'direction': 'outbound'})
+        yield self.cache.clear_batch(self.batch_id)
+        checkpoint = yield self.cache.get_recon_checkpoint(self.batch_id)
+        self.assertEqual(checkpoint, None)
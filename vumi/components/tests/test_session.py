@@ -35,10 +35,46 @@ class TestSessionManager(VumiTestCase):
         s1, s2 = yield get_sessions()
         self.assertTrue(s1[1]['created_at'] < s2[1]['created_at'])
 
+    @inlineCallbacks
+    def test_active_sessions_page(self):
+        for i in range(5):
+            yield self.sm.create_session("u%d" % i, foo="bar%d" % i)
+        # Something that isn't a session.
+        yield self.manager.set("other", "value")
+
+        sessions = []
+        page = yield self.sm.active_sessions_page(count=2)
+        pages = 1
+        while page.has_next_page():
+            sessions.extend(page)
+            page = yield page.next_page()
+            pages += 1
+        sessions.extend(page)
+        self.assertEqual((yield page.next_page()), None)
+        self.assertTrue(pages > 1)
+        self.assertEqual(
+            sorted((user_id, s['foo']) for user_id, s in sessions),
+            [("u%d" % i, "bar%d" % i) for i in range(5)])
+
+    @inlineCallbacks
+    def test_active_sessions_cleared_session(self):
+        yield self.sm.create_session("u1")
+        yield self.sm.create_session("u2")
+        yield self.sm.clear_session("u1")
+        sessions = yield self.sm.active_sessions()
+        self.assertEqual([user_id for user_id, _ in sessions], ["u2"])
+
     @inlineCallbacks
     def test_schedule_session_expiry(self):
         self.sm.max_session_length = 60.0
         yield self.sm.create_session("u1")
+        ttl = yield self.manager.ttl("session:u1")
+        self.assertTrue(0 < ttl <= 60)
+
+    @inlineCallbacks
+    def test_create_session_without_expiry(self):
+        yield self.sm.create_session("u1")
+        self.assertEqual((yield self.manager.ttl("session:u1")), None)
 
     @inlineCallbacks
     def test_create_and_retrieve_session(self):
@@ -70,3 +106,10 @@ class TestSessionManager(VumiTestCase):
         # Redis saves & returns all session values as strings
         self.assertEqual(session, dict([map(str, kvs) for kvs
                                         in test_session.items()]))
+
+    @inlineCallbacks
+    def test_save_empty_session(self):
+        yield self.sm.create_session("u1", foo="bar")
+        self.assertEqual((yield self.sm.save_session("u1", {})), {})
+        session = yield self.sm.load_session("u1")
+        self.assertEqual(session['foo'], "bar")
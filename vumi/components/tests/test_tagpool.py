@@ -41,6 +41,19 @@ class TestTxTagpoolManager(VumiTestCase):
         yield self.tpm.declare_tags([tag])
         self.assertEqual((yield self.tpm.acquire_tag(tag[0])), tag)
 
+    @inlineCallbacks
+    def test_declare_tags_in_chunks(self):
+        tkey = self.pool_key_generator("poolA")
+        self.tpm.declare_chunk_size = 2
+        tags = [("poolA", "tag%d" % i) for i in range(5)]
+        yield self.tpm.declare_tags(tags[:1])
+        yield self.tpm.declare_tags(tags)
+        redis = self.redis
+        self.assertEqual((yield redis.lrange(tkey("free:list"), 0, -1)),
+                         [t[1] for t in tags])
+        self.assertEqual((yield redis.smembers(tkey("free:set"))),
+                         set(t[1] for t in tags))
+
     @inlineCallbacks
     def test_purge_pool(self):
         tag1, tag2 = ("poolA", "tag1"), ("poolA", "tag2")
@@ -96,6 +109,38 @@ class TestTxTagpoolManager(VumiTestCase):
         self.assertEqual((yield redis.smembers(tkey("inuse:set"))),
                          set(["tag1"]))
 
+    @inlineCallbacks
+    def test_acquire_tags(self):
+        tkey = self.pool_key_generator("poolA")
+        tags = [("poolA", "tag%d" % i) for i in range(5)]
+        yield self.tpm.declare_tags(tags)
+        self.assertEqual((yield self.tpm.acquire_tags("poolA", 2)), tags[:2])
+        self.assertEqual((yield self.tpm.acquire_tags("poolA", 5)), tags[2:])
+        self.assertEqual((yield self.tpm.acquire_tags("poolA", 5)), [])
+        self.assertEqual((yield self.tpm.acquire_tags("poolB", 5)), [])
+        redis = self.redis
+        self.assertEqual((yield redis.lrange(tkey("free:list"), 0, -1)), [])
+        self.assertEqual((yield redis.smembers(tkey("free:set"))), set())
+        self.assertEqual((yield redis.smembers(tkey("inuse:set"))),
+                         set(t[1] for t in tags))
+
+    @inlineCallbacks
+    def test_acquire_unicode_tags(self):
+        tags = [(u"poöl", u"tág%d" % i) for i in range(2)]
+        yield self.tpm.declare_tags(tags)
+        self.assertEqual((yield self.tpm.acquire_tags(u"poöl", 3)), tags)
+
+    @inlineCallbacks
+    def test_acquire_tags_owner_and_reason(self):
+        tags = [[u"poöl", u"tág%d" % i] for i in range(3)]
+        yield self.tpm.declare_tags(tags)
+        yield self.tpm.acquire_tags(u"poöl", 2, u"mé", {"foo": "bar"})
+        for tag in tags[:2]:
+            owner, reason = yield self.tpm.acquired_by(tag)
+            self._check_reason(u"mé", owner, reason, {"foo": "bar"})
+        self.assertEqual(
+            sorted((yield self.tpm.owned_tags(u"mé"))), tags[:2])
+
     @inlineCallbacks
     def test_acquire_unicode_tag(self):
         tag = (u"poöl", u"tág")
@@ -275,6 +320,25 @@ class TestTxTagpoolManager(VumiTestCase):
         my_tags = yield self.tpm.owned_tags(u"me")
         self.assertEqual(my_tags, [tags[0]])
 
+    @inlineCallbacks
+    def test_release_tag_removes_owned_tag(self):
+        tags = [[u"poöl1", u"tág1"], [u"poöl1", u"tág2"]]
+        yield self.tpm.declare_tags(tags)
+        yield self.tpm.acquire_tag(tags[0][0], owner=u"mé")
+        yield self.tpm.acquire_specific_tag(tags[1], owner=u"mé")
+        yield self.tpm.release_tag(tags[0])
+        self.assertEqual((yield self.tpm.owned_tags(u"mé")), [tags[1]])
+        yield self.tpm.release_tag(tags[1])
+        self.assertEqual((yield self.tpm.owned_tags(u"mé")), [])
+
+    @inlineCallbacks
+    def test_release_unowned_tag_removes_owned_tag(self):
+        tags = [["pool1", "tag1"]]
+        yield self.tpm.declare_tags(tags)
+        yield self.tpm.acquire_tag(tags[0][0])
+        yield self.tpm.release_tag(tags[0])
+        self.assertEqual((yield self.tpm.owned_tags(None)), [])
+
 
 class TestTagpoolManager(TestTxTagpoolManager):
     sync_persistence = True
@@ -1,4 +1,4 @@
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, Deferred
 from twisted.internet.task import Clock
 
 from vumi.components.window_manager import WindowManager, WindowException
@@ -80,6 +80,73 @@ class TestWindowManager(VumiTestCase):
         next_flight_key = yield self.wm.get_next_key(self.window_id)
         self.assertTrue(next_flight_key)
 
+    @inlineCallbacks
+    def test_get_next_keys(self):
+        keys = []
+        for i in range(12):
+            keys.append((yield self.wm.add(self.window_id, i)))
+
+        self.assertEqual((yield self.wm.get_next_keys(self.window_id, 3)),
+                         keys[:3])
+        # Without a limit we get as many as there's room for.
+        self.assertEqual((yield self.wm.get_next_keys(self.window_id)),
+                         keys[3:10])
+        self.assertEqual((yield self.wm.get_next_keys(self.window_id)), [])
+        yield self.assert_in_flight(self.window_id, 10)
+        expired = yield self.wm.get_expired_flight_keys(self.window_id)
+        self.assertEqual(expired, [])
+        self.clock.advance(10)
+        expired = yield self.wm.get_expired_flight_keys(self.window_id)
+        self.assertEqual(sorted(expired), sorted(keys[:10]))
+
+        yield self.wm.remove_keys(self.window_id, keys[:2])
+        self.assertEqual((yield self.wm.get_next_keys(self.window_id, 5)),
+                         keys[10:])
+
+    @inlineCallbacks
+    def test_return_keys(self):
+        keys = []
+        for i in range(5):
+            keys.append((yield self.wm.add(self.window_id, i)))
+        yield self.wm.get_next_keys(self.window_id, 4)
+
+        yield self.wm.return_keys(self.window_id, keys[1:3])
+        yield self.assert_in_flight(self.window_id, 2)
+        yield self.assert_count_waiting(self.window_id, 3)
+        self.clock.advance(10)
+        expired = yield self.wm.get_expired_flight_keys(self.window_id)
+        self.assertEqual(sorted(expired), sorted([keys[0], keys[3]]))
+        # Returned keys are taken again in their original order.
+        self.assertEqual((yield self.wm.get_next_keys(self.window_id)),
+                         [keys[1], keys[2], keys[4]])
+
+    @inlineCallbacks
+    def test_remove_keys(self):
+        keys = []
+        for i in range(5):
+            keys.append((yield self.wm.add(self.window_id, i)))
+        yield self.wm.get_next_keys(self.window_id)
+        for key in keys:
+            yield self.wm.set_external_id(self.window_id, key, "ext-" + key)
+
+        yield self.wm.remove_keys(self.window_id, keys[:4])
+        yield self.assert_in_flight(self.window_id, 1)
+        self.assertEqual((yield self.wm.get_data(self.window_id, keys[4])), 4)
+        self.assertEqual(
+            (yield self.wm.get_external_id(self.window_id, keys[4])),
+            "ext-" + keys[4])
+        for key in keys[:4]:
+            data_key = self.wm.window_key(self.window_id, key)
+            self.assertEqual((yield self.redis.get(data_key)), None)
+            self.assertEqual(
+                (yield self.wm.get_external_id(self.window_id, key)), None)
+            self.assertEqual(
+                (yield self.wm.get_internal_id(self.window_id, "ext-" + key)),
+                None)
+        self.clock.advance(10)
+        expired = yield self.wm.get_expired_flight_keys(self.window_id)
+        self.assertEqual(expired, [keys[4]])
+
     @inlineCallbacks
     def test_set_and_external_id(self):
         yield self.wm.set_external_id(self.window_id, "flight_key",
@@ -210,6 +277,57 @@ class TestWindowManager(VumiTestCase):
         self.assertEqual((yield self.wm.get_windows()), [])
         self.assertEqual(set(cleanup_callbacks), set(window_ids))
 
+    @inlineCallbacks
+    def test_monitor_windows_concurrently(self):
+        yield self.wm.remove_window(self.window_id)
+        for window_id in ['slow', 'fast']:
+            yield self.wm.create_window(window_id)
+            for i in range(3):
+                yield self.wm.add(window_id, i)
+
+        slow_d = Deferred()
+        key_callbacks = []
+
+        def callback(window_id, key):
+            key_callbacks.append(window_id)
+            if window_id == 'slow':
+                return slow_d
+
+        d = self.wm._monitor_windows(callback, False)
+        # Wait for the fast window to be drained while the slow window is
+        # still waiting on its first callback.
+        while key_callbacks.count('fast') < 3:
+            yield self.wm.count_waiting('fast')
+        self.assertEqual(key_callbacks.count('slow'), 1)
+        self.assertFalse(d.called)
+
+        slow_d.callback(None)
+        yield d
+        self.assertEqual(key_callbacks.count('slow'), 3)
+
+    @inlineCallbacks
+    def test_monitor_windows_callback_error(self):
+        keys = []
+        for i in range(5):
+            keys.append((yield self.wm.add(self.window_id, i)))
+        called = []
+
+        def callback(window_id, key):
+            called.append(key)
+            if len(called) == 2:
+                raise WindowException("Oops")
+
+        yield self.assertFailure(
+            self.wm._monitor_windows(callback, False), WindowException)
+        self.assertEqual(called, keys[:2])
+        # The keys the callback didn't get to are back in the window
+        # rather than stranded in flight.
+        yield self.assert_in_flight(self.window_id, 2)
+        yield self.assert_count_waiting(self.window_id, 3)
+
+        yield self.wm._monitor_windows(callback, False)
+        self.assertEqual(called, keys)
+
 
 class TestConcurrentWindowManager(VumiTestCase):
 
@@ -3,16 +3,100 @@ import json
 import uuid
 
 from twisted.internet import reactor
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, succeed, gatherResults, FirstError)
 from twisted.internet.task import LoopingCall
+from twisted.python.failure import Failure
 
 from vumi import log
+from vumi.persist.redis_base import Manager
 
 
 class WindowException(Exception):
     pass
 
 
+def _get_next_keys_emulation(call, keys, args):
+    window_key, inflight_key, stats_key = keys
+    window_size, count, clock_time = args
+    room_available = int(window_size) - call('llen', inflight_key)
+    next_keys = []
+    for _ in xrange(min(room_available, int(count))):
+        next_key = call('rpoplpush', window_key, inflight_key)
+        if next_key is None:
+            break
+        call('zadd', stats_key, **{next_key: float(clock_time)})
+        next_keys.append(next_key)
+    return next_keys
+
+
+GET_NEXT_KEYS_SCRIPT = Manager.register_script("""
+local room_available = tonumber(ARGV[1]) - redis.call('LLEN', KEYS[2])
+local next_keys = {}
+for i = 1, math.min(room_available, tonumber(ARGV[2])) do
+    local next_key = redis.call('RPOPLPUSH', KEYS[1], KEYS[2])
+    if not next_key then
+        break
+    end
+    redis.call('ZADD', KEYS[3], ARGV[3], next_key)
+    table.insert(next_keys, next_key)
+end
+return next_keys
+""", _get_next_keys_emulation)
+
+
+def _remove_keys_emulation(call, keys, args):
+    (inflight_key, stats_key, data_key_prefix, external_key_prefix,
+     internal_key_prefix) = keys
+    for key in args:
+        call('lrem', inflight_key, key, 1)
+        call('delete', data_key_prefix + key)
+        external_id = call('get', external_key_prefix + key)
+        if external_id is not None:
+            call('delete', external_key_prefix + key)
+            call('delete', internal_key_prefix + external_id)
+        call('zrem', stats_key, key)
+    return len(args)
+
+
+# The data and external id mapping keys for each flight key are built on the
+# server from the prefixes passed in KEYS.
+REMOVE_KEYS_SCRIPT = Manager.register_script("""
+for i, key in ipairs(ARGV) do
+    redis.call('LREM', KEYS[1], 1, key)
+    redis.call('DEL', KEYS[3] .. key)
+    local external_id = redis.call('GET', KEYS[4] .. key)
+    if external_id then
+        redis.call('DEL', KEYS[4] .. key, KEYS[5] .. external_id)
+    end
+    redis.call('ZREM', KEYS[2], key)
+end
+return #ARGV
+""", _remove_keys_emulation)
+
+
+def _return_keys_emulation(call, keys, args):
+    window_key, inflight_key, stats_key = keys
+    for key in reversed(args):
+        if call('lrem', inflight_key, key, 1):
+            call('zrem', stats_key, key)
+            call('rpush', window_key, key)
+    return len(args)
+
+
+# Keys are pushed back in reverse order so that they are taken from the
+# window again in the order they were originally taken.
+RETURN_KEYS_SCRIPT = Manager.register_script("""
+for i = #ARGV, 1, -1 do
+    if redis.call('LREM', KEYS[2], 1, ARGV[i]) > 0 then
+        redis.call('ZREM', KEYS[3], ARGV[i])
+        redis.call('RPUSH', KEYS[1], ARGV[i])
+    end
+end
+return #ARGV
+""", _return_keys_emulation)
+
+
 class WindowManager(object):
 
     WINDOW_KEY = 'windows'
@@ -99,32 +183,38 @@ class WindowManager(object):
 
     @inlineCallbacks
     def get_next_key(self, window_id):
-
-        window_key = self.window_key(window_id)
-        inflight_key = self.flight_key(window_id)
-
-        waiting_list = yield self.count_waiting(window_id)
-        if waiting_list == 0:
-            return
-
-        flight_size = yield self.count_in_flight(window_id)
-        room_available = self.window_size - flight_size
-
-        if room_available > 0:
-            log.debug('Window %s has space for %s' % (window_key,
-                                                        room_available))
-            next_key = yield self.redis.rpoplpush(window_key, inflight_key)
-            if next_key:
-                yield self._set_timestamp(window_id, next_key)
-                returnValue(next_key)
-
-    def _set_timestamp(self, window_id, flight_key):
-        return self.redis.zadd(self.stats_key(window_id), **{
-                flight_key: self.get_clocktime(),
-        })
-
-    def _clear_timestamp(self, window_id, flight_key):
-        return self.redis.zrem(self.stats_key(window_id), flight_key)
+        next_keys = yield self.get_next_keys(window_id, 1)
+        if next_keys:
+            returnValue(next_keys[0])
+
+    def get_next_keys(self, window_id, n=None):
+        """
+        Move up to `n` keys from the window into flight, or as many as there
+        is room for if `n` is `None`, and return them.
+
+        This is a single atomic operation, so concurrent window managers
+        never put more than `window_size` keys in flight.
+        """
+        if n is None:
+            n = self.window_size
+        return self.redis.run_script(
+            GET_NEXT_KEYS_SCRIPT,
+            [self.window_key(window_id), self.flight_key(window_id),
+             self.stats_key(window_id)],
+            [self.window_size, n, repr(self.get_clocktime())])
+
+    def return_keys(self, window_id, keys):
+        """
+        Move flight keys back to the window so they are taken again by the
+        next call to :meth:`get_next_keys`.
+        """
+        if not keys:
+            return succeed(0)
+        return self.redis.run_script(
+            RETURN_KEYS_SCRIPT,
+            [self.window_key(window_id), self.flight_key(window_id),
+             self.stats_key(window_id)],
+            keys)
 
     def count_waiting(self, window_id):
         window_key = self.window_key(window_id)
@@ -151,13 +241,22 @@ class WindowManager(object):
         json_data = yield self.redis.get(self.window_key(window_id, key))
         returnValue(json.loads(json_data))
 
-    @inlineCallbacks
     def remove_key(self, window_id, key):
-        yield self.redis.lrem(self.flight_key(window_id), key, 1)
-        yield self.redis.delete(self.window_key(window_id, key))
-        yield self.redis.delete(self.stats_key(window_id, key))
-        yield self.clear_external_id(window_id, key)
-        yield self._clear_timestamp(window_id, key)
+        return self.remove_keys(window_id, [key])
+
+    def remove_keys(self, window_id, keys):
+        """
+        Remove flight keys along with their data and external ids.
+        """
+        if not keys:
+            return succeed(0)
+        return self.redis.run_script(
+            REMOVE_KEYS_SCRIPT,
+            [self.flight_key(window_id), self.stats_key(window_id),
+             self.window_key(window_id, ''),
+             self.map_key(window_id, 'external', ''),
+             self.map_key(window_id, 'internal', '')],
+            keys)
 
     @inlineCallbacks
     def set_external_id(self, window_id, flight_key, external_id):
@@ -192,19 +291,43 @@ class WindowManager(object):
         self._monitor.clock = self.get_clock()
         self._monitor.start(interval)
 
+    @inlineCallbacks
+    def _monitor_window(self, window_id, key_callback, cleanup=True,
+                        cleanup_callback=None):
+        keys = yield self.get_next_keys(window_id)
+        while keys:
+            for i, key in enumerate(keys):
+                try:
+                    yield key_callback(window_id, key)
+                except Exception:
+                    # Put the keys we haven't processed back in the window
+                    # so they aren't stranded in flight.
+                    f = Failure()
+                    yield self.return_keys(window_id, keys[i + 1:])
+                    f.raiseException()
+            keys = yield self.get_next_keys(window_id)
+
+        # Remove empty windows if required
+        if cleanup and not ((yield self.count_waiting(window_id)) or
+                            (yield self.count_in_flight(window_id))):
+            if cleanup_callback:
+                cleanup_callback(window_id)
+            yield self.remove_window(window_id)
+
     @inlineCallbacks
     def _monitor_windows(self, key_callback, cleanup=True,
                          cleanup_callback=None):
         windows = yield self.get_windows()
-        for window_id in windows:
-            key = (yield self.get_next_key(window_id))
-            while key:
-                yield key_callback(window_id, key)
-                key = (yield self.get_next_key(window_id))
-
-            # Remove empty windows if required
-            if cleanup and not ((yield self.count_waiting(window_id)) or
-                                (yield self.count_in_flight(window_id))):
-                if cleanup_callback:
-                    cleanup_callback(window_id)
-                yield self.remove_window(window_id)
+        # Each window is drained in order, but all the windows are drained
+        # at the same time so one busy window doesn't hold up the others.
+        d = gatherResults([
+            self._monitor_window(
+                window_id, key_callback, cleanup, cleanup_callback)
+            for window_id in windows], consumeErrors=True)
+        d.addErrback(self._unwrap_first_error)
+        yield d
+
+    @staticmethod
+    def _unwrap_first_error(f):
+        f.trap(FirstError)
+        return f.value.subFailure
@@ -18,7 +18,8 @@ class BaseConnector(object):
     individually all over the place.
     """
     def __init__(self, worker, connector_name, prefetch_count=None,
-                 middlewares=None):
+                 middlewares=None, max_in_flight=None,
+                 publish_confirm_window=None, lazy_decode=False):
         self.name = connector_name
         self.worker = worker
         self._consumers = {}
@@ -26,6 +27,9 @@ class BaseConnector(object):
         self._endpoint_handlers = {}
         self._default_handlers = {}
         self._prefetch_count = prefetch_count
+        self._max_in_flight = max_in_flight
+        self._publish_confirm_window = publish_confirm_window
+        self._lazy_decode = lazy_decode
         self._middlewares = MiddlewareStack(middlewares
                                             if middlewares is not None else [])
 
@@ -56,7 +60,8 @@ class BaseConnector(object):
 
     @inlineCallbacks
     def _setup_publisher(self, mtype):
-        publisher = yield self.worker.publish_to(self._rkey(mtype))
+        publisher = yield self.worker.publish_to(
+            self._rkey(mtype), confirm_window=self._publish_confirm_window)
         self._publishers[mtype] = publisher
         returnValue(publisher)
 
@@ -67,7 +72,9 @@ class BaseConnector(object):
 
         consumer = yield self.worker.consume(
             self._rkey(mtype), handler, message_class=msg_class, paused=True,
-            prefetch_count=self._prefetch_count)
+            prefetch_count=self._prefetch_count,
+            max_in_flight=self._max_in_flight,
+            lazy_decode=self._lazy_decode)
         self._consumers[mtype] = consumer
         self._set_default_endpoint_handler(mtype, default_handler)
         returnValue(consumer)
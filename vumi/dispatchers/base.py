@@ -28,6 +28,8 @@ class BaseDispatchWorker(Worker):
                 % (self.__class__.__name__, self.config))
 
         self.amqp_prefetch_count = self.config.get('amqp_prefetch_count', 20)
+        self.lazy_message_decoding = self.config.get(
+            'lazy_message_decoding', False)
         yield self.setup_endpoints()
         yield self.setup_middleware()
         yield self.setup_router()
@@ -84,13 +86,15 @@ class BaseDispatchWorker(Worker):
                 functools.partial(self.dispatch_inbound_message,
                                   transport_name),
                 message_class=TransportUserMessage, paused=True,
-                prefetch_count=self.amqp_prefetch_count)
+                prefetch_count=self.amqp_prefetch_count,
+                lazy_decode=self.lazy_message_decoding)
         for transport_name in self.transport_names:
             self.transport_event_consumer[transport_name] = yield self.consume(
                 '%s.event' % (transport_name,),
                 functools.partial(self.dispatch_inbound_event, transport_name),
                 message_class=TransportEvent, paused=True,
-                prefetch_count=self.amqp_prefetch_count)
+                prefetch_count=self.amqp_prefetch_count,
+                lazy_decode=self.lazy_message_decoding)
 
     @inlineCallbacks
     def setup_exposed_publishers(self):
@@ -112,7 +116,8 @@ class BaseDispatchWorker(Worker):
                 functools.partial(self.dispatch_outbound_message,
                                   exposed_name),
                 message_class=TransportUserMessage, paused=True,
-                prefetch_count=self.amqp_prefetch_count)
+                prefetch_count=self.amqp_prefetch_count,
+                lazy_decode=self.lazy_message_decoding)
 
     def dispatch_inbound_message(self, endpoint, msg):
         d = self._middlewares.apply_consume("inbound", msg, endpoint)
@@ -234,21 +239,21 @@ class SimpleDispatchRouter(BaseDispatchRouter):
     """
 
     def dispatch_inbound_message(self, msg):
-        names = self.config['route_mappings'][msg['transport_name']]
+        names = self.config['route_mappings'][msg.peek('transport_name')]
         for name in names:
             # copy message so that the middleware doesn't see a particular
             # message instance multiple times
             self.dispatcher.publish_inbound_message(name, msg.copy())
 
     def dispatch_inbound_event(self, msg):
-        names = self.config['route_mappings'][msg['transport_name']]
+        names = self.config['route_mappings'][msg.peek('transport_name')]
         for name in names:
             # copy message so that the middleware doesn't see a particular
             # message instance multiple times
             self.dispatcher.publish_inbound_event(name, msg.copy())
 
     def dispatch_outbound_message(self, msg):
-        name = msg['transport_name']
+        name = msg.peek('transport_name')
         name = self.config.get('transport_mappings', {}).get(name, name)
         if name in self.dispatcher.transport_publisher:
             self.dispatcher.publish_outbound_message(name, msg)
@@ -278,7 +283,7 @@ class TransportToTransportRouter(BaseDispatchRouter):
     """
 
     def dispatch_inbound_message(self, msg):
-        names = self.config['route_mappings'][msg['transport_name']]
+        names = self.config['route_mappings'][msg.peek('transport_name')]
         for name in names:
             self.dispatcher.publish_outbound_message(name, msg.copy())
 
@@ -314,7 +319,7 @@ class ToAddrRouter(SimpleDispatchRouter):
             # TODO: assert that name is in list of publishers.
 
     def dispatch_inbound_message(self, msg):
-        toaddr = msg['to_addr']
+        toaddr = msg.peek('to_addr')
         for name, regex in self.mappings:
             if regex.match(toaddr):
                 # copy message so that the middleware doesn't see a particular
@@ -365,7 +370,7 @@ class FromAddrMultiplexRouter(BaseDispatchRouter):
         self.dispatcher.publish_inbound_event(self.exposed_name, msg)
 
     def dispatch_outbound_message(self, msg):
-        name = self.config['fromaddr_mappings'][msg['from_addr']]
+        name = self.config['fromaddr_mappings'][msg.peek('from_addr')]
         msg['transport_name'] = name
         self.dispatcher.publish_outbound_message(name, msg)
 
@@ -59,7 +59,7 @@ class LoadBalancingRouter(BaseDispatchRouter):
         if self.reply_affinity:
             # TODO: we should really be pushing the endpoint name
             #       but it isn't available here
-            self.push_transport_name(msg, msg['transport_name'])
+            self.push_transport_name(msg, msg.peek('transport_name'))
         if self.rewrite_transport_names:
             msg['transport_name'] = self.exposed_name
         self.dispatcher.publish_inbound_message(self.exposed_name, msg)
@@ -70,7 +70,7 @@ class LoadBalancingRouter(BaseDispatchRouter):
         self.dispatcher.publish_inbound_event(self.exposed_name, msg)
 
     def dispatch_outbound_message(self, msg):
-        if self.reply_affinity and msg['in_reply_to']:
+        if self.reply_affinity and msg.peek('in_reply_to'):
             transport_name = self.pop_transport_name(msg)
             if transport_name not in self.transport_name_set:
                 log.warning("LoadBalancer is configured for reply affinity but"
@@ -238,6 +238,15 @@ class TestBaseDispatchWorker(VumiTestCase):
             fake_channel = consumer.channel._fake_channel
             self.assertEqual(fake_channel.qos_prefetch_count, 0)
 
+    @inlineCallbacks
+    def test_consumer_lazy_message_decoding(self):
+        dp = yield self.get_dispatcher()
+        for consumer in self.get_dispatcher_consumers(dp):
+            self.assertEqual(consumer.lazy_decode, False)
+        dp = yield self.get_dispatcher(lazy_message_decoding=True)
+        for consumer in self.get_dispatcher_consumers(dp):
+            self.assertEqual(consumer.lazy_decode, True)
+
 
 class TestToAddrRouter(VumiTestCase):
 
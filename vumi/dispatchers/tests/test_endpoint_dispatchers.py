@@ -4,6 +4,7 @@ from twisted.internet.defer import inlineCallbacks
 from vumi.dispatchers.endpoint_dispatchers import (
     Dispatcher, RoutingTableDispatcher)
 from vumi.dispatchers.tests.helpers import DispatcherHelper
+from vumi.message import TransportUserMessage
 from vumi.tests.utils import LogCatcher
 from vumi.tests.helpers import VumiTestCase
 
@@ -208,6 +209,32 @@ class TestRoutingTableDispatcher(VumiTestCase):
         self.assert_dispatched_endpoint(
             msg, 'ep1', self.ch('app1').get_dispatched_events())
 
+    @inlineCallbacks
+    def test_lazy_message_decoding_routes_without_decoding(self):
+        """
+        With lazy message decoding, routed messages are published without
+        being fully decoded, even when their endpoint changes.
+        """
+        yield self.get_dispatcher(lazy_message_decoding=True)
+        inbound = self.disp_helper.make_inbound("inbound")
+        outbound = self.disp_helper.make_outbound("outbound", endpoint='ep2')
+        decoded = []
+        self.patch(TransportUserMessage, 'validate_fields',
+                   lambda msg: decoded.append(msg))
+
+        yield self.ch('transport1').dispatch_inbound(inbound)
+        yield self.ch('app1').dispatch_outbound(outbound)
+        self.assertEqual(decoded, [])
+
+        self.assert_rkeys_used(
+            'transport1.inbound', 'app1.inbound',
+            'app1.outbound', 'transport2.outbound')
+        self.assert_dispatched_endpoint(
+            inbound, 'default', self.ch('app1').get_dispatched_inbound())
+        self.assert_dispatched_endpoint(
+            outbound, 'default',
+            self.ch('transport2').get_dispatched_outbound())
+
     def get_dispatcher_consumers(self, dispatcher):
         consumers = []
         for conn in dispatcher.connectors.values():
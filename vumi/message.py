@@ -1,6 +1,7 @@
 # -*- test-case-name: vumi.tests.test_message -*-
 
 import json
+import re
 from uuid import uuid4
 from datetime import datetime
 
@@ -13,6 +14,11 @@ from vumi.utils import to_kwargs
 VUMI_DATE_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
 # Same as above, but without microseconds (for more permissive parsing).
 _VUMI_DATE_FORMAT_NO_MICROSECONDS = "%Y-%m-%d %H:%M:%S"
+# This matches a superset of the strings that parse_vumi_date() accepts. It
+# lets us skip the (much more expensive) strptime() call and the exception it
+# raises for the vast majority of strings that aren't timestamps.
+_VUMI_DATE_RE = re.compile(
+    r"^\d{4}-\d\d?- ?\d\d?\s+\d\d?:\d\d?:\d\d?(\.\d{1,6})?$")
 
 
 def format_vumi_date(timestamp):
@@ -46,12 +52,14 @@ def parse_vumi_date(value):
 
 def date_time_decoder(json_object):
     for key, value in json_object.items():
+        if not isinstance(value, basestring):
+            continue
+        if _VUMI_DATE_RE.match(value) is None:
+            continue
         try:
             json_object[key] = parse_vumi_date(value)
         except ValueError:
             continue
-        except TypeError:
-            continue
     return json_object
 
 
@@ -63,12 +71,32 @@ class JSONMessageEncoder(json.JSONEncoder):
         return super(JSONMessageEncoder, self).default(obj)
 
 
+# These are stateless, so we build them once instead of on every call.
+_json_decoder = json.JSONDecoder(object_hook=date_time_decoder)
+_json_encoder = JSONMessageEncoder()
+
+
 def from_json(json_string):
-    return json.loads(json_string, object_hook=date_time_decoder)
+    return _json_decoder.decode(json_string)
 
 
 def to_json(obj):
-    return json.dumps(obj, cls=JSONMessageEncoder)
+    return _json_encoder.encode(obj)
+
+
+def _copy_json_value(value):
+    """
+    Copy a JSON-compatible value without serialising it.
+
+    Containers are copied recursively, with tuples becoming lists as they
+    would in a JSON round trip. Everything else is immutable and shared.
+    """
+    if isinstance(value, dict):
+        return dict(
+            (k, _copy_json_value(v)) for k, v in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return [_copy_json_value(v) for v in value]
+    return value
 
 
 class Message(object):
@@ -79,6 +107,11 @@ class Message(object):
     The special ``.cache`` property stores a dictionary of data that is not
     stored by the :class:`vumi.fields.VumiMessage` field and hence not stored
     by Vumi's message store.
+
+    Messages built with :meth:`from_json_lazy` keep the original JSON and only
+    decode it when the payload is first accessed. Until then, :meth:`peek`
+    can read top-level fields without a full decode, :meth:`copy` is cheap
+    and :meth:`to_json` returns the original JSON unchanged.
     """
 
     # name of the special attribute that isn't stored by the message store
@@ -107,12 +140,82 @@ class Message(object):
             raise InvalidMessageField(field)
 
     def to_json(self):
+        if self.is_undecoded():
+            return self._raw_json
         return to_json(self.payload)
 
     @classmethod
     def from_json(cls, json_string):
         return cls(_process_fields=False, **to_kwargs(from_json(json_string)))
 
+    @classmethod
+    def from_json_lazy(cls, json_string):
+        """
+        Build a message that only decodes ``json_string`` when it needs to.
+
+        Field validation happens when the payload is decoded, so invalid
+        messages only raise an exception then.
+        """
+        msg = cls.__new__(cls)
+        msg._raw_json = json_string
+        msg._raw_envelope = None
+        return msg
+
+    def __getattr__(self, name):
+        # This is only called when normal attribute lookup fails, so it costs
+        # nothing for messages that aren't lazily decoded.
+        if name == 'payload' and '_raw_json' in self.__dict__:
+            self.payload = to_kwargs(from_json(self._raw_json))
+            try:
+                self.validate_fields()
+            except Exception:
+                # Leave the message undecoded so that an invalid payload
+                # isn't treated as valid the next time it's accessed.
+                del self.payload
+                raise
+            self._raw_envelope = None
+            return self.payload
+        raise AttributeError(name)
+
+    def is_undecoded(self):
+        """
+        Return ``True`` if this is a lazily decoded message whose payload
+        hasn't been accessed (and therefore can't have been modified) yet.
+        """
+        return 'payload' not in self.__dict__
+
+    def peek(self, key, default=None):
+        """
+        Return the value of a top-level field without forcing a full decode.
+
+        Like :meth:`get`, this returns ``default`` (``None`` unless given)
+        for missing fields rather than raising :class:`KeyError`, so callers
+        that need to distinguish a missing field from a ``None`` value must
+        pass their own default.
+
+        If the payload hasn't been decoded yet, timestamps in the returned
+        value are not converted to datetime objects. The returned value must
+        not be modified.
+        """
+        if not self.is_undecoded():
+            return self.payload.get(key, default)
+        if self._raw_envelope is None:
+            self._raw_envelope = json.loads(self._raw_json)
+        return self._raw_envelope.get(key, default)
+
+    def _set_undecoded_field(self, key, value):
+        """
+        Set a top-level field of a message that hasn't been decoded yet
+        without decoding it.
+
+        Only the envelope read by :meth:`peek` is re-encoded, so ``value``
+        must not contain anything (such as datetimes) that would be decoded
+        differently.
+        """
+        self.peek(key)
+        self._raw_envelope[key] = value
+        self._raw_json = to_json(self._raw_envelope)
+
     def __str__(self):
         return u"<Message payload=\"%s\">" % repr(self.payload)
 
@@ -140,7 +243,10 @@ class Message(object):
         return self.payload.items()
 
     def copy(self):
-        return self.from_json(self.to_json())
+        if self.is_undecoded():
+            return self.from_json_lazy(self._raw_json)
+        return type(self)(
+            _process_fields=False, **to_kwargs(_copy_json_value(self.payload)))
 
     @property
     def cache(self):
@@ -202,10 +308,18 @@ class TransportMessage(Message):
 
     def set_routing_endpoint(self, endpoint_name=None):
         endpoint_name = self.check_routing_endpoint(endpoint_name)
+        if self.is_undecoded():
+            # Routing shouldn't force a full decode of a lazy message.
+            routing_metadata = self.peek('routing_metadata') or {}
+            if routing_metadata.get('endpoint_name') != endpoint_name:
+                self._set_undecoded_field('routing_metadata', dict(
+                    routing_metadata, endpoint_name=endpoint_name))
+            return
         self.routing_metadata['endpoint_name'] = endpoint_name
 
     def get_routing_endpoint(self):
-        endpoint_name = self.routing_metadata.get('endpoint_name')
+        routing_metadata = self.peek('routing_metadata') or {}
+        endpoint_name = routing_metadata.get('endpoint_name')
         return self.check_routing_endpoint(endpoint_name)
 
 
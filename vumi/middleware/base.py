@@ -1,8 +1,10 @@
 # -*- test-case-name: vumi.middleware.tests.test_base -*-
 from confmodel import Config
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, Deferred, DeferredList, succeed, fail)
 
+from vumi import log
 from vumi.utils import load_class_by_string
 from vumi.errors import ConfigError, VumiError
 
@@ -39,9 +41,17 @@ class BaseMiddleware(object):
     :meth:`__init__`. Custom setup should be done in
     :meth:`setup_middleware` instead. The config class can be overidden by
     replacing the ``config_class`` class variable.
+
+    Middleware that only observes messages (for example, to log them) can
+    set the ``side_effect_only`` class variable to ``True``. The messages
+    its handlers return are then ignored and the next middleware doesn't
+    wait for any deferreds they return. Failures from such handlers are
+    logged instead of stopping the message.
     """
     CONFIG_CLASS = BaseMiddlewareConfig
 
+    side_effect_only = False
+
     def __init__(self, name, config, worker):
         self.name = name
         self.config = self.CONFIG_CLASS(config, static=True)
@@ -184,6 +194,11 @@ class ApplicationMiddleware(BaseMiddleware):
 
 class MiddlewareStack(object):
     """Ordered list of middlewares to pass a Message through.
+
+    The handlers for each kind of message are looked up the first time
+    they're needed and called directly after that. Middleware handlers that
+    return a message (rather than a deferred) are run without allocating
+    any deferreds along the way.
     """
 
     def __init__(self, middlewares):
@@ -191,6 +206,8 @@ class MiddlewareStack(object):
             middlewares, 'consume_priority')
         self.publish_middlewares = self._sort_by_priority(
             reversed(middlewares), 'publish_priority')
+        self._chains = {}  # handler_name -> [(mw, handler, side_effect_only)]
+        self._side_effects = set()  # unfinished side-effect-only handlers
 
     @staticmethod
     def _sort_by_priority(middlewares, priority_key):
@@ -198,30 +215,74 @@ class MiddlewareStack(object):
         # order within priority levels.
         return sorted(middlewares, key=lambda mw: getattr(mw, priority_key))
 
-    @inlineCallbacks
-    def _handle(self, middlewares, handler_name, message, connector_name):
-        method_name = 'handle_%s' % (handler_name,)
-        for middleware in middlewares:
-            handler = getattr(middleware, method_name)
-            message = yield handler(message, connector_name)
-            if message is None:
-                raise MiddlewareError(
-                    'Returned value of %s.%s should never be None' % (
-                        middleware, method_name,))
-        returnValue(message)
+    def _get_chain(self, handler_name):
+        chain = self._chains.get(handler_name)
+        if chain is None:
+            if handler_name.startswith('consume_'):
+                middlewares = self.consume_middlewares
+            else:
+                middlewares = self.publish_middlewares
+            method_name = 'handle_%s' % (handler_name,)
+            chain = self._chains[handler_name] = [
+                (mw, getattr(mw, method_name),
+                 getattr(mw, 'side_effect_only', False))
+                for mw in middlewares]
+        return chain
+
+    def _check_result(self, message, middleware, handler):
+        if message is None:
+            raise MiddlewareError(
+                'Returned value of %s.%s should never be None' % (
+                    middleware, handler.__name__,))
+        return message
+
+    def _handle(self, chain, message, connector_name, start=0):
+        try:
+            for index in xrange(start, len(chain)):
+                middleware, handler, side_effect_only = chain[index]
+                if side_effect_only:
+                    self._run_side_effect(
+                        middleware, handler, message, connector_name)
+                    continue
+                result = handler(message, connector_name)
+                if isinstance(result, Deferred):
+                    return result.addCallback(
+                        self._resume, chain, index, connector_name)
+                message = self._check_result(result, middleware, handler)
+        except Exception:
+            return fail()
+        return succeed(message)
+
+    def _resume(self, message, chain, index, connector_name):
+        middleware, handler, _ = chain[index]
+        message = self._check_result(message, middleware, handler)
+        return self._handle(chain, message, connector_name, index + 1)
+
+    def _run_side_effect(self, middleware, handler, message, connector_name):
+        try:
+            result = handler(message, connector_name)
+        except Exception:
+            log.err(None, 'Error in %s.%s' % (middleware, handler.__name__))
+            return
+        if isinstance(result, Deferred):
+            self._side_effects.add(result)
+            result.addErrback(
+                log.err, 'Error in %s.%s' % (middleware, handler.__name__))
+            result.addBoth(lambda _: self._side_effects.discard(result))
 
     def apply_consume(self, handler_name, message, connector_name):
-        handler_name = 'consume_%s' % (handler_name,)
         return self._handle(
-            self.consume_middlewares, handler_name, message, connector_name)
+            self._get_chain('consume_%s' % (handler_name,)), message,
+            connector_name)
 
     def apply_publish(self, handler_name, message, connector_name):
-        handler_name = 'publish_%s' % (handler_name,)
         return self._handle(
-            self.publish_middlewares, handler_name, message, connector_name)
+            self._get_chain('publish_%s' % (handler_name,)), message,
+            connector_name)
 
     @inlineCallbacks
     def teardown(self):
+        yield DeferredList(list(self._side_effects))
         for mw in self.publish_middlewares:
             yield mw.teardown_middleware()
 
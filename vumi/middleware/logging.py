@@ -34,6 +34,8 @@ class LoggingMiddleware(BaseMiddleware):
     """
     CONFIG_CLASS = LoggingMiddlewareConfig
 
+    side_effect_only = True
+
     def setup_middleware(self):
         log_level = self.config.log_level
         self.message_logger = getattr(log, log_level)
@@ -1,9 +1,17 @@
 # -*- test-case-name: vumi.middleware.tests.test_message_storing -*-
 
-from confmodel.fields import ConfigBool, ConfigDict, ConfigText
+from confmodel.fields import (
+    ConfigBool, ConfigDict, ConfigText, ConfigInt, ConfigFloat)
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, succeed, Deferred)
+from twisted.internet.task import LoopingCall
+from twisted.python.failure import Failure
 
+from vumi import log
+from vumi.blinkenlights.metrics import (
+    MetricManager, MetricPublisher, Metric, AVG, MAX, SUM)
 from vumi.middleware.base import BaseMiddleware, BaseMiddlewareConfig
 from vumi.middleware.tagger import TaggingMiddleware
 from vumi.components.message_store import MessageStore
@@ -28,6 +36,42 @@ class StoringMiddlewareConfig(BaseMiddlewareConfig):
         "``True`` to store consumed messages as well as published ones, "
         "``False`` to store only published messages.", default=True,
         static=True)
+    lookup_cache_size = ConfigInt(
+        "Maximum number of tag and batch lookups to cache in memory. ``0`` "
+        "disables the cache.", default=0, static=True)
+    lookup_cache_ttl = ConfigFloat(
+        "Number of seconds cached tag and batch lookups are valid for.",
+        default=60.0, static=True)
+    lookup_cache_metrics_prefix = ConfigText(
+        "If set, tag and batch lookup cache hits and misses are published "
+        "as metrics with this prefix.", default=None, static=True)
+    write_behind = ConfigBool(
+        "``True`` to pass messages on immediately and store them in batches "
+        "in the background, ``False`` to store each message before passing "
+        "it on. Messages that fail to store in write-behind mode are logged "
+        "and dropped, and any flushes waiting for them fail.", default=False,
+        static=True)
+    write_behind_batch_size = ConfigInt(
+        "Number of buffered messages and events that triggers a flush in "
+        "write-behind mode.", default=100, static=True)
+    write_behind_flush_interval = ConfigFloat(
+        "Maximum number of seconds between flushes in write-behind mode.",
+        default=1.0, static=True)
+    write_behind_max_buffer = ConfigInt(
+        "Maximum number of buffered messages and events in write-behind "
+        "mode. Once the buffer is this full, messages are only passed on "
+        "after they've been stored.", default=10000, static=True)
+    write_behind_metrics_prefix = ConfigText(
+        "If set, write-behind buffer metrics are published with this "
+        "prefix.", default=None, static=True)
+
+    def post_validate(self):
+        super(StoringMiddlewareConfig, self).post_validate()
+        for field in ['write_behind_batch_size', 'write_behind_max_buffer']:
+            value = getattr(self, field)
+            if value < 1:
+                self.raise_config_error(
+                    "%s must be at least 1, not %r." % (field, value))
 
 
 class StoringMiddleware(BaseMiddleware):
@@ -59,25 +103,212 @@ class StoringMiddleware(BaseMiddleware):
         ``True`` to store consumed messages as well as published ones,
         ``False`` to store only published messages.
         Default is ``True``.
+    :param int lookup_cache_size:
+        Maximum number of tag and batch lookups to cache in memory.
+        Default is 0, which disables the cache.
+    :param float lookup_cache_ttl:
+        Number of seconds cached tag and batch lookups are valid for.
+        Default is 60.
+    :param string lookup_cache_metrics_prefix:
+        If set, the number of tag and batch lookup cache hits and misses are
+        published as metrics with this prefix.
+    :param bool write_behind:
+        ``True`` to pass messages on immediately and store them in batches
+        in the background. Default is ``False``.
+    :param int write_behind_batch_size:
+        Number of buffered messages and events that triggers a flush.
+        Default is 100.
+    :param float write_behind_flush_interval:
+        Maximum number of seconds between flushes. Default is 1.0.
+    :param int write_behind_max_buffer:
+        Maximum number of buffered messages and events before messages are
+        only passed on after they've been stored. Default is 10000.
+    :param string write_behind_metrics_prefix:
+        If set, the buffer depth and the number of messages and events
+        stored are published as metrics with this prefix.
     """
 
     CONFIG_CLASS = StoringMiddlewareConfig
+    LOOKUP_CACHE_METRICS_INTERVAL = 5
 
     @inlineCallbacks
     def setup_middleware(self):
+        self.clock = reactor
         store_prefix = self.config.store_prefix
         r_config = self.config.redis_manager
         self.redis = yield TxRedisManager.from_config(r_config)
         self.manager = TxRiakManager.from_config(self.config.riak_manager)
         self.store = MessageStore(
-            self.manager, self.redis.sub_manager(store_prefix))
+            self.manager, self.redis.sub_manager(store_prefix),
+            lookup_cache_size=self.config.lookup_cache_size,
+            lookup_cache_ttl=self.config.lookup_cache_ttl)
         self.store_on_consume = self.config.store_on_consume
+        self.lookup_cache_metrics = None
+        if self.config.lookup_cache_metrics_prefix is not None:
+            yield self.setup_lookup_cache_metrics()
+        self.write_behind = self.config.write_behind
+        if self.write_behind:
+            yield self.setup_write_behind()
+
+    @inlineCallbacks
+    def setup_lookup_cache_metrics(self):
+        publisher = yield self.worker.start_publisher(MetricPublisher)
+        self.lookup_cache_metrics = MetricManager(
+            self.config.lookup_cache_metrics_prefix, publisher=publisher)
+        self._lookup_cache_stats = self.store.lookup_cache_stats()
+        self._lookup_cache_metrics = {}
+        for name in self._lookup_cache_stats:
+            self._lookup_cache_metrics[name] = (
+                self.lookup_cache_metrics.register(
+                    Metric('lookup_cache.%s' % (name,), [SUM])))
+        self._lookup_cache_task = LoopingCall(
+            self.publish_lookup_cache_metrics)
+        self._lookup_cache_task.clock = self.clock
+        self._lookup_cache_task.start(
+            self.LOOKUP_CACHE_METRICS_INTERVAL, now=False)
+
+    def publish_lookup_cache_metrics(self):
+        """
+        Publish the number of lookup cache hits and misses since the last
+        time they were published.
+        """
+        stats = self.store.lookup_cache_stats()
+        for name, metric in self._lookup_cache_metrics.iteritems():
+            metric.set(stats[name] - self._lookup_cache_stats[name])
+        self._lookup_cache_stats = stats
+        self.lookup_cache_metrics.publish_metrics()
+
+    @inlineCallbacks
+    def setup_write_behind(self):
+        self._buffer = []
+        self._flush_waiters = []
+        self._flushing = False
+        self.metrics = None
+        metrics_prefix = self.config.write_behind_metrics_prefix
+        if metrics_prefix is not None:
+            publisher = yield self.worker.start_publisher(MetricPublisher)
+            self.metrics = MetricManager(metrics_prefix, publisher=publisher)
+            self.metric_buffer_depth = self.metrics.register(
+                Metric('write_behind.buffer_depth', [AVG, MAX]))
+            self.metric_stored = self.metrics.register(
+                Metric('write_behind.stored', [SUM]))
+            self.metrics.start_polling()
+        self._flush_task = LoopingCall(self._flush_tick)
+        self._flush_task.clock = self.clock
+        self._flush_task.start(
+            self.config.write_behind_flush_interval, now=False)
 
     @inlineCallbacks
     def teardown_middleware(self):
+        if self.lookup_cache_metrics is not None:
+            if self._lookup_cache_task.running:
+                self._lookup_cache_task.stop()
+        if self.write_behind:
+            if self._flush_task.running:
+                self._flush_task.stop()
+            try:
+                yield self.flush()
+            except Exception:
+                # This has already been logged, and we still need to clean up.
+                pass
+            if self.metrics is not None:
+                self.metrics.stop_polling()
         yield self.redis.close_manager()
         yield self.manager.close_manager()
 
+    def buffer_depth(self):
+        """
+        Return the number of messages and events waiting to be stored in
+        write-behind mode.
+        """
+        return len(self._buffer)
+
+    def _flush_tick(self):
+        if self.metrics is not None:
+            self.metric_buffer_depth.set(self.buffer_depth())
+        # Storage errors have already been logged by the time this fails.
+        self.flush().addErrback(lambda f: None)
+
+    def flush(self):
+        """
+        Store everything in the write-behind buffer.
+
+        :returns:
+            A deferred that fires once everything buffered before the call
+            has been stored, or fails if storing it failed.
+        """
+        d = Deferred()
+        self._flush_waiters.append(d)
+        if not self._flushing:
+            self._flush_buffer()
+        return d
+
+    @inlineCallbacks
+    def _flush_buffer(self):
+        self._flushing = True
+        try:
+            while (self._flush_waiters or
+                   len(self._buffer) >= self.config.write_behind_batch_size):
+                waiters, self._flush_waiters = self._flush_waiters, []
+                items, self._buffer = self._buffer, []
+                failure = None
+                try:
+                    yield self._store_items(items)
+                except Exception:
+                    failure = Failure()
+                    log.err(failure, "Error storing %d buffered messages and "
+                            "events" % (len(items),))
+                for d in waiters:
+                    if failure is None:
+                        d.callback(None)
+                    else:
+                        d.errback(failure)
+        finally:
+            self._flushing = False
+
+    @inlineCallbacks
+    def _store_items(self, items):
+        """
+        Store buffered items in bulk. Outbound messages are stored before
+        events so that events can find the batches of the messages they
+        refer to.
+        """
+        outbound, inbound, events = {}, {}, []
+        for kind, item, tag in items:
+            if kind == 'outbound':
+                outbound.setdefault(tag, []).append(item)
+            elif kind == 'inbound':
+                inbound.setdefault(tag, []).append(item)
+            else:
+                events.append(item)
+        for tag, msgs in outbound.iteritems():
+            yield self.store.add_outbound_messages(msgs, tag=tag)
+        for tag, msgs in inbound.iteritems():
+            yield self.store.add_inbound_messages(msgs, tag=tag)
+        if events:
+            yield self.store.add_events(events)
+        if self.metrics is not None:
+            self.metric_stored.set(len(items))
+
+    def _buffer_item(self, kind, item, tag=None):
+        """
+        Add an item to the write-behind buffer, flushing if the buffer has
+        reached the batch size.
+
+        :returns:
+            A deferred that fires immediately, unless the buffer is full, in
+            which case it fires once the item has been stored.
+        """
+        # Later middleware may modify the message before we store it, so we
+        # buffer a copy.
+        self._buffer.append((kind, item.copy(), tag))
+        if len(self._buffer) >= self.config.write_behind_max_buffer:
+            return self.flush()
+        if (not self._flushing and
+                len(self._buffer) >= self.config.write_behind_batch_size):
+            self._flush_buffer()
+        return succeed(None)
+
     def handle_consume_inbound(self, message, connector_name):
         if not self.store_on_consume:
             return message
@@ -86,7 +317,10 @@ class StoringMiddleware(BaseMiddleware):
     @inlineCallbacks
     def handle_inbound(self, message, connector_name):
         tag = TaggingMiddleware.map_msg_to_tag(message)
-        yield self.store.add_inbound_message(message, tag=tag)
+        if self.write_behind:
+            yield self._buffer_item('inbound', message, tag)
+        else:
+            yield self.store.add_inbound_message(message, tag=tag)
         returnValue(message)
 
     def handle_consume_outbound(self, message, connector_name):
@@ -97,7 +331,10 @@ class StoringMiddleware(BaseMiddleware):
     @inlineCallbacks
     def handle_outbound(self, message, connector_name):
         tag = TaggingMiddleware.map_msg_to_tag(message)
-        yield self.store.add_outbound_message(message, tag=tag)
+        if self.write_behind:
+            yield self._buffer_item('outbound', message, tag)
+        else:
+            yield self.store.add_outbound_message(message, tag=tag)
         returnValue(message)
 
     def handle_consume_event(self, event, connector_name):
@@ -115,5 +352,8 @@ class StoringMiddleware(BaseMiddleware):
             date = transport_metadata['date']
             if not isinstance(date, basestring):
                 transport_metadata['date'] = date.isoformat()
-        yield self.store.add_event(event)
+        if self.write_behind:
+            yield self._buffer_item('event', event)
+        else:
+            yield self.store.add_event(event)
         returnValue(event)
@@ -2,11 +2,12 @@ import yaml
 import itertools
 
 from confmodel.fields import ConfigInt
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, Deferred, succeed)
 
 from vumi.middleware.base import (
     BaseMiddleware, MiddlewareStack, create_middlewares_from_config,
-    setup_middlewares_from_config, BaseMiddlewareConfig)
+    setup_middlewares_from_config, BaseMiddlewareConfig, MiddlewareError)
 from vumi.tests.helpers import VumiTestCase
 
 
@@ -81,6 +82,40 @@ class ToyAsymmetricMiddleware(ToyMiddleware):
         return self._handle('publish_failure', message, connector_name)
 
 
+class ToyDeferredMiddleware(ToyMiddleware):
+
+    def _handle(self, direction, message, connector_name):
+        return succeed(super(ToyDeferredMiddleware, self)._handle(
+            direction, message, connector_name))
+
+
+class ToyWaitingMiddleware(ToyMiddleware):
+    """Waits for :attr:`wait` to fire before handling each message."""
+
+    def _handle(self, direction, message, connector_name):
+        d = Deferred()
+        self.wait = d
+        d.addCallback(lambda _: super(ToyWaitingMiddleware, self)._handle(
+            direction, message, connector_name))
+        return d
+
+
+class ToySideEffectMiddleware(ToyWaitingMiddleware):
+    side_effect_only = True
+
+
+class ToyBrokenMiddleware(ToyMiddleware):
+
+    def _handle(self, direction, message, connector_name):
+        raise ValueError("broken")
+
+
+class ToyNoneMiddleware(ToyMiddleware):
+
+    def _handle(self, direction, message, connector_name):
+        return None
+
+
 class TestMiddlewareStack(VumiTestCase):
 
     @inlineCallbacks
@@ -176,6 +211,88 @@ class TestMiddlewareStack(VumiTestCase):
                 ('mw1', 'event', 'dummy_msg.mw3.mw2.mw1', 'end_foo'),
                 ])
 
+    def test_apply_sync_middlewares_result_available(self):
+        d = self.stack.apply_consume('inbound', 'dummy_msg', 'end_foo')
+        self.assertEqual(
+            self.successResultOf(d), 'dummy_msg.mw1.mw2.mw3')
+
+    @inlineCallbacks
+    def test_apply_mixed_middlewares(self):
+        waiting = yield self.mkmiddleware('mw2', ToyWaitingMiddleware)
+        self.stack = MiddlewareStack([
+            (yield self.mkmiddleware('mw1', ToyDeferredMiddleware)),
+            waiting,
+            (yield self.mkmiddleware('mw3', ToyMiddleware)),
+        ])
+        d = self.stack.apply_consume('inbound', 'dummy_msg', 'end_foo')
+        self.assertNoResult(d)
+        self.assert_processed([
+            ('mw1', 'inbound', 'dummy_msg.mw1', 'end_foo'),
+        ])
+        waiting.wait.callback(None)
+        self.assertEqual(
+            self.successResultOf(d), 'dummy_msg.mw1.mw2.mw3')
+        self.assertEqual(len(self.processed_messages), 3)
+
+    @inlineCallbacks
+    def test_apply_none_result(self):
+        self.stack = MiddlewareStack([
+            (yield self.mkmiddleware('mw1', ToyNoneMiddleware)),
+            (yield self.mkmiddleware('mw2', ToyMiddleware)),
+        ])
+        d = self.stack.apply_consume('inbound', 'dummy_msg', 'end_foo')
+        self.failureResultOf(d, MiddlewareError)
+        self.assert_processed([])
+
+    @inlineCallbacks
+    def test_apply_broken_middleware(self):
+        self.stack = MiddlewareStack([
+            (yield self.mkmiddleware('mw1', ToyMiddleware)),
+            (yield self.mkmiddleware('mw2', ToyBrokenMiddleware)),
+            (yield self.mkmiddleware('mw3', ToyMiddleware)),
+        ])
+        d = self.stack.apply_consume('inbound', 'dummy_msg', 'end_foo')
+        self.failureResultOf(d, ValueError)
+        self.assert_processed([
+            ('mw1', 'inbound', 'dummy_msg.mw1', 'end_foo'),
+        ])
+
+    @inlineCallbacks
+    def test_apply_side_effect_middleware(self):
+        side_effect = yield self.mkmiddleware('mw2', ToySideEffectMiddleware)
+        self.stack = MiddlewareStack([
+            (yield self.mkmiddleware('mw1', ToyMiddleware)),
+            side_effect,
+            (yield self.mkmiddleware('mw3', ToyMiddleware)),
+        ])
+        d = self.stack.apply_consume('inbound', 'dummy_msg', 'end_foo')
+        # The side-effect-only middleware isn't waited for and what it
+        # returns is ignored.
+        self.assertEqual(self.successResultOf(d), 'dummy_msg.mw1.mw3')
+
+        teardown_d = self.stack.teardown()
+        self.assertNoResult(teardown_d)
+        side_effect.wait.callback(None)
+        self.successResultOf(teardown_d)
+        self.assert_processed([
+            ('mw1', 'inbound', 'dummy_msg.mw1', 'end_foo'),
+            ('mw3', 'inbound', 'dummy_msg.mw1.mw3', 'end_foo'),
+            ('mw2', 'inbound', 'dummy_msg.mw1.mw2', 'end_foo'),
+        ])
+
+    @inlineCallbacks
+    def test_apply_side_effect_middleware_failure(self):
+        side_effect = yield self.mkmiddleware('mw1', ToySideEffectMiddleware)
+        self.stack = MiddlewareStack([
+            side_effect,
+            (yield self.mkmiddleware('mw2', ToyMiddleware)),
+        ])
+        d = self.stack.apply_consume('inbound', 'dummy_msg', 'end_foo')
+        self.assertEqual(self.successResultOf(d), 'dummy_msg.mw2')
+        side_effect.wait.errback(ValueError("broken"))
+        [err] = self.flushLoggedErrors(ValueError)
+        self.assertEqual(str(err.value), "broken")
+
     @inlineCallbacks
     def test_teardown_in_reverse_order(self):
 
@@ -1,10 +1,12 @@
 """Tests for vumi.middleware.message_storing."""
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import inlineCallbacks, returnValue, fail
 
+from vumi.config import ConfigError
 from vumi.middleware.tagger import TaggingMiddleware
 from vumi.message import TransportUserMessage, TransportEvent
-from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+from vumi.service import Worker
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper, WorkerHelper
 
 
 class TestStoringMiddleware(VumiTestCase):
@@ -12,6 +14,7 @@ class TestStoringMiddleware(VumiTestCase):
     def setUp(self):
         self.persistence_helper = self.add_helper(
             PersistenceHelper(use_riak=True))
+        self.worker_helper = self.add_helper(WorkerHelper())
 
         # Create and stash a riak manager to clean up afterwards, because we
         # don't get access to the one inside the middleware.
@@ -25,8 +28,8 @@ class TestStoringMiddleware(VumiTestCase):
         from vumi.middleware.message_storing import StoringMiddleware
 
         config = self.persistence_helper.mk_config(config)
-        dummy_worker = object()
-        mw = StoringMiddleware("dummy_storer", config, dummy_worker)
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        mw = StoringMiddleware("dummy_storer", config, worker)
         self.add_cleanup(mw.teardown_middleware)
         yield mw.setup_middleware()
         self.store = mw.store
@@ -201,3 +204,153 @@ class TestStoringMiddleware(VumiTestCase):
         resp2 = yield mw.handle_publish_event(ack2, "dummy_connector")
         self.assertEqual(resp2, ack2)
         yield self.assert_outbound_stored(msg, events=[event_id2])
+
+    @inlineCallbacks
+    def test_write_behind_outbound(self):
+        mw = yield self.setup_middleware({'write_behind': True})
+        msg = self.mk_msg()
+        resp = yield mw.handle_publish_outbound(msg, "dummy_connector")
+        self.assertEqual(msg, resp)
+        self.assertEqual(mw.buffer_depth(), 1)
+        yield self.assert_outbound_not_stored(msg)
+
+        yield mw.flush()
+        self.assertEqual(mw.buffer_depth(), 0)
+        yield self.assert_outbound_stored(msg)
+
+    @inlineCallbacks
+    def test_write_behind_inbound_with_tag(self):
+        mw = yield self.setup_middleware({'write_behind': True})
+        batch_id = yield self.store.batch_start([("pool", "tag")])
+        msg = self.mk_msg()
+        TaggingMiddleware.add_tag_to_msg(msg, ["pool", "tag"])
+        response = yield mw.handle_inbound(msg, "dummy_connector")
+        self.assertEqual(response, msg)
+        yield mw.flush()
+        yield self.assert_inbound_stored(msg, batch_id)
+
+    @inlineCallbacks
+    def test_write_behind_event(self):
+        mw = yield self.setup_middleware({'write_behind': True})
+        batch_id = yield self.store.batch_start([("pool", "tag")])
+        msg = self.mk_msg()
+        TaggingMiddleware.add_tag_to_msg(msg, ["pool", "tag"])
+        yield mw.handle_outbound(msg, "dummy_connector")
+        ack = self.mk_ack(user_message_id=msg["message_id"])
+        resp = yield mw.handle_event(ack, "dummy_connector")
+        self.assertEqual(ack, resp)
+        self.assertEqual(mw.buffer_depth(), 2)
+
+        yield mw.flush()
+        yield self.assert_outbound_stored(
+            msg, batch_id, events=[ack['event_id']])
+        batch_status = yield self.store.batch_status(batch_id)
+        self.assertEqual(batch_status['ack'], 1)
+
+    @inlineCallbacks
+    def test_write_behind_flush_on_batch_size(self):
+        mw = yield self.setup_middleware({
+            'write_behind': True,
+            'write_behind_batch_size': 2,
+        })
+        msg1 = self.mk_msg()
+        yield mw.handle_outbound(msg1, "dummy_connector")
+        self.assertEqual(mw.buffer_depth(), 1)
+        msg2 = self.mk_msg()
+        yield mw.handle_outbound(msg2, "dummy_connector")
+        # The buffer is handed over for storing as soon as it's full enough.
+        self.assertEqual(mw.buffer_depth(), 0)
+        yield mw.flush()
+        yield self.assert_outbound_stored(msg1)
+        yield self.assert_outbound_stored(msg2)
+
+    @inlineCallbacks
+    def test_write_behind_max_buffer(self):
+        mw = yield self.setup_middleware({
+            'write_behind': True,
+            'write_behind_max_buffer': 2,
+        })
+        msg1 = self.mk_msg()
+        d1 = mw.handle_outbound(msg1, "dummy_connector")
+        self.assertTrue(d1.called)
+        msg2 = self.mk_msg()
+        d2 = mw.handle_outbound(msg2, "dummy_connector")
+        # The buffer is full, so we wait until the messages are stored.
+        self.assertFalse(d2.called)
+        resp2 = yield d2
+        self.assertEqual(resp2, msg2)
+        yield self.assert_outbound_stored(msg1)
+        yield self.assert_outbound_stored(msg2)
+
+    @inlineCallbacks
+    def test_write_behind_store_failure(self):
+        """
+        If buffered messages can't be stored, flushes waiting for them fail
+        and later flushes are unaffected.
+        """
+        mw = yield self.setup_middleware({'write_behind': True})
+        msg1 = self.mk_msg()
+        yield mw.handle_outbound(msg1, "dummy_connector")
+        store_items = mw._store_items
+        mw._store_items = lambda items: fail(ValueError("Storage failed."))
+        yield self.assertFailure(mw.flush(), ValueError)
+        [err] = self.flushLoggedErrors(ValueError)
+        self.assertEqual(mw.buffer_depth(), 0)
+        yield self.assert_outbound_not_stored(msg1)
+
+        mw._store_items = store_items
+        msg2 = self.mk_msg()
+        yield mw.handle_outbound(msg2, "dummy_connector")
+        yield mw.flush()
+        yield self.assert_outbound_stored(msg2)
+
+    def test_write_behind_sizes_too_small(self):
+        from vumi.middleware.message_storing import StoringMiddleware
+
+        for field in ['write_behind_batch_size', 'write_behind_max_buffer']:
+            config = self.persistence_helper.mk_config({field: 0})
+            self.assertRaises(
+                ConfigError, StoringMiddleware, "dummy_storer", config,
+                object())
+
+    def get_metric_values(self, datapoints):
+        return dict(
+            (name, [value for _, value in points])
+            for name, aggs, points in datapoints)
+
+    @inlineCallbacks
+    def test_lookup_cache_metrics(self):
+        mw = yield self.setup_middleware({
+            'lookup_cache_size': 10,
+            'lookup_cache_metrics_prefix': 'storer.',
+        })
+        batch_id = yield self.store.batch_start([("pool", "tag")])
+        for _ in range(2):
+            msg = self.mk_msg()
+            TaggingMiddleware.add_tag_to_msg(msg, ["pool", "tag"])
+            yield mw.handle_outbound(msg, "dummy_connector")
+        yield self.store.get_batch(batch_id)
+        yield self.store.get_batch(u"missing")
+
+        mw.publish_lookup_cache_metrics()
+        [datapoints] = yield self.worker_helper.wait_for_dispatched_metrics()
+        self.assertEqual(self.get_metric_values(datapoints), {
+            'storer.lookup_cache.tag_hits': [2],
+            'storer.lookup_cache.tag_misses': [0],
+            'storer.lookup_cache.batch_hits': [1],
+            'storer.lookup_cache.batch_misses': [1],
+        })
+
+        # Only the hits and misses since the last publish are counted.
+        self.worker_helper.clear_dispatched_metrics()
+        msg = self.mk_msg()
+        TaggingMiddleware.add_tag_to_msg(msg, ["pool", "tag"])
+        yield mw.handle_outbound(msg, "dummy_connector")
+        mw.publish_lookup_cache_metrics()
+        [datapoints] = yield self.worker_helper.wait_for_dispatched_metrics()
+        self.assertEqual(self.get_metric_values(datapoints), {
+            'storer.lookup_cache.tag_hits': [1],
+            'storer.lookup_cache.tag_misses': [0],
+            'storer.lookup_cache.batch_hits': [0],
+            'storer.lookup_cache.batch_misses': [0],
+        })
@@ -0,0 +1,171 @@
+"""Tests for vumi.middleware.tracing."""
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.task import Clock
+
+from vumi.middleware.tracing import TracingMiddleware
+from vumi.service import Worker
+from vumi.tests.helpers import VumiTestCase, MessageHelper, WorkerHelper
+
+
+class TestTracingMiddleware(VumiTestCase):
+    def setUp(self):
+        self.msg_helper = self.add_helper(MessageHelper())
+        self.worker_helper = self.add_helper(WorkerHelper())
+        self.clock = Clock()
+
+    @inlineCallbacks
+    def mk_middleware(self, **config):
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        mw = TracingMiddleware("tracer", config, worker)
+        yield mw.setup_middleware()
+        mw.clock = self.clock
+        self.add_cleanup(mw.teardown_middleware)
+        returnValue(mw)
+
+    def get_hops(self, msg):
+        return msg['helper_metadata']['trace']['hops']
+
+    @inlineCallbacks
+    def test_inbound_and_reply(self):
+        transport_mw = yield self.mk_middleware()
+        app_mw = yield self.mk_middleware()
+        msg = self.msg_helper.make_inbound("hello")
+
+        msg = yield transport_mw.handle_publish_inbound(msg, "sms")
+        self.assertEqual(self.get_hops(msg), [])
+        self.clock.advance(1)
+        msg = yield app_mw.handle_consume_inbound(msg, "sms")
+        self.assertEqual(self.get_hops(msg), [{
+            'connector': 'sms.inbound', 'queue_wait': 1.0,
+            'handler_time': None,
+        }])
+
+        self.clock.advance(2)
+        reply = msg.reply("hi")
+        reply = yield app_mw.handle_publish_outbound(reply, "sms")
+        self.clock.advance(0.5)
+        reply = yield transport_mw.handle_consume_outbound(reply, "sms")
+        self.assertEqual(self.get_hops(reply), [{
+            'connector': 'sms.inbound', 'queue_wait': 1.0,
+            'handler_time': 2.0,
+        }, {
+            'connector': 'sms.outbound', 'queue_wait': 0.5,
+            'handler_time': None,
+        }])
+        # The message being replied to is left alone.
+        self.assertEqual(self.get_hops(msg), [{
+            'connector': 'sms.inbound', 'queue_wait': 1.0,
+            'handler_time': None,
+        }])
+
+    @inlineCallbacks
+    def test_dispatcher_hop(self):
+        transport_mw = yield self.mk_middleware()
+        dispatcher_mw = yield self.mk_middleware()
+        app_mw = yield self.mk_middleware()
+        msg = self.msg_helper.make_inbound("hello")
+
+        msg = yield transport_mw.handle_publish_inbound(msg, "sms")
+        self.clock.advance(1)
+        msg = yield dispatcher_mw.handle_consume_inbound(msg, "sms")
+        self.clock.advance(0.25)
+        msg = yield dispatcher_mw.handle_publish_inbound(msg, "app")
+        self.clock.advance(0.5)
+        msg = yield app_mw.handle_consume_inbound(msg, "app")
+        self.assertEqual(self.get_hops(msg), [{
+            'connector': 'sms.inbound', 'queue_wait': 1.0,
+            'handler_time': 0.25,
+        }, {
+            'connector': 'app.inbound', 'queue_wait': 0.5,
+            'handler_time': None,
+        }])
+
+    @inlineCallbacks
+    def test_event(self):
+        transport_mw = yield self.mk_middleware()
+        app_mw = yield self.mk_middleware()
+        ack = self.msg_helper.make_ack()
+
+        ack = yield transport_mw.handle_publish_event(ack, "sms")
+        self.clock.advance(1)
+        ack = yield app_mw.handle_consume_event(ack, "sms")
+        self.assertEqual(self.get_hops(ack), [{
+            'connector': 'sms.event', 'queue_wait': 1.0,
+            'handler_time': None,
+        }])
+
+    @inlineCallbacks
+    def test_consume_untraced_message(self):
+        app_mw = yield self.mk_middleware()
+        msg = self.msg_helper.make_inbound("hello")
+        msg = yield app_mw.handle_consume_inbound(msg, "sms")
+        self.assertEqual(self.get_hops(msg), [{
+            'connector': 'sms.inbound', 'queue_wait': None,
+            'handler_time': None,
+        }])
+
+    @inlineCallbacks
+    def test_max_hops(self):
+        mw = yield self.mk_middleware(max_hops=2)
+        msg = self.msg_helper.make_inbound("hello")
+        for connector in ["a", "b", "c"]:
+            msg = yield mw.handle_publish_inbound(msg, connector)
+            msg = yield mw.handle_consume_inbound(msg, connector)
+        self.assertEqual(
+            [hop['connector'] for hop in self.get_hops(msg)],
+            ['b.inbound', 'c.inbound'])
+
+    @inlineCallbacks
+    def test_sample_rate_zero(self):
+        mw = yield self.mk_middleware(sample_rate=0.0)
+        msg = self.msg_helper.make_inbound("hello")
+        msg = yield mw.handle_publish_inbound(msg, "sms")
+        msg = yield mw.handle_consume_inbound(msg, "sms")
+        self.assertEqual(msg['helper_metadata'], {})
+
+    @inlineCallbacks
+    def test_sampling(self):
+        mw1 = yield self.mk_middleware(sample_rate=0.25)
+        mw2 = yield self.mk_middleware(sample_rate=0.25)
+        ids = [u"message-%d" % i for i in range(1000)]
+        sampled = [i for i in ids if mw1.is_sampled(i)]
+        self.assertEqual(sampled, [i for i in ids if mw2.is_sampled(i)])
+        self.assertTrue(200 < len(sampled) < 300, len(sampled))
+
+    @inlineCallbacks
+    def test_sampled_trace_continued(self):
+        """
+        A message that is already being traced is traced on every hop, even
+        if its id would not be sampled.
+        """
+        transport_mw = yield self.mk_middleware()
+        app_mw = yield self.mk_middleware(sample_rate=0.0)
+        msg = self.msg_helper.make_inbound("hello")
+        msg = yield transport_mw.handle_publish_inbound(msg, "sms")
+        msg = yield app_mw.handle_consume_inbound(msg, "sms")
+        self.assertEqual(len(self.get_hops(msg)), 1)
+
+    @inlineCallbacks
+    def test_metrics(self):
+        transport_mw = yield self.mk_middleware()
+        app_mw = yield self.mk_middleware(metrics_prefix="app.")
+        for _ in range(2):
+            msg = self.msg_helper.make_inbound("hello")
+            msg = yield transport_mw.handle_publish_inbound(msg, "sms")
+            self.clock.advance(1)
+            msg = yield app_mw.handle_consume_inbound(msg, "sms")
+            self.clock.advance(0.5)
+            yield app_mw.handle_publish_outbound(msg.reply("hi"), "sms")
+
+        app_mw.metrics.publish_metrics()
+        [datapoints] = yield self.worker_helper.wait_for_dispatched_metrics()
+        values = dict(
+            (name, (aggs, [value for _, value in points]))
+            for name, aggs, points in datapoints)
+        self.assertEqual(values, {
+            'app.sms.inbound.queue_wait': (
+                ['avg', 'max', 'p95', 'p99'], [1.0, 1.0]),
+            'app.sms.inbound.handler_time': (
+                ['avg', 'max', 'p95', 'p99'], [0.5, 0.5]),
+        })
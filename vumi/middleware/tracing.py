@@ -0,0 +1,180 @@
+# -*- test-case-name: vumi.middleware.tests.test_tracing -*-
+
+import zlib
+
+from confmodel.fields import ConfigFloat, ConfigInt, ConfigText
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+
+from vumi.blinkenlights.metrics import (
+    MetricManager, MetricPublisher, Metric, AVG, MAX, P95, P99)
+from vumi.middleware.base import BaseMiddleware, BaseMiddlewareConfig
+
+
+class TracingMiddlewareConfig(BaseMiddlewareConfig):
+    """
+    Config class for the tracing middleware.
+    """
+    metrics_prefix = ConfigText(
+        "If set, queue wait and handler time metrics for each connector are "
+        "published with this prefix.", default=None, static=True)
+    sample_rate = ConfigFloat(
+        "Fraction of messages and events to trace, between 0 and 1.",
+        default=1.0, static=True)
+    field_name = ConfigText(
+        "Field name in message helper_metadata", default="trace",
+        static=True)
+    max_hops = ConfigInt(
+        "Maximum number of hops recorded in a trace. The oldest hops are "
+        "dropped first.", default=10, static=True)
+
+
+class TracingMiddleware(BaseMiddleware):
+    """Middleware for tracing how long messages spend on each hop.
+
+    When a traced message or event is published, the time is stamped into
+    ``message['helper_metadata'][field_name]``. When it is consumed by a
+    worker with this middleware, the time it spent queued is recorded as a
+    new hop, and when the same worker publishes it (or a reply to it) the
+    time it spent being handled is added to that hop. The trace carries a
+    list of hops like::
+
+        {"connector": "sms_transport.inbound",
+         "queue_wait": 0.004, "handler_time": 0.121}
+
+    Whether a message is traced is decided from its message or event id,
+    so every worker with the same ``sample_rate`` traces the same
+    messages. Queue wait times are measured against the clock of the
+    worker that published the message, so they're only as accurate as the
+    clocks are synchronised.
+
+    Configuration options:
+
+    :param string metrics_prefix:
+        If set, queue wait and handler times are published as metrics
+        named ``<connector>.<message type>.queue_wait`` and
+        ``<connector>.<message type>.handler_time`` with this prefix.
+    :param float sample_rate:
+        Fraction of messages and events to trace. Default is 1.0.
+    :param string field_name:
+        The field name to store the trace under in the message
+        helper_metadata. Defaults to 'trace'.
+    :param int max_hops:
+        Maximum number of hops recorded in a trace. Default is 10.
+    """
+
+    CONFIG_CLASS = TracingMiddlewareConfig
+
+    @inlineCallbacks
+    def setup_middleware(self):
+        self.clock = reactor
+        self.field_name = self.config.field_name
+        self.max_hops = self.config.max_hops
+        # Message ids are hashed to 32 bits and compared to this.
+        self._sample_threshold = self.config.sample_rate * 2 ** 32
+        self.metrics = None
+        metrics_prefix = self.config.metrics_prefix
+        if metrics_prefix is not None:
+            publisher = yield self.worker.start_publisher(MetricPublisher)
+            self.metrics = MetricManager(metrics_prefix, publisher=publisher)
+            self.metrics.start_polling()
+
+    def teardown_middleware(self):
+        if self.metrics is not None:
+            self.metrics.stop_polling()
+
+    def _time(self):
+        return self.clock.seconds()
+
+    def is_sampled(self, message_id):
+        """Return ``True`` if the message with this id should be traced."""
+        message_hash = zlib.crc32(message_id.encode('utf-8')) & 0xffffffff
+        return message_hash < self._sample_threshold
+
+    def _get_trace(self, message, message_id):
+        trace = message['helper_metadata'].get(self.field_name)
+        if trace is None and self.is_sampled(message_id):
+            trace = {
+                'enqueued_at': None,
+                'dequeued_at': None,
+                'dequeued_on': None,
+                'hops': [],
+            }
+        return trace
+
+    def _set_trace(self, message, trace):
+        # Replies share their helper_metadata with the message they're
+        # replying to, so we replace it rather than modifying it.
+        helper_metadata = dict(message['helper_metadata'])
+        helper_metadata[self.field_name] = trace
+        message['helper_metadata'] = helper_metadata
+
+    def _record(self, connector_key, name, value):
+        if self.metrics is None:
+            return
+        metric_name = "%s.%s" % (connector_key, name)
+        if metric_name in self.metrics:
+            metric = self.metrics[metric_name]
+        else:
+            metric = self.metrics.register(
+                Metric(metric_name, [AVG, MAX, P95, P99]))
+        metric.set(value)
+
+    def _trace_consume(self, message, message_id, connector_name,
+                       message_type):
+        trace = self._get_trace(message, message_id)
+        if trace is None:
+            return message
+        now = self._time()
+        connector_key = "%s.%s" % (connector_name, message_type)
+        hop = {
+            'connector': connector_key,
+            'queue_wait': None,
+            'handler_time': None,
+        }
+        if trace['enqueued_at'] is not None:
+            hop['queue_wait'] = now - trace['enqueued_at']
+            self._record(connector_key, 'queue_wait', hop['queue_wait'])
+        hops = (trace['hops'] + [hop])[-self.max_hops:]
+        self._set_trace(message, dict(
+            trace, enqueued_at=None, dequeued_at=now,
+            dequeued_on=connector_key, hops=hops))
+        return message
+
+    def _trace_publish(self, message, message_id):
+        trace = self._get_trace(message, message_id)
+        if trace is None:
+            return message
+        now = self._time()
+        hops = trace['hops']
+        if trace['dequeued_at'] is not None:
+            handler_time = now - trace['dequeued_at']
+            self._record(trace['dequeued_on'], 'handler_time', handler_time)
+            if hops:
+                hops = hops[:-1] + [dict(hops[-1], handler_time=handler_time)]
+        self._set_trace(message, dict(
+            trace, enqueued_at=now, dequeued_at=None, dequeued_on=None,
+            hops=hops))
+        return message
+
+    def handle_consume_inbound(self, message, connector_name):
+        return self._trace_consume(
+            message, message['message_id'], connector_name, 'inbound')
+
+    def handle_publish_inbound(self, message, connector_name):
+        return self._trace_publish(message, message['message_id'])
+
+    def handle_consume_outbound(self, message, connector_name):
+        return self._trace_consume(
+            message, message['message_id'], connector_name, 'outbound')
+
+    def handle_publish_outbound(self, message, connector_name):
+        return self._trace_publish(message, message['message_id'])
+
+    def handle_consume_event(self, event, connector_name):
+        return self._trace_consume(
+            event, event['event_id'], connector_name, 'event')
+
+    def handle_publish_event(self, event, connector_name):
+        return self._trace_publish(event, event['event_id'])
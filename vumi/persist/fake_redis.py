@@ -1,6 +1,7 @@
 # -*- test-case-name: vumi.persist.tests.test_fake_redis -*-
 
 import fnmatch
+import hashlib
 from functools import wraps
 from itertools import takewhile, dropwhile
 import os
@@ -34,6 +35,13 @@ class ResponseError(Exception):
     """
 
 
+class NoScriptError(ResponseError):
+    """
+    Exception class for running a script that hasn't been loaded, to match the
+    real Redis client libraries.
+    """
+
+
 class FakeRedis(object):
     """In process and memory implementation of redis-like data store.
 
@@ -44,8 +52,14 @@ class FakeRedis(object):
 
     * Exceptions raised are not guaranteed to match the exception
       types raised by the real Python redis module.
+
+    * Lua scripts can't be run. Instead, a Python emulation of each script
+      must be registered with :meth:`register_script_emulation`.
     """
 
+    # Script emulations, keyed by the SHA1 of the Lua source.
+    _script_emulations = {}
+
     def __init__(self, charset='utf-8', errors='strict', async=False):
         self._data = {}
         self._known_key_existence = {}
@@ -55,6 +69,22 @@ class FakeRedis(object):
         self._charset = charset
         self._charset_errors = errors
         self._delayed_calls = []
+        self._scripts = set()
+
+    @classmethod
+    def register_script_emulation(cls, source, emulation):
+        """Register a Python emulation of a Lua script.
+
+        The emulation is called as ``emulation(call, keys, args)``, with
+        ``keys`` and ``args`` as lists of strings like the script's ``KEYS``
+        and ``ARGV``. ``call(command, *args, **kw)`` plays the part of
+        ``redis.call()``, except that it takes the name and arguments of a
+        :class:`FakeRedis` method rather than a raw redis command. The whole
+        emulation runs as a single operation, so it's as atomic as the
+        script. The value it returns is converted the way Redis converts Lua
+        values.
+        """
+        cls._script_emulations[hashlib.sha1(source).hexdigest()] = emulation
 
     def teardown(self):
         self._clean_up_expires()
@@ -342,12 +372,11 @@ class FakeRedis(object):
         return sval.pop()
 
     @maybe_async
-    def srem(self, key, value):
+    def srem(self, key, *values):
         sval = self._data.get(key, set())
-        if value in sval:
-            sval.remove(value)
-            return 1
-        return 0
+        old_len = len(sval)
+        sval.difference_update(values)
+        return old_len - len(sval)
 
     @maybe_async
     def scard(self, key):
@@ -380,9 +409,9 @@ class FakeRedis(object):
         return zval.zadd(**valscores)
 
     @maybe_async
-    def zrem(self, key, value):
+    def zrem(self, key, *values):
         zval = self._setdefault_key(key, Zset())
-        return zval.zrem(value)
+        return zval.zrem(*values)
 
     @maybe_async
     def zcard(self, key):
@@ -524,6 +553,58 @@ class FakeRedis(object):
             return 1
         return 0
 
+    # Scripting operations
+
+    def _lua_result(self, value):
+        """
+        Convert a value the way Redis converts the value returned by a Lua
+        script.
+        """
+        if value is None or value is False:
+            return None
+        if value is True:
+            return 1
+        if isinstance(value, (int, long, float)):
+            return int(value)
+        if isinstance(value, (list, tuple)):
+            # Redis commands called from Lua return false rather than nil, so
+            # we treat None in a list as false and keep going.
+            return [self._lua_result(v) for v in value]
+        return self._encode(value)
+
+    def _run_script(self, sha1, keys, args):
+        emulation = self._script_emulations.get(sha1)
+        if emulation is None:
+            raise ResponseError("No emulation registered for script %s" % (
+                sha1,))
+        self._scripts.add(sha1)
+
+        def call(command, *call_args, **call_kw):
+            return getattr(self, command).sync(self, *call_args, **call_kw)
+
+        result = emulation(
+            call, map(self._encode, keys), map(self._encode, args))
+        return self._lua_result(result)
+
+    @maybe_async
+    def eval(self, source, keys=(), args=()):
+        return self._run_script(hashlib.sha1(source).hexdigest(), keys, args)
+
+    @maybe_async
+    def evalsha(self, sha1, keys=(), args=()):
+        if sha1 not in self._scripts:
+            raise NoScriptError("No matching script. Please use EVAL.")
+        return self._run_script(sha1, keys, args)
+
+    @maybe_async
+    def script_load(self, source):
+        sha1 = hashlib.sha1(source).hexdigest()
+        if sha1 not in self._script_emulations:
+            raise ResponseError("No emulation registered for script %s" % (
+                sha1,))
+        self._scripts.add(sha1)
+        return sha1
+
     # HyperLogLog operations
 
     @maybe_async
@@ -567,11 +648,12 @@ class Zset(object):
         self._zval = new_zval
         return added
 
-    def zrem(self, value):
-        new_zval = [val for val in self._zval if val[1] != value]
-        existed = len(new_zval) != len(self._zval)
+    def zrem(self, *values):
+        values = set(values)
+        new_zval = [val for val in self._zval if val[1] not in values]
+        removed = len(self._zval) - len(new_zval)
         self._zval = new_zval
-        return existed
+        return removed
 
     def zcard(self):
         return len(self._zval)
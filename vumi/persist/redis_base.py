@@ -1,6 +1,8 @@
 # -*- test-case-name: vumi.persist.tests.test_redis_base -*-
 
+import hashlib
 import os
+from copy import copy
 from functools import wraps
 
 from vumi.persist.ast_magic import make_function
@@ -20,11 +22,15 @@ def make_callfunc(name, redis_call):
         aa = [_f(k, v) for k, v in zip(arg_names, a)]
         kk = dict((k, _f(k, v)) for k, v in kw.items())
 
-        result = self._make_redis_call(name, *aa, **kk)
         f_func = redis_call.filter_func
+        if isinstance(f_func, basestring):
+            f_func = getattr(self, f_func)
+        if self._pipeline_calls is not None:
+            self._pipeline_calls.append((name, aa, kk, f_func))
+            return None
+
+        result = self._make_redis_call(name, *aa, **kk)
         if f_func:
-            if isinstance(f_func, basestring):
-                f_func = getattr(self, f_func)
             result = self._filter_redis_results(f_func, result)
         return result
 
@@ -55,6 +61,24 @@ class CallMakerMetaclass(type):
         return type.__new__(meta, classname, bases, new_class_dict)
 
 
+class RedisScript(object):
+    """A Lua script that can be run with :meth:`Manager.run_script`.
+
+    :param str source:
+        The Lua source of the script.
+    :param emulation:
+        A callable that emulates the script in
+        :class:`vumi.persist.fake_redis.FakeRedis`, which can't run Lua. See
+        :meth:`FakeRedis.register_script_emulation` for details.
+    """
+
+    def __init__(self, source, emulation=None):
+        self.source = source
+        self.sha = hashlib.sha1(source).hexdigest()
+        if emulation is not None:
+            FakeRedis.register_script_emulation(source, emulation)
+
+
 class ClientProxy(object):
     def __init__(self, client):
         self.client = client
@@ -64,6 +88,9 @@ class Manager(object):
 
     __metaclass__ = CallMakerMetaclass
 
+    # This is a list of queued calls on pipelines and None everywhere else.
+    _pipeline_calls = None
+
     def __init__(
             self, client, config, key_prefix, key_separator=None,
             client_proxy=None):
@@ -100,8 +127,81 @@ class Manager(object):
             client_proxy=self._client_proxy)
         if isinstance(self._client, FakeRedis):
             sub_man._close = self._client.teardown
+            sub_man.RESPONSE_ERROR = self.RESPONSE_ERROR
+            sub_man.NO_SCRIPT_ERROR = self.NO_SCRIPT_ERROR
         return sub_man
 
+    def pipeline(self):
+        """Return a pipeline for sending several redis calls at once.
+
+        The pipeline has the same redis call methods as this manager, but
+        calling them only queues the call (and returns ``None``). Calling
+        :meth:`execute` on the pipeline sends all the queued calls to the
+        server together and returns a list of their results in order (or a
+        deferred that fires with it for async managers).
+
+        Pipelined calls are not atomic and their results aren't available
+        until the whole pipeline has been executed, so this is only useful
+        for calls that don't depend on each other's results.
+        """
+        pipe = copy(self)
+        pipe._pipeline_calls = []
+        return pipe
+
+    def execute(self):
+        """Execute all the calls queued on a pipeline.
+
+        If any of the calls fail, the first error is raised once they've all
+        completed.
+        """
+        assert self._pipeline_calls is not None, (
+            'Only pipelines can be executed')
+        calls, self._pipeline_calls = self._pipeline_calls, []
+        return self._execute_pipeline(calls)
+
+    @staticmethod
+    def register_script(source, emulation=None):
+        """Register a Lua script to be run with :meth:`run_script`.
+
+        This is intended to be called at import time, so that the script and
+        its emulation are both available to managers using a real redis and
+        a fake one.
+
+        :param str source:
+            The Lua source of the script. Keys must be passed in ``KEYS``
+            and everything else in ``ARGV``.
+        :param emulation:
+            A callable that emulates the script for ``FakeRedis``.
+
+        :returns: A :class:`RedisScript`.
+        """
+        return RedisScript(source, emulation)
+
+    def run_script(self, script, keys=(), args=()):
+        """Run a registered script atomically on the redis server.
+
+        The script is run with ``EVALSHA`` and only sent to the server with
+        ``EVAL`` if the server doesn't have it cached yet, so in the common
+        case running a script costs a single round trip however many
+        commands it makes. Keys are prefixed the same way they are for every
+        other call. Pipelines always use ``EVAL``, because there's no way to
+        retry a single call in the pipeline.
+
+        :param script:
+            The :class:`RedisScript` to run.
+        :param list keys:
+            Keys the script uses, available to it as ``KEYS``.
+        :param list args:
+            Other arguments for the script, available to it as ``ARGV``.
+        """
+        keys = [self._key(key) for key in keys]
+        args = list(args)
+        if self._pipeline_calls is not None:
+            self._pipeline_calls.append(
+                ('eval', [script.source, keys, args], {}, None))
+            return None
+        return self._run_script(script, keys, args)
+
     @staticmethod
     def calls_manager(manager_attr):
         """Decorate a method that calls a manager.
@@ -202,6 +302,23 @@ class Manager(object):
         raise NotImplementedError("Sub-classes of Manager should implement"
                                   " ._filter_redis_results()")
 
+    def _execute_pipeline(self, calls):
+        """Make a list of redis API calls in a single round trip.
+
+        Each call is a tuple of ``(call, args, kwargs, filter_func)``, where
+        ``filter_func`` may be ``None``.
+        """
+        raise NotImplementedError("Sub-classes of Manager should implement"
+                                  " ._execute_pipeline()")
+
+    def _run_script(self, script, keys, args):
+        """Run a script with ``EVALSHA``, falling back to ``EVAL``.
+
+        Keys have already been prefixed.
+        """
+        raise NotImplementedError("Sub-classes of Manager should implement"
+                                  " ._run_script()")
+
     def _key(self, key):
         """
         Generate a key using this manager's key prefix
@@ -268,7 +385,7 @@ class Manager(object):
     sadd = RedisCall(['key'], vararg='values')
     smembers = RedisCall(['key'])
     spop = RedisCall(['key'])
-    srem = RedisCall(['key', 'value'])
+    srem = RedisCall(['key'], vararg='values')
     scard = RedisCall(['key'])
     smove = RedisCall(['src', 'dst', 'value'], key_args=['src', 'dst'])
     sunion = RedisCall(['key'], vararg='args', key_args=['key', 'args'])
@@ -277,7 +394,7 @@ class Manager(object):
     # Sorted set operations
 
     zadd = RedisCall(['key'], kwarg='valscores')
-    zrem = RedisCall(['key', 'value'])
+    zrem = RedisCall(['key'], vararg='values')
     zcard = RedisCall(['key'])
     zrange = RedisCall(['key', 'start', 'stop', 'desc', 'withscores'],
                        defaults=[False, False])
@@ -5,7 +5,8 @@ import redis.exceptions
 
 from vumi.persist.redis_base import Manager
 from vumi.persist.fake_redis import (
-    FakeRedis, ResponseError as FakeResponseError)
+    FakeRedis, ResponseError as FakeResponseError,
+    NoScriptError as FakeNoScriptError)
 from vumi.utils import flatten_generator
 
 
@@ -47,10 +48,46 @@ class VumiRedis(redis.Redis):
             cursor = None
         return (cursor, keys)
 
+    def eval(self, source, keys=(), args=()):
+        """
+        The underlying .eval() takes the number of keys followed by the keys
+        and args. This wrapper takes separate lists of keys and args to match
+        our implementation in the txredis manager.
+        """
+        return super(VumiRedis, self).eval(
+            source, len(keys), *(list(keys) + list(args)))
+
+    def evalsha(self, sha1, keys=(), args=()):
+        """
+        The underlying .evalsha() takes the number of keys followed by the
+        keys and args. This wrapper takes separate lists of keys and args to
+        match our implementation in the txredis manager.
+        """
+        return super(VumiRedis, self).evalsha(
+            sha1, len(keys), *(list(keys) + list(args)))
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        """
+        Return a pipeline that has our customisations to the client API.
+        """
+        return VumiRedisPipeline(
+            self.connection_pool, self.response_callbacks, transaction,
+            shard_hint)
+
+
+class VumiRedisPipeline(redis.client.BasePipeline, VumiRedis):
+    """
+    Custom Vumi redis pipeline implementation.
+    """
+
+    def scan(self, cursor, match=None, count=None):
+        raise NotImplementedError("SCAN is not supported in pipelines.")
+
 
 class RedisManager(Manager):
 
     RESPONSE_ERROR = redis.exceptions.ResponseError
+    NO_SCRIPT_ERROR = redis.exceptions.NoScriptError
 
     call_decorator = staticmethod(flatten_generator)
 
@@ -63,6 +100,7 @@ class RedisManager(Manager):
         # Because ._close() assumes a real connection.
         manager._close = fake_redis.teardown
         manager.RESPONSE_ERROR = FakeResponseError
+        manager.NO_SCRIPT_ERROR = FakeNoScriptError
         return manager
 
     @classmethod
@@ -99,3 +137,26 @@ class RedisManager(Manager):
         """Filter results of a redis call.
         """
         return func(results)
+
+    def _run_script(self, script, keys, args):
+        """Run a script with ``EVALSHA``, falling back to ``EVAL``.
+        """
+        try:
+            return self._client.evalsha(script.sha, keys, args)
+        except self.NO_SCRIPT_ERROR:
+            return self._client.eval(script.source, keys, args)
+
+    def _execute_pipeline(self, calls):
+        """Make a list of redis API calls in a single round trip.
+        """
+        if isinstance(self._client, FakeRedis):
+            results = [self._make_redis_call(call, *args, **kw)
+                       for call, args, kw, _f_func in calls]
+        else:
+            pipe = self._client.pipeline(transaction=False)
+            for call, args, kw, _f_func in calls:
+                getattr(pipe, call)(*args, **kw)
+            results = pipe.execute()
+        return [self._filter_redis_results(f_func, result) if f_func
+                else result
+                for result, (_c, _a, _k, f_func) in zip(results, calls)]
@@ -1,11 +1,13 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
 import os
 
 from twisted.internet import reactor
-from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, Deferred, maybeDeferred)
 
-from vumi.persist.fake_redis import FakeRedis, ResponseError
+from vumi.persist.fake_redis import FakeRedis, ResponseError, NoScriptError
 from vumi.tests.helpers import VumiTestCase
 
 
@@ -129,6 +131,16 @@ class FakeRedisTestMixin(object):
         yield self.assert_redis_error(redis, "zadd", "set", one='foo')
         yield self.assert_redis_error(redis, "zadd", "set", one=None)
 
+    @inlineCallbacks
+    def test_zadd_multiple(self):
+        redis = yield self.get_redis()
+        yield self.assert_redis_op(redis, 2, 'zadd', 'set', one=1.0, two=2.0)
+        yield self.assert_redis_op(
+            redis, 1, 'zadd', 'set', one=3.0, two=2.0, three=0.5)
+        yield self.assert_redis_op(
+            redis, [('three', 0.5), ('two', 2.0), ('one', 3.0)],
+            'zrange', 'set', 0, -1, withscores=True)
+
     @inlineCallbacks
     def test_zrange(self):
         redis = yield self.get_redis()
@@ -205,6 +217,15 @@ class FakeRedisTestMixin(object):
         yield self.assert_redis_op(
             redis, [('two', 0.2)], 'zrange', 'set', 0, -1, withscores=True)
 
+    @inlineCallbacks
+    def test_zrem_multiple(self):
+        redis = yield self.get_redis()
+        yield redis.zadd('set', one=0.1, two=0.2, three=0.3)
+        yield self.assert_redis_op(
+            redis, 2, 'zrem', 'set', 'one', 'three', 'four')
+        yield self.assert_redis_op(
+            redis, [('two', 0.2)], 'zrange', 'set', 0, -1, withscores=True)
+
     @inlineCallbacks
     def test_zremrangebyrank(self):
         redis = yield self.get_redis()
@@ -319,6 +340,15 @@ class FakeRedisTestMixin(object):
         yield self.assert_redis_op(
             redis, set(['1', '2', '3', '4']), 'smembers', 'set')
 
+    @inlineCallbacks
+    def test_srem(self):
+        redis = yield self.get_redis()
+        yield self.assert_redis_op(redis, 3, 'sadd', 'set', '1', '2', '3')
+        yield self.assert_redis_op(redis, 1, 'srem', 'set', '1')
+        yield self.assert_redis_op(redis, 0, 'srem', 'set', '1')
+        yield self.assert_redis_op(redis, 1, 'srem', 'set', '1', '2')
+        yield self.assert_redis_op(redis, set(['3']), 'smembers', 'set')
+
     @inlineCallbacks
     def test_smove(self):
         redis = yield self.get_redis()
@@ -550,6 +580,22 @@ class FakeRedisTestMixin(object):
         yield self.assert_redis_op(redis, 2, 'pfcount', 'hll2')
 
 
+GETSET_LUA = """
+local old = redis.call('GET', KEYS[1])
+redis.call('SET', KEYS[1], ARGV[1])
+return {old, 1.5, true}
+"""
+
+
+def _getset_emulation(call, keys, args):
+    old = call('get', keys[0])
+    call('set', keys[0], args[0])
+    return [old, 1.5, True]
+
+
+FakeRedis.register_script_emulation(GETSET_LUA, _getset_emulation)
+
+
 class FakeRedisUnverifiedTestMixin(object):
     """
     This mixin adds some extra tests that are not verified against real Redis.
@@ -620,6 +666,56 @@ class FakeRedisUnverifiedTestMixin(object):
         yield self.assert_redis_op(redis, 0, 'pfadd', 'hll1', *values)
         yield self.assert_redis_op(redis, 998, 'pfcount', 'hll1')
 
+    @inlineCallbacks
+    def test_eval(self):
+        """
+        Scripts are run by a Python emulation rather than Lua, so we can't
+        compare them with real Redis.
+        """
+        redis = yield self.get_redis()
+        yield self.assert_redis_op(
+            redis, [None, 1, 1], 'eval', GETSET_LUA, ['key'], [2])
+        yield self.assert_redis_op(
+            redis, ['2', 1, 1], 'eval', GETSET_LUA, ['key'], [3])
+        yield self.assert_redis_error(redis, 'eval', "return 1")
+
+    @inlineCallbacks
+    def test_evalsha(self):
+        """
+        Scripts are run by a Python emulation rather than Lua, so we can't
+        compare them with real Redis.
+        """
+        redis = yield self.get_redis()
+        sha1 = hashlib.sha1(GETSET_LUA).hexdigest()
+        yield self.assert_redis_error(redis, 'evalsha', sha1, ['key'], [2])
+        yield self.assert_redis_op(redis, sha1, 'script_load', GETSET_LUA)
+        yield self.assert_redis_op(
+            redis, [None, 1, 1], 'evalsha', sha1, ['key'], [2])
+        yield self.assert_redis_op(redis, '2', 'get', 'key')
+        yield self.assert_redis_error(redis, 'script_load', "return 1")
+
+    @inlineCallbacks
+    def test_evalsha_after_eval(self):
+        """
+        Scripts are run by a Python emulation rather than Lua, so we can't
+        compare them with real Redis.
+        """
+        redis = yield self.get_redis()
+        sha1 = hashlib.sha1(GETSET_LUA).hexdigest()
+        yield redis.eval(GETSET_LUA, ['key'], [2])
+        yield self.assert_redis_op(
+            redis, ['2', 1, 1], 'evalsha', sha1, ['key'], [3])
+
+    def test_evalsha_noscript(self):
+        """
+        Scripts are run by a Python emulation rather than Lua, so we can't
+        compare them with real Redis.
+        """
+        redis = self.get_redis()
+        sha1 = hashlib.sha1(GETSET_LUA).hexdigest()
+        d = maybeDeferred(redis.evalsha, sha1, ['key'], [2])
+        return self.assertFailure(d, NoScriptError)
+
 
 class TestFakeRedis(FakeRedisUnverifiedTestMixin, FakeRedisTestMixin,
                     VumiTestCase):
@@ -43,3 +43,21 @@ class TestBaseRedisManager(VumiTestCase):
         self.assertEqual(
             str(e),
             'Only one of client or client_proxy may be specified')
+
+    def test_pipeline(self):
+        manager = self.mk_manager()
+        pipe = manager.pipeline()
+        self.assertEqual(pipe._key_prefix, manager._key_prefix)
+        self.assertEqual(pipe._client, manager._client)
+        self.assertEqual(manager._pipeline_calls, None)
+        self.assertEqual(pipe.set('foo', 'bar'), None)
+        self.assertEqual(pipe.keys(), None)
+        self.assertEqual(pipe._pipeline_calls, [
+            ('set', ['test:foo', 'bar'], {}, None),
+            ('keys', [], {'pattern': 'test:*'}, pipe._unkeys),
+        ])
+
+    def test_execute_not_pipeline(self):
+        manager = self.mk_manager()
+        e = self.assertRaises(AssertionError, manager.execute)
+        self.assertEqual(str(e), 'Only pipelines can be executed')
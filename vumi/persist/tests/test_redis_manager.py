@@ -1,8 +1,18 @@
 """Tests for vumi.persist.redis_manager."""
 
+from vumi.persist.redis_base import Manager
 from vumi.tests.helpers import VumiTestCase, import_skip
 
 
+def _incr_by_emulation(call, keys, args):
+    return [call('incr', keys[0], int(args[0])), keys[0]]
+
+
+INCR_BY_SCRIPT = Manager.register_script("""
+return {redis.call('INCRBY', KEYS[1], ARGV[1]), KEYS[1]}
+""", _incr_by_emulation)
+
+
 class TestRedisManager(VumiTestCase):
     def setUp(self):
         try:
@@ -42,6 +52,41 @@ class TestRedisManager(VumiTestCase):
         self.manager._close()
         self.manager._close()
 
+    def test_pipeline(self):
+        self.manager.set('foo', '1')
+        pipe = self.manager.pipeline()
+        self.assertEqual(pipe.incr('foo'), None)
+        self.assertEqual(pipe.set('bar', 'baz'), None)
+        self.assertEqual(pipe.keys(), None)
+        self.assertEqual(pipe.get('bar'), None)
+        # Nothing happens until we execute the pipeline.
+        self.assertEqual('1', self.manager.get('foo'))
+        results = pipe.execute()
+        self.assertEqual(results[0], 2)
+        self.assertEqual(sorted(results[2]), ['bar', 'foo'])
+        self.assertEqual(results[3], 'baz')
+        self.assertEqual('2', self.manager.get('foo'))
+        # The pipeline is empty after executing.
+        self.assertEqual([], pipe.execute())
+
+    def test_run_script(self):
+        result = self.manager.run_script(INCR_BY_SCRIPT, ['foo'], [2])
+        self.assertEqual(result, [2, 'redistest:foo'])
+        result = self.manager.run_script(INCR_BY_SCRIPT, ['foo'], [3])
+        self.assertEqual(result, [5, 'redistest:foo'])
+        self.assertEqual('5', self.manager.get('foo'))
+
+    def test_run_script_sub_manager(self):
+        sub_manager = self.manager.sub_manager('sub')
+        result = sub_manager.run_script(INCR_BY_SCRIPT, ['foo'], [2])
+        self.assertEqual(result, [2, 'redistest:sub:foo'])
+
+    def test_run_script_pipeline(self):
+        pipe = self.manager.pipeline()
+        self.assertEqual(pipe.run_script(INCR_BY_SCRIPT, ['foo'], [2]), None)
+        pipe.get('foo')
+        self.assertEqual(pipe.execute(), [[2, 'redistest:foo'], '2'])
+
     def test_scan(self):
         self.assertEqual([], self.manager.keys())
         for i in range(10):
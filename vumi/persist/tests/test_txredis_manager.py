@@ -7,6 +7,7 @@ from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
 from twisted.trial.unittest import SkipTest
 
+from vumi.persist.redis_base import Manager
 from vumi.persist.txredis_manager import TxRedisManager
 from vumi.tests.helpers import VumiTestCase
 
@@ -29,6 +30,15 @@ def skip_fake_redis(func):
     return wrapper
 
 
+def _incr_by_emulation(call, keys, args):
+    return [call('incr', keys[0], int(args[0])), keys[0]]
+
+
+INCR_BY_SCRIPT = Manager.register_script("""
+return {redis.call('INCRBY', KEYS[1], ARGV[1]), KEYS[1]}
+""", _incr_by_emulation)
+
+
 class TestTxRedisManager(VumiTestCase):
     @inlineCallbacks
     def get_manager(self):
@@ -107,6 +117,54 @@ class TestTxRedisManager(VumiTestCase):
         ttl = yield manager.ttl("key-ttl")
         self.assertTrue(10 <= ttl <= 30)
 
+    @inlineCallbacks
+    def test_pipeline(self):
+        manager = yield self.get_manager()
+        yield manager.set('foo', '1')
+        pipe = manager.pipeline()
+        self.assertEqual(pipe.incr('foo'), None)
+        self.assertEqual(pipe.set('bar', 'baz'), None)
+        self.assertEqual(pipe.keys(), None)
+        self.assertEqual(pipe.get('bar'), None)
+        # Nothing happens until we execute the pipeline.
+        self.assertEqual('1', (yield manager.get('foo')))
+        results = yield pipe.execute()
+        self.assertEqual(results[0], 2)
+        self.assertEqual(sorted(results[2]), ['bar', 'foo'])
+        self.assertEqual(results[3], 'baz')
+        self.assertEqual('2', (yield manager.get('foo')))
+        # The pipeline is empty after executing.
+        self.assertEqual([], (yield pipe.execute()))
+
+    @inlineCallbacks
+    def test_run_script(self):
+        manager = yield self.get_manager()
+        result = yield manager.run_script(INCR_BY_SCRIPT, ['foo'], [2])
+        self.assertEqual(result, [2, 'redistest:foo'])
+        result = yield manager.run_script(INCR_BY_SCRIPT, ['foo'], [3])
+        self.assertEqual(result, [5, 'redistest:foo'])
+        self.assertEqual('5', (yield manager.get('foo')))
+
+    @inlineCallbacks
+    def test_run_script_pipeline(self):
+        manager = yield self.get_manager()
+        pipe = manager.pipeline()
+        self.assertEqual(pipe.run_script(INCR_BY_SCRIPT, ['foo'], [2]), None)
+        pipe.get('foo')
+        results = yield pipe.execute()
+        self.assertEqual(results, [[2, 'redistest:foo'], '2'])
+
+    @inlineCallbacks
+    def test_pipeline_error(self):
+        manager = yield self.get_manager()
+        yield manager.set('foo', 'bar')
+        pipe = manager.pipeline()
+        pipe.hincrby('foo', 'field')
+        pipe.set('baz', 'quux')
+        yield self.assertFailure(pipe.execute(), manager.RESPONSE_ERROR)
+        # Calls that don't fail still happen.
+        self.assertEqual('quux', (yield manager.get('baz')))
+
     @skip_fake_redis
     @inlineCallbacks
     def test_reconnect_sub_managers(self):
@@ -13,11 +13,14 @@ except ImportError:
 import txredis.exceptions
 
 from twisted.internet import reactor
-from twisted.internet.defer import inlineCallbacks, succeed, Deferred
+from twisted.internet.defer import (
+    inlineCallbacks, succeed, Deferred, maybeDeferred, gatherResults,
+    FirstError)
 
 from vumi.persist.redis_base import Manager
 from vumi.persist.fake_redis import (
-    FakeRedis, ResponseError as FakeResponseError)
+    FakeRedis, ResponseError as FakeResponseError,
+    NoScriptError as FakeNoScriptError)
 
 
 class VumiRedis(txr.Redis):
@@ -116,23 +119,29 @@ class VumiRedis(txr.Redis):
         return self.getResponse()
 
     def zadd(self, key, *args, **kwargs):
+        """
+        Add members to a sorted set with a single variadic ``ZADD``.
+
+        Members and scores may be given as alternating ``member, score``
+        positional arguments or as ``member=score`` keyword arguments.
+
+        .. note::
+
+           Adding more than one member requires redis server 2.4 or later.
+        """
         if args:
             if len(args) % 2 != 0:
                 raise ValueError("ZADD requires an equal number of "
                                  "values and scores")
         pieces = zip(args[::2], args[1::2])
         pieces.extend(kwargs.iteritems())
-        orig_zadd = super(VumiRedis, self).zadd
-        d = succeed(0)
-
-        def do_zadd(s, key, member, score):
-            d = orig_zadd(key, member, score)
-            d.addCallback(lambda r: r + s)
-            return d
-
+        if not pieces:
+            return succeed(0)
+        score_members = []
         for member, score in pieces:
-            d.addCallback(do_zadd, key, member, score)
-        return d
+            score_members.extend((score, member))
+        self._send('ZADD', key, *score_members)
+        return self.getResponse()
 
     def zrange(self, key, start, end, desc=False, withscores=False):
         return super(VumiRedis, self).zrange(key, start, end,
@@ -241,6 +250,7 @@ class TxRedisManager(Manager):
     call_decorator = staticmethod(inlineCallbacks)
 
     RESPONSE_ERROR = txredis.exceptions.ResponseError
+    NO_SCRIPT_ERROR = txredis.exceptions.NoScript
 
     def __init__(self, *args, **kwargs):
         super(TxRedisManager, self).__init__(*args, **kwargs)
@@ -254,6 +264,7 @@ class TxRedisManager(Manager):
         # Because ._close() assumes a real connection.
         manager._close = fake_redis.teardown
         manager.RESPONSE_ERROR = FakeResponseError
+        manager.NO_SCRIPT_ERROR = FakeNoScriptError
         return succeed(manager)
 
     @classmethod
@@ -333,3 +344,34 @@ class TxRedisManager(Manager):
         """Filter results of a redis call.
         """
         return results.addCallback(func)
+
+    def _run_script(self, script, keys, args):
+        """Run a script with ``EVALSHA``, falling back to ``EVAL``.
+        """
+        def eval_source(f):
+            f.trap(self.NO_SCRIPT_ERROR)
+            return self._client.eval(script.source, keys, args)
+
+        d = maybeDeferred(self._client.evalsha, script.sha, keys, args)
+        return d.addErrback(eval_source)
+
+    def _execute_pipeline(self, calls):
+        """Make a list of redis API calls in a single round trip.
+
+        The redis protocol matches responses to requests by order, so we can
+        send all the commands without waiting for any responses.
+        """
+        ds = []
+        for call, args, kw, f_func in calls:
+            d = maybeDeferred(self._make_redis_call, call, *args, **kw)
+            if f_func:
+                d = self._filter_redis_results(f_func, d)
+            ds.append(d)
+        d = gatherResults(ds, consumeErrors=True)
+        d.addErrback(self._unwrap_first_error)
+        return d
+
+    @staticmethod
+    def _unwrap_first_error(f):
+        f.trap(FirstError)
+        return f.value.subFailure
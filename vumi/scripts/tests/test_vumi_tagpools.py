@@ -221,3 +221,39 @@ class TestReleaseTagCmd(TagPoolBaseTestCase):
         cfg.run()
         self.assertEqual(cfg.tagpool.inuse_tags('foo'), [])
         self.assertEqual(cfg.output, ["Released ('foo', 'tag1')."])
+
+
+class TestAcquireTagsCmd(TagPoolBaseTestCase):
+
+    def setUp(self):
+        super(TestAcquireTagsCmd, self).setUp()
+        self.test_tags = [("foo", "tag%d" % i) for
+                          i in [1, 2, 3, 5, 6, 7, 9]]
+
+    def test_acquire_tags(self):
+        cfg = make_cfg(["acquire-tags", "--owner", "me", "foo", "4"])
+        cfg.tagpool.declare_tags(self.test_tags)
+        cfg.run()
+        self.assertEqual(cfg.output, [
+            'Acquiring 4 tag(s) from pool foo ...',
+            'Acquired 4 tag(s):',
+            '   tag[1-3], tag5',
+            ])
+        self.assertEqual(sorted(cfg.tagpool.inuse_tags('foo')),
+                         self.test_tags[:4])
+        self.assertEqual(sorted(cfg.tagpool.owned_tags('me')),
+                         [list(tag) for tag in self.test_tags[:4]])
+
+    def test_acquire_tags_none_free(self):
+        cfg = make_cfg(["acquire-tags", "foo", "4"])
+        cfg.run()
+        self.assertEqual(cfg.output, [
+            'Acquiring 4 tag(s) from pool foo ...',
+            'Acquired 0 tag(s):',
+            '   -- None --',
+            ])
+
+    def test_acquire_tags_bad_count(self):
+        from twisted.python.usage import UsageError
+        self.assertRaises(
+            UsageError, make_cfg, ["acquire-tags", "foo", "many"])
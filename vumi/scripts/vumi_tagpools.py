@@ -161,6 +161,31 @@ class ReleaseTagCmd(usage.Options):
             cfg.emit('Released %s.' % (tag_tuple,))
 
 
+class AcquireTagsCmd(usage.Options):
+
+    synopsis = "<pool> <count>"
+
+    optParameters = [
+        ["owner", "o", None, "Owner to acquire the tags for."],
+    ]
+
+    def parseArgs(self, pool, count):
+        self.pool = pool
+        try:
+            self.count = int(count)
+        except ValueError:
+            raise usage.UsageError("Tag count must be an integer.")
+
+    def run(self, cfg):
+        cfg.emit("Acquiring %d tag(s) from pool %s ..." % (
+            self.count, self.pool))
+        tags = cfg.tagpool.acquire_tags(
+            self.pool, self.count, owner=self['owner'])
+        cfg.emit("Acquired %d tag(s):" % len(tags))
+        cfg.emit("   " + (key_ranges([tag[1] for tag in tags])
+                          or "-- None --"))
+
+
 class Options(usage.Options):
     subCommands = [
         ["create-pool", None, CreatePoolCmd,
@@ -177,7 +202,9 @@ class Options(usage.Options):
          "List all pools defined in config and in the tag store."],
         ["release-tag", None, ReleaseTagCmd,
          "Release a single tag, moves it from the in-use to the free set. "
-         "Use only if you know what you are doing."]
+         "Use only if you know what you are doing."],
+        ["acquire-tags", None, AcquireTagsCmd,
+         "Acquire a number of free tags from a tag pool at once."],
     ]
 
     optParameters = [
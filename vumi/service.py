@@ -5,10 +5,12 @@ import warnings
 from copy import deepcopy
 
 from twisted.python import log
+from twisted.python.failure import Failure
 from twisted.application.service import MultiService
 from twisted.application.internet import TCPClient
 from twisted.internet.defer import (
-    inlineCallbacks, returnValue, Deferred, succeed)
+    inlineCallbacks, returnValue, Deferred, succeed, maybeDeferred,
+    gatherResults)
 from twisted.internet import protocol, reactor
 import txamqp
 from txamqp.client import TwistedDelegate
@@ -199,7 +201,8 @@ class Worker(MultiService, object):
 
     def consume(self, routing_key, callback, queue_name=None,
                 exchange_name='vumi', exchange_type='direct', durable=True,
-                message_class=None, paused=False, prefetch_count=None):
+                message_class=None, paused=False, prefetch_count=None,
+                max_in_flight=None, lazy_decode=False):
 
         # use the routing key to generate the name for the class
         # amq.routing.key -> AmqRoutingKey
@@ -213,6 +216,8 @@ class Worker(MultiService, object):
             'durable': durable,
             'start_paused': paused,
             'prefetch_count': prefetch_count,
+            'max_in_flight': max_in_flight,
+            'lazy_decode': lazy_decode,
         }
         log.msg('Starting %s with %s' % (class_name, kwargs))
         klass = type(class_name, (DynamicConsumer,), kwargs)
@@ -224,10 +229,13 @@ class Worker(MultiService, object):
         return self._amqp_client.start_consumer(consumer_class, *args, **kw)
 
     @inlineCallbacks
-    def publish_to(self, routing_key):
+    def publish_to(self, routing_key, confirm_window=None):
         channel = yield self._amqp_client.get_channel()
-        publisher = DynamicPublisher(channel, routing_key)
+        publisher = DynamicPublisher(
+            channel, routing_key, confirm_window=confirm_window)
         yield self._amqp_client._declare_exchange(publisher, channel)
+        if confirm_window is not None:
+            yield publisher.enable_confirms()
         # return the publisher
         returnValue(publisher)
 
@@ -245,6 +253,24 @@ class QueueCloseMarker(object):
 
 
 class Consumer(object):
+    """
+    An AMQP queue consumer.
+
+    By default, messages are processed one at a time: the next message is
+    only read from the queue once the previous one has been fully consumed
+    and acknowledged. If :attr:`max_in_flight` is set, up to that many
+    messages are processed concurrently instead. Each message is still
+    acknowledged individually when its processing completes, and
+    :meth:`pause` still waits for all in-flight messages to finish.
+
+    Note that :attr:`prefetch_count` limits the number of unacknowledged
+    messages the broker will send us, so it should be at least as large as
+    :attr:`max_in_flight` for the extra concurrency to be useful.
+
+    If :attr:`lazy_decode` is set, messages are built with
+    :meth:`vumi.message.Message.from_json_lazy` and are only decoded if the
+    consumer actually looks at their contents.
+    """
 
     exchange_name = "vumi"
     exchange_type = "direct"
@@ -256,6 +282,8 @@ class Consumer(object):
     message_class = Message
     start_paused = False
     prefetch_count = None
+    max_in_flight = None
+    lazy_decode = False
 
     def __init__(self, channel):
         self.channel = channel
@@ -268,6 +296,7 @@ class Consumer(object):
     @inlineCallbacks
     def start(self):
         self._in_progress = 0
+        self._slot_d = None
         self.keep_consuming = True
         self.paused = self.start_paused
         self._unpause_d = None
@@ -284,9 +313,16 @@ class Consumer(object):
                 message = yield self.queue.get()
                 if isinstance(message, QueueCloseMarker):
                     break
-                if self.paused:
-                    yield self._unpause_d
-                yield self.consume(message)
+                if self.max_in_flight is None:
+                    if self.paused:
+                        yield self._unpause_d
+                    yield self.consume(message)
+                else:
+                    yield self._wait_for_slot()
+                    if self.paused:
+                        yield self._unpause_d
+                    d = self.consume(message)
+                    d.addErrback(log.err, "Error consuming message")
         except txamqp.queue.Closed as e:
             log.err("Queue has closed", e)
         except Exception:
@@ -294,6 +330,23 @@ class Consumer(object):
             # garbage-collected, because that might only happen later on pypy.
             log.err()
 
+    def _wait_for_slot(self):
+        """
+        Return a deferred that fires when fewer than :attr:`max_in_flight`
+        messages are being processed.
+        """
+        if self._in_progress < self.max_in_flight:
+            return succeed(None)
+        self._slot_d = Deferred()
+        return self._slot_d
+
+    def _check_slot(self):
+        if self._slot_d is None or self.max_in_flight is None:
+            return
+        if self._in_progress < self.max_in_flight:
+            d, self._slot_d = self._slot_d, None
+            d.callback(None)
+
     @inlineCallbacks
     def _channel_consume(self):
         if self._consumer_tag is not None:
@@ -334,8 +387,11 @@ class Consumer(object):
     def consume(self, message):
         self._in_progress += 1
         try:
-            result = yield self.consume_message(
-                self.message_class.from_json(message.content.body))
+            if self.lazy_decode:
+                msg = self.message_class.from_json_lazy(message.content.body)
+            else:
+                msg = self.message_class.from_json(message.content.body)
+            result = yield self.consume_message(msg)
         finally:
             # If we get an exception here the consumer's already pretty much
             # broken, but we still decrement the _in_progress counter so we
@@ -343,6 +399,7 @@ class Consumer(object):
             self._in_progress -= 1
             if self._fake_channel is not None:
                 self._fake_channel.message_processed()
+            self._check_slot()
         if result is not False:
             yield self.channel.basic_ack(message.delivery_tag, False)
         else:
@@ -441,32 +498,148 @@ class Publisher(_Publisher):
 class DynamicPublisher(_Publisher):
     """
     A single-routing-key publisher.
+
+    By default, messages are written to the channel without waiting for any
+    acknowledgement from the broker. If a ``confirm_window`` is given and
+    :meth:`enable_confirms` has been called, the channel is put into
+    transactional mode and published messages are committed in groups.
+    :meth:`publish_message` and :meth:`publish_messages` then return
+    deferreds that only fire once the broker has accepted the messages, and
+    no more than ``confirm_window`` messages are allowed to be outstanding
+    at once. Callers that wait for these deferreds get backpressure from the
+    broker instead of growing the client-side buffers without bound.
     """
 
     durable = True
 
-    def __init__(self, channel, routing_key):
+    def __init__(self, channel, routing_key, confirm_window=None):
         self.channel = channel
         self.check_routing_key(routing_key)
         self.routing_key = routing_key
+        if confirm_window is not None and (
+                not isinstance(confirm_window, (int, long)) or
+                confirm_window < 1):
+            raise VumiError(
+                "confirm_window must be a positive integer if given, not %r."
+                % (confirm_window,))
+        self.confirm_window = confirm_window
+        self.confirms_enabled = False
+        self._outstanding = 0
+        self._window_waiters = []
+        self._uncommitted = []
+        self._committing = False
+
+    @inlineCallbacks
+    def enable_confirms(self):
+        """
+        Put the channel into transactional mode so that publishes can be
+        confirmed by the broker.
+        """
+        if self.confirm_window is None:
+            raise VumiError("Publisher confirms require a confirm_window.")
+        yield self.channel.tx_select()
+        self.confirms_enabled = True
 
     def publish_message(self, message):
-        self.publish_raw(message.to_json())
-        return succeed(message)
+        d = self.publish_raw(message.to_json())
+        return d.addCallback(lambda _: message)
+
+    def publish_messages(self, messages):
+        """
+        Publish a list of messages in one go.
+
+        In confirm mode, the messages are committed together (in chunks of at
+        most ``confirm_window`` messages) rather than one at a time. Returns a
+        deferred that fires with the list of messages once they have all been
+        published.
+        """
+        d = self._publish_raw_batch(
+            [message.to_json() for message in messages])
+        return d.addCallback(lambda _: messages)
 
     def publish_json(self, data):
-        self.publish_raw(json.dumps(data, cls=json.JSONEncoder))
+        return self.publish_raw(json.dumps(data, cls=json.JSONEncoder))
 
     def publish_raw(self, data):
+        return self._publish_raw_batch([data])
+
+    def _publish_raw_batch(self, datas):
+        if not self.confirms_enabled:
+            for data in datas:
+                self._publish_data(data)
+            return succeed(None)
+        ds = []
+        for i in xrange(0, len(datas), self.confirm_window):
+            chunk = datas[i:i + self.confirm_window]
+            d = self._wait_for_window(len(chunk))
+            d.addCallback(lambda _, chunk=chunk: self._publish_chunk(chunk))
+            ds.append(d)
+        return gatherResults(ds, consumeErrors=True).addErrback(
+            lambda f: f.value.subFailure)
+
+    def _publish_data(self, data):
         amq_message = Content(data)
         amq_message['delivery mode'] = self.delivery_mode
-        self._publish(amq_message)
+        return self._publish(amq_message)
 
     def _publish(self, message):
         return self.channel.basic_publish(
             exchange=self.exchange_name, content=message,
             routing_key=self.routing_key)
 
+    def _wait_for_window(self, count):
+        """
+        Reserve room for ``count`` outstanding messages, waiting for earlier
+        publishes to be confirmed if the window is full.
+        """
+        d = Deferred()
+        self._window_waiters.append((count, d))
+        self._check_window()
+        return d
+
+    def _check_window(self):
+        while self._window_waiters:
+            count, d = self._window_waiters[0]
+            if (self._outstanding > 0 and
+                    self._outstanding + count > self.confirm_window):
+                break
+            self._window_waiters.pop(0)
+            self._outstanding += count
+            d.callback(None)
+
+    def _publish_chunk(self, datas):
+        for data in datas:
+            self._publish_data(data)
+        d = Deferred()
+        self._uncommitted.append((len(datas), d))
+        self._commit_pending()
+        return d
+
+    def _commit_pending(self):
+        """
+        Commit everything published since the last commit, unless there's
+        already a commit in progress. Anything published while a commit is in
+        progress is committed as soon as it finishes.
+        """
+        if self._committing or not self._uncommitted:
+            return
+        self._committing = True
+        batch, self._uncommitted = self._uncommitted, []
+        d = maybeDeferred(self.channel.tx_commit)
+        d.addBoth(self._commit_done, batch)
+
+    def _commit_done(self, result, batch):
+        self._committing = False
+        for count, _d in batch:
+            self._outstanding -= count
+        for _count, d in batch:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(None)
+        self._check_window()
+        self._commit_pending()
+
 
 class WorkerCreator(object):
     """
@@ -295,6 +295,8 @@ class FakeAMQPChannel(object):
         self.delegate = client.delegate
         self.unacked = []
         self._consumer_prefetch = {}
+        self.tx_mode = False
+        self._tx_published = []
 
     def __repr__(self):
         return '<FakeAMQPChannel: id=%s>' % (self.channel_id,)
@@ -342,8 +344,24 @@ class FakeAMQPChannel(object):
         return Message(mkMethod("cancel-ok", 31))
 
     def basic_publish(self, exchange, routing_key, content):
+        if self.tx_mode:
+            self._tx_published.append((exchange, routing_key, content))
+            return
         return self.broker.basic_publish(exchange, routing_key, content)
 
+    def tx_select(self):
+        self.tx_mode = True
+
+    def tx_commit(self):
+        assert self.tx_mode
+        published, self._tx_published = self._tx_published, []
+        for exchange, routing_key, content in published:
+            self.broker.basic_publish(exchange, routing_key, content)
+
+    def tx_rollback(self):
+        assert self.tx_mode
+        self._tx_published = []
+
     def basic_ack(self, delivery_tag, multiple):
         assert delivery_tag in [dtag for dtag, _ctag, _queue in self.unacked]
         for dtag, ctag, queue in self.unacked[:]:
@@ -552,5 +570,14 @@ class FakeAMQPChannelWrapper(object):
     def basic_ack(self, delivery_tag, multiple):
         return self._fake_channel.basic_ack(delivery_tag, multiple)
 
+    def tx_select(self):
+        return self._fake_channel.tx_select()
+
+    def tx_commit(self):
+        return self._fake_channel.tx_commit()
+
+    def tx_rollback(self):
+        return self._fake_channel.tx_rollback()
+
     def basic_get(self, queue):
         return self._fake_channel.basic_get(queue)
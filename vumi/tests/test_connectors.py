@@ -31,14 +31,17 @@ class BaseConnectorTestCase(VumiTestCase):
 
     @inlineCallbacks
     def mk_connector(self, worker=None, connector_name=None,
-                     prefetch_count=None, middlewares=None, setup=False):
+                     prefetch_count=None, middlewares=None, setup=False,
+                     max_in_flight=None, lazy_decode=False):
         if worker is None:
             worker = yield self.worker_helper.get_worker(DummyWorker, {})
         if connector_name is None:
             connector_name = "dummy_connector"
         connector = self.connector_class(worker, connector_name,
                                          prefetch_count=prefetch_count,
-                                         middlewares=middlewares)
+                                         middlewares=middlewares,
+                                         max_in_flight=max_in_flight,
+                                         lazy_decode=lazy_decode)
         if setup:
             yield connector.setup()
         returnValue(connector)
@@ -102,6 +105,20 @@ class TestBaseConnector(BaseConnectorTestCase):
         fake_channel = consumer.channel._fake_channel
         self.assertEqual(fake_channel.qos_prefetch_count, 10)
 
+    @inlineCallbacks
+    def test_max_in_flight(self):
+        conn, consumer = yield self.mk_consumer()
+        self.assertEqual(consumer.max_in_flight, None)
+        conn, consumer = yield self.mk_consumer(max_in_flight=5)
+        self.assertEqual(consumer.max_in_flight, 5)
+
+    @inlineCallbacks
+    def test_lazy_decode(self):
+        conn, consumer = yield self.mk_consumer()
+        self.assertEqual(consumer.lazy_decode, False)
+        conn, consumer = yield self.mk_consumer(lazy_decode=True)
+        self.assertEqual(consumer.lazy_decode, True)
+
     @inlineCallbacks
     def test_setup_raises(self):
         conn = yield self.mk_connector()
@@ -138,6 +138,29 @@ class TestFakeAMQP(VumiTestCase):
         self.assertEqual([('direct', 'routing.key.two', 'blah')] * 2,
                          delivered)
 
+    def test_publish_tx(self):
+        self.set_up_broker()
+        self.chan1.queue_bind('q1', 'direct', 'routing.key.one')
+        delivered = []
+
+        def fake_put(*args):
+            delivered.append(args)
+        self.q1.put = fake_put
+
+        self.chan1.tx_select()
+        self.chan1.basic_publish('direct', 'routing.key.one', 'blah1')
+        self.chan1.basic_publish('direct', 'routing.key.one', 'blah2')
+        self.assertEqual([], delivered)
+        self.chan1.tx_commit()
+        self.assertEqual([('direct', 'routing.key.one', 'blah1'),
+                          ('direct', 'routing.key.one', 'blah2')], delivered)
+
+        delivered[:] = []  # Clear without reassigning
+        self.chan1.basic_publish('direct', 'routing.key.one', 'blah3')
+        self.chan1.tx_rollback()
+        self.chan1.tx_commit()
+        self.assertEqual([], delivered)
+
     def test_publish_topic(self):
         self.set_up_broker()
         self.chan1.queue_bind('q1', 'topic', 'routing.key.*.foo.#')
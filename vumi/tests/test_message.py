@@ -72,6 +72,28 @@ class ModuleUtilityTest(VumiTestCase):
             'foo': timestamp,
         })
 
+    def test_from_json_supports_nested_vumi_dates(self):
+        data = {
+            'foo': {
+                'bar': ['2015-01-02 12:01:02', {'baz': '2015-01-02 1:2:3'}],
+            },
+        }
+        self.assertEqual(from_json(json.dumps(data)), {
+            'foo': {'bar': ['2015-01-02 12:01:02', {
+                'baz': datetime(2015, 1, 2, 1, 2, 3)}]},
+        })
+
+    def test_from_json_ignores_non_dates(self):
+        data = {
+            'a': '2015-01-02',
+            'b': '2015-01-02 12:01:02 and more',
+            'c': '2015-13-02 12:01:02',
+            'd': 'hello',
+            'e': 12,
+            'f': None,
+        }
+        self.assertEqual(from_json(json.dumps(data)), data)
+
 
 class MessageTest(VumiTestCase):
 
@@ -96,6 +118,67 @@ class MessageTest(VumiTestCase):
             "thing": "dont_store_me",
         })
 
+    def test_message_copy(self):
+        timestamp = datetime(2015, 1, 2, 12, 1, 2)
+        msg = Message(a=5, b={'c': [1, {'d': 'e'}]}, ts=timestamp)
+        msg_copy = msg.copy()
+        self.assertEqual(msg_copy, msg)
+        self.assertEqual(msg_copy['ts'], timestamp)
+        msg_copy['b']['c'][1]['d'] = 'f'
+        msg_copy['b']['c'].append(2)
+        self.assertEqual(msg['b'], {'c': [1, {'d': 'e'}]})
+
+    def test_message_copy_matches_json_round_trip(self):
+        msg = Message(a=(1, 2), b={'c': (3, {'d': 4})})
+        self.assertEqual(msg.copy(), Message.from_json(msg.to_json()))
+
+    def test_from_json_lazy(self):
+        msg_json = to_json({'a': 5, 'ts': datetime(2015, 1, 2, 12, 1, 2)})
+        msg = Message.from_json_lazy(msg_json)
+        self.assertTrue(msg.is_undecoded())
+        self.assertEqual(msg.to_json(), msg_json)
+        self.assertEqual(msg['ts'], datetime(2015, 1, 2, 12, 1, 2))
+        self.assertFalse(msg.is_undecoded())
+        self.assertEqual(msg, Message.from_json(msg_json))
+
+    def test_from_json_lazy_modified(self):
+        msg = Message.from_json_lazy(to_json({'a': 5}))
+        msg['a'] = 6
+        self.assertEqual(json.loads(msg.to_json()), {'a': 6})
+
+    def test_peek(self):
+        msg = Message(a=5)
+        self.assertEqual(msg.peek('a'), 5)
+        self.assertEqual(msg.peek('b'), None)
+        self.assertEqual(msg.peek('b', 'default'), 'default')
+
+    def test_peek_lazy(self):
+        msg = Message.from_json_lazy(
+            to_json({'a': {'b': 1}, 'ts': datetime(2015, 1, 2, 12, 1, 2)}))
+        self.assertEqual(msg.peek('a'), {'b': 1})
+        self.assertEqual(msg.peek('ts'), '2015-01-02 12:01:02.000000')
+        self.assertEqual(msg.peek('c'), None)
+        self.assertEqual(msg.peek('c', 'default'), 'default')
+        self.assertTrue(msg.is_undecoded())
+
+    def test_peek_missing_matches_get(self):
+        msg_json = to_json({'a': None})
+        lazy_msg = Message.from_json_lazy(msg_json)
+        msg = Message.from_json(msg_json)
+        for key in ['a', 'b']:
+            self.assertEqual(lazy_msg.peek(key), msg.get(key))
+            self.assertEqual(lazy_msg.peek(key, 'x'), msg.get(key, 'x'))
+        self.assertTrue(lazy_msg.is_undecoded())
+
+    def test_copy_lazy(self):
+        msg_json = to_json({'a': 5})
+        msg = Message.from_json_lazy(msg_json)
+        msg_copy = msg.copy()
+        self.assertTrue(msg_copy.is_undecoded())
+        self.assertEqual(msg_copy.to_json(), msg_json)
+        msg_copy['a'] = 6
+        self.assertEqual(msg['a'], 5)
+
 
 class TransportMessageTestMixin(object):
     def make_message(self, **fields):
@@ -116,6 +199,59 @@ class TransportMessageTestMixin(object):
         msg = self.make_message(routing_metadata={'foo': 'bar'})
         self.assertEqual({'foo': 'bar'}, msg.routing_metadata)
 
+    def test_copy(self):
+        msg = self.make_message(helper_metadata={'foo': {'bar': 'baz'}})
+        msg_copy = msg.copy()
+        self.assertEqual(type(msg_copy), type(msg))
+        self.assertEqual(msg_copy, msg)
+        msg_copy['helper_metadata']['foo']['bar'] = 'quux'
+        self.assertEqual({'foo': {'bar': 'baz'}}, msg['helper_metadata'])
+
+    def test_from_json_lazy_validates_on_decode(self):
+        msg = self.make_message()
+        del msg.payload['message_type']
+        lazy_msg = type(msg).from_json_lazy(msg.to_json())
+        self.assertRaises(MissingMessageField, lambda: lazy_msg['to_addr'])
+
+    def test_from_json_lazy_invalid_stays_undecoded(self):
+        msg = self.make_message()
+        del msg.payload['message_type']
+        msg_json = msg.to_json()
+        lazy_msg = type(msg).from_json_lazy(msg_json)
+        self.assertRaises(MissingMessageField, lambda: lazy_msg['to_addr'])
+        self.assertTrue(lazy_msg.is_undecoded())
+        self.assertEqual(lazy_msg.to_json(), msg_json)
+        # Later accesses fail too, instead of seeing the invalid payload.
+        self.assertRaises(MissingMessageField, lambda: lazy_msg['to_addr'])
+        self.assertRaises(MissingMessageField, lazy_msg.copy().get, 'to_addr')
+
+    def test_get_routing_endpoint_lazy(self):
+        msg = self.make_message()
+        msg.set_routing_endpoint('foo')
+        lazy_msg = type(msg).from_json_lazy(msg.to_json())
+        self.assertEqual('foo', lazy_msg.get_routing_endpoint())
+        self.assertTrue(lazy_msg.is_undecoded())
+
+    def test_set_routing_endpoint_lazy(self):
+        msg = self.make_message()
+        msg.set_routing_endpoint('foo')
+        lazy_msg = type(msg).from_json_lazy(msg.to_json())
+        lazy_msg.set_routing_endpoint('bar')
+        self.assertTrue(lazy_msg.is_undecoded())
+        self.assertEqual('bar', lazy_msg.get_routing_endpoint())
+        msg.set_routing_endpoint('bar')
+        self.assertEqual(type(msg).from_json(lazy_msg.to_json()), msg)
+        self.assertEqual(lazy_msg, msg)
+
+    def test_set_routing_endpoint_lazy_unchanged(self):
+        msg = self.make_message()
+        msg.set_routing_endpoint('foo')
+        msg_json = msg.to_json()
+        lazy_msg = type(msg).from_json_lazy(msg_json)
+        lazy_msg.set_routing_endpoint('foo')
+        self.assertTrue(lazy_msg.is_undecoded())
+        self.assertEqual(lazy_msg.to_json(), msg_json)
+
     def test_check_routing_endpoint(self):
         msgcls = type(self.make_message())
         self.assertEqual('default', msgcls.check_routing_endpoint(None))
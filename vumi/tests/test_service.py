@@ -1,10 +1,12 @@
 import json
 from collections import namedtuple
 
-from twisted.internet.defer import inlineCallbacks, Deferred
+from twisted.internet.defer import inlineCallbacks, Deferred, returnValue
 
+from vumi.errors import VumiError
 from vumi.message import Message
 from vumi.service import Worker, WorkerCreator
+from vumi.tests.fake_connection import wait0
 from vumi.tests.helpers import VumiTestCase, WorkerHelper
 
 
@@ -91,6 +93,161 @@ class TestService(VumiTestCase):
         [failure] = self.flushLoggedErrors()
         self.assertEqual(failure.getErrorMessage(), "oops")
 
+    @inlineCallbacks
+    def test_consume_lazy_decode(self):
+        message = fake_amq_message({"key": "value"})
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        log = []
+        yield worker.consume(
+            'test.routing.key', lambda msg: log.append(msg), lazy_decode=True)
+        self.worker_helper.broker.basic_publish(
+            'vumi', 'test.routing.key', message.content)
+        yield self.worker_helper.broker.wait_delivery()
+        [msg] = log
+        self.assertTrue(msg.is_undecoded())
+        self.assertEqual(msg.to_json(), message.content.body)
+        self.assertEqual(msg, Message(key="value"))
+
+    @inlineCallbacks
+    def test_consume_serially_by_default(self):
+        """
+        Without max_in_flight, only one message is processed at a time.
+        """
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        started = []
+        pause_d = Deferred()
+
+        def consume_func(msg):
+            started.append(msg)
+            return pause_d
+
+        consumer = yield worker.consume(
+            'test.routing.key', consume_func, prefetch_count=10)
+        for i in range(3):
+            self.worker_helper.broker.basic_publish(
+                'vumi', 'test.routing.key',
+                fake_amq_message({"key": i}).content)
+        yield wait0()
+        self.assertEqual(started, [Message(key=0)])
+        self.assertEqual(consumer._in_progress, 1)
+
+        pause_d.callback(None)
+        yield self.worker_helper.kick_delivery()
+        self.assertEqual(
+            started, [Message(key=0), Message(key=1), Message(key=2)])
+        self.assertEqual(consumer._in_progress, 0)
+
+    @inlineCallbacks
+    def test_consume_max_in_flight(self):
+        """
+        With max_in_flight set, up to that many messages are processed
+        concurrently and each is acked when its processing finishes.
+        """
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        pending = []
+
+        def consume_func(msg):
+            d = Deferred()
+            pending.append((msg, d))
+            return d
+
+        consumer = yield worker.consume(
+            'test.routing.key', consume_func, prefetch_count=10,
+            max_in_flight=2)
+        fake_channel = consumer.channel._fake_channel
+        for i in range(3):
+            self.worker_helper.broker.basic_publish(
+                'vumi', 'test.routing.key',
+                fake_amq_message({"key": i}).content)
+        yield wait0()
+        self.assertEqual(
+            [msg for msg, _ in pending], [Message(key=0), Message(key=1)])
+        self.assertEqual(consumer._in_progress, 2)
+        self.assertEqual(len(fake_channel.unacked), 3)
+
+        # Finishing the second message acks it and frees up a slot.
+        pending[1][1].callback(None)
+        yield wait0()
+        self.assertEqual(
+            [msg for msg, _ in pending],
+            [Message(key=0), Message(key=1), Message(key=2)])
+        self.assertEqual(consumer._in_progress, 2)
+        self.assertEqual(len(fake_channel.unacked), 2)
+
+        pending[0][1].callback(None)
+        pending[2][1].callback(None)
+        yield self.worker_helper.kick_delivery()
+        self.assertEqual(consumer._in_progress, 0)
+        self.assertEqual(fake_channel.unacked, [])
+
+    @inlineCallbacks
+    def test_consume_max_in_flight_pause(self):
+        """
+        Pausing a consumer with max_in_flight set waits for all in-flight
+        messages to finish and stops new messages from being processed.
+        """
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        pending = []
+
+        def consume_func(msg):
+            d = Deferred()
+            pending.append((msg, d))
+            return d
+
+        consumer = yield worker.consume(
+            'test.routing.key', consume_func, prefetch_count=10,
+            max_in_flight=2)
+        for i in range(3):
+            self.worker_helper.broker.basic_publish(
+                'vumi', 'test.routing.key',
+                fake_amq_message({"key": i}).content)
+        yield wait0()
+        self.assertEqual(len(pending), 2)
+
+        paused = []
+        consumer.pause().addCallback(paused.append)
+        pending[0][1].callback(None)
+        self.assertEqual(paused, [])
+        pending[1][1].callback(None)
+        self.assertEqual(paused, [None])
+        self.assertEqual(len(pending), 2)
+
+        consumer.unpause()
+        yield wait0()
+        self.assertEqual(
+            [msg for msg, _ in pending],
+            [Message(key=0), Message(key=1), Message(key=2)])
+        pending[2][1].callback(None)
+        yield self.worker_helper.kick_delivery()
+
+    @inlineCallbacks
+    def test_broken_consume_max_in_flight(self):
+        """
+        If a consumer function throws an exception while processing
+        concurrently, the error is logged and other messages are still
+        processed.
+        """
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        log = []
+
+        def consume_func(msg):
+            if msg['key'] == 0:
+                raise Exception("oops")
+            log.append(msg)
+
+        consumer = yield worker.consume(
+            'test.routing.key', consume_func, prefetch_count=10,
+            max_in_flight=2)
+        for i in range(3):
+            self.worker_helper.broker.basic_publish(
+                'vumi', 'test.routing.key',
+                fake_amq_message({"key": i}).content)
+        yield self.worker_helper.kick_delivery()
+        self.assertEqual(log, [Message(key=1), Message(key=2)])
+        self.assertEqual(consumer._in_progress, 0)
+        [failure] = self.flushLoggedErrors()
+        self.assertEqual(failure.getErrorMessage(), "oops")
+
     @inlineCallbacks
     def test_start_publisher(self):
         """The publisher should publish"""
@@ -104,6 +261,154 @@ class TestService(VumiTestCase):
         self.assertEquals(published_msg.body, '{"key": "value"}')
         self.assertEquals(published_msg.properties, {'delivery mode': 2})
 
+    @inlineCallbacks
+    def test_publish_messages(self):
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        publisher = yield worker.publish_to('test.routing.key')
+        msgs = [Message(key=i) for i in range(3)]
+        result = yield publisher.publish_messages(msgs)
+        self.assertEqual(result, msgs)
+        self.assertEqual(
+            self.worker_helper.broker.get_messages('vumi', 'test.routing.key'),
+            msgs)
+
+    @inlineCallbacks
+    def get_confirming_publisher(self, confirm_window):
+        """
+        Return a confirming publisher and a list of pending commit deferreds.
+        Firing a commit deferred commits the messages on the fake channel.
+        """
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        publisher = yield worker.publish_to(
+            'test.routing.key', confirm_window=confirm_window)
+        channel = publisher.channel
+        commits = []
+
+        def tx_commit():
+            d = Deferred()
+            d.addCallback(lambda _: channel._fake_channel.tx_commit())
+            commits.append(d)
+            return d
+
+        channel.tx_commit = tx_commit
+        returnValue((publisher, commits))
+
+    def get_published(self):
+        return self.worker_helper.broker.get_messages(
+            'vumi', 'test.routing.key')
+
+    @inlineCallbacks
+    def test_publish_to_with_confirms(self):
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        publisher = yield worker.publish_to(
+            'test.routing.key', confirm_window=10)
+        self.assertEqual(publisher.confirms_enabled, True)
+        self.assertEqual(publisher.channel._fake_channel.tx_mode, True)
+        msg = Message(key="value")
+        result = yield publisher.publish_message(msg)
+        self.assertEqual(result, msg)
+        self.assertEqual(self.get_published(), [msg])
+
+    @inlineCallbacks
+    def test_enable_confirms_without_window(self):
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        publisher = yield worker.publish_to('test.routing.key')
+        self.assertEqual(publisher.confirms_enabled, False)
+        yield self.assertFailure(publisher.enable_confirms(), VumiError)
+
+    @inlineCallbacks
+    def test_publish_to_invalid_confirm_window(self):
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        for confirm_window in [0, -1, 2.5, "10"]:
+            yield self.assertFailure(
+                worker.publish_to(
+                    'test.routing.key', confirm_window=confirm_window),
+                VumiError)
+
+    @inlineCallbacks
+    def test_publish_message_waits_for_confirm(self):
+        publisher, commits = yield self.get_confirming_publisher(10)
+        msg = Message(key="value")
+        d = publisher.publish_message(msg)
+        self.assertNoResult(d)
+        self.assertEqual(self.get_published(), [])
+        commits[0].callback(None)
+        result = yield d
+        self.assertEqual(result, msg)
+        self.assertEqual(self.get_published(), [msg])
+
+    @inlineCallbacks
+    def test_publish_message_groups_commits(self):
+        """
+        Messages published while a commit is in progress are committed
+        together in the next commit.
+        """
+        publisher, commits = yield self.get_confirming_publisher(10)
+        d0 = publisher.publish_message(Message(key=0))
+        d1 = publisher.publish_message(Message(key=1))
+        d2 = publisher.publish_message(Message(key=2))
+        self.assertEqual(len(commits), 1)
+        commits[0].callback(None)
+        yield d0
+        self.assertNoResult(d1)
+        self.assertNoResult(d2)
+        self.assertEqual(len(commits), 2)
+        commits[1].callback(None)
+        yield d1
+        yield d2
+        self.assertEqual(len(commits), 2)
+        self.assertEqual(
+            self.get_published(), [Message(key=i) for i in range(3)])
+
+    @inlineCallbacks
+    def test_publish_message_confirm_window(self):
+        """
+        No more than confirm_window messages may be outstanding at once.
+        """
+        publisher, commits = yield self.get_confirming_publisher(2)
+        ds = [publisher.publish_message(Message(key=i)) for i in range(3)]
+        self.assertEqual(publisher._outstanding, 2)
+        self.assertEqual(len(publisher._window_waiters), 1)
+        commits[0].callback(None)
+        yield ds[0]
+        # The first message's confirm frees up room for the third.
+        self.assertEqual(publisher._outstanding, 2)
+        self.assertEqual(publisher._window_waiters, [])
+        commits[1].callback(None)
+        yield ds[1]
+        yield ds[2]
+        self.assertEqual(publisher._outstanding, 0)
+        self.assertEqual(
+            self.get_published(), [Message(key=i) for i in range(3)])
+
+    @inlineCallbacks
+    def test_publish_messages_confirmed(self):
+        """
+        A batch of messages is committed in chunks no larger than
+        confirm_window.
+        """
+        publisher, commits = yield self.get_confirming_publisher(3)
+        msgs = [Message(key=i) for i in range(5)]
+        d = publisher.publish_messages(msgs)
+        self.assertEqual(len(commits), 1)
+        self.assertEqual(publisher._outstanding, 3)
+        commits[0].callback(None)
+        self.assertEqual(self.get_published(), msgs[:3])
+        self.assertNoResult(d)
+        self.assertEqual(len(commits), 2)
+        commits[1].callback(None)
+        result = yield d
+        self.assertEqual(result, msgs)
+        self.assertEqual(self.get_published(), msgs)
+
+    @inlineCallbacks
+    def test_publish_message_commit_failure(self):
+        publisher, commits = yield self.get_confirming_publisher(10)
+        d = publisher.publish_message(Message(key="value"))
+        commits[0].errback(VumiError("commit failed"))
+        yield self.assertFailure(d, VumiError)
+        self.assertEqual(publisher._outstanding, 0)
+
 
 class LoadableTestWorker(Worker):
     def poke(self):
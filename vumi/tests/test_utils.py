@@ -14,7 +14,7 @@ from vumi.utils import (
     normalize_msisdn, vumi_resource_path, cleanup_msisdn, get_operator_name,
     http_request, http_request_full, get_first_word, redis_from_config,
     build_web_site, LogFilterSite, PkgResources, HttpTimeoutError,
-    StatusEdgeDetector)
+    StatusEdgeDetector, LRUCache)
 from vumi.message import TransportStatus
 from vumi.persist.fake_redis import FakeRedis
 from vumi.tests.fake_connection import (
@@ -527,3 +527,57 @@ class TestStatusEdgeDetector(VumiTestCase):
             'type': 'baz',
             'message': 'test'}
         self.assertEqual(sed.check_status(**status2), status2)
+
+
+class TestLRUCache(VumiTestCase):
+
+    def test_lookup_missing(self):
+        cache = LRUCache(2)
+        self.assertEqual(cache.lookup('foo'), (False, None))
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+    def test_set_and_lookup(self):
+        cache = LRUCache(2)
+        cache.set('foo', None)
+        self.assertEqual(cache.lookup('foo'), (True, None))
+        cache.set('foo', 'bar')
+        self.assertEqual(cache.lookup('foo'), (True, 'bar'))
+        self.assertEqual((cache.hits, cache.misses), (2, 0))
+        self.assertEqual(len(cache), 1)
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.lookup('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.lookup('a'), (True, 1))
+        self.assertEqual(cache.lookup('b'), (False, None))
+        self.assertEqual(cache.lookup('c'), (True, 3))
+
+    def test_expiry(self):
+        clock = Clock()
+        cache = LRUCache(2, ttl=10, clock=clock)
+        cache.set('a', 1)
+        clock.advance(9)
+        self.assertEqual(cache.lookup('a'), (True, 1))
+        clock.advance(1)
+        self.assertEqual(cache.lookup('a'), (False, None))
+        self.assertEqual(len(cache), 0)
+
+    def test_invalidate_and_clear(self):
+        cache = LRUCache(3)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.invalidate('a')
+        cache.invalidate('missing')
+        self.assertEqual(cache.lookup('a'), (False, None))
+        cache.clear()
+        self.assertEqual(cache.lookup('b'), (False, None))
+
+    def test_disabled(self):
+        cache = LRUCache(0)
+        cache.set('a', 1)
+        self.assertEqual(cache.lookup('a'), (False, None))
+        self.assertEqual(len(cache), 0)
+        self.assertEqual((cache.hits, cache.misses), (0, 0))
@@ -1,5 +1,6 @@
 from twisted.internet.defer import inlineCallbacks, succeed, Deferred
 
+from vumi.config import ConfigError, ConfigText
 from vumi.worker import BaseConfig, BaseWorker
 from vumi.connectors import (
     ReceiveInboundConnector, ReceiveOutboundConnector,
@@ -20,6 +21,14 @@ class DummyWorker(BaseWorker):
         pass
 
 
+class DynamicConfig(BaseConfig):
+    greeting = ConfigText("A per-message greeting.", default="hello")
+
+
+class DynamicConfigWorker(DummyWorker):
+    CONFIG_CLASS = DynamicConfig
+
+
 class DummyMiddleware(BaseMiddleware):
     setup_called = False
     teardown_called = False
@@ -52,6 +61,31 @@ class TestBaseConfig(VumiTestCase):
         config = BaseConfig({'amqp_prefetch_count': 10})
         self.assertEqual(config.amqp_prefetch_count, 10)
 
+    def test_no_amqp_max_in_flight(self):
+        config = BaseConfig({})
+        self.assertEqual(config.amqp_max_in_flight, None)
+
+    def test_amqp_max_in_flight(self):
+        config = BaseConfig({'amqp_max_in_flight': 5})
+        self.assertEqual(config.amqp_max_in_flight, 5)
+
+    def test_amqp_max_in_flight_too_small(self):
+        self.assertRaises(
+            ConfigError, BaseConfig, {'amqp_max_in_flight': 0})
+        self.assertRaises(
+            ConfigError, BaseConfig, {'amqp_max_in_flight': -1})
+
+    def test_amqp_publish_confirm_window_too_small(self):
+        self.assertRaises(
+            ConfigError, BaseConfig, {'amqp_publish_confirm_window': 0})
+        self.assertRaises(
+            ConfigError, BaseConfig, {'amqp_publish_confirm_window': -1})
+
+    def test_lazy_message_decoding(self):
+        self.assertEqual(BaseConfig({}).lazy_message_decoding, False)
+        config = BaseConfig({'lazy_message_decoding': True})
+        self.assertEqual(config.lazy_message_decoding, True)
+
 
 class TestBaseWorker(VumiTestCase):
 
@@ -154,6 +188,62 @@ class TestBaseWorker(VumiTestCase):
         cfg = yield self.worker.get_config(msg)
         self.assertEqual(cfg.amqp_prefetch_count, 20)
 
+    @inlineCallbacks
+    def test_get_config_reuses_static_config(self):
+        msg = self.msg_helper.make_inbound("inbound")
+        cfg = yield self.worker.get_config(msg)
+        self.assertTrue(cfg is self.worker.get_static_config())
+
+    @inlineCallbacks
+    def test_get_config_cached(self):
+        worker = yield self.worker_helper.get_worker(
+            DynamicConfigWorker, {'greeting': 'hi'}, False)
+        msg = self.msg_helper.make_inbound("inbound")
+        cfg = yield worker.get_config(msg)
+        self.assertEqual(cfg.greeting, 'hi')
+        self.assertFalse(cfg is worker.get_static_config())
+        cfg2 = yield worker.get_config(msg)
+        self.assertTrue(cfg2 is cfg)
+
+    def test_get_cached_config(self):
+        calls = []
+
+        def get_config_data(greeting):
+            calls.append(greeting)
+            return {'greeting': greeting}
+
+        worker = self.worker_helper.get_worker_raw(DynamicConfigWorker, {})
+        cfg_a = worker.get_cached_config('a', lambda: get_config_data('a'))
+        cfg_b = worker.get_cached_config('b', lambda: get_config_data('b'))
+        self.assertEqual(cfg_a.greeting, 'a')
+        self.assertEqual(cfg_b.greeting, 'b')
+        self.assertTrue(worker.get_cached_config('a', lambda: None) is cfg_a)
+        self.assertEqual(calls, ['a', 'b'])
+
+    def test_get_cached_config_size_limit(self):
+        worker = self.worker_helper.get_worker_raw(DynamicConfigWorker, {})
+        worker.CONFIG_CACHE_SIZE = 2
+        cfg_a = worker.get_cached_config('a', lambda: {})
+        worker.get_cached_config('b', lambda: {})
+        # Using 'a' makes 'b' the least recently used config.
+        worker.get_cached_config('a', lambda: {})
+        worker.get_cached_config('c', lambda: {})
+        self.assertEqual(worker._config_cache.keys(), ['a', 'c'])
+        self.assertTrue(worker.get_cached_config('a', lambda: None) is cfg_a)
+
+    @inlineCallbacks
+    def test_invalidate_config_cache(self):
+        worker = yield self.worker_helper.get_worker(
+            DynamicConfigWorker, {'amqp_prefetch_count': 5}, False)
+        msg = self.msg_helper.make_inbound("inbound")
+        cfg = yield worker.get_config(msg)
+        worker.config = {'amqp_prefetch_count': 10, 'greeting': 'hi'}
+        worker.invalidate_config_cache()
+        new_cfg = yield worker.get_config(msg)
+        self.assertFalse(new_cfg is cfg)
+        self.assertEqual(new_cfg.greeting, 'hi')
+        self.assertEqual(worker.get_static_config().amqp_prefetch_count, 10)
+
     def test__validate_config(self):
         # should call .validate_config()
         self.worker.validate_config = CallRecorder(self.worker.validate_config)
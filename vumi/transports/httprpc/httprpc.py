@@ -82,6 +82,7 @@ class HttpRpcTransportConfig(Transport.CONFIG_CLASS):
         default=1.0, static=True)
 
     def post_validate(self):
+        super(HttpRpcTransportConfig, self).post_validate()
         auth_supplied = (self.web_username is None, self.web_password is None)
         if any(auth_supplied) and not all(auth_supplied):
             raise ConfigError("If either web_username or web_password is"
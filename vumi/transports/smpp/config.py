@@ -63,6 +63,13 @@ class SmppTransportConfig(Transport.CONFIG_CLASS):
         "the TX bind are handled by the RX bind and they need to share the "
         "same prefix for the lookup for message ids in delivery reports to "
         "work.", default='', static=True)
+    sequence_block_size = ConfigInt(
+        "How many sequence numbers to reserve from Redis at a time. The "
+        "default of 1 does a Redis round trip for every PDU. Larger blocks "
+        "avoid most of those round trips, but sequence numbers are then "
+        "no longer issued in order across transports sharing the same "
+        "`split_bind_prefix`. Must be at most 65535.",
+        default=1, static=True)
     codec_class = ConfigClassName(
         'Which class should be used to handle character encoding/decoding. '
         'MUST implement `IVumiCodec`.',
@@ -133,9 +140,28 @@ class SmppTransportConfig(Transport.CONFIG_CLASS):
     mt_tps = ConfigInt(
         'Mobile Terminated Transactions per Second. The Maximum Vumi '
         'messages per second to attempt to put on the wire. '
-        'Defaults to 0 which means no throttling is applied. '
+        'Defaults to 0 which means no throttling is applied. The limit '
+        'is applied smoothly, allowing bursts of at most `mt_tps` PDUs. '
         '(NOTE: 1 Vumi message may result in multiple PDUs)',
         default=0, static=True, required=False)
+    bind_count = ConfigInt(
+        'The number of binds to open to the SMSC. Outbound messages are '
+        'spread across the bound sessions, preferring those with the most '
+        'room in their submit windows, and keep flowing while at least '
+        'one bind can send. `mt_tps` and `max_outstanding_pdus` apply to '
+        'each bind separately.',
+        default=1, static=True)
+    max_outstanding_pdus = ConfigInt(
+        'The maximum number of `submit_sm` PDUs that may be awaiting a '
+        '`submit_sm_resp` at any time. Outbound messages are paused while '
+        'this window is full. Defaults to 0 which means no limit is '
+        'applied. (NOTE: the window is checked between Vumi messages, so '
+        'a multipart message may briefly overfill it)',
+        default=0, static=True, required=False)
+    metrics_prefix = ConfigText(
+        "If set, submit window occupancy and time spent throttled are "
+        "published as metrics with this prefix.",
+        default=None, static=True)
 
     # TODO: Deprecate these fields when confmodel#5 is done.
     host = ConfigText(
@@ -144,3 +170,9 @@ class SmppTransportConfig(Transport.CONFIG_CLASS):
     port = ConfigInt(
         "*DEPRECATED* 'host' and 'port' fields may be used in place of the"
         " 'twisted_endpoint' field.", static=True)
+
+    def post_validate(self):
+        super(SmppTransportConfig, self).post_validate()
+        if self.bind_count < 1:
+            self.raise_config_error(
+                "bind_count must be at least 1, not %r." % (self.bind_count,))
@@ -174,6 +174,7 @@ class SmppTransportConfig(Transport.CONFIG_CLASS):
         " 'twisted_endpoint' field.", static=True)
 
     def post_validate(self):
+        super(SmppTransportConfig, self).post_validate()
         long_message_params = (
             'send_long_messages', 'send_multipart_sar', 'send_multipart_udh')
         set_params = [p for p in long_message_params if getattr(self, p)]
@@ -1,4 +1,5 @@
 import binascii
+import struct
 
 from vumi.transports.smpp.smpp_utils import unpacked_pdu_opts
 
@@ -46,3 +47,31 @@ def chop_pdu_stream(data):
     pdu, data = (data[0:cmd_length],
                  data[cmd_length:])
     return pdu, data
+
+
+def split_pdu_stream(data):
+    """
+    Find all complete PDUs in a buffer in a single pass.
+
+    :param data:
+        A ``bytearray`` (or ``str``) holding PDU bytes read from the wire.
+
+    :returns:
+        A tuple of a list of PDU strings and the number of bytes they used
+        up at the start of ``data``. Incomplete trailing PDUs are left for
+        the next call.
+    """
+    pdus = []
+    offset = 0
+    end = len(data)
+    while end - offset >= 16:
+        (cmd_length,) = struct.unpack_from('!I', data, offset)
+        if cmd_length < 16:
+            raise ValueError(
+                "Invalid PDU command_length %d at offset %d." % (
+                    cmd_length, offset))
+        if end - offset < cmd_length:
+            break
+        pdus.append(bytes(data[offset:offset + cmd_length]))
+        offset += cmd_length
+    return pdus, offset
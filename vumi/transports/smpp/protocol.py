@@ -16,7 +16,7 @@ from smpp.pdu_builder import (
     SubmitSM, QuerySM)
 
 from vumi.transports.smpp.pdu_utils import (
-    pdu_ok, seq_no, command_status, command_id, message_id, chop_pdu_stream)
+    pdu_ok, seq_no, command_status, command_id, message_id, split_pdu_stream)
 
 
 def require_bind(func):
@@ -67,7 +67,7 @@ class EsmeProtocol(Protocol):
         self.clock = service.clock
         self.config = self.service.get_config()
 
-        self.buffer = b''
+        self.buffer = bytearray()
         self.state = self.CLOSED_STATE
 
         self.deliver_sm_processor = self.service.deliver_sm_processor
@@ -220,19 +220,13 @@ class EsmeProtocol(Protocol):
         return self.transport.write(pdu.get_bin())
 
     def dataReceived(self, data):
-        self.buffer += data
-        data = self.handle_buffer()
-        while data is not None:
-            self.on_pdu(unpack_pdu(data))
-            data = self.handle_buffer()
-
-    def handle_buffer(self):
-        pdu_found = chop_pdu_stream(self.buffer)
-        if pdu_found is None:
-            return
-
-        data, self.buffer = pdu_found
-        return data
+        self.buffer.extend(data)
+        pdus, consumed = split_pdu_stream(self.buffer)
+        # Remove everything we've consumed before handling any PDUs, in case
+        # handling them leads to more data being received.
+        del self.buffer[:consumed]
+        for pdu in pdus:
+            self.on_pdu(unpack_pdu(pdu))
 
     def on_pdu(self, pdu):
         """
@@ -527,10 +521,15 @@ class EsmeProtocol(Protocol):
 
     @inlineCallbacks
     def send_submit_sm(self, vumi_message_id, pdu):
-        yield self.service.message_stash.cache_pdu(vumi_message_id, pdu)
-        yield self.service.message_stash.set_sequence_number_message_id(
-            seq_no(pdu.obj), vumi_message_id)
+        # The stash writes are issued before the PDU is sent, so they're
+        # applied before we look anything up for the response. We don't
+        # need to wait for them before putting the PDU on the wire.
+        d = self.service.message_stash.stash_submit_sm(vumi_message_id, pdu)
+        # The response may arrive before the stash writes complete, so the
+        # PDU must count as outstanding before it goes on the wire.
+        self.service.add_outstanding_pdu(seq_no(pdu.obj))
         self.send_pdu(pdu)
+        yield d
 
     @require_bind
     @inlineCallbacks
@@ -1,5 +1,7 @@
 # -*- test-case-name: vumi.transports.smpp.tests.test_sequence -*-
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, succeed, Deferred)
+from twisted.python.failure import Failure
 
 
 class RedisSequence(object):
@@ -70,7 +72,8 @@ class RedisSequence(object):
             # We didn't actually get the lock, so our job is done.
             return
 
-        if (yield self.redis.get('smpp_last_sequence_number')) < 0xFFFF0000:
+        current = yield self.redis.get('smpp_last_sequence_number')
+        if int(current or 0) < self.rollover_at:
             # Our stored sequence number is no longer outside the allowed
             # range, so someone else must have reset it before we got the lock.
             return
@@ -78,3 +81,93 @@ class RedisSequence(object):
         # We reset the counter by deleting the key. The next INCR will recreate
         # it for us.
         yield self.redis.delete('smpp_last_sequence_number')
+
+
+class BlockRedisSequence(RedisSequence):
+
+    """
+    Generate a sequence of incrementing numbers that rollover at a given
+    limit, reserving them from Redis in blocks.
+
+    Each block of ``block_size`` numbers is reserved with a single
+    ``INCRBY``, and numbers are handed out locally until the block is used
+    up. Processes sharing the counter get disjoint blocks, so numbers are
+    unique but not ordered across processes.
+
+    ``block_size`` must be smaller than ``0xFFFFFFFF - rollover_at`` so that
+    every block that starts below ``rollover_at`` ends in the valid range
+    while the counter is being reset.
+    """
+
+    MAX_SEQUENCE_NUMBER = 0xFFFFFFFF
+
+    def __init__(self, redis, block_size=100, rollover_at=0xFFFF0000):
+        super(BlockRedisSequence, self).__init__(redis, rollover_at)
+        if block_size > self.MAX_SEQUENCE_NUMBER - rollover_at:
+            raise ValueError(
+                "block_size must be at most %d, not %d." % (
+                    self.MAX_SEQUENCE_NUMBER - rollover_at, block_size))
+        self.block_size = block_size
+        self._next = 1
+        self._end = 0
+        self._waiters = []
+        self._filling = False
+
+    def get_next_seq(self):
+        """Get the next available SMPP sequence number.
+
+        Returns a deferred that fires immediately if there are numbers left
+        in the current block. Otherwise a new block is reserved, and
+        concurrent callers all wait for the same reservation.
+        """
+        if self._next <= self._end:
+            seq = self._next
+            self._next += 1
+            return succeed(seq)
+        d = Deferred()
+        self._waiters.append(d)
+        if not self._filling:
+            self._fill_waiters()
+        return d
+
+    @inlineCallbacks
+    def _fill_waiters(self):
+        # Waiters may ask for more numbers when they're called back, so we
+        # use a flag rather than the number of waiters to make sure only one
+        # block is reserved at a time.
+        self._filling = True
+        try:
+            while self._waiters:
+                try:
+                    yield self._reserve_block()
+                except Exception:
+                    waiters, self._waiters = self._waiters, []
+                    failure = Failure()
+                    for d in waiters:
+                        d.errback(failure)
+                    # Anyone who asked again when called back gets a fresh
+                    # attempt.
+                    continue
+                while self._waiters and self._next <= self._end:
+                    seq = self._next
+                    self._next += 1
+                    self._waiters.pop(0).callback(seq)
+        finally:
+            self._filling = False
+
+    @inlineCallbacks
+    def _reserve_block(self):
+        while True:
+            end = yield self.redis.incr(
+                'smpp_last_sequence_number', self.block_size)
+            start = end - self.block_size + 1
+
+            if end >= self.rollover_at:
+                # As in RedisSequence, we try to reset but still use this
+                # block if it's valid.
+                yield self._reset_seq_counter()
+
+            end = min(end, self.MAX_SEQUENCE_NUMBER)
+            if start <= end:
+                self._next, self._end = start, end
+                return
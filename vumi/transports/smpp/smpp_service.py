@@ -1,16 +1,63 @@
 from twisted.internet.defer import inlineCallbacks, returnValue, succeed
-from twisted.internet.task import LoopingCall
 
 from vumi.reconnecting_client import ReconnectingClientService
 from vumi.transports.smpp.protocol import (
     EsmeProtocol, EsmeProtocolFactory, EsmeProtocolError)
-from vumi.transports.smpp.sequence import RedisSequence
+from vumi.transports.smpp.sequence import (
+    RedisSequence, BlockRedisSequence)
 
 
 GSM_MAX_SMS_BYTES = 140
 GSM_MAX_SMS_7BIT_CHARS = 160
 
 
+class TokenBucket(object):
+    """
+    A token bucket that refills smoothly at ``rate`` tokens per second, up to
+    ``capacity`` tokens.
+
+    Taking a token from an empty bucket leaves it in debt rather than
+    failing, so that a multipart message that has started sending can
+    finish. The debt is paid off before any more tokens are available.
+    """
+
+    # Allow for floating point error when refilling.
+    EPSILON = 1e-9
+
+    def __init__(self, rate, capacity, clock):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.clock = clock
+        self.tokens = self.capacity
+        self._last_refill = clock.seconds()
+
+    def _refill(self):
+        now = self.clock.seconds()
+        self.tokens = min(
+            self.capacity,
+            self.tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def take(self):
+        """
+        Take a token from the bucket.
+
+        :returns: ``True`` if there are tokens left afterwards.
+        """
+        self._refill()
+        self.tokens -= 1
+        return self.tokens + self.EPSILON >= 1
+
+    def delay(self):
+        """
+        :returns: The number of seconds until a token is available.
+        """
+        self._refill()
+        if self.tokens + self.EPSILON >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
 class SmppService(ReconnectingClientService):
 
     throttle_statuses = ('ESME_RTHROTTLED', 'ESME_RMSGQFUL')
@@ -22,24 +69,34 @@ class SmppService(ReconnectingClientService):
         self.message_stash = self.transport.message_stash
         self.deliver_sm_processor = self.transport.deliver_sm_processor
         self.dr_processor = self.transport.dr_processor
-        self.sequence_generator = RedisSequence(transport.redis)
+        self.sequence_generator = self.make_sequence_generator(
+            transport.redis)
 
         # Throttling setup.
         self.throttled = False
         self._throttled_pdus = []
         self._unthrottle_delayedCall = None
 
-        self.tps_counter = 0
+        self._throttled_at = None
         self.tps_limit = self.get_config().mt_tps
-        if self.tps_limit > 0:
-            self.mt_tps_lc = LoopingCall(self.reset_mt_tps)
-        else:
-            self.mt_tps_lc = None
+        self.tps_bucket = None
+        self._tps_delayedCall = None
+
+        # Submit window setup.
+        self.window_size = self.get_config().max_outstanding_pdus
+        self.window_full = False
+        self._outstanding_pdus = set()
 
         # Connection setup.
         factory = EsmeProtocolFactory(self, bind_type)
         ReconnectingClientService.__init__(self, endpoint, factory)
 
+    def make_sequence_generator(self, redis):
+        block_size = self.get_config().sequence_block_size
+        if block_size > 1:
+            return BlockRedisSequence(redis, block_size)
+        return RedisSequence(redis)
+
     def get_protocol(self):
         return self._protocol
 
@@ -54,14 +111,16 @@ class SmppService(ReconnectingClientService):
         return False
 
     def startService(self):
-        if self.mt_tps_lc is not None:
-            self.mt_tps_lc.clock = self.clock
-            self.mt_tps_lc.start(1, now=True)
+        if self.tps_limit > 0:
+            self.tps_bucket = TokenBucket(
+                self.tps_limit, self.tps_limit, self.clock)
         return ReconnectingClientService.startService(self)
 
     def stopService(self):
-        if self.mt_tps_lc and self.mt_tps_lc.running:
-            self.mt_tps_lc.stop()
+        if self._tps_delayedCall is not None:
+            if self._tps_delayedCall.active():
+                self._tps_delayedCall.cancel()
+            self._tps_delayedCall = None
         d = succeed(None)
         if self._protocol is not None:
             d.addCallback(lambda _: self._protocol.disconnect())
@@ -71,33 +130,83 @@ class SmppService(ReconnectingClientService):
     def get_config(self):
         return self.transport.get_static_config()
 
-    @inlineCallbacks
-    def reset_mt_tps(self):
-        if self.throttled and self.need_mt_throttling():
-            if not self.is_bound():
-                # We don't have a bound SMPP connection, so try again later.
-                self.log.msg(
-                    "Can't stop throttling while unbound, trying later.")
-                return
-            self.reset_mt_throttle_counter()
-            yield self.stop_throttling()
+    def check_mt_throttling(self):
+        if self.tps_bucket is None:
+            return
+        if not self.tps_bucket.take():
+            # We can't yield here, because we need the current message to
+            # finish sending before it will return.
+            self.start_throttling()
+            self.check_stop_mt_throttling(self.tps_bucket.delay())
+
+    def check_stop_mt_throttling(self, delay):
+        if self._tps_delayedCall is not None:
+            # We already have one of these scheduled.
+            return
+        self._tps_delayedCall = self.clock.callLater(
+            delay, self._check_stop_mt_throttling)
+
+    def _check_stop_mt_throttling(self):
+        """
+        Stop throttling once the tps bucket has a token available again.
+        """
+        self._tps_delayedCall = None
+        if not self.throttled or self._throttled_pdus:
+            # Either we're no longer throttled or the SMSC has throttled us
+            # as well, in which case the retry process will stop throttling.
+            return
+        delay = self.tps_bucket.delay()
+        if delay > 0:
+            self.check_stop_mt_throttling(delay)
+            return
+        if not self.is_bound():
+            # We don't have a bound SMPP connection, so try again later.
+            self.log.msg("Can't stop throttling while unbound, trying later.")
+            self.check_stop_mt_throttling(1)
+            return
+        return self.stop_throttling()
 
-    def reset_mt_throttle_counter(self):
-        self.tps_counter = 0
+    def window_occupancy(self):
+        """
+        :returns: The number of ``submit_sm`` PDUs awaiting a response.
+        """
+        return len(self._outstanding_pdus)
 
-    def incr_mt_throttle_counter(self):
-        self.tps_counter += 1
+    def add_outstanding_pdu(self, seq_no):
+        """
+        Record a ``submit_sm`` PDU that is about to be sent so that it counts
+        towards the submit window until its response arrives.
+        """
+        self._outstanding_pdus.add(seq_no)
+        self._check_window()
 
-    def need_mt_throttling(self):
-        return self.tps_counter >= self.tps_limit
+    def _remove_outstanding_pdu(self, seq_no):
+        self._outstanding_pdus.discard(seq_no)
+        self._check_window()
 
-    def check_mt_throttling(self):
-        if self.get_config().mt_tps > 0:
-            self.incr_mt_throttle_counter()
-            if self.need_mt_throttling():
-                # We can't yield here, because we need the current message to
-                # finish sending before it will return.
-                self.start_throttling()
+    def _check_window(self):
+        """
+        Pause outbound messages while the submit window is full and unpause
+        them when it has room again, unless something else needs them to
+        stay paused.
+        """
+        self.transport.on_window_occupancy(self.window_occupancy())
+        if self.window_size <= 0:
+            return
+        if self.window_occupancy() >= self.window_size:
+            if not self.window_full:
+                self.window_full = True
+                self.transport.pause_outbound()
+        elif self.window_full:
+            self.window_full = False
+            if self.can_send():
+                self.transport.unpause_outbound()
+
+    def can_send(self):
+        """
+        Check whether outbound messages may currently be sent.
+        """
+        return self.is_bound() and not (self.throttled or self.window_full)
 
     def _append_throttle_retry(self, seq_no):
         if seq_no not in self._throttled_pdus:
@@ -147,6 +256,11 @@ class SmppService(ReconnectingClientService):
             return
 
         if not self._throttled_pdus:
+            if self.tps_bucket is not None and self.tps_bucket.delay() > 0:
+                # We're still over our tps limit, so leave it to the tps
+                # check to stop throttling.
+                self.check_stop_mt_throttling(self.tps_bucket.delay())
+                return
             # We have no throttled messages waiting, so stop throttling.
             self.log.msg("No more throttled messages to retry.")
             yield self.stop_throttling()
@@ -173,7 +287,7 @@ class SmppService(ReconnectingClientService):
             pdu_data.pdu.obj['header']['sequence_number'] = new_seq_no
             yield self._protocol.send_submit_sm(
                 pdu_data.vumi_message_id, pdu_data.pdu)
-            yield self.message_stash.delete_cached_pdu(seq_no)
+            yield self.message_stash.delete_submit_sm(seq_no)
 
     @inlineCallbacks
     def start_throttling(self):
@@ -181,7 +295,8 @@ class SmppService(ReconnectingClientService):
             return
         self.log.msg("Throttling outbound messages.")
         self.throttled = True
-        yield self.transport.pause_connectors()
+        self._throttled_at = self.clock.seconds()
+        yield self.transport.pause_outbound()
         yield self.transport.on_throttled()
 
     @inlineCallbacks
@@ -190,12 +305,15 @@ class SmppService(ReconnectingClientService):
             return
         self.log.msg("No longer throttling outbound messages.")
         self.throttled = False
-        self.transport.unpause_connectors()
-        yield self.transport.on_throttled_end()
+        throttled_time = self.clock.seconds() - self._throttled_at
+        self._throttled_at = None
+        if self.can_send():
+            self.transport.unpause_outbound()
+        yield self.transport.on_throttled_end(throttled_time)
 
     @inlineCallbacks
     def on_smpp_bind(self):
-        self.transport.unpause_connectors()
+        self.transport.unpause_outbound()
         yield self.transport.on_smpp_bind()
 
     @inlineCallbacks
@@ -212,10 +330,15 @@ class SmppService(ReconnectingClientService):
 
     @inlineCallbacks
     def on_connection_lost(self, reason):
-        yield self.transport.pause_connectors()
+        # We'll never see responses for PDUs sent over this connection.
+        self._outstanding_pdus.clear()
+        self.window_full = False
+        self.transport.on_window_occupancy(0)
+        yield self.transport.pause_outbound()
         yield self.transport.on_connection_lost(reason)
 
     def handle_submit_sm_resp(self, message_id, smpp_id, pdu_status, seq_no):
+        self._remove_outstanding_pdu(seq_no)
         if pdu_status in self.throttle_statuses:
             return self.handle_submit_sm_throttled(seq_no)
         func = self.transport.handle_submit_sm_failure
@@ -223,8 +346,7 @@ class SmppService(ReconnectingClientService):
             func = self.transport.handle_submit_sm_success
         ms = self.message_stash
         d = func(message_id, smpp_id, pdu_status)
-        d.addCallback(lambda _: ms.delete_cached_pdu(seq_no))
-        d.addCallback(lambda _: ms.delete_sequence_number_message_id(seq_no))
+        d.addCallback(lambda _: ms.delete_submit_sm(seq_no))
         return d.addCallback(self.check_stop_throttling_cb, 0)
 
     def handle_submit_sm_throttled(self, message_id):
@@ -333,7 +455,9 @@ class SmppService(ReconnectingClientService):
         optional_parameters = pdu_params.pop('optional_parameters', {}).copy()
         ref_num = yield self.sequence_generator.next()
         sequence_numbers = []
-        yield self.message_stash.init_multipart_info(
+        # The multipart info doesn't need to be stored before we send the
+        # parts, only before we handle their responses.
+        multipart_d = self.message_stash.init_multipart_info(
             vumi_message_id, len(split_msg))
         for i, msg in enumerate(split_msg):
             pdu_params = pdu_params.copy()
@@ -347,6 +471,7 @@ class SmppService(ReconnectingClientService):
                 vumi_message_id, destination_addr, short_message=msg,
                 optional_parameters=optional_parameters, **pdu_params)
             sequence_numbers.extend(sequence_number)
+        yield multipart_d
         returnValue(sequence_numbers)
 
     @inlineCallbacks
@@ -380,7 +505,9 @@ class SmppService(ReconnectingClientService):
 
         ref_num = yield self.sequence_generator.next()
         sequence_numbers = []
-        yield self.message_stash.init_multipart_info(
+        # The multipart info doesn't need to be stored before we send the
+        # parts, only before we handle their responses.
+        multipart_d = self.message_stash.init_multipart_info(
             vumi_message_id, len(split_msg))
         for i, msg in enumerate(split_msg):
             # 0x40 is the UDHI flag indicating that this payload contains a
@@ -409,4 +536,5 @@ class SmppService(ReconnectingClientService):
                 vumi_message_id, destination_addr, short_message=short_message,
                 **pdu_params)
             sequence_numbers.extend(sequence_number)
+        yield multipart_d
         returnValue(sequence_numbers)
@@ -9,6 +9,8 @@ from twisted.internet.defer import inlineCallbacks, returnValue, succeed
 
 from smpp.pdu import decode_pdu
 from smpp.pdu_builder import PDU
+from vumi.blinkenlights.metrics import (
+    MetricManager, MetricPublisher, Metric, AVG, MAX, SUM)
 from vumi.message import TransportUserMessage
 from vumi.persist.txredis_manager import TxRedisManager
 from vumi.transports.base import Transport
@@ -70,6 +72,17 @@ class CachedPDU(object):
 class SmppMessageDataStash(object):
     """
     Stash message data in Redis.
+
+    Writes that don't depend on each other's results are pipelined so they
+    cost a single Redis round trip. All of the state for a single
+    ``submit_sm`` PDU is written by :meth:`stash_submit_sm` and removed by
+    :meth:`delete_submit_sm`.
+
+    Because Redis handles the commands on a connection in order, a write
+    that has been issued (even if it hasn't completed yet) is visible to
+    every command issued after it. Callers may therefore send a PDU as
+    soon as they have issued the writes for it, as long as they wait for
+    the writes to complete before reporting success.
     """
 
     def __init__(self, redis, config):
@@ -79,11 +92,12 @@ class SmppMessageDataStash(object):
     def init_multipart_info(self, message_id, part_count):
         key = multipart_info_key(message_id)
         expiry = self.config.submit_sm_expiry
-        d = self.redis.hmset(key, {
+        pipe = self.redis.pipeline()
+        pipe.hmset(key, {
             'parts': part_count,
         })
-        d.addCallback(lambda _: self.redis.expire(key, expiry))
-        return d
+        pipe.expire(key, expiry)
+        return pipe.execute()
 
     def get_multipart_info(self, message_id):
         key = multipart_info_key(message_id)
@@ -111,8 +125,10 @@ class SmppMessageDataStash(object):
             return
         part_key = 'part:%s' % (remote_id,)
         mp_info[part_key] = 'fail'
-        d = self.redis.hset(key, part_key, 'fail')
-        d.addCallback(lambda _: self.redis.hset(key, 'event_result', 'fail'))
+        d = self.redis.hmset(key, {
+            part_key: 'fail',
+            'event_result': 'fail',
+        })
         d.addCallback(lambda _: mp_info)
         return d
 
@@ -191,6 +207,29 @@ class SmppMessageDataStash(object):
     def delete_sequence_number_message_id(self, sequence_number):
         return self.redis.delete(sequence_number_key(sequence_number))
 
+    def stash_submit_sm(self, vumi_message_id, pdu):
+        """
+        Cache a ``submit_sm`` PDU and the vumi message_id for its sequence
+        number in a single round trip.
+        """
+        expiry = self.config.submit_sm_expiry
+        cached_pdu = CachedPDU(vumi_message_id, pdu)
+        pipe = self.redis.pipeline()
+        pipe.setex(pdu_key(cached_pdu.seq_no), expiry, cached_pdu.to_json())
+        pipe.setex(
+            sequence_number_key(cached_pdu.seq_no), expiry, vumi_message_id)
+        return pipe.execute()
+
+    def delete_submit_sm(self, seq_no):
+        """
+        Delete everything stored by :meth:`stash_submit_sm` for ``seq_no``
+        in a single round trip.
+        """
+        pipe = self.redis.pipeline()
+        pipe.delete(pdu_key(seq_no))
+        pipe.delete(sequence_number_key(seq_no))
+        return pipe.execute()
+
     def cache_message(self, message):
         key = message_key(message['message_id'])
         expiry = self.config.submit_sm_expiry
@@ -252,10 +291,13 @@ class SmppTransceiverTransport(Transport):
     bind_type = 'TRX'
     clock = reactor
     start_message_consumer = False
+    metrics = None
+    services = ()
+    _throttled_published = False
 
     @property
     def throttled(self):
-        return self.service.throttled
+        return all(service.throttled for service in self.services)
 
     @inlineCallbacks
     def setup_transport(self):
@@ -280,7 +322,26 @@ class SmppTransceiverTransport(Transport):
         self.disable_ack = config.disable_ack
         self.disable_delivery_report = config.disable_delivery_report
         self.message_stash = SmppMessageDataStash(self.redis, config)
-        self.service = self.start_service()
+        yield self.setup_metrics()
+        self.services = []
+        self._next_service_index = 0
+        for _ in range(config.bind_count):
+            self.services.append(self.start_service())
+        # With a single bind, this is the only service we have.
+        self.service = self.services[0]
+
+    @inlineCallbacks
+    def setup_metrics(self):
+        metrics_prefix = self.get_static_config().metrics_prefix
+        if metrics_prefix is None:
+            return
+        publisher = yield self.start_publisher(MetricPublisher)
+        self.metrics = MetricManager(metrics_prefix, publisher=publisher)
+        self.metric_window_occupancy = self.metrics.register(
+            Metric('smpp.window_occupancy', [AVG, MAX]))
+        self.metric_throttled_time = self.metrics.register(
+            Metric('smpp.throttled_time', [SUM]))
+        self.metrics.start_polling()
 
     def start_service(self):
         config = self.get_static_config()
@@ -289,10 +350,49 @@ class SmppTransceiverTransport(Transport):
         service.startService()
         return service
 
+    def get_outbound_service(self):
+        """
+        Choose the bind to send the next outbound message over.
+
+        We prefer binds that can send, and among those the ones with the
+        fewest PDUs awaiting responses. Ties are broken round-robin so that
+        each bind's tps allowance gets used. If no bind can send, we fall
+        back to a bound one (or just the first one) and let it complain.
+        """
+        if len(self.services) == 1:
+            return self.service
+        index = self._next_service_index
+        self._next_service_index = (index + 1) % len(self.services)
+        services = self.services[index:] + self.services[:index]
+        candidates = [service for service in services if service.can_send()]
+        if not candidates:
+            candidates = [
+                service for service in services if service.is_bound()]
+        if not candidates:
+            return services[0]
+        return min(candidates, key=lambda service: service.window_occupancy())
+
+    def pause_outbound(self):
+        """
+        Called by a bind that can no longer send. Outbound messages are only
+        paused if none of our binds can send them.
+        """
+        if any(service.can_send() for service in self.services):
+            return succeed(None)
+        return self.pause_connectors()
+
+    def unpause_outbound(self):
+        """
+        Called by a bind that can send again.
+        """
+        self.unpause_connectors()
+
     @inlineCallbacks
     def teardown_transport(self):
-        if self.service:
-            yield self.service.stopService()
+        for service in self.services:
+            yield service.stopService()
+        if self.metrics is not None:
+            self.metrics.stop_polling()
         yield self.redis._close()
 
     def _check_address_valid(self, message, field):
@@ -306,13 +406,25 @@ class SmppTransceiverTransport(Transport):
         return self.publish_nack(
             message['message_id'], u'Invalid %s: %s' % (field, message[field]))
 
+    def bound_count(self):
+        """
+        Return the number of our binds that are bound.
+        """
+        return len([service for service in self.services
+                    if service.is_bound()])
+
     @inlineCallbacks
     def on_smpp_binding(self):
-        yield self.publish_status_binding()
+        # Another bind may still be sending messages, in which case we
+        # aren't down.
+        if self.bound_count() == 0:
+            yield self.publish_status_binding()
 
     @inlineCallbacks
     def on_smpp_unbinding(self):
-        yield self.publish_status_unbinding()
+        # The bind that is unbinding is still bound at this point.
+        if self.bound_count() <= 1:
+            yield self.publish_status_unbinding()
 
     @inlineCallbacks
     def on_smpp_bind(self):
@@ -323,23 +435,36 @@ class SmppTransceiverTransport(Transport):
 
     @inlineCallbacks
     def on_throttled(self):
-        yield self.publish_throttled()
+        # The transport is only throttled once all its binds are.
+        if self.throttled:
+            yield self.publish_throttled()
 
     @inlineCallbacks
     def on_throttled_resume(self):
-        yield self.publish_throttled()
+        if self.throttled:
+            yield self.publish_throttled()
 
     @inlineCallbacks
-    def on_throttled_end(self):
-        yield self.publish_throttled_end()
+    def on_throttled_end(self, throttled_time):
+        if self.metrics is not None:
+            self.metric_throttled_time.set(throttled_time)
+        if self._throttled_published and not self.throttled:
+            yield self.publish_throttled_end()
+
+    def on_window_occupancy(self, outstanding):
+        if self.metrics is not None:
+            self.metric_window_occupancy.set(sum(
+                service.window_occupancy() for service in self.services))
 
     @inlineCallbacks
     def on_smpp_bind_timeout(self):
-        yield self.publish_status_bind_timeout()
+        yield self.publish_status_bind_timeout(
+            'degraded' if self.bound_count() else 'down')
 
     @inlineCallbacks
     def on_connection_lost(self, reason):
-        yield self.publish_status_connection_lost(reason)
+        yield self.publish_status_connection_lost(
+            reason, 'degraded' if self.bound_count() else 'down')
 
     def publish_status_starting(self):
         return self.publish_status(
@@ -370,6 +495,7 @@ class SmppTransceiverTransport(Transport):
             message='Bound')
 
     def publish_throttled(self):
+        self._throttled_published = True
         return self.publish_status(
             status='degraded',
             component='smpp',
@@ -377,22 +503,23 @@ class SmppTransceiverTransport(Transport):
             message='Throttled')
 
     def publish_throttled_end(self):
+        self._throttled_published = False
         return self.publish_status(
             status='ok',
             component='smpp',
             type='throttled_end',
             message='No longer throttled')
 
-    def publish_status_bind_timeout(self):
+    def publish_status_bind_timeout(self, status='down'):
         return self.publish_status(
-            status='down',
+            status=status,
             component='smpp',
             type='bind_timeout',
             message='Timed out awaiting bind')
 
-    def publish_status_connection_lost(self, reason):
+    def publish_status_connection_lost(self, reason, status='down'):
         return self.publish_status(
-            status='down',
+            status=status,
             component='smpp',
             type='connection_lost',
             message=str(reason.value))
@@ -407,7 +534,7 @@ class SmppTransceiverTransport(Transport):
             return
         yield self.message_stash.cache_message(message)
         yield self.submit_sm_processor.handle_outbound_message(
-            message, self.service)
+            message, self.get_outbound_service())
 
     @inlineCallbacks
     def process_submit_sm_event(self, message_id, event_type, remote_id,
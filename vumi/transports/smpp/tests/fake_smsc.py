@@ -1,7 +1,7 @@
 # -*- test-case-name: vumi.transports.smpp.tests.test_fake_smsc -*-
 
 from twisted.internet.defer import (
-    Deferred, succeed, DeferredQueue, gatherResults)
+    Deferred, succeed, fail, DeferredQueue, gatherResults)
 from twisted.internet.error import ConnectionRefusedError
 from twisted.internet.interfaces import IStreamClientEndpoint
 from twisted.internet.protocol import Protocol
@@ -287,6 +287,22 @@ class FakeSMSCEndpoint(object):
         return client
 
 
+@implementer(IStreamClientEndpoint)
+class FakeSMSCPoolEndpoint(object):
+    """
+    This endpoint connects each client to the first of several FakeSMSCs
+    that doesn't already have a client.
+    """
+    def __init__(self, fake_smscs):
+        self.fake_smscs = fake_smscs
+
+    def connect(self, protocolFactory):
+        for fake_smsc in self.fake_smscs:
+            if fake_smsc.protocol is None:
+                return fake_smsc.endpoint.connect(protocolFactory)
+        return fail(ConnectionRefusedError())
+
+
 class FakeSMSCProtocol(Protocol):
     """
     Very simple protocol for pretending to be an SMSC.
@@ -9,7 +9,8 @@ from smpp.pdu_builder import (
     BindReceiver, BindReceiverResp, EnquireLink, EnquireLinkResp, DeliverSM,
     Unbind, UnbindResp, SubmitSM, SubmitSMResp)
 from vumi.tests.helpers import VumiTestCase
-from vumi.transports.smpp.tests.fake_smsc import FakeSMSC
+from vumi.transports.smpp.tests.fake_smsc import (
+    FakeSMSC, FakeSMSCPoolEndpoint)
 
 
 def wait0():
@@ -86,6 +87,23 @@ class TestFakeSMSC(VumiTestCase):
         self.assertNoResult(connect_d)
         self.assertEqual(client.connected, False)
 
+    def test_pool_endpoint(self):
+        """
+        A pool endpoint connects each client to the first FakeSMSC that
+        doesn't have one, and refuses connections once they all do.
+        """
+        fake_smsc1 = FakeSMSC()
+        fake_smsc2 = FakeSMSC()
+        endpoint = FakeSMSCPoolEndpoint([fake_smsc1, fake_smsc2])
+
+        client1 = self.successResultOf(endpoint.connect(FakeESMEFactory()))
+        self.assertEqual(fake_smsc1._client_protocol, client1)
+        self.assertEqual(fake_smsc2._client_protocol, None)
+        client2 = self.successResultOf(endpoint.connect(FakeESMEFactory()))
+        self.assertEqual(fake_smsc2._client_protocol, client2)
+        self.failureResultOf(
+            endpoint.connect(FakeESMEFactory()), ConnectionRefusedError)
+
     def test_await_connected(self):
         """
         The caller can wait for a client to connect.
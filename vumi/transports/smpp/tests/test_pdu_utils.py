@@ -0,0 +1,36 @@
+from smpp.pdu_builder import DeliverSM, EnquireLink
+
+from vumi.tests.helpers import VumiTestCase
+from vumi.transports.smpp.pdu_utils import split_pdu_stream
+
+
+class TestSplitPduStream(VumiTestCase):
+
+    def test_empty(self):
+        self.assertEqual(split_pdu_stream(bytearray()), ([], 0))
+
+    def test_incomplete_header(self):
+        data = bytearray(EnquireLink(1).get_bin()[:10])
+        self.assertEqual(split_pdu_stream(data), ([], 0))
+
+    def test_incomplete_pdu(self):
+        data = bytearray(DeliverSM(1, short_message='foo').get_bin()[:-1])
+        self.assertEqual(split_pdu_stream(data), ([], 0))
+
+    def test_multiple_pdus(self):
+        pdu1 = DeliverSM(1, short_message='foo').get_bin()
+        pdu2 = EnquireLink(2).get_bin()
+        pdu3 = DeliverSM(3, short_message='bar').get_bin()
+        data = bytearray(pdu1 + pdu2 + pdu3[:20])
+        pdus, consumed = split_pdu_stream(data)
+        self.assertEqual(pdus, [pdu1, pdu2])
+        self.assertEqual(consumed, len(pdu1) + len(pdu2))
+        self.assertEqual(type(pdus[0]), str)
+
+    def test_str(self):
+        pdu = EnquireLink(1).get_bin()
+        self.assertEqual(split_pdu_stream(pdu + pdu), ([pdu, pdu], 32))
+
+    def test_invalid_command_length(self):
+        data = bytearray('\x00\x00\x00\x08' + '\x00' * 12)
+        self.assertRaises(ValueError, split_pdu_stream, data)
@@ -56,6 +56,9 @@ class DummySmppService(object):
     def on_smpp_bind_timeout(self):
         pass
 
+    def add_outstanding_pdu(self, seq_no):
+        pass
+
 
 class TestEsmeProtocol(VumiTestCase):
 
@@ -361,6 +364,24 @@ class TestEsmeProtocol(VumiTestCase):
         self.assertEqual(seq_no(handled_pdu), 1)
         self.assertEqual(short_message(handled_pdu), 'foo')
 
+    @inlineCallbacks
+    def test_multiple_pdus_data_received(self):
+        protocol = yield self.get_protocol()
+        calls = []
+        protocol.handle_deliver_sm = calls.append
+        yield self.fake_smsc.bind()
+        pdus = [DeliverSM(i, short_message='foo %d' % (i,)).get_bin()
+                for i in range(1, 4)]
+        data = ''.join(pdus)
+        yield self.fake_smsc.send_bytes(data[:-5])
+        self.assertEqual([seq_no(pdu) for pdu in calls], [1, 2])
+        self.assertEqual(protocol.buffer, data[-len(pdus[2]):-5])
+        yield self.fake_smsc.send_bytes(data[-5:])
+        self.assertEqual([seq_no(pdu) for pdu in calls], [1, 2, 3])
+        self.assertEqual(
+            [short_message(pdu) for pdu in calls], ['foo 1', 'foo 2', 'foo 3'])
+        self.assertEqual(protocol.buffer, '')
+
     @inlineCallbacks
     def test_unsupported_command_id(self):
         protocol = yield self.get_protocol()
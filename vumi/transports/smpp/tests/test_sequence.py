@@ -1,7 +1,7 @@
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, gatherResults
 
 from vumi.tests.helpers import VumiTestCase, PersistenceHelper
-from vumi.transports.smpp.sequence import RedisSequence
+from vumi.transports.smpp.sequence import RedisSequence, BlockRedisSequence
 
 
 class EsmeTestCase(VumiTestCase):
@@ -36,3 +36,97 @@ class EsmeTestCase(VumiTestCase):
         self.assertEqual((yield sequence_generator.next()), 2)
         self.assertEqual((yield sequence_generator.next()), 3)
         self.assertEqual((yield sequence_generator.next()), 1)
+
+    @inlineCallbacks
+    def test_rollover_after_reset_by_someone_else(self):
+        sequence_generator = RedisSequence(self.redis, rollover_at=3)
+        yield self.redis.set('smpp_last_sequence_number', 2)
+        yield self.redis.set('smpp_last_sequence_number_wrap', 1)
+        self.assertEqual((yield sequence_generator.next()), 3)
+        yield self.redis.set('smpp_last_sequence_number', 1)
+        yield self.redis.delete('smpp_last_sequence_number_wrap')
+        yield sequence_generator._reset_seq_counter()
+        self.assertEqual(
+            (yield self.redis.get('smpp_last_sequence_number')), '1')
+
+
+class TestBlockRedisSequence(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+
+    @inlineCallbacks
+    def test_next(self):
+        sequence_generator = BlockRedisSequence(self.redis, block_size=10)
+        self.assertEqual((yield sequence_generator.next()), 1)
+        self.assertEqual((yield sequence_generator.next()), 2)
+        self.assertEqual(
+            (yield self.redis.get('smpp_last_sequence_number')), '10')
+
+    @inlineCallbacks
+    def test_reserves_new_block(self):
+        sequence_generator = BlockRedisSequence(self.redis, block_size=2)
+        seqs = []
+        for _ in range(5):
+            seqs.append((yield sequence_generator.next()))
+        self.assertEqual(seqs, [1, 2, 3, 4, 5])
+        self.assertEqual(
+            (yield self.redis.get('smpp_last_sequence_number')), '6')
+
+    @inlineCallbacks
+    def test_concurrent_callers(self):
+        sequence_generator = BlockRedisSequence(self.redis, block_size=2)
+        seqs = yield gatherResults(
+            [sequence_generator.next() for _ in range(5)])
+        self.assertEqual(seqs, [1, 2, 3, 4, 5])
+        self.assertEqual(
+            (yield self.redis.get('smpp_last_sequence_number')), '6')
+
+    @inlineCallbacks
+    def test_shared_counter(self):
+        seq_gen_1 = BlockRedisSequence(self.redis, block_size=3)
+        seq_gen_2 = BlockRedisSequence(self.redis, block_size=3)
+        seqs = []
+        for _ in range(4):
+            seqs.append((yield seq_gen_1.next()))
+            seqs.append((yield seq_gen_2.next()))
+        self.assertEqual(seqs, [1, 4, 2, 5, 3, 6, 7, 10])
+
+    @inlineCallbacks
+    def test_rollover(self):
+        sequence_generator = BlockRedisSequence(
+            self.redis, block_size=2, rollover_at=5)
+        seqs = []
+        for _ in range(8):
+            seqs.append((yield sequence_generator.next()))
+        self.assertEqual(seqs, [1, 2, 3, 4, 5, 6, 1, 2])
+
+    @inlineCallbacks
+    def test_block_clipped_at_max_sequence_number(self):
+        sequence_generator = BlockRedisSequence(self.redis, block_size=10)
+        yield self.redis.set('smpp_last_sequence_number', 0xFFFFFFFF - 5)
+        seqs = []
+        for _ in range(6):
+            seqs.append((yield sequence_generator.next()))
+        self.assertEqual(seqs, [
+            0xFFFFFFFF - 4, 0xFFFFFFFF - 3, 0xFFFFFFFF - 2, 0xFFFFFFFF - 1,
+            0xFFFFFFFF, 1])
+
+    def test_block_size_too_big(self):
+        self.assertRaises(
+            ValueError, BlockRedisSequence, self.redis, block_size=0x10000)
+
+    @inlineCallbacks
+    def test_redis_failure(self):
+        sequence_generator = BlockRedisSequence(self.redis, block_size=2)
+
+        def broken_incr(key, amount):
+            raise Exception("Redis is down")
+
+        self.patch(self.redis, 'incr', broken_incr)
+        d1 = sequence_generator.next()
+        d2 = sequence_generator.next()
+        yield self.assertFailure(d1, Exception)
+        yield self.assertFailure(d2, Exception)
@@ -8,10 +8,11 @@ from vumi.tests.helpers import VumiTestCase, PersistenceHelper, skiptest
 from vumi.transports.smpp.smpp_transport import (
     SmppTransceiverTransport, SmppMessageDataStash, pdu_key)
 from vumi.transports.smpp.protocol import EsmeProtocol, EsmeProtocolError
-from vumi.transports.smpp.smpp_service import SmppService
+from vumi.transports.smpp.smpp_service import SmppService, TokenBucket
 from vumi.transports.smpp.pdu_utils import (
     command_id, unpacked_pdu_opts, short_message)
-from vumi.transports.smpp.sequence import RedisSequence
+from vumi.transports.smpp.sequence import (
+    RedisSequence, BlockRedisSequence)
 from vumi.transports.smpp.tests.fake_smsc import FakeSMSC
 
 
@@ -41,10 +42,10 @@ class DummySmppTransport(object):
     def get_static_config(self):
         return self._static_config
 
-    def pause_connectors(self):
+    def pause_outbound(self):
         self.paused = True
 
-    def unpause_connectors(self):
+    def unpause_outbound(self):
         self.paused = False
 
     def on_smpp_binding(self):
@@ -62,9 +63,54 @@ class DummySmppTransport(object):
     def on_throttled(self):
         pass
 
-    def on_throttled_end(self):
+    def on_throttled_end(self, throttled_time):
         pass
 
+    def on_window_occupancy(self, outstanding):
+        pass
+
+
+class TestTokenBucket(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+
+    def test_take(self):
+        """
+        Tokens can be taken until the bucket is empty.
+        """
+        bucket = TokenBucket(2, 2, self.clock)
+        self.assertEqual(bucket.take(), True)
+        self.assertEqual(bucket.take(), False)
+        self.assertEqual(bucket.delay(), 0.5)
+
+    def test_refill(self):
+        """
+        Tokens are refilled smoothly, up to the bucket's capacity.
+        """
+        bucket = TokenBucket(4, 2, self.clock)
+        bucket.take()
+        bucket.take()
+        self.clock.advance(0.25)
+        self.assertEqual(bucket.delay(), 0)
+        self.assertEqual(bucket.take(), False)
+        self.clock.advance(10)
+        self.assertEqual(bucket.delay(), 0)
+        self.assertEqual(bucket.tokens, 2)
+
+    def test_debt(self):
+        """
+        Taking a token from an empty bucket leaves it in debt, which must be
+        paid off before another token is available.
+        """
+        bucket = TokenBucket(2, 2, self.clock)
+        for i in range(4):
+            bucket.take()
+        self.assertEqual(bucket.tokens, -2)
+        self.assertEqual(bucket.delay(), 1.5)
+        self.clock.advance(1.5)
+        self.assertEqual(bucket.delay(), 0)
+
 
 class TestSmppService(VumiTestCase):
 
@@ -192,6 +238,46 @@ class TestSmppService(VumiTestCase):
         stored_ids = yield self.lookup_message_ids(service, seq_nums)
         self.assertEqual(['abc123'], stored_ids)
 
+    @inlineCallbacks
+    def test_submit_sm_with_block_sequence(self):
+        """
+        Sequence numbers can be reserved from Redis in blocks.
+        """
+        service = yield self.get_service({'sequence_block_size': 10})
+        self.assertTrue(
+            isinstance(service.sequence_generator, BlockRedisSequence))
+        yield self.fake_smsc.bind()
+
+        seq_nums = []
+        for i in range(3):
+            seq_nums.extend((yield service.submit_sm(
+                'abc%d' % (i,), 'dest_addr', short_message='foo')))
+        stored_ids = yield self.lookup_message_ids(service, seq_nums)
+        self.assertEqual(['abc0', 'abc1', 'abc2'], stored_ids)
+        self.assertEqual(
+            (yield self.redis.get('smpp_last_sequence_number')), '10')
+
+    @inlineCallbacks
+    def test_submit_sm_window(self):
+        """
+        Connectors are paused while the submit window is full.
+        """
+        service = yield self.get_service({'max_outstanding_pdus': 2})
+        yield self.fake_smsc.bind()
+        self.assertEqual(service.transport.paused, False)
+
+        yield service.submit_sm('abc1', 'dest_addr', short_message='foo')
+        self.assertEqual(service.window_occupancy(), 1)
+        self.assertEqual(service.transport.paused, False)
+        seq_nums = yield service.submit_sm(
+            'abc2', 'dest_addr', short_message='foo')
+        self.assertEqual(service.window_occupancy(), 2)
+        self.assertEqual(service.transport.paused, True)
+
+        service._remove_outstanding_pdu(seq_nums[0])
+        self.assertEqual(service.window_occupancy(), 1)
+        self.assertEqual(service.transport.paused, False)
+
     @inlineCallbacks
     def test_submit_sm_unbound(self):
         """
@@ -486,3 +572,31 @@ class TestSmppService(VumiTestCase):
         yield message_stash.delete_cached_pdu(1337)
         deleted_pdu_data = yield message_stash.get_cached_pdu(1337)
         self.assertEqual(deleted_pdu_data, None)
+
+    @inlineCallbacks
+    def test_submit_sm_stash(self):
+        """
+        All the state for a submit_sm PDU is stashed together and can be
+        deleted together.
+        """
+        service = yield self.get_service()
+
+        message_stash = service.message_stash
+        config = service.get_config()
+
+        pdu = SubmitSM(1337, short_message="foo")
+        yield message_stash.stash_submit_sm("vumi0", pdu)
+
+        pdu_data = yield message_stash.get_cached_pdu(1337)
+        self.assertEqual(pdu_data.vumi_message_id, "vumi0")
+        self.assertEqual(pdu_data.pdu.get_hex(), pdu.get_hex())
+        message_id = yield message_stash.get_sequence_number_message_id(1337)
+        self.assertEqual(message_id, "vumi0")
+        for key in [pdu_key(1337), 'sequence_number:1337']:
+            ttl = yield message_stash.redis.ttl(key)
+            self.assertTrue(0 < ttl <= config.submit_sm_expiry)
+
+        yield message_stash.delete_submit_sm(1337)
+        self.assertEqual((yield message_stash.get_cached_pdu(1337)), None)
+        self.assertEqual(
+            (yield message_stash.get_sequence_number_message_id(1337)), None)
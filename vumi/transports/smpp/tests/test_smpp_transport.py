@@ -2,7 +2,7 @@
 
 import logging
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import Deferred, inlineCallbacks, returnValue
 from twisted.internet.task import Clock
 
 from smpp.pdu_builder import DeliverSM, SubmitSMResp
@@ -17,7 +17,8 @@ from vumi.transports.smpp.smpp_transport import (
 from vumi.transports.smpp.pdu_utils import (
     pdu_ok, short_message, command_id, seq_no, pdu_tlv, unpacked_pdu_opts)
 from vumi.transports.smpp.processors import SubmitShortMessageProcessor
-from vumi.transports.smpp.tests.fake_smsc import FakeSMSC
+from vumi.transports.smpp.tests.fake_smsc import (
+    FakeSMSC, FakeSMSCPoolEndpoint, wait0)
 from vumi.transports.tests.helpers import TransportHelper
 
 
@@ -47,6 +48,20 @@ class TestSmppTransportConfig(VumiTestCase):
         cfg = {'host': 'example.com', 'port': 1337}
         self.assertNotEqual(parse_config(cfg).twisted_endpoint.connect, None)
 
+    def test_bind_count_too_small(self):
+        config = {
+            'transport_name': 'name',
+            'system_id': 'foo',
+            'password': 'bar',
+            'twisted_endpoint': 'tcp:host=example.com:port=1337',
+        }
+        config_class = SmppTransceiverTransport.CONFIG_CLASS
+        self.assertEqual(config_class(config, static=True).bind_count, 1)
+        for bind_count in [0, -1]:
+            config['bind_count'] = bind_count
+            self.assertRaises(
+                ConfigError, config_class, config, static=True)
+
 
 class SmppTransportTestCase(VumiTestCase):
 
@@ -1038,6 +1053,133 @@ class SmppTransceiverTransportTestCase(SmppTransportTestCase):
         self.assertEqual(short_message(pdu3_1)[-5:], '33333')
         self.assertEqual(short_message(pdu3_2)[-5:], '3333c')
 
+    @inlineCallbacks
+    def test_mt_sms_tps_limits_smooth(self):
+        """
+        TPS throttling refills tokens smoothly rather than once a second.
+        """
+        transport = yield self.get_transport({'mt_tps': 4})
+
+        for i in range(4):
+            yield self.tx_helper.make_dispatch_outbound('hello %d' % (i,))
+        self.assertTrue(transport.throttled)
+        msg5_d = self.tx_helper.make_dispatch_outbound('hello 4')
+        yield self.fake_smsc.await_pdus(4)
+
+        self.clock.advance(0.2)
+        self.assertTrue(transport.throttled)
+        self.assertNoResult(msg5_d)
+        self.clock.advance(0.05)
+        self.assertFalse(transport.throttled)
+        yield msg5_d
+        submit_sm_pdu5 = yield self.fake_smsc.await_pdu()
+        self.assertEqual(short_message(submit_sm_pdu5), 'hello 4')
+
+    @inlineCallbacks
+    def test_mt_sms_submit_window(self):
+        """
+        Outbound messages are paused while the maximum number of submit_sm
+        PDUs are awaiting responses.
+        """
+        transport = yield self.get_transport({'max_outstanding_pdus': 2})
+
+        yield self.tx_helper.make_dispatch_outbound('hello world 1')
+        yield self.tx_helper.make_dispatch_outbound('hello world 2')
+        msg3_d = self.tx_helper.make_dispatch_outbound('hello world 3')
+        [submit_sm_pdu1, submit_sm_pdu2] = yield self.fake_smsc.await_pdus(2)
+        self.assertEqual(transport.service.window_occupancy(), 2)
+        self.assertTrue(transport.service.window_full)
+        self.assertNoResult(msg3_d)
+
+        yield self.fake_smsc.submit_sm_resp(submit_sm_pdu2)
+        yield msg3_d
+        submit_sm_pdu3 = yield self.fake_smsc.await_pdu()
+        self.assertEqual(short_message(submit_sm_pdu3), 'hello world 3')
+        self.assertEqual(transport.service.window_occupancy(), 2)
+        self.assertTrue(transport.service.window_full)
+
+    @inlineCallbacks
+    def test_mt_sms_submit_window_reconnect(self):
+        """
+        PDUs sent over a lost connection no longer count towards the submit
+        window.
+        """
+        transport = yield self.get_transport({'max_outstanding_pdus': 1})
+
+        yield self.tx_helper.make_dispatch_outbound('hello world 1')
+        msg2_d = self.tx_helper.make_dispatch_outbound('hello world 2')
+        yield self.fake_smsc.await_pdu()
+        self.assertTrue(transport.service.window_full)
+
+        yield self.fake_smsc.disconnect()
+        self.assertEqual(transport.service.window_occupancy(), 0)
+        self.assertFalse(transport.service.window_full)
+        self.assertNoResult(msg2_d)
+
+        self.clock.advance(transport.service.delay)
+        yield self.fake_smsc.bind()
+        yield msg2_d
+        submit_sm_pdu2 = yield self.fake_smsc.await_pdu()
+        self.assertEqual(short_message(submit_sm_pdu2), 'hello world 2')
+
+    @inlineCallbacks
+    def test_mt_sms_submit_window_fast_response(self):
+        """
+        A submit_sm_resp that arrives before the stash writes for its PDU
+        have completed still frees the PDU's place in the submit window.
+        """
+        transport = yield self.get_transport({'max_outstanding_pdus': 2})
+        stash = transport.service.message_stash
+        stash_submit_sm = stash.stash_submit_sm
+        stash_written = Deferred()
+        self.patch(
+            stash, 'stash_submit_sm',
+            lambda *args: stash_submit_sm(*args).addCallback(
+                lambda _: stash_written))
+
+        msg_d = self.tx_helper.make_dispatch_outbound('hello world')
+        submit_sm_pdu = yield self.fake_smsc.await_pdu()
+        self.assertEqual(transport.service.window_occupancy(), 1)
+        yield self.fake_smsc.submit_sm_resp(submit_sm_pdu)
+        [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(ack['event_type'], 'ack')
+        self.assertNoResult(msg_d)
+
+        stash_written.callback(None)
+        yield msg_d
+        self.assertEqual(transport.service.window_occupancy(), 0)
+        self.assertFalse(transport.service.window_full)
+
+    @inlineCallbacks
+    def test_flow_control_metrics(self):
+        """
+        Submit window occupancy and time spent throttled are published as
+        metrics if a metrics prefix is configured.
+        """
+        transport = yield self.get_transport({
+            'mt_tps': 2,
+            'metrics_prefix': 'smpp_metrics.',
+        })
+
+        yield self.tx_helper.make_dispatch_outbound('hello world 1')
+        yield self.tx_helper.make_dispatch_outbound('hello world 2')
+        msg3_d = self.tx_helper.make_dispatch_outbound('hello world 3')
+        [submit_sm_pdu1, _] = yield self.fake_smsc.await_pdus(2)
+        yield self.fake_smsc.submit_sm_resp(submit_sm_pdu1)
+        yield self.tx_helper.wait_for_dispatched_events(1)
+        self.clock.advance(0.5)
+        yield msg3_d
+        yield self.fake_smsc.await_pdu()
+
+        transport.metrics.publish_metrics()
+        [datapoints] = yield self.tx_helper.wait_for_dispatched_metrics()
+        values = dict(
+            (name, [value for _, value in points])
+            for name, _, points in datapoints)
+        self.assertEqual(
+            values['smpp_metrics.smpp.window_occupancy'], [1, 2, 1, 2])
+        self.assertEqual(values['smpp_metrics.smpp.throttled_time'], [0.5])
+
     @inlineCallbacks
     def test_mt_sms_reconnect_while_tps_throttled(self):
         """
@@ -1990,7 +2132,9 @@ class SmppTransceiverTransportTestCase(SmppTransportTestCase):
         self.tx_helper.make_dispatch_outbound('hello world 3')
         yield self.fake_smsc.await_pdus(2)
 
-        # We can't wait here because that requires throttling to end.
+        # We can't wait here because that requires throttling to end, but we
+        # need to give the throttled status a chance to be published.
+        yield wait0()
         [msg] = self.tx_helper.get_dispatched_statuses()
         self.assertEqual(msg['status'], 'degraded')
         self.assertEqual(msg['component'], 'smpp')
@@ -2038,6 +2182,187 @@ class SmppTransceiverTransportTestCase(SmppTransportTestCase):
         self.assertEqual(msg3['type'], 'throttled')
         self.assertEqual(msg3['message'], 'Throttled')
 
+    @inlineCallbacks
+    def get_multi_bind_transport(self, config={}):
+        """
+        Get a transport with a bind to each of two fake SMSCs.
+        """
+        self.fake_smsc2 = FakeSMSC()
+        cfg = {
+            'bind_count': 2,
+            'twisted_endpoint': FakeSMSCPoolEndpoint(
+                [self.fake_smsc, self.fake_smsc2]),
+        }
+        cfg.update(config)
+        transport = yield self.get_transport(cfg, bind=False)
+        yield self.fake_smsc.bind()
+        yield self.fake_smsc2.bind()
+        returnValue(transport)
+
+    @inlineCallbacks
+    def test_multi_bind(self):
+        """
+        Outbound messages are spread across binds and their responses are
+        handled by whichever bind they were sent over.
+        """
+        transport = yield self.get_multi_bind_transport()
+        self.assertEqual(len(transport.services), 2)
+        self.assertTrue(all(s.is_bound() for s in transport.services))
+
+        msg1 = yield self.tx_helper.make_dispatch_outbound('hello 1')
+        msg2 = yield self.tx_helper.make_dispatch_outbound('hello 2')
+        submit_sm1 = yield self.fake_smsc.await_pdu()
+        submit_sm2 = yield self.fake_smsc2.await_pdu()
+        self.assertEqual(short_message(submit_sm1), 'hello 1')
+        self.assertEqual(short_message(submit_sm2), 'hello 2')
+        self.assertNotEqual(seq_no(submit_sm1), seq_no(submit_sm2))
+
+        yield self.fake_smsc2.submit_sm_resp(submit_sm2, message_id='id2')
+        yield self.fake_smsc.submit_sm_resp(submit_sm1, message_id='id1')
+        [ack2, ack1] = yield self.tx_helper.wait_for_dispatched_events(2)
+        self.assertEqual(ack1['user_message_id'], msg1['message_id'])
+        self.assertEqual(ack1['sent_message_id'], 'id1')
+        self.assertEqual(ack2['user_message_id'], msg2['message_id'])
+        self.assertEqual(ack2['sent_message_id'], 'id2')
+
+    @inlineCallbacks
+    def test_multi_bind_prefers_window_room(self):
+        """
+        Outbound messages go to the bind with the fewest PDUs awaiting
+        responses, even when it isn't that bind's turn.
+        """
+        transport = yield self.get_multi_bind_transport()
+        [service1, service2] = transport.services
+
+        for i in [1, 2, 3]:
+            yield self.tx_helper.make_dispatch_outbound('hello %d' % (i,))
+        [submit_sm1, submit_sm3] = yield self.fake_smsc.await_pdus(2)
+        yield self.fake_smsc2.await_pdu()
+        yield self.fake_smsc.submit_sm_resp(submit_sm1)
+        yield self.fake_smsc.submit_sm_resp(submit_sm3)
+        yield self.tx_helper.wait_for_dispatched_events(2)
+        self.assertEqual(service1.window_occupancy(), 0)
+        self.assertEqual(service2.window_occupancy(), 1)
+
+        # It's service2's turn, but service1 has more room.
+        yield self.tx_helper.make_dispatch_outbound('hello 4')
+        submit_sm4 = yield self.fake_smsc.await_pdu()
+        self.assertEqual(short_message(submit_sm4), 'hello 4')
+        self.assertEqual(self.fake_smsc2.waiting_pdu_count(), 0)
+
+    @inlineCallbacks
+    def test_multi_bind_connection_lost(self):
+        """
+        Outbound messages keep flowing over the remaining binds when one of
+        them is lost.
+        """
+        transport = yield self.get_multi_bind_transport()
+
+        yield self.fake_smsc2.disconnect()
+        [service1, service2] = transport.services
+        self.assertFalse(service2.is_bound())
+        self.assertTrue(service1.is_bound())
+
+        yield self.tx_helper.make_dispatch_outbound('hello 1')
+        yield self.tx_helper.make_dispatch_outbound('hello 2')
+        [submit_sm1, submit_sm2] = yield self.fake_smsc.await_pdus(2)
+        self.assertEqual(short_message(submit_sm1), 'hello 1')
+        self.assertEqual(short_message(submit_sm2), 'hello 2')
+
+        # Once the second bind is back, it gets used again.
+        self.clock.advance(service2.delay)
+        yield self.fake_smsc2.bind()
+        yield self.tx_helper.make_dispatch_outbound('hello 3')
+        yield self.tx_helper.make_dispatch_outbound('hello 4')
+        submit_sm3 = yield self.fake_smsc2.await_pdu()
+        self.assertTrue(short_message(submit_sm3) in ['hello 3', 'hello 4'])
+
+    @inlineCallbacks
+    def test_multi_bind_throttling(self):
+        """
+        A bind that is throttled doesn't stop the others from sending, and
+        the transport is only throttled once all its binds are.
+        """
+        transport = yield self.get_multi_bind_transport({'mt_tps': 1})
+
+        yield self.tx_helper.make_dispatch_outbound('hello 1')
+        self.assertEqual(
+            [s.throttled for s in transport.services], [True, False])
+        self.assertFalse(transport.throttled)
+        yield self.tx_helper.make_dispatch_outbound('hello 2')
+        self.assertTrue(transport.throttled)
+        msg3_d = self.tx_helper.make_dispatch_outbound('hello 3')
+        yield self.fake_smsc.await_pdu()
+        yield self.fake_smsc2.await_pdu()
+        self.assertNoResult(msg3_d)
+
+        self.clock.advance(1)
+        self.assertFalse(transport.throttled)
+        yield msg3_d
+
+    @inlineCallbacks
+    def test_multi_bind_connection_lost_status(self):
+        """
+        The transport is only down once all its binds are lost.
+        """
+        transport = yield self.get_multi_bind_transport(
+            {'publish_status': True})
+        [service1, service2] = transport.services
+        self.tx_helper.clear_dispatched_statuses()
+
+        yield self.fake_smsc2.disconnect()
+        [msg] = yield self.tx_helper.wait_for_dispatched_statuses()
+        self.assertEqual(msg['status'], 'degraded')
+        self.assertEqual(msg['type'], 'connection_lost')
+
+        # Rebinding while the other bind is still bound isn't a status
+        # change.
+        self.tx_helper.clear_dispatched_statuses()
+        self.clock.advance(service2.delay)
+        yield self.fake_smsc2.await_connected()
+        self.assertEqual(self.tx_helper.get_dispatched_statuses(), [])
+        yield self.fake_smsc2.disconnect()
+
+        self.tx_helper.clear_dispatched_statuses()
+        yield self.fake_smsc.disconnect()
+        [msg] = yield self.tx_helper.wait_for_dispatched_statuses()
+        self.assertEqual(msg['status'], 'down')
+        self.assertEqual(msg['type'], 'connection_lost')
+
+    @inlineCallbacks
+    def test_multi_bind_throttling_status(self):
+        """
+        Throttling is only published once all binds are throttled, and its
+        end only once the transport is no longer throttled.
+        """
+        transport = yield self.get_multi_bind_transport(
+            {'mt_tps': 1, 'publish_status': True})
+        self.tx_helper.clear_dispatched_statuses()
+
+        yield self.tx_helper.make_dispatch_outbound('hello 1')
+        yield wait0()
+        self.assertEqual(self.tx_helper.get_dispatched_statuses(), [])
+
+        yield self.tx_helper.make_dispatch_outbound('hello 2')
+        self.tx_helper.make_dispatch_outbound('hello 3')
+        yield self.fake_smsc.await_pdu()
+        yield self.fake_smsc2.await_pdu()
+        self.assertTrue(transport.throttled)
+        # We can't wait here because that requires throttling to end, but we
+        # need to give the throttled status a chance to be published.
+        yield wait0()
+        [msg] = self.tx_helper.get_dispatched_statuses()
+        self.assertEqual(msg['status'], 'degraded')
+        self.assertEqual(msg['type'], 'throttled')
+
+        self.tx_helper.clear_dispatched_statuses()
+        self.clock.advance(1)
+        self.assertFalse(transport.throttled)
+        [msg] = yield self.tx_helper.wait_for_dispatched_statuses()
+        self.assertEqual(msg['status'], 'ok')
+        self.assertEqual(msg['type'], 'throttled_end')
+        self.assertEqual(len(self.tx_helper.get_dispatched_statuses()), 1)
+
 
 class SmppTransmitterTransportTestCase(SmppTransceiverTransportTestCase):
     transport_class = SmppTransmitterTransport
@@ -6,6 +6,7 @@ import sys
 import base64
 import pkg_resources
 import warnings
+from collections import OrderedDict
 from functools import wraps
 
 from zope.interface import implements
@@ -504,3 +505,81 @@ class StatusEdgeDetector(object):
             self._add_type(component, type_)
             return True
         return False
+
+
+class LRUCache(object):
+    """
+    A small in-process least-recently-used cache with optional expiry.
+
+    :param int max_size:
+        The maximum number of entries to keep. If this is ``0``, the cache
+        is disabled and nothing is stored.
+    :param float ttl:
+        The number of seconds an entry is valid for, or ``None`` for
+        entries that never expire.
+    :param clock:
+        An object with a ``seconds()`` method. Defaults to the reactor.
+
+    The :attr:`hits` and :attr:`misses` attributes count lookups.
+    """
+
+    def __init__(self, max_size, ttl=None, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, key):
+        """
+        Look up ``key``.
+
+        :returns:
+            A ``(found, value)`` tuple. ``found`` is ``False`` if there is no
+            current entry for ``key``, in which case ``value`` is ``None``.
+        """
+        if not self.max_size:
+            return False, None
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            expiry, value = entry
+            if expiry is None or expiry > self.clock.seconds():
+                # Put the entry back at the most recently used end.
+                self._entries[key] = entry
+                self.hits += 1
+                return True, value
+        self.misses += 1
+        return False, None
+
+    def set(self, key, value):
+        """
+        Store ``value`` for ``key``, evicting the least recently used entry
+        if the cache is full.
+        """
+        if not self.max_size:
+            return
+        expiry = None
+        if self.ttl is not None:
+            expiry = self.clock.seconds() + self.ttl
+        self._entries.pop(key, None)
+        self._entries[key] = (expiry, value)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """
+        Remove the entry for ``key``, if there is one.
+        """
+        self._entries.pop(key, None)
+
+    def clear(self):
+        """
+        Remove all entries.
+        """
+        self._entries.clear()
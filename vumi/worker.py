@@ -5,6 +5,7 @@
 import time
 import os
 import socket
+from collections import OrderedDict
 
 from twisted.internet.defer import (
     inlineCallbacks, succeed, maybeDeferred, gatherResults)
@@ -15,7 +16,7 @@ from vumi.middleware import setup_middlewares_from_config
 from vumi.connectors import (
     ReceiveInboundConnector, ReceiveOutboundConnector,
     PublishStatusConnector, ReceiveStatusConnector)
-from vumi.config import Config, ConfigInt
+from vumi.config import Config, ConfigInt, ConfigBool
 from vumi.errors import DuplicateConnectorError
 from vumi.utils import generate_worker_id
 from vumi.blinkenlights.heartbeat import (HeartBeatPublisher,
@@ -36,6 +37,36 @@ class BaseConfig(Config):
         "The number of messages fetched concurrently from each AMQP queue"
         " by each worker instance.",
         default=20, static=True)
+    amqp_max_in_flight = ConfigInt(
+        "The maximum number of messages from each AMQP queue that each worker"
+        " instance processes concurrently. If unset, messages are processed"
+        " one at a time. This should not be larger than"
+        " `amqp_prefetch_count`.",
+        static=True)
+    amqp_publish_confirm_window = ConfigInt(
+        "If set, published messages are only considered sent once the AMQP"
+        " broker has accepted them, and no more than this many messages may"
+        " be waiting for the broker at once. This provides backpressure for"
+        " workers that publish large volumes of messages.",
+        static=True)
+    lazy_message_decoding = ConfigBool(
+        "If set, consumed messages are only decoded when their contents are"
+        " accessed and unmodified messages are republished without being"
+        " re-encoded. This is useful for workers, such as dispatchers, that"
+        " only look at a few routing fields.",
+        default=False, static=True)
+
+    def post_validate(self):
+        max_in_flight = self.amqp_max_in_flight
+        if max_in_flight is not None and max_in_flight < 1:
+            self.raise_config_error(
+                "amqp_max_in_flight must be at least 1 if set, not %r."
+                % (max_in_flight,))
+        confirm_window = self.amqp_publish_confirm_window
+        if confirm_window is not None and confirm_window < 1:
+            self.raise_config_error(
+                "amqp_publish_confirm_window must be at least 1 if set,"
+                " not %r." % (confirm_window,))
 
 
 class BaseWorker(Worker):
@@ -48,11 +79,16 @@ class BaseWorker(Worker):
 
     CONFIG_CLASS = BaseConfig
 
+    # The maximum number of per-message config objects kept by
+    # get_cached_config().
+    CONFIG_CACHE_SIZE = 100
+
     def __init__(self, options, config=None):
         super(BaseWorker, self).__init__(options, config=config)
         self.connectors = {}
         self.middlewares = []
         self._static_config = self.CONFIG_CLASS(self.config, static=True)
+        self._config_cache = OrderedDict()
         self._hb_pub = None
         self._worker_id = None
         self.log = WrappingLogger(system=self.config.get('worker_name'))
@@ -158,8 +194,51 @@ class BaseWorker(Worker):
         It deliberately returns a deferred even when this isn't strictly
         necessary to ensure that workers will continue to work when per-message
         configuration needs to be fetched from elsewhere.
+
+        The config object is built once and reused for every message. If
+        `self.config` is replaced, :meth:`invalidate_config_cache` must be
+        called.
+        """
+        return succeed(self.get_cached_config(None, lambda: self.config))
+
+    def get_cached_config(self, key, get_config_data):
+        """Return a (possibly cached) config object for `key`.
+
+        :param key:
+            A hashable value identifying the message specific parts of the
+            config data, or ``None`` if there are none.
+        :param get_config_data:
+            A function returning the config data for `key`. It is only called
+            if there is no cached config object for `key`.
+
+        If there is nothing message specific about the config data and
+        `CONFIG_CLASS` has only static fields, the static config object is
+        returned. At most `CONFIG_CACHE_SIZE` config objects are kept, with
+        the least recently used ones discarded first.
         """
-        return succeed(self.CONFIG_CLASS(self.config))
+        cache = self._config_cache
+        config = cache.pop(key, None)
+        if config is None:
+            if key is None and self._has_only_static_fields():
+                config = self._static_config
+            else:
+                config = self.CONFIG_CLASS(get_config_data())
+            while len(cache) >= self.CONFIG_CACHE_SIZE:
+                cache.popitem(last=False)
+        cache[key] = config
+        return config
+
+    def _has_only_static_fields(self):
+        return all(field.static for field in self.CONFIG_CLASS._get_fields())
+
+    def invalidate_config_cache(self):
+        """Discard all cached config objects.
+
+        This must be called when the worker's config data changes so that
+        :meth:`get_static_config` and :meth:`get_config` reflect the change.
+        """
+        self._static_config = self.CONFIG_CLASS(self.config, static=True)
+        self._config_cache.clear()
 
     def _validate_config(self):
         """Once subclasses call `super().validate_config` properly,
@@ -183,12 +262,16 @@ class BaseWorker(Worker):
         if connector_name in self.connectors:
             raise DuplicateConnectorError("Attempt to add duplicate connector"
                                           " with name %r" % (connector_name,))
-        prefetch_count = self.get_static_config().amqp_prefetch_count
+        static_config = self.get_static_config()
         middlewares = self.middlewares if middleware else None
 
-        connector = connector_cls(self, connector_name,
-                                  prefetch_count=prefetch_count,
-                                  middlewares=middlewares)
+        connector = connector_cls(
+            self, connector_name,
+            prefetch_count=static_config.amqp_prefetch_count,
+            max_in_flight=static_config.amqp_max_in_flight,
+            publish_confirm_window=static_config.amqp_publish_confirm_window,
+            lazy_decode=static_config.lazy_message_decoding,
+            middlewares=middlewares)
         self.connectors[connector_name] = connector
 
         d = connector.setup()